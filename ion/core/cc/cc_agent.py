@@ -16,10 +16,12 @@ log = ion.util.ionlog.getLogger(__name__)
 from ion.agents.resource_agent import ResourceAgent
 from ion.core import ionconst, ioninit
 from ion.core.ioninit import ion_config
+from ion.core.id import Id
 from ion.core.cc.container import Container
 from ion.core.messaging.receiver import Receiver, FanoutReceiver
 from ion.core.pack import app_supervisor
 from ion.core.process.process import Process, ProcessFactory, ProcessDesc
+from ion.core.process import process_metrics
 import ion.util.procutils as pu
 from ion.services.coi.exchange.agent_client import ExchangeManagementClient
 
@@ -173,6 +175,15 @@ class CCAgent(ResourceAgent):
         res = {}
         yield self.reply_ok(msg, res)
 
+    def op_get_metrics(self, content, headers, msg):
+        """
+        Service operation: replies with the metrics of all processes in the
+        container, by process id, and their totals by operation
+        """
+        res = process_metrics.get_metrics_registry().snapshot()
+        res['container-id'] = Id.default_container_id
+        return self.reply_ok(msg, res)
+
 # Spawn of the process using the module name
 factory = ProcessFactory(CCAgent)
 
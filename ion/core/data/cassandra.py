@@ -11,7 +11,9 @@
 @note Test cases for the cassandra backend are now in ion.data.test.test_store
 """
 
-from twisted.internet import defer
+import time
+
+from twisted.internet import defer, reactor, task
 
 from zope.interface import implements
 
@@ -22,11 +24,13 @@ from telephus.cassandra.ttypes import ColumnDef, IndexExpression, IndexOperator
 
 from ion.core.data import store
 
-from ion.util.tcp_connections import TCPConnection
+from ion.util.state_object import BasicLifecycleObject
 
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
 
+from ion.core import ioninit
+
 # Moving to not use CONF. In the store service module, spawn args can be
 # used to pass appropriate configuration parameters.
 #CONF = ioninit.config(__name__)
@@ -36,6 +40,18 @@ log = ion.util.ionlog.getLogger(__name__)
 #CF_default_namespace = CONF['default_namespace']
 #CF_default_key = CONF['default_key']
 
+# The connection pool is shared by the whole container, so its limits are
+# container configuration rather than spawn args.
+CONF = ioninit.config(__name__)
+# Maximum number of connections to one host and keyspace
+CF_pool_size = CONF.getValue('pool_size', 4)
+# Maximum number of requests queued on one connection
+CF_max_in_flight = CONF.getValue('max_in_flight', 8)
+# Seconds a connection may be idle before it is closed
+CF_idle_timeout = CONF.getValue('idle_timeout', 60)
+# Seconds between idle reaping and health checks
+CF_check_interval = CONF.getValue('check_interval', 30)
+
 
 class CassandraError(Exception):
     """
@@ -43,13 +59,225 @@ class CassandraError(Exception):
     """
 
 
-class CassandraStore(TCPConnection):
+class CassandraConnection(object):
+    """
+    One TCP connection in a connection pool. Telephus sends the requests of a
+    connection one at a time, so in_flight counts the requests queued on it.
+    """
+    def __init__(self, host, port, keyspace, credentials):
+        self.factory = ManagedCassandraClientFactory(keyspace=keyspace, credentials=credentials)
+        self.client = CassandraClient(self.factory)
+        self.connector = reactor.connectTCP(host, port, self.factory)
+        self.in_flight = 0
+        self.last_used = time.time()
+        
+    def close(self):
+        self.factory.shutdown()
+
+
+class CassandraConnectionPool(object):
+    """
+    @brief A pool of connections to one Cassandra host and keyspace which is
+    shared by all the stores in the container. Each request runs on the least
+    busy connection. New connections are opened up to size, each connection
+    takes at most max_in_flight requests and when the pool is full callers
+    wait for a connection to free up. Connections idle for longer than
+    idle_timeout are closed, except for one which is kept open and health
+    checked.
+    
+    Use get_connection_pool to get the shared pool - acquire it while it is in
+    use and release it when done. The last release closes its connections;
+    they are opened again if the pool is acquired again.
+    """
+    
+    def __init__(self, host, port, keyspace=None, credentials=None, size=None,
+                 max_in_flight=None, idle_timeout=None, check_interval=None):
+        self.host = host
+        self.port = port
+        self.keyspace = keyspace
+        self.credentials = credentials
+        
+        self.size = size or CF_pool_size
+        self.max_in_flight = max_in_flight or CF_max_in_flight
+        self.idle_timeout = idle_timeout or CF_idle_timeout
+        self.check_interval = check_interval or CF_check_interval
+        
+        self._connections = []
+        self._waiting = []
+        self._refs = 0
+        self._checker = None
+        
+    def acquire(self):
+        """
+        Register a user of the pool and start the idle reaping and health checks
+        """
+        self._refs += 1
+        if self._checker is None:
+            self._checker = task.LoopingCall(self.check)
+            self._checker.start(self.check_interval, now=False)
+            
+    def release(self):
+        """
+        Unregister a user of the pool - the last one to leave closes it
+        """
+        self._refs -= 1
+        if self._refs <= 0:
+            self.close()
+            
+    def close(self):
+        if self._checker is not None and self._checker.running:
+            self._checker.stop()
+        self._checker = None
+        
+        for conn in self._connections:
+            conn.close()
+        self._connections = []
+        
+        waiting = self._waiting
+        self._waiting = []
+        for d in waiting:
+            d.errback(CassandraError('The connection pool was closed'))
+        
+    def stats(self):
+        return {'connections':len(self._connections),
+                'in_flight':sum([conn.in_flight for conn in self._connections]),
+                'waiting':len(self._waiting)}
+        
+    def _open(self):
+        log.info('Opening connection %d to cassandra at %s:%s keyspace %s' % \
+                 (len(self._connections)+1, self.host, self.port, self.keyspace))
+        conn = CassandraConnection(self.host, self.port, self.keyspace, self.credentials)
+        self._connections.append(conn)
+        return conn
+        
+    def _get_connection(self):
+        """
+        Return a deferred which fires with a connection that has room for a request
+        """
+        best = None
+        for conn in self._connections:
+            if conn.in_flight < self.max_in_flight and \
+                    (best is None or conn.in_flight < best.in_flight):
+                best = conn
+                
+        if best is not None and best.in_flight == 0:
+            return defer.succeed(best)
+        
+        if len(self._connections) < self.size:
+            return defer.succeed(self._open())
+        
+        if best is not None:
+            return defer.succeed(best)
+        
+        # Everything is busy - wait for a request to finish
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+        
+    def _done(self, conn):
+        conn.in_flight -= 1
+        conn.last_used = time.time()
+        if not self._waiting:
+            return
+        
+        if conn in self._connections:
+            self._waiting.pop(0).callback(conn)
+        elif len(self._connections) < self.size:
+            # The connection was closed - replace it
+            self._waiting.pop(0).callback(self._open())
+        
+    @defer.inlineCallbacks
+    def call(self, method, *args, **kwargs):
+        """
+        Run a CassandraClient method on a pooled connection
+        """
+        conn = yield self._get_connection()
+        conn.in_flight += 1
+        try:
+            result = yield getattr(conn.client, method)(*args, **kwargs)
+        finally:
+            self._done(conn)
+        defer.returnValue(result)
+        
+    def check(self):
+        """
+        Close the connections which have been idle too long and health check
+        the one that is kept open. A connection which fails its health check is
+        closed - a new one is opened when it is needed.
+        """
+        now = time.time()
+        keep = None
+        for conn in self._connections[:]:
+            if conn.in_flight > 0:
+                continue
+            
+            if keep is None:
+                keep = conn
+                continue
+            
+            if now - conn.last_used > self.idle_timeout:
+                log.debug('Closing idle cassandra connection')
+                self._connections.remove(conn)
+                conn.close()
+                
+        if keep is not None:
+            return self._health_check(keep)
+        
+    @defer.inlineCallbacks
+    def _health_check(self, conn):
+        conn.in_flight += 1
+        try:
+            yield conn.client.describe_version()
+        except Exception, ex:
+            log.warn('Cassandra connection failed its health check: %s' % str(ex))
+            if conn in self._connections:
+                self._connections.remove(conn)
+            conn.close()
+        self._done(conn)
+
+
+class PooledCassandraClient(object):
+    """
+    Provides the telephus CassandraClient methods - each call runs on a
+    connection from the pool.
+    """
+    def __init__(self, pool):
+        self._pool = pool
+        
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        
+        def pooled_call(*args, **kwargs):
+            return self._pool.call(name, *args, **kwargs)
+        return pooled_call
+
+
+_pools = {}
+
+def get_connection_pool(host, port, keyspace=None, credentials=None, **kwargs):
+    """
+    @brief Get the container wide connection pool for a host and keyspace
+    @param kwargs are passed to the CassandraConnectionPool if it is created
+    """
+    cred_key = None
+    if credentials:
+        cred_key = tuple(sorted(credentials.items()))
+    key = (host, port, keyspace, cred_key)
+    
+    pool = _pools.get(key)
+    if pool is None:
+        pool = CassandraConnectionPool(host, port, keyspace, credentials, **kwargs)
+        _pools[key] = pool
+    return pool
+
+
+class CassandraStore(BasicLifecycleObject):
     """
     An Adapter class that implements the IStore interface by way of a
-    cassandra client connection. As an adapter, this assumes an active
-    client (it implements/provides no means of connection management).
-    The same client instance could be used by another adapter class that
-    implements another interface.
+    cassandra client connection. The client runs its requests on the container
+    wide connection pool for the host and keyspace, which is shared with the
+    other stores. The store holds the pool while it is active.
     
     @note: This is how we map the OOI architecture terms to Cassandra.  
     persistent_technology --> hostname, port
@@ -83,13 +311,12 @@ class CassandraStore(TCPConnection):
         pword = credentials.password
         authorization_dictionary = {'username': uname, 'password': pword}
         
-        ### Create the twisted factory for the TCP connection  
-        self._manager = ManagedCassandraClientFactory(keyspace=self._keyspace, credentials=authorization_dictionary)
-        #self._manager = ManagedCassandraClientFactory(credentials=authorization_dictionary)
+        BasicLifecycleObject.__init__(self)
         
-        # Call the initialization of the Managed TCP connection base class
-        TCPConnection.__init__(self,host, port, self._manager)
-        self.client = CassandraClient(self._manager)    
+        ### Share the connections to this keyspace with the other stores
+        self._pool = get_connection_pool(host, port, self._keyspace, authorization_dictionary)
+        self._pool_acquired = False
+        self.client = PooledCassandraClient(self._pool)
         
         
         ### Get the column family name from the Cache resource
@@ -138,16 +365,70 @@ class CassandraStore(TCPConnection):
         @note Deletes are lazy, so key may still be visible for some time.
         """
         yield self.client.remove(key, self._cache_name)
+        
+    @defer.inlineCallbacks
+    def multi_get(self, keys):
+        """
+        @brief Return the values for a list of keys in one request
+        @param keys list of keys
+        @retval Deferred that fires with a dictionary of the keys which were found
+        """
+        keys = list(keys)
+        log.debug("CassandraStore: Calling multi_get on %d keys" % len(keys))
+        result = {}
+        if not keys:
+            defer.returnValue(result)
+            
+        rows = yield self.client.multiget_slice(keys, self._cache_name)
+        for key, columns in rows.items():
+            for column in columns:
+                if column.column.name == 'value':
+                    result[key] = column.column.value
+                    break
+        defer.returnValue(result)
+        
+    @defer.inlineCallbacks
+    def batch_put(self, items):
+        """
+        @brief Write a dictionary of key/value pairs into cassandra in one request
+        @param items dictionary of key:value pairs
+        @retval Deferred for success
+        """
+        log.debug("CassandraStore: Calling batch_put on %d keys" % len(items))
+        if not items:
+            return
+            
+        mutations = {}
+        for key, value in items.items():
+            mutations[key] = {self._cache_name:{'value':value}}
+        yield self.client.batch_mutate(mutations)
+    
+    def on_initialize(self, *args, **kwargs):
+        log.info('on_initialize')
+        
+    def on_activate(self, *args, **kwargs):
+        if not self._pool_acquired:
+            self._pool.acquire()
+            self._pool_acquired = True
+        log.info('on_activate: Using the cassandra connection pool')
+        
+    def _release_pool(self):
+        if self._pool_acquired:
+            self._pool_acquired = False
+            self._pool.release()
     
     def on_deactivate(self, *args, **kwargs):
-        self._manager.shutdown()
-        log.info('on_deactivate: Lose TCP Connection')
+        self._release_pool()
+        log.info('on_deactivate: Released the cassandra connection pool')
 
     def on_terminate(self, *args, **kwargs):
         log.info("Called CassandraStore.on_terminate")
         
-        self._manager.shutdown()
-        log.info('on_terminate: Lose TCP Connection')
+        self._release_pool()
+        log.info('on_terminate: Released the cassandra connection pool')
+        
+    def on_error(self, *args, **kwargs):
+        log.info('on_error')
      
 
 class CassandraIndexedStore(CassandraStore):
@@ -172,6 +453,22 @@ class CassandraIndexedStore(CassandraStore):
         index_attributes['value'] = value
         yield self.client.batch_insert(key, self._cache_name, index_attributes)
         
+    @defer.inlineCallbacks
+    def batch_put(self, items, index_attributes={}):
+        """
+        Write many rows with their index attributes in one batch_mutate
+        """
+        log.debug("CassandraIndexedStore: Calling batch_put on %d keys" % len(items))
+        if not items:
+            return
+            
+        mutations = {}
+        for key, value in items.items():
+            columns = dict(index_attributes.get(key, {}))
+            columns['value'] = value
+            mutations[key] = {self._cache_name:columns}
+        yield self.client.batch_mutate(mutations)
+        
     @defer.inlineCallbacks    
     def query(self, indexed_attributes={}):
         """
@@ -252,7 +549,7 @@ class CassandraStorageResource:
         return authorization_dictionary
     
 
-class CassandraDataManager(TCPConnection):
+class CassandraDataManager(BasicLifecycleObject):
 
     #implements(store.IDataManager)
 
@@ -260,14 +557,20 @@ class CassandraDataManager(TCPConnection):
         """
         @param storage_resource provides the connection information to connect to the Cassandra cluster.
         """
+        BasicLifecycleObject.__init__(self)
         host = storage_resource.get_host()
         port = storage_resource.get_port()
         authorization_dictionary = storage_resource.get_credentials()
         log.info("host: %s and port: %s" % (host,str(port)))
-        self._manager = ManagedCassandraClientFactory(credentials=authorization_dictionary)
         
-        TCPConnection.__init__(self,host,port,self._manager)
-        self.client = CassandraClient(self._manager)    
+        # The manager calls set_keyspace before changing a keyspace, so its
+        # requests must all go over the same connection - a pool of one of
+        # its own. The lock keeps each set_keyspace together with the request
+        # which depends on it.
+        self._pool = CassandraConnectionPool(host, port, None, authorization_dictionary, size=1)
+        self._pool_acquired = False
+        self._keyspace_lock = defer.DeferredLock()
+        self.client = PooledCassandraClient(self._pool)
         
         
     @defer.inlineCallbacks
@@ -315,9 +618,8 @@ class CassandraDataManager(TCPConnection):
         @param persistent_archive is a persistent archive object which defines the properties of an existing Key Space
         @param cache is a cache object which defines the properties of column family
         """
-        yield self.client.set_keyspace(persistent_archive.name)
         cfdef = CfDef(keyspace=persistent_archive.name, name=cache.name)
-        yield self.client.system_add_column_family(cfdef)
+        yield self._keyspace_call(persistent_archive.name, 'system_add_column_family', cfdef)
     
     @defer.inlineCallbacks
     def remove_cache(self, persistent_archive, cache):
@@ -326,8 +628,7 @@ class CassandraDataManager(TCPConnection):
         @param persistent_archive is a persistent archive object which defines the properties of an existing Key Space
         @param cache is a cache object which defines the properties of column family
         """
-        yield self.client.set_keyspace(persistent_archive.name)
-        yield self.client.system_drop_column_family(cache.name)
+        yield self._keyspace_call(persistent_archive.name, 'system_drop_column_family', cache.name)
 
     @defer.inlineCallbacks
     def update_cache(self, persistent_archive, cache):
@@ -339,7 +640,6 @@ class CassandraDataManager(TCPConnection):
         @note This update operation handles only one column_metadata gpb object. It needs to be generalized to work
         with more than one. 
         """
-        yield self.client.set_keyspace(persistent_archive.name)
         desc = yield self.client.describe_keyspace(persistent_archive.name)
         log.info("Describe keyspace return %s" % (desc,))
         #Retrieve the correct column family by filtering by name
@@ -361,7 +661,22 @@ class CassandraDataManager(TCPConnection):
                        column_type=cache.column_type,
                        comparator_type=cache.comparator_type,
                        column_metadata= cf_column_metadata)         
-        yield self.client.system_update_column_family(cf_def) 
+        yield self._keyspace_call(persistent_archive.name, 'system_update_column_family', cf_def)
+        
+    @defer.inlineCallbacks
+    def _keyspace_call(self, keyspace, method, *args):
+        """
+        @brief internal method which calls set_keyspace and then the client
+        method, holding the lock so no other request changes the keyspace
+        in between
+        """
+        yield self._keyspace_lock.acquire()
+        try:
+            yield self.client.set_keyspace(keyspace)
+            result = yield getattr(self.client, method)(*args)
+        finally:
+            self._keyspace_lock.release()
+        defer.returnValue(result)
     
     @defer.inlineCallbacks    
     def _describe_keyspace(self, keyspace):
@@ -401,13 +716,30 @@ class CassandraDataManager(TCPConnection):
         return cdefs
         
         
+    def on_initialize(self, *args, **kwargs):
+        log.info('on_initialize')
+        
+    def on_activate(self, *args, **kwargs):
+        if not self._pool_acquired:
+            self._pool.acquire()
+            self._pool_acquired = True
+        log.info('on_activate: Using the cassandra connection pool')
+        
+    def _release_pool(self):
+        if self._pool_acquired:
+            self._pool_acquired = False
+            self._pool.release()
+        
     def on_deactivate(self, *args, **kwargs):
-        self._manager.shutdown()
-        log.info('on_deactivate: Lose Connection TCP')
+        self._release_pool()
+        log.info('on_deactivate: Released the cassandra connection pool')
 
     def on_terminate(self, *args, **kwargs):
-        self._manager.shutdown()
-        log.info('on_terminate: Lose Connection TCP')
+        self._release_pool()
+        log.info('on_terminate: Released the cassandra connection pool')
+        
+    def on_error(self, *args, **kwargs):
+        log.info('on_error')
 
 
 ### Currently not used...
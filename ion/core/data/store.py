@@ -51,6 +51,19 @@ class IStore(Interface):
         @retval Deferred, for success of this operation
      
         """
+        
+    def multi_get(keys):
+        """
+        @param keys  a list of immutable keys
+        @retval Deferred, for a dictionary of the values associated with the
+                keys. Keys which do not exist are left out.
+        """
+        
+    def batch_put(items):
+        """
+        @param items  a dictionary of key:value pairs to write together
+        @retval Deferred, for success of this operation
+        """
 
 class Store(object):
     """
@@ -83,6 +96,25 @@ class Store(object):
         if self.kvs.has_key(key):
             del self.kvs[key]
         return defer.succeed(None)
+        
+    def multi_get(self, keys):
+        """
+        @see IStore.multi_get
+        """
+        return defer.maybeDeferred(_multi_get, self.kvs, keys)
+        
+    def batch_put(self, items):
+        """
+        @see IStore.batch_put
+        """
+        return defer.maybeDeferred(self.kvs.update, items)
+
+def _multi_get(kvs, keys):
+    result = {}
+    for key in keys:
+        if kvs.has_key(key):
+            result[key] = kvs[key]
+    return result
 
 class IIndexStore(IStore):
     """
@@ -113,6 +145,21 @@ class IIndexStore(IStore):
      
         """
         
+    def multi_get(keys):
+        """
+        @param keys  a list of immutable keys
+        @retval Deferred, for a dictionary of the values associated with the
+                keys. Keys which do not exist are left out.
+        """
+        
+    def batch_put(items, index_attributes={}):
+        """
+        @param items  a dictionary of key:value pairs to write together
+        @param index_attributes  a dictionary of the index attributes for each
+                key in items. Keys which are not in it are not indexed.
+        @retval Deferred, for success of this operation
+        """
+        
     def query(self, indexed_attributes={}):
         """
         Search for rows in the Cassandra instance.
@@ -155,6 +202,11 @@ class IndexStore(object):
         """
         @see IStore.put
         """
+        self._index(key, index_attributes)
+                        
+        return defer.maybeDeferred(self.kvs.update, {key:value})
+        
+    def _index(self, key, index_attributes):
         for k,v in index_attributes.items():
             
             kindex = self.indices.get(k, None)
@@ -163,8 +215,21 @@ class IndexStore(object):
                 self.indices[k] = kindex
             kindex[v]= kindex.get(v, set())
             kindex[v].add(key)
-                        
-        return defer.maybeDeferred(self.kvs.update, {key:value})
+            
+    def multi_get(self, keys):
+        """
+        @see IIndexStore.multi_get
+        """
+        return defer.maybeDeferred(_multi_get, self.kvs, keys)
+        
+    def batch_put(self, items, index_attributes={}):
+        """
+        @see IIndexStore.batch_put
+        """
+        for key in items.keys():
+            self._index(key, index_attributes.get(key, {}))
+            
+        return defer.maybeDeferred(self.kvs.update, items)
 
     def remove(self, key):
         """
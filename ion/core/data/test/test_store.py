@@ -17,6 +17,7 @@
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
 from uuid import uuid4
+import time
 
 from twisted.trial import unittest
 from twisted.internet import defer
@@ -88,6 +89,21 @@ class IStoreTest(unittest.TestCase):
         self.failUnlessEqual(self.value, b)
         yield self.ds.remove(self.key)
 
+    #@itv(CONF)
+    @defer.inlineCallbacks
+    def test_batch_put_multi_get(self):
+        items = {}
+        for i in range(3):
+            items[str(uuid4())] = str(uuid4())
+        yield self.ds.batch_put(items)
+        
+        # Keys which were never written are left out of the result
+        result = yield self.ds.multi_get(items.keys() + [self.key])
+        self.failUnlessEqual(result, items)
+        
+        for key in items.keys():
+            yield self.ds.remove(key)
+
 
 class CassandraStoreTest(IStoreTest):
 
@@ -182,6 +198,21 @@ class IndexStoreTest(IStoreTest):
         log.info("Rows returned %s " % (rows,))
         self.failUnlessEqual(rows['prothfuss'], binary_value2)
          
+    #@itv(CONF)
+    @defer.inlineCallbacks
+    def test_batch_put_query(self):
+        d1 = {'full_name':'Brandon Sanderson', 'birth_date': '1975', 'state':'UT'}
+        d2 = {'full_name':'Patrick Rothfuss', 'birth_date': '1973', 'state':'WI'}     
+        binary_value1 = 'BinaryValue for Brandon Sanderson'
+        binary_value2 = 'BinaryValue for Patrick Rothfuss'
+        yield self.ds.batch_put({'bsanderson':binary_value1, 'prothfuss':binary_value2},
+                                {'bsanderson':d1, 'prothfuss':d2})
+        rows = yield self.ds.query({'state':'WI'})
+        self.failUnlessEqual(rows, {'prothfuss':binary_value2})
+        
+        vals = yield self.ds.multi_get(['bsanderson', 'prothfuss'])
+        self.failUnlessEqual(vals, {'bsanderson':binary_value1, 'prothfuss':binary_value2})
+        
     #@itv(CONF)
     @defer.inlineCallbacks
     def test_put(self):
@@ -274,3 +305,159 @@ class CassandraIndexedStoreTest(IStoreTest):
 
 
 
+
+
+class FakeCassandraClient(object):
+    """
+    Stands in for a telephus client - requests stay pending until the test
+    fires them.
+    """
+    def __init__(self):
+        self.pending = []
+        
+    def get(self, key, *args, **kwargs):
+        d = defer.Deferred()
+        self.pending.append((key, d))
+        return d
+        
+    def describe_version(self):
+        return defer.succeed('19.4.0')
+    
+class FakeCassandraConnection(object):
+    
+    def __init__(self):
+        self.client = FakeCassandraClient()
+        self.in_flight = 0
+        self.last_used = time.time()
+        self.closed = False
+        
+    def close(self):
+        self.closed = True
+        
+class FakeCassandraConnectionPool(cassandra.CassandraConnectionPool):
+    
+    def _open(self):
+        conn = FakeCassandraConnection()
+        self._connections.append(conn)
+        return conn
+    
+
+class CassandraConnectionPoolTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.pool = FakeCassandraConnectionPool('localhost', 9160, 'TestKeyspace',
+                                                size=2, max_in_flight=1, idle_timeout=10)
+        self.client = cassandra.PooledCassandraClient(self.pool)
+        
+    def test_requests_wait_for_a_connection(self):
+        
+        d1 = self.client.get('a')
+        d2 = self.client.get('b')
+        d3 = self.client.get('c')
+        
+        # Two connections with one request each - the third request waits
+        self.assertEqual(self.pool.stats(), {'connections':2, 'in_flight':2, 'waiting':1})
+        
+        conn1, conn2 = self.pool._connections
+        key, d = conn1.client.pending.pop(0)
+        self.assertEqual(key, 'a')
+        d.callback('value a')
+        
+        # The waiting request runs on the connection which finished
+        self.assertEqual(self.pool.stats(), {'connections':2, 'in_flight':2, 'waiting':0})
+        self.assertEqual(conn1.client.pending[0][0], 'c')
+        
+        results = []
+        d1.addCallback(results.append)
+        self.assertEqual(results, ['value a'])
+        
+    def test_idle_connections_are_reaped(self):
+        
+        self.client.get('a')
+        self.client.get('b')
+        conn1, conn2 = self.pool._connections
+        for conn in self.pool._connections:
+            key, d = conn.client.pending.pop(0)
+            d.callback(None)
+            conn.last_used -= 60
+        
+        self.pool.check()
+        
+        # One connection is kept open for the next request
+        self.assertEqual(self.pool._connections, [conn1])
+        self.assertEqual(conn2.closed, True)
+        self.assertEqual(conn1.closed, False)
+        
+    def test_shared_pool(self):
+        pool1 = cassandra.get_connection_pool('localhost', 9160, 'TestKeyspace')
+        pool2 = cassandra.get_connection_pool('localhost', 9160, 'TestKeyspace')
+        pool3 = cassandra.get_connection_pool('localhost', 9160, 'OtherKeyspace')
+        
+        self.assertIdentical(pool1, pool2)
+        self.assertNotIdentical(pool1, pool3)
+        
+        
+class FakeKeyspaceClient(object):
+    """
+    Records the keyspace each schema request runs in - set_keyspace stays
+    pending until the test fires it.
+    """
+    def __init__(self):
+        self.keyspace = None
+        self.pending = []
+        self.dropped = []
+        
+    def set_keyspace(self, keyspace):
+        d = defer.Deferred()
+        def enter(result):
+            self.keyspace = keyspace
+            return result
+        d.addCallback(enter)
+        self.pending.append(d)
+        return d
+        
+    def system_drop_column_family(self, name):
+        self.dropped.append((self.keyspace, name))
+        return defer.succeed(None)
+        
+class FakeName(object):
+    
+    def __init__(self, name):
+        self.name = name
+        
+class FakeHost(object):
+    host = 'localhost'
+    port = 9160
+    
+class FakeTechnology(object):
+    hosts = [FakeHost()]
+    
+
+class CassandraDataManagerKeyspaceTest(unittest.TestCase):
+    
+    def _manager(self):
+        resource = cassandra.CassandraStorageResource(FakeTechnology())
+        resource.get_credentials = lambda: None
+        return cassandra.CassandraDataManager(resource)
+        
+    def test_own_pool(self):
+        manager1 = self._manager()
+        manager2 = self._manager()
+        self.assertNotIdentical(manager1._pool, manager2._pool)
+        
+    def test_keyspace_requests_do_not_interleave(self):
+        manager = self._manager()
+        client = FakeKeyspaceClient()
+        manager.client = client
+        
+        d1 = manager.remove_cache(FakeName('Keyspace1'), FakeName('cf1'))
+        d2 = manager.remove_cache(FakeName('Keyspace2'), FakeName('cf2'))
+        
+        # The second set_keyspace waits for the first drop
+        self.assertEqual(len(client.pending), 1)
+        client.pending.pop(0).callback(None)
+        self.assertEqual(len(client.pending), 1)
+        client.pending.pop(0).callback(None)
+        
+        self.assertEqual(client.dropped, [('Keyspace1', 'cf1'), ('Keyspace2', 'cf2')])
+        return defer.DeferredList([d1, d2])
@@ -25,6 +25,13 @@ class Interceptor(ContainerProcess):
     """
     Interceptor that processes messages as the come along and passes them on.
     """
+    def handler(self, path):
+        """
+        @brief The callable the interceptor system calls with invocations on
+        the given path, or None if the interceptor leaves them unchanged
+        @retval callable returning an invocation or a Deferred, or None
+        """
+        return self.process
 
 class EnvelopeInterceptor(Interceptor):
     """
@@ -45,6 +52,24 @@ class EnvelopeInterceptor(Interceptor):
         else:
             raise ConfigurationError("Illegal EnvelopeInterceptor path: %s" % invocation.path)
 
+    def handler(self, path):
+        """
+        @brief before or after directly, or None if the class does not
+        override the one for the path
+        """
+        if path == Invocation.PATH_IN:
+            method = 'before'
+        elif path == Invocation.PATH_OUT:
+            method = 'after'
+        else:
+            raise ConfigurationError("Illegal EnvelopeInterceptor path: %s" % path)
+        cls = type(self)
+        if cls.process.im_func is not EnvelopeInterceptor.process.im_func:
+            return self.process
+        if getattr(cls, method).im_func is getattr(EnvelopeInterceptor, method).im_func:
+            return None
+        return getattr(self, method)
+
     def before(self, invocation):
         return invocation
     def after(self, invocation):
@@ -52,8 +77,13 @@ class EnvelopeInterceptor(Interceptor):
 
 class PassThroughInterceptor(EnvelopeInterceptor):
     """
-    Interceptor that drops messages.
+    Interceptor that lets messages pass.
     """
+    def handler(self, path):
+        # proceed() only resets the status, and a path only stops on drop or
+        # done, so leaving this out does not change which interceptors run
+        return None
+
     def before(self, invocation):
         invocation.proceed()
         return invocation
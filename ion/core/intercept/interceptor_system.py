@@ -32,6 +32,8 @@ class InterceptorSystem(Interceptor):
 
         self.interceptors = {}
         self.paths = {}
+        # path name -> list of (name, handler), the stages to call
+        self.chains = {}
 
     # Life cycle
 
@@ -66,36 +68,55 @@ class InterceptorSystem(Interceptor):
             # have priorities and alternative routes
 
     # API
-    @defer.inlineCallbacks
     def process(self, invocation):
         """
+        Calls the stages of the invocation's path in turn. Stages that return
+        an invocation are called inline; the chain is only continued from a
+        callback when a stage returns a Deferred.
         @param invocation container object for parameters
-        @retval invocation instance, may be modified
+        @retval Deferred with the invocation instance, may be modified
         """
-        pathname = invocation.path
-        path = self.paths.get(pathname, None)
-        if not path:
-            raise RuntimeError("Path %s unknown" % invocation.path)
-        for path_element in path:
+        chain = self.chains.get(invocation.path, None)
+        if chain is None:
+            return defer.fail(RuntimeError("Path %s unknown" % invocation.path))
+        return self._run_chain(chain, 0, invocation.path, invocation)
+
+    def _run_chain(self, chain, index, pathname, invocation):
+        while index < len(chain):
+            name, handler = chain[index]
+            index += 1
             invocation.path = pathname
-            intc = path_element['interceptor_instance']
-            #log.debug("Process path %s step %s" % (invocation.path, path_element['name']))
             try:
-                invocation = yield defer.maybeDeferred(intc.process, invocation)
+                result = handler(invocation)
             except Exception, ex:
-                log.exception("Error in interceptor path %s step %s" % (
-                    invocation.path, path_element['name']))
+                log.exception("Error in interceptor path %s step %s" % (pathname, name))
                 invocation.error(str(ex))
-                raise ex
+                return defer.fail()
+
+            if isinstance(result, defer.Deferred):
+                result.addCallbacks(self._resume_chain, self._chain_failed,
+                                    callbackArgs=(chain, index, pathname),
+                                    errbackArgs=(name, pathname, invocation))
+                return result
+            invocation = result
 
             # Continuation
             if invocation.status == Invocation.STATUS_DROP:
-                #log.debug("Process path %s step %s: DROP" % (invocation.path, path_element['name']))
                 break
             if invocation.status == Invocation.STATUS_DONE:
-                #log.debug("Process path %s step %s: DONE" % (invocation.path, path_element['name']))
                 break
-        defer.returnValue(invocation)
+        return defer.succeed(invocation)
+
+    def _resume_chain(self, invocation, chain, index, pathname):
+        if invocation.status in (Invocation.STATUS_DROP, Invocation.STATUS_DONE):
+            return invocation
+        return self._run_chain(chain, index, pathname, invocation)
+
+    def _chain_failed(self, reason, name, pathname, invocation):
+        log.error("Error in interceptor path %s step %s: %s" % (
+            pathname, name, reason.getErrorMessage()))
+        invocation.error(reason.getErrorMessage())
+        return reason
 
     # Helpers
 
@@ -119,6 +140,8 @@ class InterceptorSystem(Interceptor):
             in_path = self._reversed_intercept_path(out_path)
             self.paths[Invocation.PATH_OUT] = out_path
             self.paths[Invocation.PATH_IN] = in_path
+            for pathname, path in self.paths.items():
+                self.chains[pathname] = self._compile_path(pathname, path)
 
         if 'paths' in config:
             raise NotImplementedError("Not implemented")
@@ -161,3 +184,15 @@ class InterceptorSystem(Interceptor):
     def _reversed_intercept_path(self, int_path):
         assert type(int_path) is list
         return list(reversed(int_path))
+
+    def _compile_path(self, pathname, path):
+        """
+        @brief The stages of a path that do something with its invocations,
+        with the methods to call for them
+        """
+        chain = []
+        for path_elem in path:
+            handler = path_elem['interceptor_instance'].handler(pathname)
+            if handler is not None:
+                chain.append((path_elem['name'], handler))
+        return chain
@@ -7,20 +7,24 @@
 """
 
 import hashlib
+import hmac
+import os
 try:
     import json
 except:
     import simplejson as json
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from zope.interface import implements, Interface
 
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
 
 from ion.core import ioninit
+from ion.core.id import Id
 from ion.core.intercept import interceptor
 from ion.core.security import authentication
+from ion.core.security.key_manager import get_key_manager
 from ion.util import procutils as pu
 
 
@@ -30,6 +34,40 @@ msg_sign = CONF.getValue('msg_sign', True)
 #XXX HACKS
 _priv_key_path = CONF.getValue('priv_key_path')
 _cert_path = CONF.getValue('cert_path')
+# 'rsa' signs every message with the system key, 'hmac' signs messages to
+# processes of the same container with a key of the container session
+CF_signing_mode = CONF.getValue('signing_mode', 'rsa')
+# Receivers whose incoming messages are verified in batches
+CF_batch_verify_topics = CONF.getValue('batch_verify_topics', [])
+# Messages in a verification batch, and seconds the first one may wait
+CF_batch_size = CONF.getValue('batch_size', 50)
+CF_batch_delay = CONF.getValue('batch_delay', 0.01)
+
+SIGNING_RSA = 'rsa'
+SIGNING_HMAC = 'hmac'
+
+# Signer header of messages signed with the container session key
+SESSION_SIGNER = 'session'
+
+_session_key = None
+
+def session_key():
+    """
+    @retval random key of this container, never sent anywhere
+    """
+    global _session_key
+    if _session_key is None:
+        _session_key = os.urandom(32)
+    return _session_key
+
+def _equal(a, b):
+    # Compares in time independent of where the strings differ
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
 
 
 class DigitalSignatureInterceptor(interceptor.EnvelopeInterceptor):
@@ -80,7 +118,9 @@ class SystemSecurityPlugin(interceptor.EnvelopeInterceptor):
     included in the message headers.
     """
 
-    def __init__(self, name, system_priv_key_path=None, allowed_certs={}):
+    def __init__(self, name, system_priv_key_path=None, allowed_certs={},
+                 signing_mode=CF_signing_mode, batch_verify_topics=CF_batch_verify_topics,
+                 batch_size=CF_batch_size, batch_delay=CF_batch_delay):
         interceptor.EnvelopeInterceptor.__init__(self, name)
         #XXX @todo need to be able to properly configure this interceptor
         #during container startup
@@ -93,12 +133,15 @@ class SystemSecurityPlugin(interceptor.EnvelopeInterceptor):
             allowed_certs['ooi-ion'] = _cert_path #Use cert from CONF
         self.allowed_certs = allowed_certs
         self.auth = authentication.Authentication()
+        self.keys = get_key_manager()
 
-    def _read_key(self, path):
-        f = open(path)
-        key = f.read()
-        f.close()
-        return key
+        self.signing_mode = signing_mode
+        self.batch_verify_topics = set(batch_verify_topics)
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        # (invocation, Deferred) waiting for verification
+        self._batch = []
+        self._batch_call = None
 
     def certs(self, id):
         """
@@ -107,19 +150,23 @@ class SystemSecurityPlugin(interceptor.EnvelopeInterceptor):
         """
         path = self.allowed_certs[id] #XXX Need an error condition for a
                                       #bad id
-        cert = self._read_key(path)
-        return cert
+        return self.keys.pem(path)
 
     @property
     def priv_key(self):
-        key = self._read_key(self._priv_key_path)
-        return key
+        return self.keys.pem(self._priv_key_path)
+
+    def _is_local(self, message):
+        receiver = message.get('receiver', message.get('recipient'))
+        return str(receiver).startswith(Id.default_container_id + '.')
 
     def after(self, invocation):
         """
         Use the system private key to sign the message content.
         Decorate an outgoing message with a digital signature of the
         encoded content. Add signature to the message headers.
+        In hmac mode, messages to processes of this container are signed
+        with the session key instead.
         """
         content = invocation.message['content'] #Hope this is a string!
         try:
@@ -130,8 +177,12 @@ class SystemSecurityPlugin(interceptor.EnvelopeInterceptor):
             # of error.
             invocation.error(note='Error taking hash of content!')
             return invocation
-        priv_key = self.priv_key
-        signature = self.auth.sign_message(hash, priv_key)
+        if self.signing_mode == SIGNING_HMAC and self._is_local(invocation.message):
+            invocation.message['signer'] = SESSION_SIGNER
+            invocation.message['signature'] = hmac.new(session_key(), hash, hashlib.sha1).hexdigest()
+            return invocation
+        priv_key = self.keys.private_key(self._priv_key_path)
+        signature = self.auth.sign_message_with_key(hash, priv_key)
         invocation.message['signer'] = 'ooi-ion' #XXX What should this header be?
         invocation.message['signature'] = signature
         # Do we call invocation.proceed ???
@@ -140,27 +191,69 @@ class SystemSecurityPlugin(interceptor.EnvelopeInterceptor):
     def before(self, invocation):
         """
         If the signature and signer headers are missing, then drop the
-        message. Otherwise, verify the message.
+        message. Otherwise, verify the message. Messages to batch verified
+        topics are verified together, with a Deferred returned.
         """
         message = invocation.message
         #hack check of message spec!
-        if message.has_key('signature') and message.has_key('signer'):
-            content = invocation.message['content'] #this better be there
-            hash = hashlib.sha1(content).hexdigest()
-            signature = invocation.message['signature']
-            signer = invocation.message['signer']
-            cert = self.certs(signer)
-            verifiedQ = self.auth.verify_message(hash, cert, signature)
-            if verifiedQ:
-                # Do we call invocation.proceed ???
-                return invocation
-            else:
-                invocation.drop('Unverified Signature')
-                return invocation
-        else:
+        if not (message.has_key('signature') and message.has_key('signer')):
             invocation.drop('Invalid Message Format')
             return invocation
 
+        if message['signer'] == SESSION_SIGNER:
+            hash = hashlib.sha1(message['content']).hexdigest()
+            expected = hmac.new(session_key(), hash, hashlib.sha1).hexdigest()
+            if not _equal(expected, str(message['signature'])):
+                invocation.drop('Unverified Signature')
+            return invocation
+
+        if message.get('receiver') in self.batch_verify_topics:
+            d = defer.Deferred()
+            self._batch.append((invocation, d))
+            if len(self._batch) >= self.batch_size:
+                self._verify_batch()
+            elif self._batch_call is None:
+                self._batch_call = reactor.callLater(self.batch_delay, self._verify_batch)
+            return d
+
+        if not self._verify(self._signed(message)):
+            invocation.drop('Unverified Signature')
+        return invocation
+
+    def _signed(self, message):
+        hash = hashlib.sha1(message['content']).hexdigest() #this better be there
+        return (message['signer'], hash, message['signature'])
+
+    def _verify(self, signed):
+        signer, hash, signature = signed
+        pubkey = self.keys.public_key(self.allowed_certs[signer])
+        return self.auth.verify_message_with_key(hash, pubkey, signature)
+
+    def _verify_batch(self):
+        """
+        Verifies the waiting messages. A signature delivered several times,
+        as to the subscribers of a topic, is verified once.
+        """
+        if self._batch_call is not None and self._batch_call.active():
+            self._batch_call.cancel()
+        self._batch_call = None
+        batch, self._batch = self._batch, []
+
+        results = {}
+        for invocation, d in batch:
+            try:
+                signed = self._signed(invocation.message)
+                verified = results.get(signed)
+                if verified is None:
+                    verified = results[signed] = self._verify(signed)
+            except Exception, ex:
+                d.errback(ex)
+                continue
+            if not verified:
+                invocation.drop('Unverified Signature')
+            d.callback(invocation)
+        log.debug('Verified %d signatures for %d messages' % (len(results), len(batch)))
+
 
 if not msg_sign:
     del DigitalSignatureInterceptor
@@ -5,7 +5,9 @@
 @author Michael Meisinger
 @brief test interceptor system
 """
-from twisted.internet import defer
+import time
+
+from twisted.internet import defer, reactor
 
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
@@ -13,17 +15,20 @@ log = ion.util.ionlog.getLogger(__name__)
 from ion.core import ioninit
 from ion.core.cc.container import Container
 from ion.core.exception import ConfigurationError
+from ion.core.id import Id
 from ion.core.intercept.interceptor import Interceptor, EnvelopeInterceptor
 from ion.core.intercept.interceptor import PassThroughInterceptor, DropInterceptor
 from ion.core.intercept.interceptor import Invocation
 from ion.core.intercept.interceptor_system import InterceptorSystem
 from ion.test.iontest import IonTestCase
 from ion.util.config import Config
+from ion.util.itv_decorator import itv
 
 # Configuration
 CONF = ioninit.config("ion.core.cc.container")
 is_file = CONF.getValue('interceptor_system')
 is_config = Config(ioninit.adjust_dir(is_file)).getObject()
+ITV_CONF = ioninit.config(__name__)
 
 class InterceptorTest(IonTestCase):
     """
@@ -216,6 +221,97 @@ class InterceptorTest(IonTestCase):
         finally:
             yield self._stop_container()
 
+    @defer.inlineCallbacks
+    def test_compiled_chain(self):
+        is_config1 = {
+            'interceptors':{
+                'pass':{
+                    'classname':'ion.core.intercept.interceptor.PassThroughInterceptor'
+                },
+                'ionmessage':{
+                    'classname':'ion.core.messaging.ionmessage.IONMessageInterceptor'
+                },
+                'test1':{
+                    'classname':'ion.core.intercept.test.test_interceptor.TestInterceptor',
+                },
+                'async':{
+                    'classname':'ion.core.intercept.test.test_interceptor.AsyncTestInterceptor',
+                },
+            },
+            'stack':[
+                {'name':'ionmessage', 'interceptor':'ionmessage' },
+                {'name':'pass1', 'interceptor':'pass' },
+                {'name':'async', 'interceptor':'async' },
+                {'name':'test1', 'interceptor':'test1' },
+            ]
+        }
+        intercept_sys = InterceptorSystem()
+        yield intercept_sys.initialize(is_config1)
+        yield intercept_sys.activate()
+
+        # Pass through stages are left out, and so is the in-path of the
+        # message interceptor, which only builds outgoing messages
+        chains = intercept_sys.chains
+        self.assertEqual([name for name, h in chains[Invocation.PATH_IN]], ['test1', 'async'])
+        self.assertEqual([name for name, h in chains[Invocation.PATH_OUT]], ['ionmessage', 'async', 'test1'])
+
+        # The chain goes on after a stage that returns a Deferred
+        ti1 = intercept_sys.interceptors['test1']
+        ta = intercept_sys.interceptors['async']
+        inv = yield intercept_sys.process(Invocation(path=Invocation.PATH_IN, message="123"))
+        self.assertEqual((ti1.numbefore, ta.numbefore), (1, 1))
+        self.assertEqual(inv.path, Invocation.PATH_IN)
+
+        ta.drop = True
+        msg = {'headers':{}, 'sender':'a', 'recipient':'b', 'operation':'op', 'content':'c'}
+        inv = yield intercept_sys.process(Invocation(path=Invocation.PATH_OUT, message=msg))
+        self.assertEqual(inv.status, Invocation.STATUS_DROP)
+        self.assertEqual((ti1.numafter, ta.numafter), (0, 1))
+        self.assertEqual(inv.message['receiver'], 'b')
+
+        ta.fail = True
+        inv = Invocation(path=Invocation.PATH_IN, message="123")
+        try:
+            yield intercept_sys.process(inv)
+            self.fail("RuntimeError expected")
+        except RuntimeError, re:
+            pass
+        self.assertEqual(inv.status, Invocation.STATUS_ERROR)
+
+    @itv(ITV_CONF)
+    @defer.inlineCallbacks
+    def test_intercept_performance(self):
+        count = 5000
+        intercept_sys = InterceptorSystem()
+        yield intercept_sys.initialize(is_config)
+        yield intercept_sys.activate()
+
+        @defer.inlineCallbacks
+        def generic_process(invocation):
+            # The interceptor loop as it was before the paths were compiled
+            pathname = invocation.path
+            for path_element in intercept_sys.paths[pathname]:
+                invocation.path = pathname
+                intc = path_element['interceptor_instance']
+                invocation = yield defer.maybeDeferred(intc.process, invocation)
+                if invocation.status in (Invocation.STATUS_DROP, Invocation.STATUS_DONE):
+                    break
+            defer.returnValue(invocation)
+
+        def message():
+            return {'headers':{}, 'sender':'a', 'recipient':'b', 'operation':'op', 'content':'c'}
+
+        timings = []
+        for process in (generic_process, intercept_sys.process):
+            tzero = time.time()
+            for i in xrange(count):
+                yield process(Invocation(path=Invocation.PATH_OUT, message=message()))
+                yield process(Invocation(path=Invocation.PATH_IN, message=message(), content='c'))
+            timings.append((time.time() - tzero) / count * 1e6)
+
+        print('Interceptor stack, %d messages out and in: generic %.1f us, compiled %.1f us per message, speedup %.1fx' % \
+            (count, timings[0], timings[1], timings[0] / max(timings[1], 1e-6)))
+
 class TestInterceptor(EnvelopeInterceptor):
     """
     Interceptor to test messages.
@@ -240,6 +336,32 @@ class TestInterceptor(EnvelopeInterceptor):
         return invocation
 
 
+class AsyncTestInterceptor(TestInterceptor):
+    """
+    Interceptor that returns Deferreds, and can drop or fail messages.
+    """
+    drop = False
+    fail = False
+
+    def _later(self, invocation):
+        d = defer.Deferred()
+        if self.fail:
+            reactor.callLater(0, d.errback, RuntimeError('failed'))
+        else:
+            if self.drop:
+                invocation.drop()
+            reactor.callLater(0, d.callback, invocation)
+        return d
+
+    def before(self, invocation):
+        TestInterceptor.before(self, invocation)
+        return self._later(invocation)
+
+    def after(self, invocation):
+        TestInterceptor.after(self, invocation)
+        return self._later(invocation)
+
+
 class TestSignature(IonTestCase):
 
     @defer.inlineCallbacks
@@ -319,9 +441,49 @@ class TestSignature(IonTestCase):
         self.failUnlessEqual(inv_incoming_b.status, 
                 Invocation.STATUS_DROP)
 
+    def _signed_message(self, receiver):
+        plugin = self.intercept_sys.interceptors['signature']
+        msg = {'content':'foo', 'receiver':receiver}
+        return plugin.after(Invocation(path=Invocation.PATH_OUT, message=msg)).message
 
+    @defer.inlineCallbacks
+    def test_hmac_session(self):
+        plugin = self.intercept_sys.interceptors['signature']
+        plugin.signing_mode = 'hmac'
 
+        # Only messages to processes of this container use the session key
+        local = Id('5').full
+        self.failUnlessEqual(self._signed_message(local)['signer'], 'session')
+        self.failUnlessEqual(self._signed_message('elsewhere.5')['signer'], 'ooi-ion')
 
+        inv = yield self.intercept_sys.process(Invocation(path=Invocation.PATH_IN,
+                                                          message=self._signed_message(local)))
+        self.failUnlessEqual(inv.status, Invocation.STATUS_PROCESS)
 
+        message = self._signed_message(local)
+        message['content'] = 'bar'
+        inv = yield self.intercept_sys.process(Invocation(path=Invocation.PATH_IN, message=message))
+        self.failUnlessEqual(inv.status, Invocation.STATUS_DROP)
 
-
+    @defer.inlineCallbacks
+    def test_batch_verify(self):
+        plugin = self.intercept_sys.interceptors['signature']
+        plugin.batch_verify_topics = set(['topic'])
+        verified = []
+        verify = plugin._verify
+        def counting_verify(signed):
+            verified.append(signed)
+            return verify(signed)
+        plugin._verify = counting_verify
+
+        message = self._signed_message('topic')
+        bad = dict(message)
+        bad['content'] = 'bar'
+        ds = [self.intercept_sys.process(Invocation(path=Invocation.PATH_IN, message=dict(m)))
+              for m in (message, message, bad, message)]
+        results = yield defer.gatherResults(ds)
+        self.failUnlessEqual([inv.status for inv in results],
+                             [Invocation.STATUS_PROCESS, Invocation.STATUS_PROCESS,
+                              Invocation.STATUS_DROP, Invocation.STATUS_PROCESS])
+        # One verification for each distinct signed content
+        self.failUnlessEqual(len(verified), 2)
@@ -20,9 +20,6 @@ class IONMessageInterceptor(EnvelopeInterceptor):
     """
     Interceptor that assembles the headers in the ION message format.
     """
-    def before(self, invocation):
-        return invocation
-
     def after(self, invocation):
         message = invocation.message
         headers = message['headers']
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+"""
+@file ion/core/messaging/message_trace.py
+@brief Message tracing. Keeps short summaries of sampled messages in a
+bounded ring, queryable by processes, and optionally appends them to a binary
+trace file (a stream of msgpack maps) for offline analysis. Full message
+dumps are only formatted when a log handler emits them.
+"""
+
+import logging
+import random
+import re
+import time
+
+import msgpack
+
+import ion.util.ionlog
+log = ion.util.ionlog.getLogger(__name__)
+
+from ion.core import ioninit
+CONF = ioninit.config(__name__)
+
+# Fraction of messages traced, and overrides by process name and operation.
+# Off by default - turn it on for the processes or operations of interest.
+CF_sample_rate = CONF.getValue('sample_rate', 0.0)
+CF_process_rates = CONF.getValue('process_rates', {})
+CF_op_rates = CONF.getValue('op_rates', {})
+# Summaries of recent messages kept in memory
+CF_ring_size = CONF.getValue('ring_size', 1000)
+# Binary trace file, None for none
+CF_trace_file = CONF.getValue('trace_file', None)
+
+DIRECTION_IN = 'in'
+DIRECTION_OUT = 'out'
+
+# Message headers copied into a summary
+SUMMARY_HEADERS = ('sender', 'sender-name', 'receiver', 'reply-to', 'op',
+                   'conv-id', 'conv-seq', 'status', 'encoding')
+
+
+class MessageDump(object):
+    """
+    A full dump of a received message, built when it is turned into a str.
+    Pass as an argument to a log call, so messages that no handler emits are
+    never formatted.
+    """
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        msg = self.msg
+        body = msg.payload
+        lstr = ""
+        procname = str(body.get('receiver',None))
+        lstr += "===Message=== receiver=%s op=%s===" % (procname, body.get('op', None))
+        if body.get('quiet', False):
+            lstr += " (Q)"
+            return lstr
+        amqpm = str(msg._amqp_message)
+        # Cut out the redundant or encrypted AMQP body to make log shorter
+        amqpm = re.sub("body='(\\\\'|[^'])*'","*BODY*", amqpm)
+        lstr += '\n---AMQP--- ' + amqpm + "; "
+        for attr in sorted(msg.__dict__.keys()):
+            value = msg.__dict__.get(attr)
+            if attr == '_amqp_message' or attr == 'body' or \
+                    attr == '_decoded_cache' or attr == 'backend':
+                pass
+            else:
+                lstr += "%s=%r, " % (attr, value)
+        lstr += "\n---ION HEADERS--- "
+        mbody = dict(body)
+        content = mbody.pop('content')
+        for attr in sorted(mbody.keys()):
+            value = mbody.get(attr)
+            lstr += "%s=%r, " % (attr, value)
+        lstr += "\n---CONTENT---\n"
+        if type(content) is dict:
+            for attr in sorted(content.keys()):
+                value = content.get(attr)
+                lstr += "%s=%r, " % (attr, value)
+        else:
+            lstr += repr(content)
+        lstr += "\n============="
+        return lstr
+
+
+class MessageTracer(object):
+    """
+    Samples messages into a ring of summaries. A summary is a dict with the
+    SUMMARY_HEADERS present in the message, plus 'ts' (seconds), 'dir' (in
+    or out), 'proc' and 'pid' (name and id of the tracing process) and 'size'
+    (of string content).
+    """
+    def __init__(self, sample_rate=CF_sample_rate, process_rates=CF_process_rates,
+                 op_rates=CF_op_rates, ring_size=CF_ring_size, trace_file=CF_trace_file):
+        self.sample_rate = sample_rate
+        self.process_rates = dict(process_rates)
+        self.op_rates = dict(op_rates)
+        self.ring_size = ring_size
+        self._ring = []
+        self._next = 0
+        self.traced = 0
+        self.skipped = 0
+        self._file = None
+        if trace_file:
+            self.open_trace_file(trace_file)
+
+    def rate(self, proc_name, op):
+        """
+        @retval the sampling rate for messages of an operation to or from a
+        process; the operation's rate takes precedence
+        """
+        rate = self.op_rates.get(op)
+        if rate is None:
+            rate = self.process_rates.get(proc_name, self.sample_rate)
+        return rate
+
+    def trace(self, direction, proc_name, headers, content=None, pid=None, **fields):
+        """
+        Records a summary of a message, if it is sampled
+        @param headers the message payload, or the headers of an outgoing
+        message
+        @param fields summary values not in the headers, such as the op and
+        receiver of an outgoing message
+        @retval the summary, or None if the message was not sampled
+        """
+        op = fields.get('op', headers.get('op'))
+        rate = self.rate(proc_name, op)
+        if rate <= 0 or (rate < 1 and random.random() >= rate):
+            self.skipped += 1
+            return None
+
+        summary = {'ts':time.time(), 'dir':direction, 'proc':proc_name, 'pid':pid}
+        for name in SUMMARY_HEADERS:
+            if name in headers:
+                summary[name] = headers[name]
+        summary.update(fields)
+        if content is None:
+            content = headers.get('content')
+        if isinstance(content, str):
+            summary['size'] = len(content)
+
+        if len(self._ring) < self.ring_size:
+            self._ring.append(summary)
+        else:
+            self._ring[self._next] = summary
+        self._next = (self._next + 1) % self.ring_size
+        self.traced += 1
+
+        if self._file is not None:
+            try:
+                self._file.write(msgpack.packb(summary))
+            except Exception, ex:
+                log.error('Could not write message trace, closing it: %s' % ex)
+                self.close_trace_file()
+        return summary
+
+    def recent(self, count=None, pid=None, op=None):
+        """
+        @retval list of summaries, oldest first, optionally only the last
+        count matching a process id and operation
+        """
+        if len(self._ring) < self.ring_size:
+            ordered = list(self._ring)
+        else:
+            ordered = self._ring[self._next:] + self._ring[:self._next]
+        if pid is not None:
+            ordered = [s for s in ordered if s['pid'] == pid]
+        if op is not None:
+            ordered = [s for s in ordered if s.get('op') == op]
+        if count is not None:
+            ordered = ordered[-count:] if count > 0 else []
+        return ordered
+
+    def clear(self):
+        self._ring = []
+        self._next = 0
+
+    def open_trace_file(self, path):
+        """
+        Appends summaries to a binary trace file from now on
+        """
+        self.close_trace_file()
+        self._file = open(path, 'ab')
+
+    def close_trace_file(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            finally:
+                self._file = None
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+
+def read_trace_file(path):
+    """
+    @retval iterator over the summaries in a binary trace file
+    """
+    f = open(path, 'rb')
+    try:
+        unpacker = msgpack.Unpacker()
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            unpacker.feed(data)
+            for summary in unpacker:
+                yield summary
+    finally:
+        f.close()
+
+
+def log_message(msg, logger=log):
+    """
+    Logs a full dump of a received message at debug level, formatted only if
+    a handler emits it
+    @param msg carrot BaseMessage instance
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%s', MessageDump(msg))
+
+
+_tracer = None
+
+def get_tracer():
+    """
+    @retval the MessageTracer of the container
+    """
+    global _tracer
+    if _tracer is None:
+        _tracer = MessageTracer()
+    return _tracer
@@ -232,7 +232,7 @@ class Receiver(BasicLifecycleObject):
         except Exception, ex:
             log.exception("Send error")
         else:
-            log.info("Message sent! to=%s op=%s" % (msg.get('receiver',None), msg.get('op',None)))
+            log.info("Message sent! to=%s op=%s", msg.get('receiver',None), msg.get('op',None))
             #log.debug("msg"+str(msg))
 
     def __str__(self):
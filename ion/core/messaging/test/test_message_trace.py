@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+@file ion/core/messaging/test/test_message_trace.py
+@test ion.core.messaging.message_trace Sampling, ring and trace file
+"""
+
+import logging
+import os
+import tempfile
+
+from twisted.trial import unittest
+
+from ion.core.messaging import message_trace
+from ion.core.messaging.message_trace import MessageTracer, DIRECTION_IN, DIRECTION_OUT
+
+
+class FakeMessage(object):
+    def __init__(self):
+        self.formatted = 0
+        self._amqp_message = 'amqp'
+
+    @property
+    def payload(self):
+        self.formatted += 1
+        return {'receiver':'r', 'op':'ping', 'content':'x'}
+
+
+class MessageTracerTest(unittest.TestCase):
+
+    def _headers(self, i, op='ping'):
+        return {'sender':'s', 'receiver':'r', 'op':op, 'conv-id':'#%d' % i, 'content':'abc'}
+
+    def test_ring(self):
+        tracer = MessageTracer(sample_rate=1.0, ring_size=3, trace_file=None)
+        for i in range(5):
+            tracer.trace(DIRECTION_IN, 'proc', self._headers(i), pid='p.1')
+        tracer.trace(DIRECTION_OUT, 'other', {'conv-id':'#9'}, 'xy', pid='p.2', op='pong', receiver='s')
+
+        recent = tracer.recent()
+        self.assertEqual([s['conv-id'] for s in recent], ['#3', '#4', '#9'])
+        self.assertEqual(recent[0]['size'], 3)
+        self.assertEqual(recent[2]['op'], 'pong')
+        self.assertEqual(recent[2]['receiver'], 's')
+        self.assertEqual([s['conv-id'] for s in tracer.recent(pid='p.1')], ['#3', '#4'])
+        self.assertEqual([s['conv-id'] for s in tracer.recent(count=1, pid='p.1')], ['#4'])
+        self.assertEqual(tracer.recent(op='missing'), [])
+
+    def test_sampling(self):
+        tracer = MessageTracer(sample_rate=0.0, process_rates={'busy':0.5, 'quiet':1.0},
+                               op_rates={'heartbeat':0.0}, trace_file=None)
+        self.assertEqual(tracer.trace(DIRECTION_IN, 'proc', self._headers(1)), None)
+        self.assertNotEqual(tracer.trace(DIRECTION_IN, 'quiet', self._headers(1)), None)
+        self.assertEqual(tracer.trace(DIRECTION_IN, 'quiet', self._headers(1, 'heartbeat')), None)
+
+        for i in range(1000):
+            tracer.trace(DIRECTION_IN, 'busy', self._headers(i))
+        self.assertTrue(300 < len(tracer.recent(op='ping')) - 1 < 700)
+
+    def test_trace_file(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            tracer = MessageTracer(sample_rate=1.0, ring_size=2, trace_file=path)
+            for i in range(5):
+                tracer.trace(DIRECTION_IN, 'proc', self._headers(i))
+            tracer.close_trace_file()
+            summaries = list(message_trace.read_trace_file(path))
+            self.assertEqual([s['conv-id'] for s in summaries], ['#%d' % i for i in range(5)])
+            self.assertEqual(summaries[0]['dir'], DIRECTION_IN)
+        finally:
+            os.remove(path)
+
+    def test_lazy_dump(self):
+        logger = logging.getLogger('ion.core.messaging.test.lazy')
+        handler = logging.StreamHandler(open(os.devnull, 'w'))
+        handler.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        try:
+            # The logger accepts debug records, but its handler drops them
+            msg = FakeMessage()
+            message_trace.log_message(msg, logger)
+            self.assertEqual(msg.formatted, 0)
+
+            handler.setLevel(logging.DEBUG)
+            message_trace.log_message(msg, logger)
+            self.assertTrue(msg.formatted > 0)
+        finally:
+            logger.removeHandler(handler)
+            handler.stream.close()
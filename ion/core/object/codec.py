@@ -17,6 +17,7 @@ import ion.util.procutils as pu
 
 from ion.core.object import gpb_wrapper
 from ion.core.object import repository
+from ion.core.object import workbench
 from net.ooici.core.container import container_pb2
 from ion.core.object import object_utils
 from ion.core.messaging import message_client
@@ -98,6 +99,11 @@ class ObjectCodecInterceptor(EnvelopeInterceptor):
                      
             invocation.message['encoding'] = ION_R1_GPB
             
+        elif isinstance(content, workbench.RepositoryTransfer):
+            invocation.message['content'] = invocation.workbench.pack_repositories(content.repos, content.haves)
+                     
+            invocation.message['encoding'] = ION_R1_GPB
+            
         elif isinstance(content, container_pb2.Structure):
             serialized = content.SerializeToString()
             invocation.message['content'] = serialized
@@ -109,9 +115,6 @@ class ObjectCodecInterceptor(EnvelopeInterceptor):
             if isinstance(content[0], repository.Repository):
                 # assume it is a list of repository objects to send
                 
-                
-                print 'PELEPELEPELPELELELPELPELPELPPEEL'
-                
                 invocation.message['content'] = invocation.workbench.pack_repositories(content)
                      
                 invocation.message['encoding'] = ION_R1_GPB
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+@file ion/core/object/gpb_type_index.py
+@brief Index of protocol buffer type ids to the module and class defining
+each message type, so object_utils imports a generated *_pb2 module when one
+of its types is first used instead of importing all of them at startup.
+Generate the index at build time with
+    python -m ion.core.object.gpb_type_index
+An index for a different list of proto modules than the installed one is
+ignored.
+"""
+
+import os
+
+import simplejson as json
+
+import ion.util.ionlog
+log = ion.util.ionlog.getLogger(__name__)
+
+from ion.core import ioninit
+CONF = ioninit.config(__name__)
+
+# Index file, relative to the top directory of the code
+CF_index_file = CONF.getValue('index_file', 'res/gpb_type_index.json')
+# Write the index when it is missing or stale and all types had to be imported
+CF_write_missing = CONF.getValue('write_missing', True)
+
+# Package of the generated modules, with the list of them in 'protos'
+ROOT_PACKAGE = 'net'
+
+
+def get_protos(rootpath=ROOT_PACKAGE):
+    """
+    @retval list of the proto modules of a package, relative to it
+    """
+    root = __import__(rootpath)
+    return list(root.protos)
+
+def class_path(msg_class):
+    """
+    @retval dotted path of a message class in its module; nested message
+    types are attributes of the class containing them
+    """
+    names = []
+    descriptor = msg_class.DESCRIPTOR
+    while descriptor is not None:
+        names.insert(0, descriptor.name)
+        descriptor = descriptor.containing_type
+    return '.'.join(names)
+
+def build_index(id_to_class):
+    """
+    @param id_to_class dict of type id -> message class
+    @retval dict of type id -> (module, class path)
+    """
+    return dict((type_id, (msg_class.__module__, class_path(msg_class)))
+                for type_id, msg_class in id_to_class.iteritems())
+
+def write_index(index, protos, path=None):
+    """
+    Writes an index for the given list of proto modules
+    """
+    path = path or ioninit.adjust_dir(CF_index_file)
+    data = {'protos':protos,
+            'types':dict((str(type_id), list(entry)) for type_id, entry in index.iteritems())}
+    tmppath = path + '.tmp'
+    f = open(tmppath, 'w')
+    try:
+        json.dump(data, f, sort_keys=True, indent=1)
+    finally:
+        f.close()
+    os.rename(tmppath, path)
+
+def read_index(protos, path=None):
+    """
+    @retval dict of type id -> (module, class path), or None if there is no
+    index, it can not be read, or it is for other proto modules
+    """
+    path = path or ioninit.adjust_dir(CF_index_file)
+    if not os.path.exists(path):
+        return None
+    try:
+        f = open(path)
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+        if data['protos'] != protos:
+            log.info('Type index %s is for other proto modules, ignoring it' % path)
+            return None
+        return dict((int(type_id), (str(modname), str(clspath)))
+                    for type_id, (modname, clspath) in data['types'].iteritems())
+    except (IOError, ValueError, KeyError, TypeError), ex:
+        log.warn('Could not read type index %s: %s' % (path, ex))
+        return None
+
+def import_class(entry):
+    """
+    @param entry (module, class path) of an index
+    @retval the message class
+    """
+    modname, clspath = entry
+    obj = __import__(modname, {}, {}, [clspath.split('.')[0]])
+    for name in clspath.split('.'):
+        obj = getattr(obj, name)
+    return obj
+
+
+def main(path=None):
+    from ion.core.object import object_utils
+    path = path or ioninit.adjust_dir(CF_index_file)
+    protos = get_protos()
+    object_utils.build_gpb_lookup(ROOT_PACKAGE)
+    index = build_index(object_utils.gpb_id_to_class)
+    write_index(index, protos, path)
+    print 'Wrote %d protocol buffer types to %s' % (len(index), path)
+
+if __name__ == '__main__':
+    import sys
+    main(*sys.argv[1:])
@@ -223,6 +223,54 @@ class WrappedScalarProperty(WrappedProperty):
 
 
 
+class BulkEditContext(object):
+    """
+    Context manager returned by Wrapper.BulkEdit. The state of the wrapper is
+    checked once on entry and the raw GPB message is returned for editing. The
+    wrapper and its parents are set modified once on exit.
+    """
+    
+    def __init__(self, wrapper):
+        self._wrapper = wrapper
+        
+    def __enter__(self):
+        wrapper = self._wrapper
+        if wrapper._invalid:
+            raise OOIObjectError('Can not access Invalidated Object which may be left behind after a checkout or reset.')
+        
+        if wrapper.ReadOnly:
+            raise OOIObjectError('This object wrapper is read only!')
+        
+        return wrapper.GPBMessage
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Even a failed edit may have changed the message
+        self._wrapper._set_parents_modified()
+        return False
+    
+    
+@memoize(0)
+def _descriptor_has_links(msg_descriptor):
+    """
+    Check whether a message type is, or contains at any depth, a link. Raw
+    messages of these types can not be added without the wrapper.
+    """
+    link_descriptor = get_gpb_class_from_type_id(link_type).DESCRIPTOR
+    
+    touched = set()
+    descriptors = [msg_descriptor]
+    while len(descriptors) > 0:
+        desc = descriptors.pop()
+        if desc is link_descriptor or desc.full_name == link_descriptor.full_name:
+            return True
+        touched.add(desc.full_name)
+        
+        for field in desc.fields:
+            if field.message_type and not field.message_type.full_name in touched:
+                descriptors.append(field.message_type)
+    return False
+
+
 class WrapperType(type):
     """
     Metaclass that automatically generates subclasses of Wrapper with corresponding enums and
@@ -260,6 +308,9 @@ class WrapperType(type):
                 for enum_name, enum_desc in descriptor.enum_types_by_name.iteritems():
                     clsDict[enum_name] = EnumObject(enum_desc)
 
+            # The names of the singular scalar fields - used by SetFields
+            scalar_fields = set()
+            
             # Add the property wrappers for each of the fields of the message
             for fieldName, field_desc in descriptor.fields_by_name.items():
                 fieldType = getattr(msgType, fieldName)
@@ -275,6 +326,7 @@ class WrapperType(type):
                         prop = WrappedMessageProperty(fieldName, doc=fieldType.__doc__)
                     else:
                         prop = WrappedScalarProperty(fieldName, doc=fieldType.__doc__)
+                        scalar_fields.add(fieldName)
 
                 clsDict[fieldName] = prop
 
@@ -283,6 +335,8 @@ class WrapperType(type):
                 if enum_desc and not enum_desc.name in clsDict:
                     clsDict[enum_desc.name] = EnumObject(enum_desc)
             
+            clsDict['_scalar_fields'] = frozenset(scalar_fields)
+            
             # Set the object type:
             if clsDict.has_key('_MessageTypeIdentifier'):
                 mti = clsDict['_MessageTypeIdentifier']
@@ -650,6 +704,42 @@ class Wrapper(object):
     
             
         
+    def SetFields(self, **kwargs):
+        """
+        Set several scalar fields at once. The state of the wrapper is checked
+        once and the parents are set modified once, instead of once per field.
+        """
+        if self._invalid:
+            raise OOIObjectError('Can not access Invalidated Object which may be left behind after a checkout or reset.')
+            
+        if self.ReadOnly:
+            raise OOIObjectError('This object wrapper is read only!')
+        
+        for name in kwargs.iterkeys():
+            if not name in self._scalar_fields:
+                raise OOIObjectError('The "%s" object definition does not have a scalar field named "%s"' % \
+                    (str(self._GPBClass), name))
+        
+        gpb = self.GPBMessage
+        try:
+            for name, value in kwargs.iteritems():
+                setattr(gpb, name, value)
+        finally:
+            self._set_parents_modified()
+            
+    def BulkEdit(self):
+        """
+        Edit the raw GPB message of this wrapper in a with block:
+        
+            with wrapper.BulkEdit() as msg:
+                for i in xrange(10000):
+                    msg.integers.append(i)
+        
+        The state of the wrapper is checked once and modification is set once
+        at the end. Links must still be set through the wrapper!
+        """
+        return BulkEditContext(self)
+        
     def SetLinkByName(self,linkname,value):
         if self._invalid:
             raise OOIObjectError('Can not access Invalidated Object which may be left behind after a checkout or reset.')
@@ -719,18 +809,33 @@ class Wrapper(object):
             # This object is already committed!
             return
         
+        # Treat every child link as changed
+        self._commit_self(structure, self.ChildLinks)
+        
+    def _commit_self(self, structure, dirty_links):
+        """
+        Serialize and hash this wrapper once its modified children are committed.
+        Only the links in dirty_links can point at a changed child - the leaf
+        flag is updated for those. Any other child which is not yet committed
+        is found by its key and committed recursively.
+        Returns False if the object was invalidated by a hash conflict.
+        """
         # Create the Structure Element in which the binary blob will be stored
         se = StructureElement()        
         repo = self.Repository
+        hashed = repo._hashed_elements
         for link in  self.ChildLinks:
-                        
-            # Test to see if it is already serialized!
             
-            if  repo._hashed_elements.has_key(link.key):
-                child_se = repo._hashed_elements.get(link.key)
-
-                # Set the links is leaf property
-                link.isleaf = child_se.isleaf
+            key = link.key
+            
+            # Test to see if it is already serialized!
+            if key in structure or key in hashed:
+                
+                if link in dirty_links:
+                    child_se = structure.get(key) or hashed.get(key)
+                    # Set the links is leaf property
+                    if link.isleaf != child_se.isleaf:
+                        link.isleaf = child_se.isleaf
                 
             else:
                 child = repo.get_linked_object(link)
@@ -808,7 +913,7 @@ class Wrapper(object):
                     self.Invalidate()
                     
                     # We are done - get outta here!
-                    return
+                    return False
                 
             else:
                 repo._workspace[se.key] = self
@@ -824,6 +929,8 @@ class Wrapper(object):
         for link in self.ParentLinks:
             link.key = self.MyId
             
+        return True
+
         
         
         
@@ -946,6 +1053,7 @@ class Wrapper(object):
                     # Tricky - set the message directly and call modified!
                     #link.GPBMessage.key = self.MyId
                     link.GPBMessage.key = self.MyId
+                    repo._mark_dirty_link(link)
                     #link._set_parents_modified()
                     link._set_parents_modified()
             
@@ -1299,6 +1407,31 @@ class ContainerWrapper(object):
         self._wrapper._set_parents_modified()
         return self._wrapper._rewrap(new_element)
         
+    def extend_raw(self, messages):
+        """
+        Append copies of a sequence of raw GPB messages without creating a
+        wrapper for each new element. Not allowed for messages which contain
+        links - use add and set the link through the wrapper.
+        """
+        if self.Invalid:
+            raise OOIObjectError('Can not access Invalidated Object which may be left behind after a checkout or reset.')
+        
+        if self._wrapper.ReadOnly:
+            raise OOIObjectError('This object wrapper is read only!')
+        
+        checked = set()
+        try:
+            for msg in messages:
+                msg_descriptor = msg.DESCRIPTOR
+                if not msg_descriptor in checked:
+                    if _descriptor_has_links(msg_descriptor):
+                        raise OOIObjectError('Can not extend a repeated field with raw messages which contain links!')
+                    checked.add(msg_descriptor)
+                    
+                self._gpbcontainer.add().MergeFrom(msg)
+        finally:
+            self._wrapper._set_parents_modified()
+        
     def __getslice__(self, start, stop):
         """Retrieves the subset of items from between the specified indices."""
         if self.Invalid:
@@ -1395,6 +1528,9 @@ class ScalarContainerWrapper(object):
         if self.Invalid:
             raise OOIObjectError('Can not access Invalidated Object which may be left behind after a checkout or reset.')
            
+        if self._wrapper.ReadOnly:
+            raise OOIObjectError('This object wrapper is read only!')
+           
         self._gpbcontainer.extend(elem_seq)
         self._wrapper._set_parents_modified()
 
@@ -1489,21 +1625,73 @@ class StructureElement(object):
     stored in the hashed elements table. Mostly convience methods are provided
     here. A set provides references to the child objects so that the content
     need not be decoded to find them.
+    
+    An element may also be created lazily from a slice of a received buffer -
+    see lazy_structure_element. It is only decoded when its content is first
+    accessed and it serializes by returning its bytes.
     """
     def __init__(self,se=None):
             
         if se:
-            self._element = se
+            self._gpb = se
         else:
-            self._element = get_gpb_class_from_type_id(structure_element_type)()
+            self._gpb = get_gpb_class_from_type_id(structure_element_type)()
         self.ChildLinks = set()
         
+        # The undecoded bytes of a lazy element
+        self._buffer = None
+        self._lazy_key = None
+        
     @classmethod
     def parse_structure_element(cls,blob):
         se = get_gpb_class_from_type_id(structure_element_type)()
         se.ParseFromString(blob)
         return cls(se)
         
+    @classmethod
+    def lazy_structure_element(cls, buf, start, end, key):
+        """
+        Create an element from buf[start:end] without decoding it. The element
+        keeps a copy of only its own bytes, so an element left in the hashed
+        elements does not hold the whole received message in memory. The key
+        must already be known - it is read from the element when the container
+        is scanned.
+        """
+        inst = cls.__new__(cls)
+        inst._gpb = None
+        inst.ChildLinks = set()
+        inst._buffer = buf[start:end]
+        inst._lazy_key = key
+        return inst
+    
+    def _get_element(self):
+        if self._gpb is None:
+            se = get_gpb_class_from_type_id(structure_element_type)()
+            se.ParseFromString(self._buffer)
+            self._gpb = se
+            # Once decoded the element may be modified - drop the buffer
+            self._buffer = None
+            self._lazy_key = None
+        return self._gpb
+    
+    _element = property(_get_element)
+    
+    @property
+    def decoded(self):
+        """
+        False until the content of a lazy element is accessed.
+        """
+        return self._gpb is not None
+    
+    @property
+    def size(self):
+        """
+        The serialized size of the element - does not decode a lazy element.
+        """
+        if self._gpb is None:
+            return len(self._buffer)
+        return self._gpb.ByteSize()
+        
     @property
     def sha1(self):
         """
@@ -1565,6 +1753,8 @@ class StructureElement(object):
     #@property
     def _get_key(self):
         #return sha1_to_hex(self._element.key)
+        if self._gpb is None:
+            return self._lazy_key
         return self._element.key
         
     #@key.setter
@@ -1588,5 +1778,7 @@ class StructureElement(object):
         return msg + self._element.__str__()
         
     def serialize(self):
+        if self._gpb is None:
+            return self._buffer
         return self._element.SerializeToString()
         
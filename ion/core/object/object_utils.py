@@ -5,8 +5,12 @@
 @author David Stuebe
 """
 
+import ion.util.ionlog
+log = ion.util.ionlog.getLogger(__name__)
+
 from ion.util import procutils as pu
 from ion.util.cache import memoize
+from ion.core.object import gpb_type_index
 
 from net.ooici.core.type import type_pb2
 
@@ -15,7 +19,12 @@ import struct
 from google.protobuf import message
 
 # Globals
+# Type id -> message class, for the types used so far
 gpb_id_to_class = {}
+# Type id -> (module, class path), read when a class is first looked up
+_type_index = None
+# Whether all protocol buffer modules were imported into gpb_id_to_class
+_all_imported = False
 
 class ObjectUtilException(Exception):
     """ Exceptions specific to Object Utilities. """
@@ -117,18 +126,42 @@ def create_type_identifier(object_id='', version=1):
         
     return ObjectType
 
+ENUM_NAME = '_MessageTypeIdentifier'
+ENUM_ID_NAME = '_ID'
+ENUM_VERSION_NAME = '_VERSION'
+
+def _message_type_id(msg_class):
+    """
+    @retval the type id of a message class, None if it has none
+    @throws ObjectUtilException if its version is not 1
+    """
+    type_id = None
+    descriptor = getattr(msg_class, 'DESCRIPTOR', None)
+    for enum_type in getattr(descriptor, 'enum_types', ()):
+        if enum_type.name == ENUM_NAME:
+            for val in enum_type.values:
+                if val.name == ENUM_ID_NAME:
+                    type_id = val.number
+                elif val.name == ENUM_VERSION_NAME:
+                    # Eventually this will implement versioning...
+                    # For now return an error if the version is not 1
+                    if val.number != 1:
+                        msg = '''Protocol Buffer Object VERSION in the MessageTypeIdentifier should be 1. \n'''
+                        msg += '''Explicit versioning is not yet supported.\n'''
+                        msg +='''Invalid Object Class: "%s"'''\
+                            % (str(msg_class.__name__))
+                        raise ObjectUtilException(msg)
+    return type_id
+
 def build_gpb_lookup(rootpath):
     """
-    To be called once on package initialization.
+    Imports all protocol buffer modules of a package and finds the class of
+    every type id. Classes are otherwise looked up in the type index and
+    imported when first needed, see get_gpb_class_from_type_id.
     The given package must include a list named "protos" specifying which protocol buffer files to import.
     @param rootpath The full path of the package to import the Protocol Buffers classes from.
     """
-
-    ENUM_NAME = '_MessageTypeIdentifier'
-    ENUM_ID_NAME = '_ID'
-    ENUM_VERSION_NAME = '_VERSION'
-    
-    global gpb_id_to_class
+    global gpb_id_to_class, _all_imported
     gpb_id_to_class = {}
 
     root = __import__(rootpath)
@@ -140,27 +173,59 @@ def build_gpb_lookup(rootpath):
     msg_classes = message.Message.__subclasses__()
     for msg_class in msg_classes:
         if msg_class.__module__.startswith(rootpath):
-            if hasattr(msg_class, 'DESCRIPTOR'):
-                descriptor = msg_class.DESCRIPTOR
-                if hasattr(descriptor, 'enum_types'):
-                    for enum_type in descriptor.enum_types:
-                        if enum_type.name == ENUM_NAME:
-                            for val in enum_type.values:
-                                if val.name == ENUM_ID_NAME:
-                                    gpb_id_to_class[val.number] = msg_class
-                                elif val.name == ENUM_VERSION_NAME:
-                                    # Eventually this will implement versioning...
-                                    # For now return an error if the version is not 1
-                                    if val.number != 1:
-                                        msg = '''Protocol Buffer Object VERSION in the MessageTypeIdentifier should be 1. \n'''
-                                        msg += '''Explicit versioning is not yet supported.\n'''
-                                        msg +='''Invalid Object Class: "%s"'''\
-                                            % (str(msg_class.__name__))
-                                        raise ObjectUtilException(msg)
+            type_id = _message_type_id(msg_class)
+            if type_id is not None:
+                gpb_id_to_class[type_id] = msg_class
+    _all_imported = True
+
+def _load_type_index():
+    """
+    Reads the type index, or builds it by importing all protocol buffer
+    modules if it is missing or stale
+    """
+    global _type_index
+    protos = gpb_type_index.get_protos()
+    index = gpb_type_index.read_index(protos)
+    if index is None:
+        log.info('No protocol buffer type index, importing all types')
+        build_gpb_lookup(gpb_type_index.ROOT_PACKAGE)
+        index = gpb_type_index.build_index(gpb_id_to_class)
+        if gpb_type_index.CF_write_missing:
+            try:
+                gpb_type_index.write_index(index, protos)
+            except (IOError, OSError), ex:
+                log.warn('Could not write protocol buffer type index: %s' % ex)
+    _type_index = index
+
+def _resolve_type_id(object_id):
+    """
+    Imports the class of a type id not looked up before, from the module the
+    type index names. If the index is wrong, all modules are imported.
+    """
+    if _type_index is None:
+        _load_type_index()
+    msg_class = None
+    entry = _type_index.get(object_id)
+    if entry is not None:
+        try:
+            msg_class = gpb_type_index.import_class(entry)
+        except (ImportError, AttributeError), ex:
+            log.warn('Protocol buffer type index entry %s for id %s is invalid: %s' % (entry, object_id, ex))
+        else:
+            if _message_type_id(msg_class) != object_id:
+                log.warn('Protocol buffer type index entry %s is not id %s' % (entry, object_id))
+                msg_class = None
+    if msg_class is None and not _all_imported:
+        build_gpb_lookup(gpb_type_index.ROOT_PACKAGE)
+        msg_class = gpb_id_to_class.get(object_id)
+    if msg_class is not None:
+        gpb_id_to_class[object_id] = msg_class
+    return msg_class
 
 def get_gpb_class_from_type_id(typeid):
     """
     Get a callable google.protobuf.message.Message subclass with the given MessageTypeIdentifier enum id.
+    The class is imported on first use.
     @param id The type id object
     @retval msg_class The class for the given id.
     @throws ObjectUtilException
@@ -170,7 +235,7 @@ def get_gpb_class_from_type_id(typeid):
     except AttributeError, ex:
         raise ObjectUtilException('The type argument is not a valid type identifier object: "%s, type: %s "' % (str(typeid), type(typeid)))
     except KeyError, ex:
-        raise ObjectUtilException('No Protocol Buffer Message class found for id "%s"' % (str(typeid)))
-
-# Build the lookup table on first import
-build_gpb_lookup('net')
+        msg_class = _resolve_type_id(typeid.object_id)
+        if msg_class is None:
+            raise ObjectUtilException('No Protocol Buffer Message class found for id "%s"' % (str(typeid)))
+        return msg_class
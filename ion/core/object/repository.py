@@ -18,6 +18,7 @@ log = ion.util.ionlog.getLogger(__name__)
 import sys
 
 import time
+import bisect
 from twisted.internet import threads, reactor, defer
 
 from ion.core.object import gpb_wrapper
@@ -25,6 +26,14 @@ from ion.core.object import object_utils
 
 from ion.util import procutils as pu
 
+from ion.core import ioninit
+CONF = ioninit.config(__name__)
+
+# Maximum number of links requested in one fetch_linked_objects call - 0 is unbounded
+CF_fetch_batch_size = CONF.getValue('fetch_batch_size', 0)
+# Ask the upstream process to return the full closure under each requested link
+CF_fetch_closure = CONF.getValue('fetch_closure', False)
+
 commit_type = object_utils.create_type_identifier(object_id=8, version=1)
 mutable_type = object_utils.create_type_identifier(object_id=6, version=1)
 branch_type = object_utils.create_type_identifier(object_id=5, version=1)
@@ -36,6 +45,39 @@ class RepositoryError(Exception):
     An exception class for errors in the object management repository 
     """
 
+class BranchCommitIndex(object):
+    """
+    @brief The ids of the commits reachable from the heads of a branch, with
+    their dates kept in sorted order so that a checkout by date is a bisect.
+    heads is the tuple of head commit ids the index was last brought up to date with.
+    """
+    def __init__(self):
+        self.heads = ()
+        self.ids = set()
+        self._dates = []
+        self._keys = []
+        
+    def add(self, cref):
+        key = cref.MyId
+        if key in self.ids:
+            return
+        self.ids.add(key)
+        ind = bisect.bisect_right(self._dates, cref.date)
+        self._dates.insert(ind, cref.date)
+        self._keys.insert(ind, key)
+        
+    def older_than(self, date):
+        """
+        Return the id of the newest commit at or before date, or None
+        """
+        ind = bisect.bisect_right(self._dates, date)
+        if ind == 0:
+            return None
+        return self._keys[ind-1]
+        
+    def __len__(self):
+        return len(self.ids)
+
 class Repository(object):
     
     UPTODATE='up to date'
@@ -73,6 +115,18 @@ class Repository(object):
         A dictionary containing the commit objects - all immutable content hashed
         """
         
+        self._commit_generation = {}
+        """
+        The generation number of each commit in the commit index whose ancestors
+        are all loaded - root commits are generation 1.
+        """
+        
+        self._branch_index = {}
+        """
+        A BranchCommitIndex for each branch key which has been checked out by
+        commit id or date. It is brought up to date incrementally as the heads move.
+        """
+        
         self._hashed_elements = None
         """
         All content elements are stored here - from incoming messages and
@@ -123,6 +177,30 @@ class Repository(object):
         The upstream source of this repository. 
         """
         
+        self._dirty_links = {}
+        """
+        The link wrappers which were pointed at a new or modified object since
+        the last commit, keyed by the root wrapper which holds the link. Commit
+        uses this to visit only the changed part of the structure.
+        """
+        
+        self.commit_profile = {}
+        """
+        The cost of the last commit - objects serialized, bytes hashed and time
+        """
+        
+        self.fetch_batch_size = CF_fetch_batch_size
+        """
+        The maximum number of links to request from the upstream process in a
+        single fetch - 0 or None means no limit.
+        """
+        
+        self.fetch_closure = CF_fetch_closure
+        """
+        If true, ask the upstream process to return everything reachable from
+        the requested links in one reply instead of just the linked objects.
+        """
+        
         if head:
             self._dotgit = self._load_element(head)
             # Set it to modified and give it a new ID as soon as we get it!
@@ -313,81 +391,26 @@ class Repository(object):
             # IF you are checking out a specific commit ID it is always a detached head!
             detached = True
             
-            # Use this set to make sure we only examine each commit once!
-            touched_refs = set()
-                
-            crefs = branch.commitrefs[:]
-            
-            while len(crefs) >0:
-                new_set = set()
-                    
-                for ref in crefs:
-                        
-                    if ref.MyId == commit_id:
-                        
-                        # Empty the crefs set to exit the while loop!
-                        crefs = set()
-                        # Save the CRef!
-                        cref = ref
-                        break # Break to ref in crefs
-                        
-                    # For each child reference...
-                    for pref in ref.parentrefs:
-                        # If we have not already looked at this one...
-                        p_commit = pref.commitref
-                        if not p_commit in touched_refs:                            
-                            new_set.add(p_commit)
-                            touched_refs.add(p_commit)    
-                    
-                else:
-                    crefs = new_set                    
-            else:
-                if not cref:
-                    raise RepositoryError('End of Ancestors: No matching reference \
-                                          found in commit history on branch name %s, \
-                                          commit_id: %s' % (branch_name, commit_id))
-                
-            
+            commits = self._branch_commits(branch)
+            if not commit_id in commits.ids:
+                raise RepositoryError('End of Ancestors: No matching reference \
+                                      found in commit history on branch name %s, \
+                                      commit_id: %s' % (branchname, commit_id))
+            cref = self._commit_index[commit_id]
             
         elif older_than:
             
             # IF you are checking out a specific commit date it is always a detached head!
             detached = True
             
-            # Need to make sure we get the closest commit to the older_than date!
-            younger_than = -9999.99
-            
-            # Use this set to make sure we only examine each commit once!
-            touched_refs = set()
-            
-            crefs = branch.commitrefs[:]
-            
-            while len(crefs) >0:
-                
-                new_set = set()
-                
-                for ref in crefs:
-                        
-                    if ref.date <= older_than & ref.date > younger_than:
-                        cref = ref
-                        younger_than = ref.date
-                        
-                    # Only keep looking at parent references if they are to young
-                    elif ref.date > older_than:
-                        # For each child reference...
-                        for pref in ref.parentrefs:
-                            # If we have not already looked at this one...
-                            if not pref in touched_refs:                            
-                                new_set.add(pref)
-                                touched_refs.add(pref)    
-                       
-                crefs = new_set
-                       
-            else:
-                if not cref:
-                    raise RepositoryError('End of Ancestors: No matching commit \
-                                          found in commit history on branch name %s, \
-                                          older_than: %s' % (branch_name, older_than))
+            # The closest commit to the older_than date
+            commits = self._branch_commits(branch)
+            key = commits.older_than(older_than)
+            if key is None:
+                raise RepositoryError('End of Ancestors: No matching commit \
+                                      found in commit history on branch name %s, \
+                                      older_than: %s' % (branchname, older_than))
+            cref = self._commit_index[key]
                 
         # Just checking out the current head - need to make sure it has not diverged! 
         else:
@@ -407,6 +430,7 @@ class Repository(object):
             item.Invalidate()
         self._workspace = {}
         self._workspace_root = None
+        self._dirty_links = {}
             
         # Automatically fetch the object from the hashed dictionary
         rootobj = yield self.get_remote_linked_object(cref.GetLink('objectroot'))
@@ -470,7 +494,7 @@ class Repository(object):
         cref.ReadOnly = True
         
         # Add the cref to the active commit objects - for convienance
-        self._commit_index[cref.MyId] = cref
+        self._index_commit(cref)
 
         # update the hashed elements
         self._hashed_elements.update(structure)
@@ -497,6 +521,7 @@ class Repository(object):
             item.Invalidate()
         self._workspace = {}
         self._workspace_root = None
+        self._dirty_links = {}
             
             
         # Automatically fetch the object from the hashed dictionary or fetch if needed!
@@ -515,8 +540,10 @@ class Repository(object):
         
         # If the repo is in a valid state - make the commit even if it is up to date
         if self.status == self.MODIFIED or self.status == self.UPTODATE:
+            tzero = time.time()
+            
             structure={}
-            self._workspace_root.RecurseCommit(structure)
+            self._commit_dirty(self._workspace_root, structure)
                                 
             cref = self._create_commit_ref(comment=comment)
                 
@@ -527,11 +554,23 @@ class Repository(object):
             cref.ReadOnly = True
             
             # Add the cref to the active commit objects - for convienance
-            self._commit_index[cref.MyId] = cref
+            self._index_commit(cref)
 
             # update the hashed elements
             self._hashed_elements.update(structure)
-            log.info('Commited repository - Comment: cref.comment')
+            
+            # Move any branch index which is in use along to the new head
+            if self._branch_index.has_key(self._current_branch.branchkey):
+                self._branch_commits(self._current_branch)
+            
+            nbytes = 0
+            for se in structure.itervalues():
+                nbytes += len(se.value)
+            self.commit_profile = {'objects':len(structure),
+                                   'bytes':nbytes,
+                                   'time':time.time() - tzero}
+            
+            log.info('Commited repository - Comment: %s; Profile: %s' % (cref.comment, self.commit_profile))
                             
         else:
             raise RepositoryError('Repository in invalid state to commit')
@@ -541,6 +580,53 @@ class Repository(object):
         return branch.commitrefs.GetLink(0).key
             
             
+    def _mark_dirty_link(self, link):
+        """
+        Record that a link now points at a new or modified object
+        """
+        links = self._dirty_links.get(link.Root, None)
+        if links is None:
+            links = set()
+            self._dirty_links[link.Root] = links
+        links.add(link)
+        
+    def _commit_dirty(self, root, structure):
+        """
+        Commit the modified objects under root. Only the objects reached through
+        links which changed since the last commit are visited, children before
+        their parents, so the cost is in the number of changed objects.
+        """
+        dirty_links = self._dirty_links
+        self._dirty_links = {}
+        
+        if not root.Modified:
+            return
+        
+        # Order the modified objects so that each child is committed before its parents
+        ordered = []
+        touched = set()
+        def visit(wrapper):
+            touched.add(wrapper)
+            for link in dirty_links.get(wrapper, ()):
+                if link.Invalid or not link in wrapper.ChildLinks:
+                    # The link has been cleared since it was set
+                    continue
+                try:
+                    child = self.get_linked_object(link)
+                except KeyError, ex:
+                    # Not loaded so it can not have been modified
+                    continue
+                if child.Modified and not child in touched:
+                    visit(child)
+            ordered.append(wrapper)
+        visit(root)
+        
+        for wrapper in ordered:
+            if wrapper.Invalid or not wrapper.Modified:
+                # Invalidated by a hash conflict or committed as a shared child
+                continue
+            wrapper._commit_self(structure, dirty_links.get(wrapper, ()))
+            
     def _create_commit_ref(self, comment='', date=None):
         """
         @brief internal method to create commit references
@@ -596,6 +682,165 @@ class Repository(object):
         branch.commitrefs.SetLink(0,cref)
         
         return cref
+        
+    def _index_commit(self, cref):
+        """
+        Add a commit to the commit graph index. The generation number is set now
+        if the parents are already indexed, otherwise when it is first asked for.
+        """
+        key = cref.MyId
+        self._commit_index[key] = cref
+        
+        if self._commit_generation.has_key(key):
+            return
+        
+        generation = 1
+        for pkey in self._parent_keys(cref):
+            pgen = self._commit_generation.get(pkey)
+            if pgen is None:
+                return
+            generation = max(generation, pgen + 1)
+        self._commit_generation[key] = generation
+        
+    def _parent_keys(self, cref):
+        return [pref.GetLink('commitref').key for pref in cref.parentrefs]
+        
+    def commit_generation(self, commit_id):
+        """
+        @brief The generation number of a commit - one more than the largest
+        generation of its parents, 1 for a commit with no parents.
+        @retval the generation or None if the commit or one of its ancestors is not loaded
+        """
+        generation = self._commit_generation.get(commit_id)
+        if generation is not None:
+            return generation
+        
+        # Work down to the ancestors which are already numbered without recursion
+        stack = [commit_id]
+        while stack:
+            key = stack[-1]
+            if self._commit_generation.has_key(key):
+                stack.pop()
+                continue
+            
+            cref = self._commit_index.get(key)
+            if cref is None:
+                return None
+            
+            pkeys = self._parent_keys(cref)
+            missing = [pkey for pkey in pkeys if not self._commit_generation.has_key(pkey)]
+            if missing:
+                stack.extend(missing)
+                continue
+            
+            generation = 1
+            for pkey in pkeys:
+                generation = max(generation, self._commit_generation[pkey] + 1)
+            self._commit_generation[key] = generation
+            stack.pop()
+            
+        return self._commit_generation[commit_id]
+        
+    def is_ancestor(self, ancestor_id, commit_id):
+        """
+        @brief Test whether ancestor_id is commit_id or one of its ancestors.
+        Generation numbers prune the walk - no commit with a generation at or
+        below that of the ancestor can lead to it.
+        @retval False if either commit is not loaded in this repository
+        """
+        if ancestor_id == commit_id:
+            return self._commit_index.has_key(commit_id)
+        
+        if not self._commit_index.has_key(ancestor_id):
+            return False
+        
+        a_gen = self.commit_generation(ancestor_id)
+        if a_gen is None:
+            # The history below the ancestor is not loaded - walk without pruning
+            a_gen = 0
+        
+        touched = set([commit_id])
+        frontier = [commit_id]
+        while frontier:
+            new_frontier = []
+            for key in frontier:
+                cref = self._commit_index.get(key)
+                if cref is None:
+                    continue
+                
+                for pkey in self._parent_keys(cref):
+                    if pkey == ancestor_id:
+                        return True
+                    if pkey in touched:
+                        continue
+                    touched.add(pkey)
+                    
+                    pgen = self.commit_generation(pkey)
+                    if pgen is not None and pgen <= a_gen:
+                        continue
+                    new_frontier.append(pkey)
+            frontier = new_frontier
+            
+        return False
+        
+    def _branch_commits(self, branch):
+        """
+        Return the BranchCommitIndex for a branch, bringing it up to date with
+        the current heads. Only the commits added since it was last used are
+        walked, unless a previous head is no longer an ancestor of the branch.
+        """
+        heads = tuple([link.key for link in branch.commitrefs.GetLinks()])
+        
+        index = self._branch_index.get(branch.branchkey)
+        if index is not None and index.heads == heads:
+            return index
+        
+        if index is None:
+            index = BranchCommitIndex()
+        
+        crefs, stops = self._walk_new_commits(branch, index.ids)
+        
+        for key in index.heads:
+            if not key in stops:
+                # The branch has moved somewhere else - start again
+                index = BranchCommitIndex()
+                crefs, stops = self._walk_new_commits(branch, index.ids)
+                break
+            
+        for cref in crefs:
+            index.add(cref)
+        index.heads = heads
+        
+        self._branch_index[branch.branchkey] = index
+        return index
+        
+    def _walk_new_commits(self, branch, known):
+        """
+        Walk the ancestors of the branch heads which are not in the known set of
+        ids. Returns the new commits and the known ids at which the walk stopped.
+        """
+        crefs = []
+        stops = set()
+        touched = set()
+        
+        frontier = branch.commitrefs[:]
+        while frontier:
+            new_frontier = []
+            for cref in frontier:
+                key = cref.MyId
+                if key in known:
+                    stops.add(key)
+                    continue
+                if key in touched:
+                    continue
+                touched.add(key)
+                crefs.append(cref)
+                
+                for pref in cref.parentrefs:
+                    new_frontier.append(pref.commitref)
+            frontier = new_frontier
+            
+        return crefs, stops
             
 
     @defer.inlineCallbacks
@@ -651,6 +896,7 @@ class Repository(object):
         assert len(crefs) > 0, 'Illegal state reached in Repository Merge function!'
         
         for cref in crefs:
+            self._index_commit(cref)
             self._merge_from.append(cref)
             
             rootobj = yield self.get_remote_linked_object(cref.GetLink('objectroot'))
@@ -781,15 +1027,13 @@ class Repository(object):
             obj.AddParentLink(link)
             return obj
 
-        elif self._hashed_elements.has_key(link.key):
-            
-            element = self._hashed_elements.get(link.key)
-            
         else:
             
-            log.debug('Linked object not found. Need non local object: %s' % str(link))
+            element = self._hashed_elements.get(link.key)
+            if element is None:
+                log.debug('Linked object not found. Need non local object: %s' % str(link))
             
-            raise KeyError('Object not found in the local work bench.')
+                raise KeyError('Object not found in the local work bench.')
             
             
             
@@ -804,8 +1048,8 @@ class Repository(object):
         obj.AddParentLink(link)
         
         if obj.ObjectType == self.CommitClassType:
-            self._commit_index[obj.MyId]=obj
             obj.ReadOnly = True
+            self._index_commit(obj)
                 
         elif link.Root.ObjectType == self.CommitClassType:
             # if the link is a commit but the linked object is not then it is a root object
@@ -837,7 +1081,11 @@ class Repository(object):
          
     @defer.inlineCallbacks
     def _fetch_remote_objects(self, links):
-    
+        """
+        Fetch the objects for a list of links from the upstream process. Links
+        with the same key are only requested once and the request is split into
+        batches of at most fetch_batch_size links.
+        """
         if not self._workbench:
                 raise RepositoryError('Object not found and not work bench is present!')
                 
@@ -852,10 +1100,35 @@ class Repository(object):
         else:
             fetch_linked_objects = self._workbench.fetch_linked_objects
             
-        #@TODO provide catch mechanism to use the service name instead of the
-        # process name if the process does not respond...
-        result = yield fetch_linked_objects(self.upstream['process'], links)
-        
+        # Only ask for each key once!
+        unique_links = []
+        keys = set()
+        for link in links:
+            if not link.key in keys:
+                keys.add(link.key)
+                unique_links.append(link)
+            
+        batch_size = self.fetch_batch_size or len(unique_links)
+            
+        result = {}
+        for start in range(0, len(unique_links), batch_size):
+            batch = unique_links[start:start + batch_size]
+            
+            #@TODO provide catch mechanism to use the service name instead of the
+            # process name if the process does not respond...
+            if self.fetch_closure:
+                objs = yield fetch_linked_objects(self.upstream['process'], batch, closure=True)
+            else:
+                objs = yield fetch_linked_objects(self.upstream['process'], batch)
+            
+            # The datastore returns a list of elements, the workbench a dictionary
+            if isinstance(objs, dict):
+                result.update(objs)
+            elif objs:
+                for wse in objs:
+                    if wse is not None:
+                        result[wse.key] = wse
+            
         defer.returnValue(result)
             
             
@@ -872,20 +1145,47 @@ class Repository(object):
     def _load_remote_links(self, obj):
         """
         Load links which may require remote (deferred) access
+        
+        The structure is resolved breadth first. Every link which is missing
+        locally anywhere in the current frontier is fetched in one request, so
+        the number of round trips grows with the depth of the missing part of
+        the structure rather than with the number of objects in it.
         """
-        remote_objects = []
-        for link in obj.ChildLinks:
-            try:
-                child = self.get_linked_object(link)
-                yield self._load_remote_links(child)
-            except KeyError, ex:
-                log.info('"_load_remote_links": Caught object not found:'+str(ex))
-                remote_objects.append(link)
+        frontier = [obj]
+        touched = set()
+        
+        while len(frontier) > 0:
             
+            next_frontier = []
+            remote_links = []
             
-        if remote_objects:
-            res = yield self._fetch_remote_objects(remote_objects)
-            res = yield self._load_remote_links(obj)
+            for item in frontier:
+                for link in item.ChildLinks:
+                    try:
+                        child = self.get_linked_object(link)
+                    except KeyError, ex:
+                        remote_links.append(link)
+                        continue
+                    
+                    # Shared children in a DAG only need to be walked once
+                    if not child.MyId in touched:
+                        touched.add(child.MyId)
+                        next_frontier.append(child)
+                        
+            if remote_links:
+                log.info('"_load_remote_links": Fetching %d objects not found locally' % len(remote_links))
+                yield self._fetch_remote_objects(remote_links)
+                
+                for link in remote_links:
+                    # Objects are now in the hashed elements dictionary
+                    child = self.get_linked_object(link)
+                    
+                    if not child.MyId in touched:
+                        touched.add(child.MyId)
+                        next_frontier.append(child)
+                        
+            frontier = next_frontier
+                
         defer.returnValue(True)
             
     def _load_element(self, element):
@@ -1027,6 +1327,7 @@ class Repository(object):
             
         # Set the id of the linked wrapper
         link.key = value.MyId
+        self._mark_dirty_link(link)
         
         # Set the type
         tp = link.type
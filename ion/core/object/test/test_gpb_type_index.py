@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""
+@file ion/core/object/test/test_gpb_type_index.py
+@test ion.core.object.gpb_type_index and the lazy class lookup of object_utils
+"""
+
+import os
+import subprocess
+import sys
+
+from twisted.trial import unittest
+
+import ion.util.ionlog
+log = ion.util.ionlog.getLogger(__name__)
+
+from net.ooici.play import addressbook_pb2
+
+import ion
+
+from ion.core.object import gpb_type_index
+from ion.core.object import object_utils
+
+from ion.core import ioninit
+from ion.util.itv_decorator import itv
+CONF = ioninit.config(__name__)
+
+person_type = object_utils.create_type_identifier(object_id=20001, version=1)
+invalid_type = object_utils.create_type_identifier(object_id=-1, version=1)
+
+PERSON_ENTRY = ('net.ooici.play.addressbook_pb2', 'Person')
+
+# Imports the process module and looks up one type, as a container does on
+# startup; the eager variant imports all types first, as importing
+# object_utils used to
+STARTUP_SCRIPT = """
+import time
+start = time.time()
+import ion.core.process.process
+from ion.core.object import gpb_type_index, object_utils
+gpb_type_index.CF_index_file = %r
+if %r:
+    object_utils.build_gpb_lookup('net')
+object_utils.get_gpb_class_from_type_id(object_utils.create_type_identifier(20001))
+print time.time() - start
+"""
+
+
+class TypeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (object_utils.gpb_id_to_class, object_utils._type_index,
+                      object_utils._all_imported)
+        self.path = self.mktemp()
+        self.protos = gpb_type_index.get_protos()
+
+    def tearDown(self):
+        (object_utils.gpb_id_to_class, object_utils._type_index,
+         object_utils._all_imported) = self.saved
+
+    def _reset(self, index):
+        object_utils.gpb_id_to_class = {}
+        object_utils._type_index = index
+        object_utils._all_imported = False
+
+    def test_write_read(self):
+        index = {20001:PERSON_ENTRY}
+        gpb_type_index.write_index(index, self.protos, self.path)
+        self.assertEqual(gpb_type_index.read_index(self.protos, self.path), index)
+        # An index of other modules, or none, is not used
+        self.assertEqual(gpb_type_index.read_index(self.protos + ['other'], self.path), None)
+        self.assertEqual(gpb_type_index.read_index(self.protos, self.path + '.missing'), None)
+
+    def test_build_index(self):
+        object_utils.build_gpb_lookup('net')
+        index = gpb_type_index.build_index(object_utils.gpb_id_to_class)
+        self.assertEqual(index[20001], PERSON_ENTRY)
+        for type_id, entry in index.iteritems():
+            self.assertTrue(gpb_type_index.import_class(entry) is object_utils.gpb_id_to_class[type_id])
+
+    def test_lazy_lookup(self):
+        self._reset({20001:PERSON_ENTRY})
+        msg_class = object_utils.get_gpb_class_from_type_id(person_type)
+        self.assertTrue(msg_class is addressbook_pb2.Person)
+        self.assertEqual(object_utils.gpb_id_to_class.keys(), [20001])
+        self.assertFalse(object_utils._all_imported)
+
+    def test_stale_index(self):
+        # A wrong entry is noticed, and all types are imported instead
+        self._reset({20001:('net.ooici.play.addressbook_pb2', 'AddressBook')})
+        msg_class = object_utils.get_gpb_class_from_type_id(person_type)
+        self.assertTrue(msg_class is addressbook_pb2.Person)
+        self.assertTrue(object_utils._all_imported)
+        self.assertRaises(object_utils.ObjectUtilException,
+                          object_utils.get_gpb_class_from_type_id, invalid_type)
+
+    def _startup_time(self, eager, runs=3):
+        script = STARTUP_SCRIPT % (os.path.abspath(self.path), eager)
+        topdir = os.path.dirname(os.path.dirname(os.path.abspath(ion.__file__)))
+        times = []
+        for i in range(runs):
+            out = subprocess.Popen([sys.executable, '-c', script], cwd=topdir,
+                                   stdout=subprocess.PIPE).communicate()[0]
+            times.append(float(out.strip().splitlines()[-1]))
+        return min(times)
+
+    @itv(CONF)
+    def test_startup_performance(self):
+        object_utils.build_gpb_lookup('net')
+        index = gpb_type_index.build_index(object_utils.gpb_id_to_class)
+        gpb_type_index.write_index(index, self.protos, self.path)
+
+        eager = self._startup_time(True)
+        lazy = self._startup_time(False)
+        print '\nStartup with all %d types imported: %.3f s, with the type index: %.3f s (%.1fx)' % (
+            len(index), eager, lazy, eager / lazy)
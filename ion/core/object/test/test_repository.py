@@ -187,8 +187,53 @@ class RepositoryTest(unittest.TestCase):
         ab = yield repo.checkout(branchname='master', commit_id=commit_ref3)
         self.assertEqual(ab.person[0].id,1)
         self.assertEqual(ab.person[0].name,'alpha')
-        
-        
+
+    @defer.inlineCallbacks
+    def test_checkout_older_than(self):
+        repo, ab = self.wb.init_repository(addressbook_type)
+
+        commit_ref1 = repo.commit()
+
+        p = ab.person.add()
+        p.id = 1
+        p.name = 'Uma'
+        commit_ref2 = repo.commit()
+
+        cref1 = repo._commit_index[commit_ref1]
+        cref2 = repo._commit_index[commit_ref2]
+
+        ab = yield repo.checkout(branchname='master', older_than=cref2.date + 1.0)
+        self.assertEqual(ab.person[0].name,'Uma')
+
+        try:
+            yield repo.checkout(branchname='master', older_than=cref1.date - 1.0)
+            self.fail('Checkout older than the first commit should fail')
+        except repository.RepositoryError, ex:
+            pass
+
+    def test_commit_graph(self):
+        repo, ab = self.wb.init_repository(addressbook_type)
+
+        commit_ref1 = repo.commit('a')
+        commit_ref2 = repo.commit('b')
+
+        branch = repo.get_branch('master')
+        commits = repo._branch_commits(branch)
+        self.assertEqual(commits.ids, set([commit_ref1, commit_ref2]))
+
+        # The branch index moves along with new commits
+        commit_ref3 = repo.commit('c')
+        self.assertIn(commit_ref3, commits.ids)
+        self.assertEqual(commits.heads, (commit_ref3,))
+
+        self.assertEqual(repo.commit_generation(commit_ref1), 1)
+        self.assertEqual(repo.commit_generation(commit_ref3), 3)
+
+        self.assertEqual(repo.is_ancestor(commit_ref1, commit_ref3), True)
+        self.assertEqual(repo.is_ancestor(commit_ref3, commit_ref1), False)
+        self.assertEqual(repo.is_ancestor(commit_ref2, commit_ref2), True)
+
+
     def test_log(self):
         wb1 = workbench.WorkBench('No Process Test')
         
@@ -401,4 +446,39 @@ class RepositoryTest(unittest.TestCase):
  
  
  
- 
\ No newline at end of file
+         
+        
+    def test_incremental_commit(self):
+        repo, ab = self.wb.init_repository(addresslink_type)
+        
+        for i in range(20):
+            p = repo.create_object(person_type)
+            p.name = 'Person %d' % i
+            p.id = i
+            ab.person.add()
+            ab.person[i] = p
+            
+        repo.commit('Twenty people')
+        # The root, twenty people and the commit
+        self.assertEqual(repo.commit_profile['objects'], 22)
+        
+        ab.person[5].name = 'David'
+        
+        repo.commit('Changed one person')
+        # Only the changed person, the root and the commit are serialized
+        self.assertEqual(repo.commit_profile['objects'], 3)
+        self.assert_(repo.commit_profile['bytes'] > 0)
+        
+        self.assertEqual(repo.root_object.person[5].name, 'David')
+        self.assertEqual(repo.root_object.person[5].MyId, repo.root_object.person.GetLink(5).key)
+        self.assertIn(repo.root_object.person.GetLink(5).key, self.wb._hashed_elements)
+        
+        # A new object linked after the last commit
+        p = repo.create_object(person_type)
+        p.name = 'John'
+        ab.owner = p
+        
+        repo.commit('Added an owner')
+        self.assertEqual(repo.commit_profile['objects'], 3)
+        self.assertEqual(ab.GetLink('owner').isleaf, True)
+        self.assertEqual(ab.owner.name, 'John')
@@ -143,8 +143,56 @@ class WorkBenchTest(unittest.TestCase):
         
         #Check that the commit came through in the current branch
         self.assertEqual(commit, self.repo._current_branch.commitrefs[0])
-        
-        
+
+    def test_pack_container_wire_format(self):
+
+        serialized = self.wb.pack_structure(self.ab)
+
+        # The directly written container must parse as a container structure
+        cs = object_utils.get_gpb_class_from_type_id(workbench.structure_type)()
+        cs.ParseFromString(serialized)
+
+        self.assertEqual(len(cs.heads), 1)
+        self.assertEqual(cs.heads[0].key, self.ab.MyId)
+        self.assertEqual(cs.heads[0].SerializeToString(),
+                         self.wb._hashed_elements.get(self.ab.MyId).serialize())
+
+        keys = set([se.key for se in cs.items])
+        self.assertIn(self.ab.person[0].MyId, keys)
+        self.assertIn(self.ab.person[1].MyId, keys)
+
+    def test_unpack_container_lazy(self):
+
+        serialized = self.wb.pack_structure(self.ab)
+
+        heads, obj_dict = self.wb._unpack_container(serialized)
+
+        self.assertEqual(len(heads), 1)
+        self.assertEqual(heads[0].key, self.ab.MyId)
+
+        for key, wse in obj_dict.items():
+            self.assertEqual(wse.key, key)
+
+            # Nothing is decoded until the content is used
+            self.assertEqual(wse.decoded, False)
+            original = self.wb._hashed_elements.get(key)
+            self.assertEqual(wse.serialize(), original.serialize())
+            self.assertEqual(wse.size, original.size)
+            self.assertEqual(wse.decoded, False)
+            # Only the element's own bytes are kept, not the whole message
+            self.assertEqual(len(wse._buffer), wse.size)
+
+            self.assertEqual(wse.value, original.value)
+            self.assertEqual(wse.decoded, True)
+            self.assertEqual(wse.sha1, key)
+
+    def test_unpack_truncated_container(self):
+
+        serialized = self.wb.pack_structure(self.ab)
+
+        self.assertRaises(workbench.WorkBenchError,self.wb.unpack_structure,serialized[:-5])
+
+
     def test_create_repo(self):
             
         # Try it with no arguments
@@ -213,12 +261,42 @@ class WorkBenchMergeTest(unittest.TestCase):
         heads = wb2.unpack_structure(serialized)
         
         repo2 = wb2._load_repo_from_mutable(heads[0])
-        
+
         repo2.log_commits('master')
-        
+
         self.assertEqual(repo2._dotgit, repo1._dotgit)
-        
-        
+
+    def test_pack_repository_haves(self):
+        wb1 = workbench.WorkBench('No Process Test')
+
+        repo1, ab = wb1.init_repository(addressbook_type)
+
+        commit_ref1 = repo1.commit(comment='a')
+        commit_ref2 = repo1.commit(comment='b')
+
+        wb2 = workbench.WorkBench('No Process Test')
+        heads = wb2.unpack_structure(wb1.pack_repository(repo1))
+        repo2 = wb2._load_repo_from_mutable(heads[0])
+
+        commit_ref3 = repo1.commit(comment='c')
+        commit_ref4 = repo1.commit(comment='d')
+
+        # Send only the commits which are newer than the heads in wb2
+        haves = wb2._head_keys(repo2)
+        self.assertEqual(haves, set([commit_ref2]))
+
+        serialized = wb1.pack_repository(repo1, haves)
+
+        heads, obj_dict = wb1._unpack_container(serialized)
+        self.assertEqual(set(obj_dict.keys()), set([heads[0].key, commit_ref3, commit_ref4]))
+
+        heads = wb2.unpack_structure(serialized)
+        repo2 = wb2._load_repo_from_mutable(heads[0])
+
+        self.assertEqual(repo2._dotgit, repo1._dotgit)
+        self.assertEqual(repo2.is_ancestor(commit_ref1, commit_ref4), True)
+
+
     @defer.inlineCallbacks
     def test_divergent_merge(self):
         wb1 = workbench.WorkBench('No Process Test')
@@ -306,4 +384,350 @@ class WorkBenchMergeTest(unittest.TestCase):
         
                         
         
-        
\ No newline at end of file
+                
+        
+class FetchCountingProcess(object):
+    """
+    Stand in for a process which fetches linked objects directly from the
+    workbench of another 'process' and counts the number of round trips.
+    """
+    
+    def __init__(self, source_wb):
+        self.source_wb = source_wb
+        self.workbench = workbench.WorkBench(self)
+        self.fetch_count = 0
+        # Fetches fail while this is set
+        self.failure = None
+        # Replies wait for this Deferred while it is set
+        self.gate = None
+        
+    def fetch_linked_objects(self, address, links, closure=False, max_bytes=None):
+        self.fetch_count += 1
+        if self.failure is not None:
+            return defer.fail(self.failure)
+        
+        raw_links = [link.GPBMessage for link in links]
+        cs = self.source_wb._pack_linked_objects(raw_links, closure, max_bytes)
+        
+        objs = self.workbench.unpack_structure(cs.SerializeToString())
+        self.workbench._hashed_elements.update(objs)
+        if self.gate is not None:
+            d = defer.Deferred()
+            self.gate.addCallback(lambda _: d.callback(objs))
+            return d
+        return defer.succeed(objs)
+        
+        
+class WorkBenchFetchTest(unittest.TestCase):
+        
+    def setUp(self):
+        wb = workbench.WorkBench('No Process Test')
+        
+        repo, ab = wb.init_repository(addresslink_type)
+        
+        for name in ['David', 'John', 'Michael']:
+            p = repo.create_object(person_type)
+            p.name = name
+            ab.person.add()
+            ab.person[len(ab.person)-1] = p
+        
+        ab.owner = ab.person[0]
+        repo.commit('Three people')
+        
+        self.wb = wb
+        self.repo = repo
+        self.ab = ab
+        
+        self.proc = FetchCountingProcess(wb)
+        
+    def _remote_repo(self):
+        heads = self.proc.workbench.unpack_structure(self.wb.pack_repository(self.repo))
+        
+        repo = self.proc.workbench._load_repo_from_mutable(heads[0])
+        repo.upstream['process'] = 'source'
+        return repo
+        
+    @defer.inlineCallbacks
+    def test_checkout_fetches_by_level(self):
+        
+        repo = self._remote_repo()
+        
+        ab = yield repo.checkout('master')
+        
+        # One fetch for the root object and one for all of its children
+        self.assertEqual(self.proc.fetch_count, 2)
+        self.assertEqual(ab.person[2].name, 'Michael')
+        self.assertIdentical(ab.owner, ab.person[0])
+        
+    @defer.inlineCallbacks
+    def test_checkout_batch_size(self):
+        
+        repo = self._remote_repo()
+        repo.fetch_batch_size = 2
+        
+        ab = yield repo.checkout('master')
+        
+        # The three children are split into two batches
+        self.assertEqual(self.proc.fetch_count, 3)
+        self.assertEqual(ab.person[1].name, 'John')
+        
+    @defer.inlineCallbacks
+    def test_checkout_closure(self):
+        
+        repo = self._remote_repo()
+        repo.fetch_closure = True
+        
+        ab = yield repo.checkout('master')
+        
+        self.assertEqual(self.proc.fetch_count, 1)
+        self.assertEqual(ab.person[0].name, 'David')
+        
+    def _root_links(self, repo):
+        return [cref.GetLink('objectroot') for cref in repo._commit_index.values()]
+        
+    @defer.inlineCallbacks
+    def test_transfer_batches(self):
+        
+        repo = self._remote_repo()
+        reports = []
+        transfer = workbench.ObjectTransfer(self.proc.workbench, repo, 'source',
+                                            self.proc.fetch_linked_objects,
+                                            batch_bytes=1, batch_links=2, in_flight=2,
+                                            progress=reports.append, progress_interval=0)
+        transfer.add(self._root_links(repo))
+        status = yield transfer.run()
+        
+        # The root, then one person per fetch - the byte budget leaves the
+        # others out of each reply and they are asked for again
+        self.assertEqual(status['objects'], 4)
+        self.assertEqual(status['pending'], 0)
+        self.assertEqual(self.proc.fetch_count, 4)
+        self.assertEqual(reports[-1], status)
+        
+        # Everything is here
+        ab = yield repo.checkout('master')
+        self.assertEqual(ab.person[2].name, 'Michael')
+        self.assertEqual(self.proc.fetch_count, 4)
+        
+    @defer.inlineCallbacks
+    def test_transfer_resume(self):
+        
+        repo = self._remote_repo()
+        wb = self.proc.workbench
+        
+        # The root arrives, then its children fail to
+        transfer = workbench.ObjectTransfer(wb, repo, 'source', self.proc.fetch_linked_objects)
+        transfer.add(self._root_links(repo))
+        
+        fetch = self.proc.fetch_linked_objects
+        def fetch_once(address, links, **kwargs):
+            d = fetch(address, links, **kwargs)
+            self.proc.failure = defer.TimeoutError()
+            return d
+        transfer.fetch = fetch_once
+        
+        try:
+            yield transfer.run()
+            self.fail('TimeoutError expected')
+        except defer.TimeoutError:
+            pass
+        self.assertEqual(len(transfer.received), 1)
+        self.assertEqual(len(transfer.remaining()), 3)
+        
+        # A failed push leaves the transfer to resume
+        self.proc.failure = None
+        wb._unfinished_transfers[repo.repository_key] = transfer
+        known = set(repo._commit_index.keys())
+        status = yield wb._fetch_repo_objects(repo, 'source', known)
+        self.assertEqual(status['objects'], 4)
+        self.assertEqual(wb._unfinished_transfers, {})
+        
+        ab = yield repo.checkout('master')
+        self.assertEqual(ab.person[1].name, 'John')
+        
+    @defer.inlineCallbacks
+    def test_transfer_resume_late_reply(self):
+        
+        # A second commit whose root has a different first person
+        keys = set([self.ab.MyId] + [p.MyId for p in self.ab.person])
+        self.ab.person[0].name = 'Dave'
+        self.repo.commit('Renamed')
+        keys.update([self.ab.MyId] + [p.MyId for p in self.ab.person])
+        
+        repo = self._remote_repo()
+        wb = self.proc.workbench
+        
+        # The reply for one root is held back and the fetch of the other fails
+        fetch = self.proc.fetch_linked_objects
+        calls = []
+        late = defer.Deferred()
+        def flaky_fetch(address, links, **kwargs):
+            calls.append(links)
+            if len(calls) == 1:
+                d = fetch(address, links, **kwargs)
+                late.addCallback(lambda _: d)
+                return late
+            if len(calls) == 2:
+                return defer.fail(defer.TimeoutError())
+            return fetch(address, links, **kwargs)
+        self.proc.fetch_linked_objects = flaky_fetch
+        
+        saved = (workbench.CF_transfer_batch_links, workbench.CF_transfer_retries)
+        workbench.CF_transfer_batch_links = 1
+        workbench.CF_transfer_retries = 0
+        try:
+            try:
+                yield wb._fetch_repo_objects(repo, 'source')
+                self.fail('TimeoutError expected')
+            except defer.TimeoutError:
+                pass
+            
+            # The held back reply arrives after the transfer failed
+            late.callback(None)
+            
+            # The commits are here now, only the transfer is left to resume
+            known = set(repo._commit_index.keys())
+            yield wb._fetch_repo_objects(repo, 'source', known)
+        finally:
+            workbench.CF_transfer_batch_links, workbench.CF_transfer_retries = saved
+            
+        self.assertEqual(wb._unfinished_transfers, {})
+        for key in keys:
+            self.assertIn(key, wb._hashed_elements)
+            
+    @defer.inlineCallbacks
+    def test_transfer_retry_progress(self):
+        
+        repo = self._remote_repo()
+        reports = []
+        fetch = self.proc.fetch_linked_objects
+        def fail_once(address, links, **kwargs):
+            if self.proc.fetch_count == 0:
+                self.proc.fetch_count += 1
+                return defer.fail(defer.TimeoutError())
+            return fetch(address, links, **kwargs)
+        
+        transfer = workbench.ObjectTransfer(self.proc.workbench, repo, 'source', fail_once,
+                                            retries=1, progress=reports.append,
+                                            progress_interval=0)
+        transfer.add(self._root_links(repo))
+        status = yield transfer.run()
+        
+        # The retry is reported before anything arrived
+        self.assertEqual(reports[0]['objects'], 0)
+        self.assertEqual(reports[0]['fetches'], 1)
+        self.assertEqual(status['objects'], 4)
+        
+    @defer.inlineCallbacks
+    def test_fetch_joins_transfer(self):
+        
+        repo = self._remote_repo()
+        wb = self.proc.workbench
+        self.proc.gate = defer.Deferred()
+        
+        # A push sent again while the first transfer is still going
+        d1 = wb._fetch_repo_objects(repo, 'source')
+        reports = []
+        d2 = wb._fetch_repo_objects(repo, 'source', progress=reports.append)
+        self.assertEqual(self.proc.fetch_count, 1)
+        self.assertFalse(d2.called)
+        # The second pusher hears of the transfer from now on
+        self.assertEqual(len(reports), 1)
+        
+        gate, self.proc.gate = self.proc.gate, None
+        gate.callback(None)
+        status1 = yield d1
+        status2 = yield d2
+        self.assertEqual(status1['objects'], 4)
+        # Nothing was left for the second one to fetch
+        self.assertEqual(status2['objects'], 0)
+        self.assertEqual(self.proc.fetch_count, 2)
+        self.assertEqual(wb._active_transfers, {})
+        
+    def test_pack_max_bytes(self):
+        
+        links = [link.GPBMessage for link in self._root_links(self.repo)]
+        cs = self.wb._pack_linked_objects(links, closure=True)
+        self.assertEqual(len(cs.items), 4)
+        
+        # At least one object, however small the budget
+        cs = self.wb._pack_linked_objects(links, closure=True, max_bytes=1)
+        self.assertEqual(len(cs.items), 1)
+        
+        
+class HashedElementCacheTest(unittest.TestCase):
+    
+    def _element(self, value):
+        se = gpb_wrapper.StructureElement()
+        se.value = value
+        se.type = person_type
+        se.key = se.sha1
+        return se
+    
+    def test_lru_eviction(self):
+        cache = workbench.HashedElementCache(max_elements=2)
+        
+        a = self._element('a')
+        b = self._element('b')
+        c = self._element('c')
+        
+        cache[a.key] = a
+        cache[b.key] = b
+        
+        # Use a so that b is the least recently used
+        self.assertIdentical(cache.get(a.key), a)
+        
+        cache[c.key] = c
+        self.assertEqual(cache.collect(), 1)
+        
+        self.assertIn(a.key, cache)
+        self.assertNotIn(b.key, cache)
+        self.assertIn(c.key, cache)
+        
+        self.assertEqual(cache.get(b.key), None)
+        
+        stats = cache.stats()
+        self.assertEqual(stats['elements'], 2)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['evictions'], 1)
+        
+    def test_byte_limit(self):
+        cache = workbench.HashedElementCache(max_bytes=100)
+        
+        big = self._element('x'*60)
+        bigger = self._element('y'*60)
+        
+        cache[big.key] = big
+        cache[bigger.key] = bigger
+        cache.collect()
+        
+        self.assertEqual(len(cache), 1)
+        self.assertIn(bigger.key, cache)
+        self.assertEqual(cache.stats()['bytes'], bigger.size)
+        
+    @defer.inlineCallbacks
+    def test_pinned_elements(self):
+        wb = workbench.WorkBench('No Process Test')
+        repo, ab = wb.init_repository(addressbook_type)
+        p = ab.person.add()
+        p.name = 'David'
+        repo.commit('Loaded in the workspace')
+        
+        pinned = set(wb._hashed_elements.keys())
+        
+        # Add some elements which are not loaded in any repository
+        wb2 = workbench.WorkBench('No Process Test')
+        repo2, ab2 = wb2.init_repository(addressbook_type)
+        for name in ['John', 'Michael']:
+            ab2.title = name
+            repo2.commit(name)
+        wb._hashed_elements.update(wb2._hashed_elements)
+        
+        wb._hashed_elements.max_elements = 1
+        wb._hashed_elements.collect()
+        
+        self.assertEqual(set(wb._hashed_elements.keys()), pinned)
+        
+        ab = yield repo.checkout('master')
+        self.assertEqual(ab.person[0].name, 'David')
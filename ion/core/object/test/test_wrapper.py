@@ -5,10 +5,12 @@
 @author David Stuebe
 @test Service the protobuffers wrapper class
 """
+from __future__ import with_statement
 
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
 from uuid import uuid4
+import time
 
 from twisted.trial import unittest
 #from twisted.internet import defer
@@ -22,11 +24,16 @@ from ion.core.object import repository
 from ion.core.object import workbench
 from ion.core.object import object_utils
 
+from ion.core import ioninit
+from ion.util.itv_decorator import itv
+CONF = ioninit.config(__name__)
+
 person_type = object_utils.create_type_identifier(object_id=20001, version=1)
 addresslink_type = object_utils.create_type_identifier(object_id=20003, version=1)
 addressbook_type = object_utils.create_type_identifier(object_id=20002, version=1)
 
 attribute_type = object_utils.create_type_identifier(object_id=10017, version=1)
+testobj_type = object_utils.create_type_identifier(object_id=20010, version=1)
 
 class WrapperMethodsTest(unittest.TestCase):
     
@@ -433,4 +440,128 @@ class RecurseCommitTest(unittest.TestCase):
         
         
         
-            
\ No newline at end of file
+            
+        
+        
+class BulkEditTest(unittest.TestCase):
+    
+    def setUp(self):
+        wb = workbench.WorkBench('No Process Test')
+        
+        repo, ab = wb.init_repository(addressbook_type)
+        repo.commit('Empty address book')
+        
+        self.repo = repo
+        self.ab = ab
+        
+    def test_set_fields(self):
+        p = self.ab.person.add()
+        self.repo.commit('Added a person')
+        self.assertEqual(self.ab.Modified, False)
+        
+        p.SetFields(name='David', id=5, email='d@s.com')
+        
+        self.assertEqual(p.name, 'David')
+        self.assertEqual(p.id, 5)
+        self.assertEqual(self.ab.Modified, True)
+        
+        # Only scalar fields can be set
+        self.assertRaises(gpb_wrapper.OOIObjectError, p.SetFields, phone=None)
+        self.assertRaises(gpb_wrapper.OOIObjectError, p.SetFields, foobar=5)
+        self.assertRaises(TypeError, p.SetFields, id='five')
+        
+    def test_bulk_edit(self):
+        
+        with self.ab.BulkEdit() as msg:
+            msg.title = 'Raw'
+            p = msg.person.add()
+            p.name = 'David'
+            
+        self.assertEqual(self.ab.Modified, True)
+        self.assertEqual(self.ab.title, 'Raw')
+        self.assertEqual(self.ab.person[0].name, 'David')
+        
+        self.repo.commit('Bulk edit')
+        self.ab.ReadOnly = True
+        
+        def edit():
+            with self.ab.BulkEdit() as msg:
+                msg.title = 'Not allowed'
+                
+        self.assertRaises(gpb_wrapper.OOIObjectError, edit)
+        
+    def test_extend_raw(self):
+        
+        person_cls = object_utils.get_gpb_class_from_type_id(person_type)
+        raw = []
+        for i in range(3):
+            p = person_cls()
+            p.name = 'Person %d' % i
+            p.id = i
+            raw.append(p)
+        
+        self.ab.person.extend_raw(raw)
+        self.assertEqual(len(self.ab.person), 3)
+        self.assertEqual(self.ab.person[2].name, 'Person 2')
+        
+        simple = gpb_wrapper.Wrapper._create_object(testobj_type)
+        simple.integers.extend(range(5))
+        self.assertEqual(simple.integers[4], 4)
+        # Values are type checked
+        self.assertRaises(TypeError, simple.integers.extend, ['five'])
+        
+        simple.ReadOnly = True
+        self.assertRaises(gpb_wrapper.OOIObjectError, simple.integers.extend, [5])
+        
+        # Links must be set through the wrapper
+        alink = gpb_wrapper.Wrapper._create_object(addresslink_type)
+        link_cls = object_utils.get_gpb_class_from_type_id(gpb_wrapper.link_type)
+        self.assertRaises(gpb_wrapper.OOIObjectError, alink.person.extend_raw, [link_cls()])
+        
+    @itv(CONF)
+    def test_bulk_edit_performance(self):
+        count = 10000
+        
+        ab = gpb_wrapper.Wrapper._create_object(addressbook_type)
+        
+        tzero = time.time()
+        for i in xrange(count):
+            p = ab.person.add()
+            p.name = 'David'
+            p.id = i
+            p.email = 'd@s.com'
+        per_field = time.time() - tzero
+        
+        bulk_ab = gpb_wrapper.Wrapper._create_object(addressbook_type)
+        
+        tzero = time.time()
+        with bulk_ab.BulkEdit() as msg:
+            for i in xrange(count):
+                p = msg.person.add()
+                p.name = 'David'
+                p.id = i
+                p.email = 'd@s.com'
+        bulk = time.time() - tzero
+        
+        self.assertEqual(ab, bulk_ab)
+        
+        person_cls = object_utils.get_gpb_class_from_type_id(person_type)
+        raw_ab = gpb_wrapper.Wrapper._create_object(addressbook_type)
+        
+        tzero = time.time()
+        raw_people = []
+        for i in xrange(count):
+            p = person_cls()
+            p.name = 'David'
+            p.id = i
+            p.email = 'd@s.com'
+            raw_people.append(p)
+        raw_ab.person.extend_raw(raw_people)
+        raw = time.time() - tzero
+        
+        self.assertEqual(ab, raw_ab)
+        
+        print('Repeated composite, %d elements: per field %f s, bulk edit %f s, speedup %.1fx' % \
+            (count, per_field, bulk, per_field / max(bulk, 1e-6)))
+        print('Repeated composite, %d elements: per field %f s, extend_raw %f s, speedup %.1fx' % \
+            (count, per_field, raw, per_field / max(raw, 1e-6)))
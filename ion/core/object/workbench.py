@@ -8,15 +8,23 @@ TODO
 Add persistent store to the work bench. Use it fetch linked objects
 """
 
-from twisted.internet import defer
+import binascii
+import time
+
+from twisted.internet import defer, reactor
+from twisted.internet.error import ConnectError, ConnectionLost
+from twisted.python import failure
 
 from google.protobuf import message
 
 from google.protobuf.internal import decoder
+from google.protobuf.internal import encoder
+from google.protobuf.internal import wire_format
 
 from ion.core.object import object_utils
 from ion.core.object import repository
 from ion.core.object import gpb_wrapper
+from ion.core.exception import ReceivedError
 
 from twisted.internet import defer
 
@@ -25,24 +33,453 @@ log = ion.util.ionlog.getLogger(__name__)
 
 from net.ooici.core.container import container_pb2
 
+from ion.core import ioninit
+CONF = ioninit.config(__name__)
+
+# Limits for the hashed elements cache of each work bench - 0 is unbounded
+CF_cache_max_elements = CONF.getValue('cache_max_elements', 0)
+CF_cache_max_bytes = CONF.getValue('cache_max_bytes', 0)
+# Ask the receiver of a push for its heads so that only new commits are sent
+CF_push_negotiate = CONF.getValue('push_negotiate', True)
+# Seconds a push waits for the receiver without progress, and how often it is
+# sent again after a failure. The receiver reports progress as batches arrive
+# and as failed fetches are retried, so this must exceed the time one fetch
+# may take (the rpc_timeout of the receiver) with room to spare.
+CF_push_timeout = CONF.getValue('push_timeout', 90)
+CF_push_resumes = CONF.getValue('push_resumes', 2)
+# Transfer of the objects of a push: bytes the sender packs in one reply - 0
+# is unbounded, links asked for in one fetch, and fetches in flight at once
+CF_transfer_batch_bytes = CONF.getValue('transfer_batch_bytes', 1048576)
+CF_transfer_batch_links = CONF.getValue('transfer_batch_links', 1000)
+CF_transfer_in_flight = CONF.getValue('transfer_in_flight', 4)
+# Failed fetches of a link before a transfer gives up, and seconds between
+# progress reports
+CF_transfer_retries = CONF.getValue('transfer_retries', 3)
+CF_transfer_progress_interval = CONF.getValue('transfer_progress_interval', 1.0)
+
+# Failures of a push which are worth sending it again for: the receiver
+# also asks for it when its transfer failed, see op_push
+PUSH_RETRY_ERRORS = (defer.TimeoutError, ConnectError, ConnectionLost)
+PUSH_RESUMABLE = 'resumable'
+
 structure_element_type = object_utils.create_type_identifier(object_id=1, version=1)
 structure_type = object_utils.create_type_identifier(object_id=2, version=1)
 
 idref_type = object_utils.create_type_identifier(object_id=4, version=1)
 gpbtype_type = object_utils.create_type_identifier(object_id=9, version=1)
 
+# Field numbers used to write and scan the container wire format directly
+_structure_fields = object_utils.get_gpb_class_from_type_id(structure_type).DESCRIPTOR.fields_by_name
+_element_fields = object_utils.get_gpb_class_from_type_id(structure_element_type).DESCRIPTOR.fields_by_name
+
+HEADS_FIELD = _structure_fields['heads'].number
+ITEMS_FIELD = _structure_fields['items'].number
+KEY_FIELD = _element_fields['key'].number
+
+HEADS_TAG = encoder.TagBytes(HEADS_FIELD, wire_format.WIRETYPE_LENGTH_DELIMITED)
+ITEMS_TAG = encoder.TagBytes(ITEMS_FIELD, wire_format.WIRETYPE_LENGTH_DELIMITED)
+
 
 class WorkBenchError(Exception):
     """
     An exception class for errors that occur in the Object WorkBench class
     """
 
+def encode_keys(keys):
+    """
+    Encode a set of binary sha1 keys as a string which can go in a header
+    """
+    return ','.join([binascii.b2a_hex(key) for key in keys])
+    
+def decode_keys(value):
+    """
+    Decode a string of keys made by encode_keys
+    """
+    if not value:
+        return set()
+    return set([binascii.a2b_hex(hexkey) for hexkey in value.split(',')])
+
+
+class RepositoryTransfer(object):
+    """
+    @brief Message content for sending repositories without the commits which
+    the receiver already has. The history of each repository is packed down
+    to, but not including, the commits in haves.
+    """
+    def __init__(self, repos, haves=None):
+        self.repos = repos
+        self.haves = haves or set()
+
+
+class ObjectTransfer(object):
+    """
+    @brief Fetches the objects below a set of links from another process in
+    batches. Each fetch asks for at most batch_links links and the sender packs
+    at most batch_bytes of objects in its reply; links it leaves out are asked
+    for again. Up to in_flight fetches are outstanding at once. A failed fetch
+    is retried, and the transfer fails when a link failed retries times. Then
+    remaining() gives the links not yet received, and run() resumes the
+    transfer. Replies which arrive after it failed are still taken in, so the
+    links below them are fetched when it resumes.
+    """
+    def __init__(self, workbench, repo, origin, fetch, batch_bytes=None,
+                 batch_links=None, in_flight=None, retries=None,
+                 progress=None, progress_interval=None):
+        """
+        @param fetch fetch_linked_objects(address, links, max_bytes=...) of the
+        process or work bench
+        @param progress optional callable given status() as batches arrive and
+        as failed fetches are retried
+        Limits which are not given come from the config.
+        """
+        self.workbench = workbench
+        self.repo = repo
+        self.origin = origin
+        self.fetch = fetch
+        self.batch_bytes = batch_bytes
+        if batch_bytes is None:
+            self.batch_bytes = CF_transfer_batch_bytes
+        self.batch_links = batch_links or CF_transfer_batch_links
+        self.in_flight = in_flight or CF_transfer_in_flight
+        self.retries = retries
+        if retries is None:
+            self.retries = CF_transfer_retries
+        self.progress = progress
+        self.progress_interval = progress_interval
+        if progress_interval is None:
+            self.progress_interval = CF_transfer_progress_interval
+        
+        # Links to fetch, and the keys queued or in flight
+        self._queue = []
+        self._queued = set()
+        # Batches in flight by number
+        self._batches = {}
+        self._batch_count = 0
+        # Failed fetches by key
+        self._attempts = {}
+        self._filling = False
+        self._done = None
+        self._reported = 0
+        
+        self.received = set()
+        self.bytes = 0
+        self.fetches = 0
+        
+    def add(self, links):
+        """
+        Queue links to fetch, unless they are here or queued already
+        """
+        hashed = self.workbench._hashed_elements
+        for link in links:
+            key = link.key
+            if key in self._queued or key in self.received or key in hashed:
+                continue
+            self._queued.add(key)
+            self._queue.append(link)
+            
+    def remaining(self):
+        """
+        The links queued or in flight
+        """
+        links = list(self._queue)
+        for batch in self._batches.values():
+            links.extend(batch)
+        return links
+        
+    def status(self):
+        return {'repository':self.repo.repository_key, 'objects':len(self.received),
+                'bytes':self.bytes, 'pending':len(self._queued), 'fetches':self.fetches}
+        
+    def run(self):
+        """
+        Start the transfer, or resume it after it failed. Its fetches still in
+        flight are waited for.
+        @retval Deferred which fires with status() when everything below the
+        links is here
+        """
+        if self._done is not None:
+            self._attempts = {}
+        self._done = defer.Deferred()
+        self._fill()
+        return self._done
+        
+    def _fill(self):
+        # Replies which arrive while sending are handled by the loop
+        if self._filling or self._done.called:
+            return
+        self._filling = True
+        try:
+            while self._queue and len(self._batches) < self.in_flight and not self._done.called:
+                batch = self._queue[:self.batch_links]
+                del self._queue[:self.batch_links]
+                self._batch_count += 1
+                self._batches[self._batch_count] = batch
+                self.fetches += 1
+                d = defer.maybeDeferred(self.fetch, self.origin, batch, max_bytes=self.batch_bytes)
+                d.addCallbacks(self._received, self._fetch_failed,
+                               callbackArgs=(self._batch_count,), errbackArgs=(self._batch_count,))
+                d.addErrback(self._fail)
+        finally:
+            self._filling = False
+            
+        if not self._queue and not self._batches:
+            self._report(final=True)
+            if not self._done.called:
+                self._done.callback(self.status())
+                
+    def _received(self, objs, batchno):
+        batch = self._batches.pop(batchno)
+        
+        # The datastore returns a list of elements, the workbench a dictionary
+        if not isinstance(objs, dict):
+            objs = dict([(wse.key, wse) for wse in objs or () if wse is not None])
+        hashed = self.workbench._hashed_elements
+        
+        missing = []
+        loaded = []
+        for link in batch:
+            element = objs.get(link.key) or hashed.get(link.key)
+            if element is None:
+                missing.append(link)
+                continue
+            self._queued.discard(link.key)
+            self.received.add(link.key)
+            self.bytes += len(element.value)
+            if not link.isleaf:
+                loaded.append(link)
+                
+        if len(missing) == len(batch):
+            self._retry(batch, failure.Failure(WorkBenchError(
+                'Fetch from %s returned none of %d objects' % (self.origin, len(batch)))))
+            return
+        
+        # Left out by the byte budget of the sender - ask for them first
+        self._queue[:0] = missing
+        
+        for link in loaded:
+            obj = self.repo.get_linked_object(link)
+            self.add(obj.ChildLinks)
+            
+        if self._done.called:
+            # Failed already - kept for a resumed run
+            return
+        self._report()
+        self._fill()
+        
+    def _fetch_failed(self, reason, batchno):
+        self._retry(self._batches.pop(batchno), reason)
+        
+    def _retry(self, batch, reason):
+        self._queue[:0] = batch
+        if self._done.called:
+            return
+        attempts = 0
+        for link in batch:
+            attempts = max(attempts, self._attempts.get(link.key, 0) + 1)
+            self._attempts[link.key] = attempts
+        if attempts > self.retries:
+            log.warn('Transfer from %s failed with %d objects left: %s' % (
+                self.origin, len(self._queued), reason.getErrorMessage()))
+            self._done.errback(reason)
+            return
+        log.warn('Fetch of %d objects from %s failed, retrying: %s' % (
+            len(batch), self.origin, reason.getErrorMessage()))
+        # Still going - keeps the push from timing out
+        self._report()
+        self._fill()
+        
+    def _fail(self, reason):
+        if not self._done.called:
+            self._done.errback(reason)
+            
+    def _report(self, final=False):
+        if self.progress is None:
+            return
+        now = time.time()
+        if final or now - self._reported >= self.progress_interval:
+            self._reported = now
+            self.progress(self.status())
+            
+            
+class HashedElementCache(object):
+    """
+    @brief Content addressed cache for the structure elements shared by all the
+    repositories in a work bench. It behaves like the dictionary it replaces,
+    but when max_elements or max_bytes is set the least recently used elements
+    are evicted. Elements whose keys are pinned - loaded in a live workspace
+    or commit index - are never evicted. An evicted element is fetched again
+    through fetch_linked_objects the next time it is needed.
+    
+    Eviction runs on the next pass of the reactor after an insert, so elements
+    which arrive together in a message can be loaded before they become
+    candidates for eviction. Call collect to evict immediately.
+    """
+    
+    def __init__(self, max_elements=0, max_bytes=0, pinned=None):
+        
+        self.max_elements = max_elements
+        self.max_bytes = max_bytes
+        
+        self._pinned = pinned
+        """
+        A callable which returns the set of keys which must not be evicted
+        """
+        
+        self._elements = {}
+        self._last_used = {}
+        self._tick = 0
+        self._bytes = 0
+        self._collect_call = None
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+    def _touch(self, key):
+        self._tick += 1
+        self._last_used[key] = self._tick
+        
+    def _element_size(self, element):
+        return element.size
+        
+    def _over_limit(self):
+        if self.max_elements and len(self._elements) > self.max_elements:
+            return True
+        if self.max_bytes and self._bytes > self.max_bytes:
+            return True
+        return False
+    
+    def _schedule_collect(self):
+        if self._collect_call is None and self._over_limit():
+            self._collect_call = reactor.callLater(0, self.collect)
+        
+    def collect(self):
+        """
+        Evict least recently used, unpinned elements until the cache is within
+        its limits. Returns the number of elements evicted.
+        """
+        if self._collect_call is not None:
+            if self._collect_call.active():
+                self._collect_call.cancel()
+            self._collect_call = None
+            
+        if not self._over_limit():
+            return 0
+        
+        pinned = set()
+        if self._pinned:
+            pinned = self._pinned()
+        
+        candidates = [(tick, key) for key, tick in self._last_used.iteritems() if not key in pinned]
+        candidates.sort()
+        
+        evicted = 0
+        for tick, key in candidates:
+            if not self._over_limit():
+                break
+            self._remove(key)
+            evicted += 1
+            
+        self.evictions += evicted
+        if self._over_limit():
+            log.info('HashedElementCache: %d elements (%d bytes) are pinned above the cache limits' % (len(self._elements), self._bytes))
+        return evicted
+        
+    def _remove(self, key):
+        element = self._elements.pop(key)
+        del self._last_used[key]
+        self._bytes -= self._element_size(element)
+        return element
+    
+    def stats(self):
+        """
+        Return the cache counters as a dictionary
+        """
+        return {'elements':len(self._elements),
+                'bytes':self._bytes,
+                'hits':self.hits,
+                'misses':self.misses,
+                'evictions':self.evictions}
+        
+    def get(self, key, default=None):
+        element = self._elements.get(key, None)
+        if element is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._touch(key)
+        return element
+        
+    def __getitem__(self, key):
+        element = self.get(key)
+        if element is None:
+            raise KeyError(key)
+        return element
+        
+    def __setitem__(self, key, element):
+        old = self._elements.get(key, None)
+        if old is not None:
+            self._bytes -= self._element_size(old)
+        self._elements[key] = element
+        self._bytes += self._element_size(element)
+        self._touch(key)
+        self._schedule_collect()
+        
+    def __delitem__(self, key):
+        self._remove(key)
+        
+    def update(self, elements):
+        for key, element in elements.iteritems():
+            self[key] = element
+            
+    def has_key(self, key):
+        return key in self._elements
+    
+    def __contains__(self, key):
+        return key in self._elements
+        
+    def __len__(self):
+        return len(self._elements)
+    
+    def __iter__(self):
+        return iter(self._elements)
+    
+    def keys(self):
+        return self._elements.keys()
+    
+    def values(self):
+        return self._elements.values()
+    
+    def items(self):
+        return self._elements.items()
+    
+    def iteritems(self):
+        return self._elements.iteritems()
+    
+
 class WorkBench(object):
  
     MutableClassType = object_utils.create_type_identifier(object_id=6, version=1)
     LinkClassType = object_utils.create_type_identifier(object_id=3, version=1)
     CommitClassType = object_utils.create_type_identifier(object_id=8, version=1)
     
+    FETCH_CLOSURE = 'fetch-closure'
+    """
+    Header set by fetch_linked_objects to ask for everything reachable from
+    the requested links, not just the linked objects themselves.
+    """
+    
+    HAVE_HEADS = 'have-heads'
+    """
+    Header set by pull to give the head commits the requester already has, so
+    that only newer commits are sent in the reply.
+    """
+    
+    FETCH_MAX_BYTES = 'fetch-max-bytes'
+    """
+    Header set by fetch_linked_objects to limit the bytes of objects in the
+    reply. The requested objects which do not fit are left out.
+    """
     
     def __init__(self, myprocess):   
     
@@ -53,11 +490,34 @@ class WorkBench(object):
         self._repository_nicknames = {}
         
         """
-        A dictionary - shared between repositories for hashed objects
+        A dictionary like cache - shared between repositories for hashed objects
         """  
-        self._hashed_elements={}
+        self._hashed_elements=HashedElementCache(max_elements=CF_cache_max_elements,
+                                                 max_bytes=CF_cache_max_bytes,
+                                                 pinned=self._pinned_keys)
+        
+        # The transfers of repositories whose push failed, by key
+        self._unfinished_transfers = {}
+        
+        # (ObjectTransfer, Deferreds waiting for it to end) of the transfers
+        # in progress, by repository key
+        self._active_transfers = {}
+        
+        # Progress callbacks of the pushes in progress, by conv-id
+        self._push_progress = {}
       
       
+    def _pinned_keys(self):
+        """
+        The keys of hashed elements which are loaded in the workspace or commit
+        index of a repository in this work bench. These must stay in the cache.
+        """
+        pinned = set()
+        for repo in self._repos.values():
+            pinned.update(repo._workspace.keys())
+            pinned.update(repo._commit_index.keys())
+        return pinned
+      
     def create_repository(self, root_type=None, nickname=None):
         """
         New better method to initialize a repository.
@@ -174,7 +634,13 @@ class WorkBench(object):
         #print 'PULL Targetname: ', targetname
         #print 'PULL RepoName: ', repo_name
         
-        heads, headers, msg = yield self._process.rpc_send(targetname,'pull', repo_name)
+        # Tell the origin which commits we already have
+        pull_headers = None
+        local_repo = self.get_repository(repo_name)
+        if local_repo is not None:
+            pull_headers = {self.HAVE_HEADS:encode_keys(self._head_keys(local_repo))}
+        
+        heads, headers, msg = yield self._process.rpc_send(targetname,'pull', repo_name, headers=pull_headers)
         
         response = headers.get(self._process.MSG_RESPONSE)
         exception = headers.get(self._process.MSG_EXCEPTION)
@@ -212,17 +678,30 @@ class WorkBench(object):
         repo = self.get_repository(content)
         
         if repo:
-            yield self._process.reply(msg,content=repo)
+            haves = decode_keys(headers.get(self.HAVE_HEADS, None))
+            if haves:
+                # Only send the commits which are newer than the requester's heads
+                yield self._process.reply(msg,content=RepositoryTransfer([repo], haves))
+            else:
+                yield self._process.reply(msg,content=repo)
         else:
             yield self._process.reply(msg,response_code=self._process.APP_RESOURCE_NOT_FOUND)
         
         
     @defer.inlineCallbacks
-    def push(self, origin, name_or_names):
+    def push(self, origin, name_or_names, progress=None):
         """
         Push the current state of the repository.
         When the operation is complete - the transfer of all objects in the
         repository is complete.
+        
+        The receiver fetches the objects in batches and sends progress messages
+        meanwhile; the push times out after push_timeout seconds without any.
+        After a failure the push is sent again, up to push_resumes times, and
+        the receiver resumes the transfer from the objects it has.
+        @param progress optional callable given the progress reports of the
+        receiver, dicts of 'repository', 'objects', 'bytes', 'pending' and
+        'fetches'
         """
         targetname = self._process.get_scoped_name('system', origin)
         
@@ -242,9 +721,48 @@ class WorkBench(object):
             if not repo_or_repos:
                     raise KeyError('Repository name %s not found in work bench to push!' % name)
 
+        # Progress reports of the receiver come to this process
+        if not hasattr(self._process, 'op_push_progress'):
+            setattr(self._process, 'op_push_progress', self.op_push_progress)
+            
+        attempt = 0
+        while True:
+            try:
+                result = yield self._send_push(origin, targetname, repo_or_repos, progress)
+                break
+            except (PUSH_RETRY_ERRORS + (ReceivedError,)), ex:
+                # Pushes the receiver rejected are not sent again
+                if isinstance(ex, ReceivedError) and not self._push_resumable(ex):
+                    raise
+                attempt += 1
+                if attempt > CF_push_resumes:
+                    raise
+                log.warn('Push to %s failed, resuming it: %s' % (origin, ex))
+                
+        defer.returnValue(result)
+        
+    @defer.inlineCallbacks
+    def _send_push(self, origin, targetname, repo_or_repos, progress=None):
+        
+        if CF_push_negotiate:
+            # Negotiate by head keys - send only the commits the target does not have
+            repos = repo_or_repos
+            if not isinstance(repos, list):
+                repos = [repos]
+            haves = yield self.get_heads(origin, [repo.repository_key for repo in repos])
+            repo_or_repos = RepositoryTransfer(repos, haves)
     
-        #print 'PUSH TARGET: ',targetname
-        content, headers, msg = yield self._process.rpc_send(targetname,'push', repo_or_repos)
+        # The push times out unless progress reports keep coming
+        convid = self._process._create_convid()
+        if progress is not None:
+            self._push_progress[convid] = progress
+        try:
+            #print 'PUSH TARGET: ',targetname
+            content, headers, msg = yield self._process.rpc_send(targetname,'push', repo_or_repos,
+                                                                 headers={'conv-id':convid, 'conv-seq':1},
+                                                                 timeout=CF_push_timeout)
+        finally:
+            self._push_progress.pop(convid, None)
     
         response = headers.get(self._process.MSG_RESPONSE)
         exception = headers.get(self._process.MSG_EXCEPTION)
@@ -256,7 +774,30 @@ class WorkBench(object):
             defer.returnValue((response, exception))
 
         else:
-            raise WorkBenchError('Push returned an exception!' % exception)
+            raise WorkBenchError('Push returned an exception: %s' % exception)
+            
+    def _push_resumable(self, ex):
+        """
+        True if the receiver of a push failed to fetch its objects and asks for
+        the push again, to resume the transfer
+        """
+        content = getattr(ex, 'msg_content', None)
+        return isinstance(content, dict) and bool(content.get(PUSH_RESUMABLE))
+        
+    def op_push_progress(self, content, headers, msg):
+        """
+        A progress report of the receiver of a push. Restarts the timeout of
+        the push and passes the report on to the progress callback of push.
+        """
+        convid = content.get('conv-id')
+        rpc_deferred = self._process.rpc_conv.get(convid)
+        call = getattr(rpc_deferred, 'rpc_call', None)
+        if call is not None and call.active():
+            call.reset(CF_push_timeout)
+            
+        progress = self._push_progress.get(convid)
+        if progress is not None:
+            progress(content)
             
 
         
@@ -265,25 +806,127 @@ class WorkBench(object):
         """
         The Operation which responds to a push.
         
-        Operation does not complete until transfer is complete!
+        Operation does not complete until transfer is complete! If the transfer
+        fails, the reply is an error which asks the pusher to push again, and
+        the next push resumes the transfer. Returns True if the transfer
+        completed.
         """
         log.info('op_push: received content: %s' % heads)
+        
+        origin = headers.get('reply-to')
+        progress = self._push_progress_sender(origin, headers.get('conv-id'))
                 
         for head in heads:
+            # The commits we had before the push already have their objects
+            known = set()
+            existing_repo = self.get_repository(self._mutable_repository_key(head))
+            if existing_repo is not None:
+                known.update(existing_repo._commit_index.keys())
+            
             repo = self._load_repo_from_mutable(head)
                 
-            yield self._fetch_repo_objects(repo, headers.get('reply-to'))
+            try:
+                yield self._fetch_repo_objects(repo, origin, known, progress)
+            except Exception, ex:
+                log.warn('op_push: Transfer of %s from %s failed: %s' % (
+                    repo.repository_key, origin, ex))
+                yield self._process.reply_err(msg, {'errmsg':'Transfer failed: %s' % ex,
+                                                    PUSH_RESUMABLE:True})
+                defer.returnValue(False)
             
         # The following line shows how to reply to a message
         yield self._process.reply_ok(msg)
         log.info('op_push: Complete!')
+        defer.returnValue(True)
 
         
+    def _push_progress_sender(self, origin, convid):
+        """
+        A callable which sends transfer progress to the pusher, for op_push_progress
+        """
+        def send_progress(status):
+            content = dict(status)
+            content['conv-id'] = convid
+            d = self._process.send(origin, 'push_progress', content)
+            d.addErrback(lambda reason: log.warn('Could not send push progress to %s: %s' % (
+                origin, reason.getErrorMessage())))
+        return send_progress
+        
+    @defer.inlineCallbacks
+    def get_heads(self, origin, repo_keys):
+        """
+        Ask origin for the head commits of its copies of the repositories.
+        Returns the set of head commit keys.
+        """
+        targetname = self._process.get_scoped_name('system', origin)
+        
+        content, headers, msg = yield self._process.rpc_send(targetname,'get_heads', list(repo_keys))
+        
+        haves = set()
+        if isinstance(content, dict):
+            for value in content.values():
+                haves.update(decode_keys(value))
+                
+        defer.returnValue(haves)
+        
+    @defer.inlineCallbacks
+    def op_get_heads(self, content, headers, msg):
+        """
+        Reply with the head commit keys of the repositories we have, keyed by
+        repository key. Repositories which are not found are left out.
+        """
+        heads = {}
+        for repo_key in content:
+            repo = self.get_repository(repo_key)
+            if repo is not None:
+                heads[repo_key] = encode_keys(self._head_keys(repo))
+                
+        yield self._process.reply(msg,content=heads)
+        
+    def _head_keys(self, repo):
+        """
+        The keys of the head commits of every branch in the repository
+        """
+        keys = set()
+        for branch in repo.branches:
+            for link in branch.commitrefs.GetLinks():
+                keys.add(link.key)
+        return keys
+        
+    def _mutable_repository_key(self, head):
+        """
+        Read the repository key from a mutable head element without loading it
+        """
+        raw_mutable = object_utils.get_gpb_class_from_type_id(self.MutableClassType)()
+        raw_mutable.ParseFromString(head.value)
+        return str(raw_mutable.repositorykey)
+        
     @defer.inlineCallbacks
-    def _fetch_repo_objects(self, repo, origin):
+    def _fetch_repo_objects(self, repo, origin, known=None, progress=None):
         """
-        This method does not have a return value? What should it be?
+        Fetch the objects of the commits of a repository from origin in
+        batches, see ObjectTransfer. Returns the status of the transfer.
+        Commits in known are skipped along with their ancestors - their objects
+        are already here. If an earlier transfer of the repository failed, it
+        is resumed. A transfer of the repository
+        already in progress - for a push which was sent again - is waited for
+        first, and its progress reports go to this caller from then on.
         """
+        key = repo.repository_key
+        while key in self._active_transfers:
+            transfer, waiters = self._active_transfers[key]
+            log.info('Waiting for the transfer of %s in progress' % key)
+            if progress is not None:
+                transfer.progress = progress
+                progress(transfer.status())
+            d = defer.Deferred()
+            waiters.append(d)
+            try:
+                yield d
+            except Exception:
+                # Its remaining links are fetched below
+                pass
+            
         cref_links = set()
         for branch in repo.branches:
             
@@ -299,6 +942,9 @@ class WorkBench(object):
             for ref_link in cref_links:
                 refs_touched.add(ref_link)
                 
+                if known and ref_link.key in known:
+                    continue
+                
                 cref= repo.get_linked_object(ref_link)
                     
                 obj_link = cref.GetLink('objectroot')
@@ -317,34 +963,48 @@ class WorkBench(object):
             cref_links = new_links
             
             
-        # Recursively get the structure
-        while len(objs_to_get) > 0:
-
-            new_links = set()
-            
-            # Get the objects we don't have
-            ### Call the method defined by the process - not the workbench!
-            result = yield self._process.fetch_linked_objects(origin, objs_to_get)
-            
-            if not result:
-                raise WorkBenchError('Fetch failed!')
-            
-            # Would like to have fetch use reply to - to keep the conversation context but does not work yet...
-            #yield self.fetch_linked_objects(msg, objs_to_get)
-            
-            for link in objs_to_get:
-                if not link.isleaf:
-                    obj = repo.get_linked_object(link)
-                    for child_link in obj.ChildLinks:
-                        if not self._hashed_elements.has_key(child_link.key):
-                            new_links.add(child_link)
+        # Get the structure below the objects we don't have
+        ### Call the method defined by the process - not the workbench!
+        if hasattr(self._process, 'fetch_linked_objects'):
+            fetch = self._process.fetch_linked_objects
+        else:
+            fetch = self.fetch_linked_objects
             
-            objs_to_get = new_links
+        transfer = self._unfinished_transfers.pop(key, None)
+        if transfer is None:
+            transfer = ObjectTransfer(self, repo, origin, fetch, progress=progress)
+        else:
+            # Resume it - including the fetches which were still in flight
+            transfer.repo = repo
+            transfer.origin = origin
+            transfer.fetch = fetch
+            transfer.progress = progress
+        transfer.add(objs_to_get)
+        waiters = []
+        self._active_transfers[key] = (transfer, waiters)
+        try:
+            status = yield transfer.run()
+        except Exception, ex:
+            # Resume from here with the next push
+            self._unfinished_transfers[key] = transfer
+            reason = failure.Failure()
+            del self._active_transfers[key]
+            for d in waiters:
+                d.errback(reason)
+            reason.raiseException()
+        
+        del self._active_transfers[key]
+        for d in waiters:
+            d.callback(status)
+        defer.returnValue(status)
     
     @defer.inlineCallbacks
-    def fetch_linked_objects(self, address, links):
+    def fetch_linked_objects(self, address, links, closure=False, max_bytes=None):
         """
         Fetch the linked objects from the data store service
+        If closure is True, the reply includes every object reachable from the
+        links which the other process has. If max_bytes is given, the reply
+        holds no more than that, and may leave out requested objects.
         """     
             
         cs = object_utils.get_gpb_class_from_type_id(structure_type)()
@@ -363,8 +1023,13 @@ class WorkBench(object):
             se.key = se.sha1
             se.isleaf = link.isleaf # What does this mean in this context?
             
+        headers = {}
+        if closure:
+            headers[self.FETCH_CLOSURE] = 'True'
+        if max_bytes:
+            headers[self.FETCH_MAX_BYTES] = str(max_bytes)
             
-        objs, headers, msg = yield self._process.rpc_send(address,'fetch_linked_objects', cs)
+        objs, headers, msg = yield self._process.rpc_send(address,'fetch_linked_objects', cs, headers=headers)
         
         # put the dictionary of new objects into the hased elements list
         self._hashed_elements.update(objs)
@@ -379,8 +1044,8 @@ class WorkBench(object):
         Send a linked object back to a requestor if you have it!
         """
         log.info('op_fetch_linked_objects: received content type, %s; \n Elements: %s' % (type(elements), str(elements)))
-        cs = object_utils.get_gpb_class_from_type_id(structure_type)()
         
+        links = []
         # Elements is a dictionary of wrapped structure elements
         for se in elements.values():
             
@@ -388,8 +1053,29 @@ class WorkBench(object):
     
             link = object_utils.get_gpb_class_from_type_id(self.LinkClassType)()
             link.ParseFromString(se.value)
-
-            se = cs.items.add()
+            links.append(link)
+            
+        closure = headers.get(self.FETCH_CLOSURE, False) == 'True'
+        max_bytes = int(headers.get(self.FETCH_MAX_BYTES, 0) or 0)
+        cs = self._pack_linked_objects(links, closure, max_bytes)
+        
+        yield self._process.reply(message,content=cs)
+        log.info('op_fetch_linked_objects: Complete!')
+        
+    def _pack_linked_objects(self, links, closure=False, max_bytes=0):
+        """
+        Helper for op_fetch_linked_objects - pack the hashed elements for a list
+        of raw link objects into a container structure. If closure is True also
+        pack all the objects reachable from the links which are present in the
+        hashed elements. If max_bytes is set, packing stops before the values
+        exceed it, after at least one object.
+        """
+        cs = object_utils.get_gpb_class_from_type_id(structure_type)()
+        
+        size = 0
+        packed = set()
+        items = []
+        for link in links:
         
             item = self._hashed_elements.get(link.key,None)
             
@@ -400,47 +1086,97 @@ class WorkBench(object):
             assert item.isleaf == link.isleaf, 'Link isleaf does not match item isleaf!'
             assert item.key == link.key, 'Link key does not match item key!'
             
-            # Can not set the pointer directly... must set the components
-            se.value = item.value
+            if not item.key in packed:
+                packed.add(item.key)
+                items.append(item)
+            
+        while len(items) > 0:
+            
+            child_items = []
+            for item in items:
+                
+                if max_bytes and size and size + len(item.value) > max_bytes:
+                    # The requestor asks again for what is left out
+                    return cs
+                size += len(item.value)
+                
+                se = cs.items.add()
+                
+                # Can not set the pointer directly... must set the components
+                se.value = item.value
 
-            se.key = item.key
-            se.isleaf = item.isleaf # What does this mean in this context?
-            se.type.CopyFrom(item.type) # Copy is okay - this is small
+                se.key = item.key
+                se.isleaf = item.isleaf # What does this mean in this context?
+                se.type.CopyFrom(item.type) # Copy is okay - this is small
+                
+                if not closure or item.isleaf:
+                    continue
+                
+                for key in self._get_child_keys(item):
+                    child = self._hashed_elements.get(key, None)
+                    # Send what we have - the requestor can fetch the rest
+                    if child and not key in packed:
+                        packed.add(key)
+                        child_items.append(child)
+                        
+            items = child_items
+            
+        return cs
         
-        yield self._process.reply(message,content=cs)
-        log.info('op_fetch_linked_objects: Complete!')
+    def _get_child_keys(self, element):
+        """
+        Return the keys of the objects linked from a hashed element. Elements
+        which arrived in a message have not been loaded yet, so their child links
+        are found by decoding the value once and noting them in the element.
+        """
+        if element.isleaf or len(element.ChildLinks) > 0:
+            return element.ChildLinks
+        
+        obj = gpb_wrapper.Wrapper._create_object(element.type)
+        obj.ParseFromString(element.value)
+        obj.FindChildLinks()
+        
+        for link in obj.ChildLinks:
+            element.ChildLinks.add(link.key)
+            
+        return element.ChildLinks
         
-    def pack_repositories(self, repos):
+    def pack_repositories(self, repos, haves=None):
         
-        container_structure = object_utils.get_gpb_class_from_type_id(structure_type)()
+        # Serialized containers concatenate - repeated heads and items merge
+        # when the result is parsed.
+        parts = []
         for repo in repos:
             log.debug('pack_repositories: Packing repository:\n'+str(repo))
-            container_structure.MergeFrom(self._repo_to_structure(repo))
+            parts.append(self._serialize_repository(repo, haves))
 
-        print 'CONTAINER',container_structure
         log.debug('pack_repositories: Packing Complete!')         
-        serialized = container_structure.SerializeToString()
+        serialized = ''.join(parts)
         
         return serialized
         
         
         
-    def pack_repository(self,repo):
+    def pack_repository(self,repo, haves=None):
         
         log.debug('pack_repository: Packing repository:\n'+str(repo))
-        container_structure = self._repo_to_structure(repo)
+        serialized = self._serialize_repository(repo, haves)
         
         log.debug('pack_repository: Packing Complete!')         
-        serialized = container_structure.SerializeToString()
         return serialized
         
         
-    def _repo_to_structure(self,repo):
+    def _serialize_repository(self,repo, haves=None):
         """
         pack just the mutable head and the commits!
         By default send all commits in the history. Too damn complex on the other
         side to deal with merge otherwise.
+        
+        If haves - a set of commit keys the receiver already has - is given, the
+        history stops at those commits. The receiver has them and their ancestors.
         """
+        if haves is None:
+            haves = ()
         
         mutable = repo._dotgit
         
@@ -459,6 +1195,8 @@ class WorkBench(object):
             new_set = set()
                         
             for cref in cref_set:
+                if cref.MyId in haves or cref.MyId in obj_set:
+                    continue
                 obj_set.add(cref.MyId)
                     
                 for prefs in cref.parentrefs:
@@ -474,9 +1212,9 @@ class WorkBench(object):
             obj_list.append(key)
                 
         
-        container_structure = self._pack_container(root_obj, obj_list)
+        serialized = self._pack_container(root_obj, obj_list)
         
-        return container_structure
+        return serialized
         
     def pack_structure(self, wrapper, include_leaf=True):
         """
@@ -550,10 +1288,9 @@ class WorkBench(object):
         
         #print 'OBJLIST',obj_list
         
-        container_structure = self._pack_container(root_obj, obj_list)
+        serialized = self._pack_container(root_obj, obj_list)
         log.debug('pack_structure: Packing Complete!')
         
-        serialized = container_structure.SerializeToString()
         return serialized
         
     def serialize_mutable(self, mutable):
@@ -569,9 +1306,8 @@ class WorkBench(object):
         repo = mutable.Repository
         for link in  mutable.ChildLinks:
                                     
-            if  repo._hashed_elements.has_key(link.key):
-                child_se = repo._hashed_elements.get(link.key)
-
+            child_se = repo._hashed_elements.get(link.key)
+            if  child_se is not None:
                 # Set the links is leaf property
                 link.isleaf = child_se.isleaf
                 
@@ -603,32 +1339,26 @@ class WorkBench(object):
         Helper for the sender to pack message content into a container in order
         Awkward interface. Head is wrapper object, object_keys is a list of keys.
         Should be all objects or all keys...
+        
+        Returns the serialized container. The wire format is written directly
+        from the serialized elements so the values are not copied into a new
+        container message and encoded a second time.
         """
         log.debug('_pack_container: Packing container head and object_keys!')
-        # An unwrapped GPB Structure message to put stuff into!
-        cs = object_utils.get_gpb_class_from_type_id(structure_type)()
         
-        cs.heads.add()
-        cs.heads[0].key = head._element.key
-        cs.heads[0].type.CopyFrom(head._element.type)
-        cs.heads[0].isleaf = head._element.isleaf
-        cs.heads[0].value = head._element.value
+        head_bytes = head.serialize()
+        parts = [HEADS_TAG, encoder._VarintBytes(len(head_bytes)), head_bytes]
                         
         for key in object_keys:
-            hashed_obj = self._hashed_elements.get(key)         
-            gpb_obj = hashed_obj._element
-                        
-            se = cs.items.add()
-        
-            # Can not set the pointer directly... must set the components
-            se.key = gpb_obj.key
-            se.isleaf = gpb_obj.isleaf
-            se.type.CopyFrom(gpb_obj.type) # Copy is okay - this is small
-            se.value = gpb_obj.value # Let python's object manager keep track of the pointer to the big things!
-        
+            hashed_obj = self._hashed_elements.get(key)
+            se_bytes = hashed_obj.serialize()
+            
+            parts.append(ITEMS_TAG)
+            parts.append(encoder._VarintBytes(len(se_bytes)))
+            parts.append(se_bytes)
         
         log.debug('_pack_container: Packed container!')
-        return cs
+        return ''.join(parts)
         
     def unpack_structure(self, serialized_container):
         """
@@ -697,42 +1427,85 @@ class WorkBench(object):
         Helper for the receiver for unpacking message content
         Returns the content as a list of ids in order now in the workbench
         hashed elements dictionary
+        
+        The container is scanned without decoding the elements - each one is
+        a lazy structure element over its slice of the received buffer.
         """
             
         log.debug('_unpack_container: Unpacking Container')
-        # An unwrapped GPB Structure message to put stuff into!
-        cs = object_utils.get_gpb_class_from_type_id(structure_type)()
-            
+        
         try:
-            cs.ParseFromString(serialized_container)
-        except decoder._DecodeError, de:
+            heads, obj_dict = self._scan_container(serialized_container)
+        except (decoder._DecodeError, IndexError, TypeError), ex:
             log.debug('Received invalid content: "%s"' % str(serialized_container))
             raise WorkBenchError('Could not decode message content as a GPB container structure!')
-                
-        # Return arguments
-        heads = []
-        obj_dict={}
-        
-        if cs.heads:
-            # The head field is optional - if not included this is a fetch links op            
-            
-            for raw_head in cs.heads:
-                
-                wrapped_head = gpb_wrapper.StructureElement(raw_head)
-                #self._hashed_elements[head.key]=head
-                obj_dict[wrapped_head.key] = wrapped_head
-                heads.append(wrapped_head)
-            
-        for se in cs.items:
-            wse = gpb_wrapper.StructureElement(se)
-            
-            obj_dict[wse.key] = wse
         
         log.debug('_unpack_container: returning head:\n'+str(heads))
         log.debug('_unpack_container: returning dictionary of objects:\n'+str(obj_dict))
         
         return heads, obj_dict
         
+    def _scan_container(self, buf):
+        """
+        Walk the wire format of a serialized container and return its heads and
+        items as lazy structure elements. Only the key of each element is read.
+        """
+        heads = []
+        obj_dict = {}
+        
+        pos = 0
+        end = len(buf)
+        while pos < end:
+            tag, pos = decoder._DecodeVarint(buf, pos)
+            field_number, wire_type = wire_format.UnpackTag(tag)
+            if wire_type != wire_format.WIRETYPE_LENGTH_DELIMITED or \
+                    field_number not in (HEADS_FIELD, ITEMS_FIELD):
+                raise decoder._DecodeError('Unexpected field in container: %d' % field_number)
+                
+            length, pos = decoder._DecodeVarint(buf, pos)
+            se_end = pos + length
+            if se_end > end:
+                raise decoder._DecodeError('Truncated structure element!')
+            
+            key = self._scan_element_key(buf, pos, se_end)
+            wse = gpb_wrapper.StructureElement.lazy_structure_element(buf, pos, se_end, key)
+            
+            obj_dict[key] = wse
+            if field_number == HEADS_FIELD:
+                heads.append(wse)
+            
+            pos = se_end
+            
+        return heads, obj_dict
+    
+    def _scan_element_key(self, buf, pos, end):
+        """
+        Read the key field of a serialized structure element, skipping over the
+        other fields without decoding them.
+        """
+        key = None
+        while pos < end:
+            tag, pos = decoder._DecodeVarint(buf, pos)
+            field_number, wire_type = wire_format.UnpackTag(tag)
+            
+            if wire_type == wire_format.WIRETYPE_LENGTH_DELIMITED:
+                length, pos = decoder._DecodeVarint(buf, pos)
+                if field_number == KEY_FIELD:
+                    key = buf[pos:pos+length]
+                pos += length
+            elif wire_type == wire_format.WIRETYPE_VARINT:
+                value, pos = decoder._DecodeVarint(buf, pos)
+            elif wire_type == wire_format.WIRETYPE_FIXED64:
+                pos += 8
+            elif wire_type == wire_format.WIRETYPE_FIXED32:
+                pos += 4
+            else:
+                raise decoder._DecodeError('Unexpected wire type in structure element: %d' % wire_type)
+        
+        if pos != end or key is None:
+            raise decoder._DecodeError('Invalid structure element!')
+        return key
+        
     def _load_repo_from_mutable(self,head):
         """
         Load a repository from a mutable - helper for push and pull - methods
@@ -746,6 +1519,13 @@ class WorkBench(object):
             
         new_repo._hashed_elements = self._hashed_elements
         
+        # Check and see if we already have one of these repositories
+        existing_repo = self.get_repository(new_repo.repository_key)
+        
+        # Commits we already have were not necessarily sent again with this head
+        known = None
+        if existing_repo:
+            known = existing_repo._commit_index
         
         # Load all of the commit refs that came with this head.
         
@@ -753,11 +1533,9 @@ class WorkBench(object):
 
             # Check for merge on read condition!            
             for link in branch.commitrefs.GetLinks():
-                self._load_commits(new_repo,link)
+                self._load_commits(new_repo,link, known)
             
             
-        # Check and see if we already have one of these repositories
-        existing_repo = self.get_repository(new_repo.repository_key)
         if existing_repo:
             
             # Merge the existing head with the new one.
@@ -774,24 +1552,44 @@ class WorkBench(object):
         return repo 
             
     
-    def _load_commits(self, repo, link):
+    def _load_commits(self, repo, link, known=None):
+        """
+        Load the commit and all of its ancestors into the repository's commit
+        graph index. Each commit is visited once - shared ancestors of merges are
+        not walked again and long histories do not recurse. The ancestors of
+        commits in known are not loaded.
+        """
                 
         log.debug('_load_commits: Loading all commits in the repository')
         
-        try:
-            cref = repo.get_linked_object(link)
-        except repository.RepositoryError, ex:
-            log.debug(ex)
-            raise WorkBenchError('Commit id not found while loding commits: \n %s' % link.key)
-            # This commit ref was not actually sent!
-            
-        if cref.ObjectType != self.CommitClassType:
-            raise WorkBenchError('This method should only load commits!')
-            
-        for parent in cref.parentrefs:
-            link = parent.GetLink('commitref')
-            # Call this method recursively for each link
-            self._load_commits(repo, link)
+        touched = set()
+        links = [link]
+        while links:
+            new_links = []
+            for link in links:
+                if link.key in touched:
+                    continue
+                touched.add(link.key)
+                
+                # Check before loading - known may be this repository's own index
+                stop = known is not None and link.key in known
+                
+                try:
+                    cref = repo.get_linked_object(link)
+                except repository.RepositoryError, ex:
+                    log.debug(ex)
+                    raise WorkBenchError('Commit id not found while loding commits: \n %s' % link.key)
+                    # This commit ref was not actually sent!
+                    
+                if cref.ObjectType != self.CommitClassType:
+                    raise WorkBenchError('This method should only load commits!')
+                
+                if stop:
+                    continue
+                    
+                for parent in cref.parentrefs:
+                    new_links.append(parent.GetLink('commitref'))
+            links = new_links
         
         log.debug('_load_commits: Loaded all commits!')
     
@@ -850,19 +1648,19 @@ class WorkBench(object):
                     # If these branches have the same state we are good - continue to the next new cref in the new branch. 
                     break
                     
-                # Look in the commit index of the existing repo to see if the new link is an old commit to existing
-                elif existing_repo._commit_index.has_key(new_link.key):
+                # Use the commit graph of the existing repo to see if the new link is an old commit to existing
+                elif existing_repo.is_ancestor(new_link.key, existing_link.key):
                     # The branch in new_repo is out of date with what exists here.
                     # We can completely ignore the new link!
                     break   
                     
-                # Look in the commit index of the new repo to see if the existing link is an old commit in new repository 
-                elif new_repo._commit_index.has_key(existing_link.key):
+                # Use the commit graph of the new repo to see if the existing link is an old commit in new repository 
+                elif new_repo.is_ancestor(existing_link.key, new_link.key):
                     # The existing repo can be fast forwarded to the new state!
                     # But we must keep looking through the existing_links to see if the push merges our state!
                     found = True
                     existing_link.key = new_link.key # Cheat and just copy the key!
-                    self._load_commits(existing_repo, new_link) # Load the new ancestors!
+                    self._load_commits(existing_repo, new_link, existing_repo._commit_index) # Load the new ancestors!
                 
                 # Anything state that is not caught by these three options is
                 # resolved in the else of the for loop by adding this divergent
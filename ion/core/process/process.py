@@ -20,8 +20,10 @@ from ion.core.exception import ReceivedError
 from ion.core.id import Id
 from ion.core.intercept.interceptor import Interceptor
 from ion.core.messaging.receiver import ProcessReceiver
+from ion.core.messaging import message_trace
 from ion.core.messaging.ion_reply_codes import ResponseCodes
 from ion.core.process.cprocess import IContainerProcess, ContainerProcess
+from ion.core.process import process_metrics
 from ion.data.store import Store
 from ion.interact.conversation import Conversation
 from ion.interact.message import Message
@@ -135,6 +137,10 @@ class Process(BasicLifecycleObject,ResponseCodes):
         # Conversations by conv-id for currently outstanding RPCs
         self.rpc_conv = {}
 
+        # Handler and RPC metrics, see op_get_metrics
+        self.metrics = process_metrics.get_metrics_registry().register(
+                                    self.id.full, self.proc_name, self.rpc_conv)
+
         # List of ProcessDesc instances of defined and spawned child processes
         self.child_procs = []
 
@@ -305,6 +311,7 @@ class Process(BasicLifecycleObject,ResponseCodes):
                 log.exception("Error terminating child %s" % child.proc_id)
 
         yield defer.maybeDeferred(self.plc_terminate)
+        process_metrics.get_metrics_registry().unregister(self.id.full)
         log.info('----- Process %s TERMINATED -----' % (self.proc_name))
 
     def plc_terminate(self):
@@ -400,6 +407,8 @@ class Process(BasicLifecycleObject,ResponseCodes):
         separated into RPC replies (by conversation ID) and other received
         messages.
         """
+        message_trace.get_tracer().trace(message_trace.DIRECTION_IN,
+                                         self.proc_name, payload, pid=self.id.full)
         try:
             # Check if this response is in reply to an outstanding RPC call
             if 'conv-id' in payload and payload['conv-id'] in self.rpc_conv:
@@ -419,7 +428,7 @@ class Process(BasicLifecycleObject,ResponseCodes):
         fromname = payload['sender']
         if 'sender-name' in payload:
             fromname = payload['sender-name']
-        log.info('>>> [%s] receive(): RPC reply from [%s] <<<' % (self.proc_name, fromname))
+        log.info('>>> [%s] receive(): RPC reply from [%s] <<<', self.proc_name, fromname)
         rpc_deferred = self.rpc_conv.pop(payload['conv-id'])
         content = payload.get('content', None)
         if type(rpc_deferred) is str:
@@ -429,10 +438,11 @@ class Process(BasicLifecycleObject,ResponseCodes):
         rpc_deferred.rpc_call.cancel()
         res = (content, payload, msg)
 
+        status = payload.get(self.MSG_STATUS, None)
+        self.metrics.finish(rpc_deferred.rpc_timer, error=(status != self.ION_OK))
 
         yield msg.ack()
         
-        status = payload.get(self.MSG_STATUS, None)
         if status == self.ION_OK:
             #Cannot do the callback right away, because the message is not yet handled
             reactor.callLater(0, lambda: rpc_deferred.callback(res))
@@ -460,8 +470,8 @@ class Process(BasicLifecycleObject,ResponseCodes):
         fromname = payload['sender']
         if 'sender-name' in payload:
             fromname = payload['sender-name']
-        log.info('#####>>> [%s] receive(): Message from [%s], dispatching... >>>' % (
-                 self.proc_name, fromname))
+        log.info('#####>>> [%s] receive(): Message from [%s], dispatching... >>>',
+                 self.proc_name, fromname)
         convid = payload.get('conv-id', None)
         conv = self.conversations.get(convid, None) if convid else None
         # Perform a dispatch of message by operation
@@ -512,11 +522,18 @@ class Process(BasicLifecycleObject,ResponseCodes):
             # dynamically invoke the operation in the given class
             if hasattr(self, opname):
                 opf = getattr(self, opname)
-                yield defer.maybeDeferred(opf, content, payload, msg)
             elif hasattr(self,'op_none'):
-                yield defer.maybeDeferred(self.op_none, content, payload, msg)
+                opf = self.op_none
             else:
                 log.error("receive() failed. Cannot dispatch to operation")
+                return
+            timer = self.metrics.start(process_metrics.KIND_OP, str(op))
+            try:
+                yield defer.maybeDeferred(opf, content, payload, msg)
+            except:
+                self.metrics.finish(timer, error=True)
+                raise
+            self.metrics.finish(timer)
         else:
             log.error("Invalid message. No 'op' in header", payload)
 
@@ -526,6 +543,24 @@ class Process(BasicLifecycleObject,ResponseCodes):
         """
         log.error('Process does not define op=%s' % headers.get('op',None))
 
+    def op_get_message_trace(self, content, headers, msg):
+        """
+        Replies with the traced summaries of recent messages to and from this
+        process, oldest first. content may be a dict with 'count' and 'op' to
+        narrow them down.
+        """
+        args = content if isinstance(content, dict) else {}
+        summaries = message_trace.get_tracer().recent(count=args.get('count'),
+                                                      pid=self.id.full, op=args.get('op'))
+        return self.reply_ok(msg, summaries)
+
+    def op_get_metrics(self, content, headers, msg):
+        """
+        Replies with the call counts and latencies of the operations this
+        process handled and the RPCs it sent, by operation
+        """
+        return self.reply_ok(msg, self.metrics.snapshot())
+
     # --- Outgoing message handling
 
     def rpc_send(self, recv, operation, content, headers=None, **kwargs):
@@ -544,10 +579,12 @@ class Process(BasicLifecycleObject,ResponseCodes):
             # Remove RPC. Delayed result will go to catch operation
             d = self.rpc_conv.pop(convid)
             self.rpc_conv[convid] = "TIMEOUT:%s" % pu.currenttime_ms()
+            self.metrics.timeout(d.rpc_timer)
             d.errback(defer.TimeoutError())
         if timeout:
             callto = reactor.callLater(timeout, _timeoutf)
             rpc_deferred.rpc_call = callto
+        rpc_deferred.rpc_timer = self.metrics.start(process_metrics.KIND_RPC, str(operation))
         self.rpc_conv[convid] = rpc_deferred
         d = self.send(recv, operation, content, msgheaders)
         # d is a deferred. The actual send of the request message will happen
@@ -564,6 +601,9 @@ class Process(BasicLifecycleObject,ResponseCodes):
         msgheaders = self._prepare_message(headers)
         message = dict(recipient=recv, operation=operation,
                        content=content, headers=msgheaders)
+        message_trace.get_tracer().trace(message_trace.DIRECTION_OUT, self.proc_name,
+                                         msgheaders, content, pid=self.id.full,
+                                         op=operation, receiver=str(recv))
         if reply:
             d = self.receiver.send(**message)
         else:
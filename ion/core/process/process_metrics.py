@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+
+"""
+@file ion/core/process/process_metrics.py
+@brief Per process and per operation metrics: call, error and in-flight
+counts, and latency histograms of op_* handler time and rpc_send round trip
+time. One MetricsRegistry is kept per container; processes reply with their
+own metrics on op_get_metrics, the CC agent with all of them.
+"""
+
+import math
+import time
+
+import ion.util.ionlog
+log = ion.util.ionlog.getLogger(__name__)
+
+from ion.core import ioninit
+CONF = ioninit.config(__name__)
+
+# Record metrics at all
+CF_enabled = CONF.getValue('enabled', True)
+# Histogram buckets per power of two are 2**sub_bucket_bits; the relative
+# error of a reported latency is at most 2**-sub_bucket_bits
+CF_sub_bucket_bits = CONF.getValue('sub_bucket_bits', 5)
+
+# Percentiles reported in a histogram snapshot
+PERCENTILES = (50, 90, 99, 99.9)
+
+KIND_OP = 'ops'
+KIND_RPC = 'rpc'
+
+
+class LatencyHistogram(object):
+    """
+    HDR style histogram of integer values (microseconds). Values below
+    2*2**sub_bucket_bits have a bucket each; above, each power of two is split
+    into 2**sub_bucket_bits buckets, so precision is relative and recording is
+    constant time. Buckets are kept sparse, by index.
+    """
+    def __init__(self, sub_bucket_bits=CF_sub_bucket_bits):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_buckets = 1 << sub_bucket_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value):
+        """
+        @retval index of the bucket of a value
+        """
+        sub = self.sub_buckets
+        if value < sub:
+            return value
+        # value has e bits; keep its top sub_bucket_bits+1 of them
+        shift = math.frexp(value)[1] - self.sub_bucket_bits - 1
+        return (shift + 1) * sub + (value >> shift) - sub
+
+    def bucket_value(self, index):
+        """
+        @retval lowest value in a bucket
+        """
+        sub = self.sub_buckets
+        if index < 2 * sub:
+            return index
+        shift = index // sub - 1
+        return (index % sub + sub) << shift
+
+    def record(self, value):
+        value = int(value)
+        if value < 0:
+            value = 0
+        index = self.bucket(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Adds the values of another histogram with the same sub_bucket_bits
+        """
+        assert other.sub_bucket_bits == self.sub_bucket_bits, \
+            "Cannot merge histograms of different precision"
+        for index, count in other.counts.iteritems():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def mean(self):
+        if not self.count:
+            return None
+        return float(self.total) / self.count
+
+    def percentile(self, pct):
+        """
+        @retval highest value of the bucket holding the pct percentile, at
+        most the largest value recorded; None if empty
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * pct / 100.0)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return max(min(self.bucket_value(index + 1) - 1, self.max), self.min)
+        return self.max
+
+    def snapshot(self):
+        """
+        @retval dict of count, min, max, mean and percentiles ('p50' etc.), and
+        'buckets', a list of [index, count] to rebuild the histogram from
+        """
+        res = {'count':self.count, 'min':self.min, 'max':self.max,
+               'mean':self.mean(), 'bits':self.sub_bucket_bits,
+               'buckets':sorted([index, count] for index, count in self.counts.iteritems())}
+        for pct in PERCENTILES:
+            res['p%s' % str(pct).replace('.', '')] = self.percentile(pct)
+        return res
+
+    @classmethod
+    def from_snapshot(cls, snap):
+        hist = cls(snap.get('bits', CF_sub_bucket_bits))
+        for index, count in snap['buckets']:
+            hist.counts[index] = count
+        hist.count = snap['count']
+        hist.min = snap['min']
+        hist.max = snap['max']
+        if snap['mean'] is not None:
+            hist.total = int(round(snap['mean'] * snap['count']))
+        return hist
+
+
+class OpMetrics(object):
+    """
+    Counts and latencies of one operation, handled or called by RPC
+    """
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.timeouts = 0
+        self.latency = LatencyHistogram()
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.errors += other.errors
+        self.in_flight += other.in_flight
+        self.timeouts += other.timeouts
+        self.latency.merge(other.latency)
+
+    def snapshot(self):
+        return {'calls':self.calls, 'errors':self.errors,
+                'in_flight':self.in_flight, 'timeouts':self.timeouts,
+                'latency_us':self.latency.snapshot()}
+
+    @classmethod
+    def from_snapshot(cls, snap):
+        opm = cls()
+        opm.calls = snap['calls']
+        opm.errors = snap['errors']
+        opm.in_flight = snap['in_flight']
+        opm.timeouts = snap['timeouts']
+        opm.latency = LatencyHistogram.from_snapshot(snap['latency_us'])
+        return opm
+
+
+class ProcessMetrics(object):
+    """
+    Metrics of one process: handled operations by op, and RPCs sent by op.
+    A call is started with start() and ended with finish() or timeout(),
+    passing the timer start() returned.
+    """
+    def __init__(self, pid, proc_name, rpc_conv=None, enabled=CF_enabled):
+        self.pid = pid
+        self.proc_name = proc_name
+        # The process' outstanding RPCs by conv-id, timed out ones as strings
+        self.rpc_conv = rpc_conv
+        self.enabled = enabled
+        self.ops = {}
+        self.rpc = {}
+        # Outstanding RPCs, and the most seen at once
+        self.rpc_in_flight = 0
+        self.rpc_pending_max = 0
+
+    def _get(self, table, op):
+        opm = table.get(op)
+        if opm is None:
+            opm = table[op] = OpMetrics()
+        return opm
+
+    def start(self, kind, op):
+        """
+        @retval timer, (OpMetrics, kind, start time), or None if disabled
+        """
+        if not self.enabled:
+            return None
+        if kind == KIND_OP:
+            opm = self._get(self.ops, op)
+        else:
+            opm = self._get(self.rpc, op)
+            self.rpc_in_flight += 1
+            if self.rpc_in_flight > self.rpc_pending_max:
+                self.rpc_pending_max = self.rpc_in_flight
+        opm.calls += 1
+        opm.in_flight += 1
+        return (opm, kind, time.time())
+
+    def finish(self, timer, error=False):
+        """
+        Ends a call started with start()
+        """
+        if timer is None:
+            return
+        opm, kind, started = timer
+        opm.in_flight -= 1
+        if kind == KIND_RPC:
+            self.rpc_in_flight -= 1
+        if error:
+            opm.errors += 1
+        opm.latency.record((time.time() - started) * 1000000)
+
+    def timeout(self, timer):
+        """
+        Ends an RPC that timed out; its time is not recorded
+        """
+        if timer is None:
+            return
+        opm = timer[0]
+        opm.in_flight -= 1
+        opm.timeouts += 1
+        self.rpc_in_flight -= 1
+
+    def snapshot(self):
+        """
+        @retval dict for a message
+        """
+        res = {'pid':self.pid, 'proc_name':self.proc_name,
+               'ops':dict((op, opm.snapshot()) for op, opm in self.ops.iteritems()),
+               'rpc':dict((op, opm.snapshot()) for op, opm in self.rpc.iteritems()),
+               'rpc_pending_max':self.rpc_pending_max}
+        rpc_conv = self.rpc_conv
+        if rpc_conv is not None:
+            expired = len([d for d in rpc_conv.itervalues() if isinstance(d, str)])
+            res['rpc_pending'] = len(rpc_conv) - expired
+            res['rpc_expired'] = expired
+        return res
+
+
+def aggregate(snapshots):
+    """
+    Merges process metrics snapshots by operation
+    @retval dict with 'ops' and 'rpc', each op -> merged OpMetrics snapshot,
+    and the summed 'rpc_pending'
+    """
+    totals = {KIND_OP:{}, KIND_RPC:{}}
+    pending = 0
+    for snap in snapshots:
+        pending += snap.get('rpc_pending', 0)
+        for kind, merged in totals.iteritems():
+            for op, opsnap in snap[kind].iteritems():
+                opm = OpMetrics.from_snapshot(opsnap)
+                if op in merged:
+                    merged[op].merge(opm)
+                else:
+                    merged[op] = opm
+    res = {'rpc_pending':pending}
+    for kind, merged in totals.iteritems():
+        res[kind] = dict((op, opm.snapshot()) for op, opm in merged.iteritems())
+    return res
+
+
+class MetricsRegistry(object):
+    """
+    The ProcessMetrics of the processes in a container, by process id
+    """
+    def __init__(self, enabled=CF_enabled):
+        self.enabled = enabled
+        self.processes = {}
+
+    def register(self, pid, proc_name, rpc_conv=None):
+        """
+        @retval the ProcessMetrics of a process, created on first use
+        """
+        pm = self.processes.get(pid)
+        if pm is None:
+            pm = ProcessMetrics(pid, proc_name, rpc_conv, self.enabled)
+            self.processes[pid] = pm
+        return pm
+
+    def unregister(self, pid):
+        self.processes.pop(pid, None)
+
+    def snapshot(self):
+        """
+        @retval dict with 'processes', process id -> snapshot, and 'totals',
+        the aggregate over all processes
+        """
+        procs = dict((pid, pm.snapshot()) for pid, pm in self.processes.iteritems())
+        return {'processes':procs, 'totals':aggregate(procs.values())}
+
+
+_registry = None
+
+def get_metrics_registry():
+    """
+    @retval the MetricsRegistry of the container
+    """
+    global _registry
+    if _registry is None:
+        _registry = MetricsRegistry()
+    return _registry
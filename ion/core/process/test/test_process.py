@@ -195,6 +195,34 @@ class ProcessTest(IonTestCase):
         except ReceivedError, re:
             log.info('Process 1 responded to error correctly')
 
+    @defer.inlineCallbacks
+    def test_metrics(self):
+        child1 = ProcessDesc(name='echo', module='ion.core.process.test.test_process')
+        pid1 = yield self.test_sup.spawn_child(child1)
+
+        yield self.test_sup.rpc_send(pid1, 'echo', 'content123')
+        try:
+            yield self.test_sup.rpc_send(pid1, 'echo_fail', 'content123')
+            self.fail("ReceivedError expected")
+        except ReceivedError, re:
+            pass
+
+        (cont, hdrs, msg) = yield self.test_sup.rpc_send(pid1, 'get_metrics', None)
+        self.assertEquals(cont['pid'], pid1.full)
+        self.assertEquals(cont['ops']['echo']['calls'], 1)
+        self.assertEquals(cont['ops']['echo']['errors'], 0)
+        self.assertEquals(cont['ops']['echo']['latency_us']['count'], 1)
+        # The handler replied with an error but did not fail
+        self.assertEquals(cont['ops']['echo_fail']['calls'], 1)
+        self.assertEquals(cont['ops']['echo_fail']['errors'], 0)
+        # The get_metrics call itself is in flight
+        self.assertEquals(cont['ops']['get_metrics']['in_flight'], 1)
+
+        rpc = self.test_sup.metrics.snapshot()['rpc']
+        self.assertEquals(rpc['echo']['calls'], 1)
+        self.assertEquals(rpc['echo_fail']['errors'], 1)
+        self.assertEquals(rpc['get_metrics']['in_flight'], 0)
+
     @defer.inlineCallbacks
     def test_send_byte_string(self):
         """
@@ -242,6 +270,10 @@ class ProcessTest(IonTestCase):
             self.fail("TimeoutError expected")
         except defer.TimeoutError, te:
             log.info('Timeout received')
+        snap = sup.metrics.snapshot()
+        self.assertEquals(snap['rpc']['noop']['timeouts'], 1)
+        self.assertEquals(snap['rpc']['noop']['in_flight'], 0)
+        self.assertEquals(snap['rpc_expired'], 1)
 
     @defer.inlineCallbacks
     def test_register_lco(self):
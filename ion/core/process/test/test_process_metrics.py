@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+@file ion/core/process/test/test_process_metrics.py
+@test ion.core.process.process_metrics histograms, counts and aggregation
+"""
+
+import random
+
+from twisted.trial import unittest
+
+from ion.core.process.process_metrics import LatencyHistogram, MetricsRegistry, \
+    KIND_OP, KIND_RPC
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def test_buckets(self):
+        hist = LatencyHistogram(5)
+        last = -1
+        for value in range(0, 5000) + [2**20, 2**40 + 12345]:
+            index = hist.bucket(value)
+            # Buckets are ordered, and hold their lowest value
+            self.assertTrue(index >= last)
+            last = index
+            low = hist.bucket_value(index)
+            self.assertTrue(low <= value)
+            self.assertTrue(value - low <= value / 32.0)
+            self.assertEqual(hist.bucket(low), index)
+
+    def test_percentiles(self):
+        hist = LatencyHistogram(5)
+        self.assertEqual(hist.percentile(50), None)
+        values = range(1, 10001)
+        random.shuffle(values)
+        for value in values:
+            hist.record(value)
+        self.assertEqual(hist.count, 10000)
+        self.assertEqual(hist.min, 1)
+        self.assertEqual(hist.max, 10000)
+        self.assertEqual(hist.mean(), 5000.5)
+        for pct in (50, 90, 99, 99.9):
+            exact = 10000 * pct / 100.0
+            self.assertTrue(abs(hist.percentile(pct) - exact) <= exact / 32.0)
+        self.assertEqual(hist.percentile(100), 10000)
+
+    def test_merge_snapshot(self):
+        hist1 = LatencyHistogram(5)
+        hist2 = LatencyHistogram(5)
+        for value in range(100):
+            hist1.record(value)
+            hist2.record(value * 1000)
+        merged = LatencyHistogram.from_snapshot(hist1.snapshot())
+        merged.merge(LatencyHistogram.from_snapshot(hist2.snapshot()))
+        self.assertEqual(merged.count, 200)
+        self.assertEqual(merged.min, 0)
+        self.assertEqual(merged.max, 99000)
+        self.assertEqual(merged.percentile(50), 99)
+
+
+class MetricsRegistryTest(unittest.TestCase):
+
+    def test_counts(self):
+        registry = MetricsRegistry()
+        rpc_conv = {}
+        pm = registry.register('p1', 'proc1', rpc_conv)
+        self.assertTrue(registry.register('p1', 'proc1') is pm)
+
+        pm.finish(pm.start(KIND_OP, 'echo'))
+        pm.finish(pm.start(KIND_OP, 'echo'), error=True)
+        pending = pm.start(KIND_OP, 'echo')
+        rpc1 = pm.start(KIND_RPC, 'store')
+        rpc2 = pm.start(KIND_RPC, 'store')
+        rpc_conv['c1'] = object()
+        rpc_conv['c2'] = 'TIMEOUT:0'
+        pm.timeout(rpc2)
+
+        snap = pm.snapshot()
+        self.assertEqual(snap['ops']['echo']['calls'], 3)
+        self.assertEqual(snap['ops']['echo']['errors'], 1)
+        self.assertEqual(snap['ops']['echo']['in_flight'], 1)
+        self.assertEqual(snap['ops']['echo']['latency_us']['count'], 2)
+        self.assertEqual(snap['rpc']['store']['timeouts'], 1)
+        self.assertEqual(snap['rpc']['store']['in_flight'], 1)
+        self.assertEqual(snap['rpc_pending'], 1)
+        self.assertEqual(snap['rpc_expired'], 1)
+        self.assertEqual(snap['rpc_pending_max'], 2)
+
+        pm.finish(pending)
+        pm.finish(rpc1)
+        pm2 = registry.register('p2', 'proc2')
+        pm2.finish(pm2.start(KIND_OP, 'echo'))
+        totals = registry.snapshot()['totals']
+        self.assertEqual(totals['ops']['echo']['calls'], 4)
+        self.assertEqual(totals['ops']['echo']['latency_us']['count'], 4)
+        self.assertEqual(totals['rpc']['store']['calls'], 2)
+
+        registry.unregister('p1')
+        self.assertEqual(registry.snapshot()['processes'].keys(), ['p2'])
+
+    def test_disabled(self):
+        pm = MetricsRegistry(enabled=False).register('p1', 'proc1')
+        timer = pm.start(KIND_OP, 'echo')
+        pm.finish(timer)
+        pm.timeout(timer)
+        self.assertEqual(pm.snapshot()['ops'], {})
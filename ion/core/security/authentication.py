@@ -50,6 +50,13 @@ class Authentication(object):
         take a message, and return a binary signature of it
         """
         pkey = EVP.load_key_string(rsa_private_key)
+        return self.sign_message_with_key(message, pkey)
+
+    def sign_message_with_key(self, message, pkey):
+        """
+        take a message, and return a binary signature of it
+        @param pkey parsed private key, M2Crypto.EVP.PKey
+        """
         pkey.sign_init()
         pkey.sign_update(message)
         sig = pkey.sign_final()
@@ -66,7 +73,14 @@ class Authentication(object):
         This verifies that the message and the signature are indeed signed by the certificate
         """
         x509 = X509.load_cert_string(certificate)
-        pubkey = x509.get_pubkey()
+        return self.verify_message_with_key(message, x509.get_pubkey(), signed_message)
+
+    def verify_message_with_key(self, message, pubkey, signed_message):
+        """
+        This verifies that the message and the signature are indeed signed by
+        the owner of the public key
+        @param pubkey parsed public key, M2Crypto.EVP.PKey
+        """
         pubkey.verify_init()
         pubkey.verify_update(message)
         if pubkey.verify_final(signed_message) == 1:
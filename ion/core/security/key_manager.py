@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""
+@file ion/core/security/key_manager.py
+@brief Loads private keys and certificates once and keeps the parsed objects,
+so signing and verifying a message does not read and parse PEM files. A file
+is read again when its modification time or size changes, checked at most
+once per check interval.
+"""
+
+import os
+import time
+
+from M2Crypto import EVP, X509
+
+import ion.util.ionlog
+log = ion.util.ionlog.getLogger(__name__)
+
+from ion.core import ioninit
+CONF = ioninit.config(__name__)
+
+# Seconds between checks of a key file for changes
+CF_check_interval = CONF.getValue('check_interval', 5.0)
+
+KIND_PEM = 'pem'
+KIND_PRIVATE_KEY = 'private_key'
+KIND_CERTIFICATE = 'certificate'
+KIND_PUBLIC_KEY = 'public_key'
+
+
+class KeyFile(object):
+    """
+    The contents of one key or certificate file and what was parsed from it
+    """
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+        self.checked = None
+        self.pem = None
+        # kind -> parsed object
+        self.parsed = {}
+
+
+class KeyManager(object):
+    """
+    Cache of key material by file path. The parsed M2Crypto objects are
+    shared; sign_init/verify_init reset them for each use.
+    """
+    def __init__(self, check_interval=CF_check_interval, clock=time.time):
+        self.check_interval = check_interval
+        self.clock = clock
+        self._files = {}
+        self._parsers = {
+            KIND_PRIVATE_KEY: lambda f: EVP.load_key_string(f.pem),
+            KIND_CERTIFICATE: lambda f: X509.load_cert_string(f.pem),
+            KIND_PUBLIC_KEY: lambda f: self._get(f, KIND_CERTIFICATE).get_pubkey(),
+            }
+        self.loads = 0
+
+    def pem(self, path):
+        """
+        @retval contents of the file
+        """
+        return self._file(path).pem
+
+    def private_key(self, path):
+        """
+        @retval M2Crypto.EVP.PKey of a PEM private key file
+        """
+        return self._get(self._file(path), KIND_PRIVATE_KEY)
+
+    def certificate(self, path):
+        """
+        @retval M2Crypto.X509.X509 of a PEM certificate file
+        """
+        return self._get(self._file(path), KIND_CERTIFICATE)
+
+    def public_key(self, path):
+        """
+        @retval M2Crypto.EVP.PKey public key of a PEM certificate file
+        """
+        return self._get(self._file(path), KIND_PUBLIC_KEY)
+
+    def invalidate(self, path=None):
+        """
+        Forgets one file, or all of them
+        """
+        if path is None:
+            self._files.clear()
+        else:
+            self._files.pop(path, None)
+
+    def _get(self, keyfile, kind):
+        obj = keyfile.parsed.get(kind)
+        if obj is None:
+            obj = self._parsers[kind](keyfile)
+            keyfile.parsed[kind] = obj
+        return obj
+
+    def _file(self, path):
+        now = self.clock()
+        keyfile = self._files.get(path)
+        if keyfile is not None and now - keyfile.checked < self.check_interval:
+            return keyfile
+
+        st = os.stat(path)
+        stamp = (st.st_mtime, st.st_size)
+        if keyfile is None or keyfile.stamp != stamp:
+            if keyfile is not None:
+                log.info('Key file %s changed, reloading' % path)
+            keyfile = KeyFile(path)
+            f = open(path)
+            try:
+                keyfile.pem = f.read()
+            finally:
+                f.close()
+            keyfile.stamp = stamp
+            self._files[path] = keyfile
+            self.loads += 1
+        keyfile.checked = now
+        return keyfile
+
+
+_manager = None
+
+def get_key_manager():
+    """
+    @retval the KeyManager shared by the container
+    """
+    global _manager
+    if _manager is None:
+        _manager = KeyManager()
+    return _manager
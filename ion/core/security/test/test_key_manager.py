@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""
+@file ion/core/security/test/test_key_manager.py
+@test ion.core.security.key_manager Caching and reloading of key files
+"""
+
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+
+from ion.core.security import authentication
+from ion.core.security.key_manager import KeyManager
+
+class KeyManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.keys = KeyManager(check_interval=5.0, clock=lambda: self.now)
+        self.dir = tempfile.mkdtemp()
+        self.priv_path = os.path.join(self.dir, 'test.priv.pem')
+        self.cert_path = os.path.join(self.dir, 'test.cert.pem')
+        shutil.copy('../res/certificates/test.priv.pem', self.priv_path)
+        shutil.copy('../res/certificates/test.cert.pem', self.cert_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_parsed_once(self):
+        auth = authentication.Authentication()
+        pkey = self.keys.private_key(self.priv_path)
+        pubkey = self.keys.public_key(self.cert_path)
+        self.assertTrue(self.keys.private_key(self.priv_path) is pkey)
+        self.assertTrue(self.keys.public_key(self.cert_path) is pubkey)
+        self.assertEqual(self.keys.loads, 2)
+
+        # The cached keys sign and verify repeatedly
+        for message in ('one', 'two'):
+            sig = auth.sign_message_with_key(message, pkey)
+            self.assertTrue(auth.verify_message_with_key(message, pubkey, sig))
+            self.assertTrue(auth.verify_message(message, self.keys.pem(self.cert_path), sig))
+        self.assertFalse(auth.verify_message_with_key('three', pubkey, sig))
+
+    def test_reload_on_change(self):
+        self.keys.pem(self.priv_path)
+        f = open(self.priv_path, 'a')
+        f.write('\n')
+        f.close()
+
+        # Not checked again within the interval
+        self.now += 1
+        self.assertEqual(self.keys.pem(self.priv_path).endswith('\n\n'), False)
+        self.now += 5
+        self.assertTrue(self.keys.pem(self.priv_path).endswith('\n\n'))
+        self.assertEqual(self.keys.loads, 2)
+
+        # Unchanged files are not read again
+        self.now += 10
+        self.keys.pem(self.priv_path)
+        self.assertEqual(self.keys.loads, 2)
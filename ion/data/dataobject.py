@@ -22,6 +22,13 @@ logging = logging.getLogger(__name__)
 
 from twisted.python import reflect
 
+from ion.core import ioninit
+CONF = ioninit.config(__name__)
+
+# Serializer used when no content type is asked for: 'alpha', the original
+# wire format every peer decodes, or 'compiled' once all peers decode it
+CF_default_serializer = CONF.getValue('default_serializer', 'alpha')
+
 class TypedAttribute(object):
     """
     @brief Descriptor class for Data Object attributes. Data Objects are
@@ -55,12 +62,11 @@ class TypedAttribute(object):
         """
 
         #print '=================================================='
-        types = _types.copy()
+        types = _types
         stype, default = value.split(NULL_CHR)
         #print '---------- ', stype, default
 
-        #the use of str is temporary unti lcaarch msging is fixed
-        mytype = eval(str(stype), types)
+        mytype = _lookup_type(stype, types)
 
         # If a value is given for the typed attribute decode it.
         if default:
@@ -76,7 +82,7 @@ class TypedAttribute(object):
                 objs=[]
                 for item in list_enc:
                     itype, ival = item.split(NULL_CHR)
-                    itype = eval(str(itype), types)
+                    itype = _lookup_type(itype, types)
 
                     if issubclass(itype, DataObject):
                         objs.append(itype.decode(json.loads(ival),header=False) )
@@ -90,13 +96,201 @@ class TypedAttribute(object):
                 return cls(mytype, json.loads(default))
 
             elif issubclass(mytype, bool):
-                return cls(mytype, eval(str(default)))
+                return cls(mytype, default == 'True')
 
             else:
                 return cls(mytype, mytype(str(default)))
         return cls(mytype)
 
 
+# Names the existing wire format may use for non DataObject types, looked up
+# instead of evaluated
+_BUILTIN_TYPES = dict([(t.__name__, t) for t in
+    (int, long, float, complex, str, unicode, bool, list, tuple, set,
+     frozenset, dict)])
+
+def _lookup_type(name, types):
+    """
+    @brief Type named in the existing wire format, from types or the builtins
+    """
+    name = str(name)
+    mytype = types.get(name) or _BUILTIN_TYPES.get(name)
+    if mytype is None:
+        raise NameError("name '%s' is not defined" % name)
+    return mytype
+
+"""
+Compiled codec. Each DataObject class gets a DataObjectCodec when it is
+created, which encodes an instance to msgpack native values in one pass:
+
+    object  -> [TAG_OBJECT, class name, {attribute: value}]
+
+Attribute values are encoded according to the type of their TypedAttribute,
+so str, int, float and bool values go as they are, LCStates as their name and
+nested objects of exactly the declared class as their attribute map. Values
+whose type is not known in advance (list items, dict values, subclasses of
+the declared class) are self describing: native scalars and dicts as they
+are, everything else as an array starting with a tag.
+"""
+TAG_OBJECT = 0
+TAG_LIST = 1
+TAG_TUPLE = 2
+TAG_SET = 3
+TAG_LCSTATE = 4
+
+_NATIVE_TYPES = frozenset([type(None), bool, int, long, float, str, unicode])
+
+# DataObject classes by name, for classes not registered in DataObject._types.
+# The first class created with a name keeps it.
+_classes = {}
+
+def _lookup_class(name):
+    cls = DataObject._types.get(name) or _classes.get(name)
+    if not isinstance(cls, DataObjectType):
+        raise ValueError('Unknown DataObject type %s' % name)
+    return cls
+
+# type -> function encoding a value of that type, for self describing values
+_value_encoders = {}
+# tag -> function decoding a tagged array
+_value_decoders = {}
+
+def encode_value(value):
+    """
+    @brief Self describing msgpack native encoding of a value
+    """
+    vtype = value.__class__
+    if vtype in _NATIVE_TYPES:
+        return value
+    encoder = _value_encoders.get(vtype)
+    if encoder is not None:
+        return encoder(value)
+    if isinstance(vtype, DataObjectType):
+        return [TAG_OBJECT, vtype.__name__, vtype._codec.encode_fields(value)]
+    raise TypeError('Can not encode value of type %s' % vtype.__name__)
+
+def decode_value(data):
+    """
+    @brief Inverse of encode_value. msgpack may return arrays as tuples.
+    """
+    if isinstance(data, (list, tuple)):
+        return _value_decoders[data[0]](data)
+    if isinstance(data, dict):
+        return dict([(k, decode_value(v)) for k, v in data.iteritems()])
+    return data
+
+def _decode_object(data):
+    return _lookup_class(data[1])._codec.decode_fields(data[2])
+
+_value_encoders.update({
+    list: lambda v: [TAG_LIST] + [encode_value(i) for i in v],
+    tuple: lambda v: [TAG_TUPLE] + [encode_value(i) for i in v],
+    set: lambda v: [TAG_SET] + [encode_value(i) for i in v],
+    dict: lambda v: dict([(k, encode_value(i)) for k, i in v.iteritems()]),
+    })
+_value_decoders.update({
+    TAG_OBJECT: _decode_object,
+    TAG_LIST: lambda d: [decode_value(i) for i in d[1:]],
+    TAG_TUPLE: lambda d: tuple([decode_value(i) for i in d[1:]]),
+    TAG_SET: lambda d: set([decode_value(i) for i in d[1:]]),
+    })
+
+def _sequence_codec(stype):
+    return (lambda v: [encode_value(i) for i in v],
+            lambda d: stype([decode_value(i) for i in d]))
+
+# Declared attribute type -> (encoder, decoder) of its values. None means the
+# value is msgpack native and goes as it is.
+_field_codecs = {
+    str: (None, None),
+    int: (None, None),
+    long: (None, None),
+    float: (None, None),
+    bool: (None, None),
+    unicode: (None, lambda d: d if isinstance(d, unicode) else d.decode('utf-8')),
+    list: _sequence_codec(list),
+    tuple: _sequence_codec(tuple),
+    set: _sequence_codec(set),
+    dict: (_value_encoders[dict], decode_value),
+    }
+
+def _object_field_codec(otype):
+    codec = otype._codec
+    def encode(value):
+        if value.__class__ is otype:
+            return codec.encode_fields(value)
+        return encode_value(value)
+    def decode(data):
+        if isinstance(data, dict):
+            return codec.decode_fields(data)
+        return decode_value(data)
+    return encode, decode
+
+def _compile_field(atype):
+    """
+    @brief (encoder, decoder) of the values of a TypedAttribute type
+    """
+    codec = _field_codecs.get(atype)
+    if codec is not None:
+        return codec
+    if isinstance(atype, DataObjectType):
+        return _object_field_codec(atype)
+    return encode_value, decode_value
+
+class DataObjectCodec(object):
+    """
+    @brief Encoder and decoder for the instances of one DataObject class,
+    compiled from its TypedAttributes by DataObjectType.
+    """
+
+    def __init__(self, cls, typedatts):
+        """
+        @param typedatts list of (name, TypedAttribute) in attribute order
+        """
+        self.cls = cls
+        self.fields = []
+        for name, att in typedatts:
+            encode, decode = _compile_field(att.type)
+            # Decoded objects are not initialised, so mutable defaults are
+            # copied rather than shared
+            if att.type in (list, dict, set):
+                make_default = att.type
+            else:
+                make_default = None
+            self.fields.append((name, att.name, att.default, encode, decode,
+                                make_default))
+
+    def encode(self, obj):
+        return [TAG_OBJECT, self.cls.__name__, self.encode_fields(obj)]
+
+    def encode_fields(self, obj):
+        fields = {}
+        for name, private, default, encode, decode, make_default in self.fields:
+            value = getattr(obj, private, default)
+            if encode is not None:
+                value = encode(value)
+            fields[name] = value
+        return fields
+
+    def decode_fields(self, data):
+        """
+        @brief Like unpickling, this does not call the class's __init__.
+        Attributes missing from data get their default.
+        """
+        obj = self.cls.__new__(self.cls)
+        for name, private, default, encode, decode, make_default in self.fields:
+            value = data.get(name, _MISSING)
+            if value is _MISSING:
+                if make_default is None:
+                    continue
+                value = make_default()
+            elif decode is not None:
+                value = decode(value)
+            setattr(obj, private, value)
+        return obj
+
+_MISSING = object()
+
 class DataObjectType(type):
     """
     @brief Metaclass for all Data Objects.
@@ -108,6 +302,7 @@ class DataObjectType(type):
         from their super class.
         """
         d = {}
+        atts = {}
         base_dicts = []
 
         for base in reversed(bases):
@@ -119,14 +314,21 @@ class DataObjectType(type):
             if isinstance(value, TypedAttribute):
                 value.name = '_' + key
                 d[value.name] = value.default
+                atts[key] = value
 
         for key, value in dict.items():
             if isinstance(value, TypedAttribute):
                 value.name = '_' + key
                 d[value.name] = value.default
+                atts[key] = value
 
         dict['__dict__'] = d
-        return type.__new__(cls, name, bases, dict)
+        newcls = type.__new__(cls, name, bases, dict)
+
+        # Compile the codec, attributes in the order of DataObject.attributes
+        newcls._codec = DataObjectCodec(newcls, [(key[1:], atts[key[1:]]) for key in d])
+        _classes.setdefault(name, newcls)
+        return newcls
 
 class DataObject(object):
     """
@@ -382,13 +584,33 @@ class DataObject(object):
         return encoded
 
 
+    def encode_native(self):
+        """
+        @brief Encode with the compiled codec of the class
+        @retval msgpack native structure, see DataObjectCodec
+        """
+        return self._codec.encode(self)
+
+    @classmethod
+    def decode_native(cls, data):
+        """
+        @brief Decode what encode_native returned, as the class named in it
+        """
+        obj = decode_value(data)
+        if not isinstance(obj, DataObject):
+            raise ValueError('Encoded value is not a DataObject')
+        return obj
+
     @classmethod
     def decode(cls, attrs,header=True):
         """
-        decode store object[s]
+        decode store object[s]. Also accepts the encode_native form.
         """
         #d = dict([(str(name), TypedAttribute.decode(value)) for name, value in attrs])
-        
+
+        if attrs and attrs[0] == TAG_OBJECT:
+            return cls.decode_native(attrs)
+
         clsobj = cls
         if isinstance(attrs, tuple):
             attrs = list(attrs)
@@ -397,7 +619,7 @@ class DataObject(object):
             header,clsname = attrs.pop(0)
             #print 'header',header
             #print 'clsname',clsname
-            clsobj = eval(str(clsname), cls._types)
+            clsobj = _lookup_type(clsname, cls._types)
 
         obj = clsobj()
 
@@ -542,6 +764,10 @@ LCStates = states(LCStates)
 # Object Dictionary to be decoded!
 DataObject._types.update(LCStates)
 
+_field_codecs[LCState] = (str, lambda d: LCStates[d])
+_value_encoders[LCState] = lambda v: [TAG_LCSTATE, str(v)]
+_value_decoders[TAG_LCSTATE] = lambda d: LCStates[d[1]]
+
 class Resource(ResourceReference):
     """
     @brief Base for all OOI resource description objects
@@ -626,6 +852,25 @@ class AlphaEncoder(object):
         """
         return Resource.decode(data)
 
+class CompiledEncoder(object):
+    """
+    Encodes DataObjects with the codec compiled for their class, into msgpack
+    native values the messaging layer can pack as they are.
+    """
+
+    def encode(self, o):
+        """
+        @param o instance of subclass of DataObject
+        """
+        assert issubclass(type(o), DataObject)
+        return o.encode_native()
+
+    def decode(self, data):
+        """
+        @param data encoded DataObject
+        """
+        return DataObject.decode_native(data)
+
 class DEncoder(object):
     """Encode a DataObject into a JSON encodable dict structure.
     """
@@ -843,7 +1088,14 @@ def register_jsond():
         content_type='application/ion-jsond',
         content_encoding='utf-8')
 
+def register_compiled():
+    compiled = CompiledEncoder()
+    serializer.register('compiled', compiled.encode, compiled.decode,
+            content_type='application/ion-dataobject-native',
+            content_encoding='binary')
+
 register_alpha()
 register_jsond()
 register_dencoder()
-serializer.set_default('alpha')
+register_compiled()
+serializer.set_default(CF_default_serializer)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""
+@file ion/data/datastore/attribute_index.py
+@brief Inverted index of resource attribute values, used by the registry to
+narrow find_resource to a candidate set instead of reading every resource.
+"""
+
+import bisect
+import re
+
+import ion.util.ionlog
+log = ion.util.ionlog.getLogger(__name__)
+
+# Values which can be looked up exactly; lists, dicts and nested DataObjects
+# are left to DataObject.compared_to on the candidates
+INDEXED_TYPES = (basestring, int, long, float, bool)
+
+_REGEX_META = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+
+def literal_prefix(pattern):
+    """
+    @brief The literal a regex must start with, for patterns of the form
+    '^literal' or '^literal.*'
+    @retval the literal, or None for any other pattern
+    """
+    if not isinstance(pattern, basestring) or not pattern.startswith('^'):
+        return None
+    body = pattern[1:]
+    if body.endswith('.*'):
+        body = body[:-2]
+    if _REGEX_META.search(body):
+        return None
+    return body
+
+
+class AttributeIndex(object):
+    """
+    Maps attribute name -> value -> set of resource ids, for the indexable
+    values of each resource. Sorted string values for prefix lookups are
+    built on demand.
+    """
+    def __init__(self):
+        # id -> {attribute: value}
+        self._values = {}
+        # attribute -> {value: set of ids}
+        self._index = {}
+        # attribute -> sorted string values, rebuilt after a change
+        self._sorted = {}
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, id, resource):
+        """
+        Indexes a resource, replacing what was indexed for its id
+        """
+        self.remove(id)
+        values = {}
+        for name in resource.attributes:
+            value = getattr(resource, name)
+            if not isinstance(value, INDEXED_TYPES):
+                continue
+            values[name] = value
+            self._index.setdefault(name, {}).setdefault(value, set()).add(id)
+            self._sorted.pop(name, None)
+        self._values[id] = values
+
+    def remove(self, id):
+        values = self._values.pop(id, None)
+        if not values:
+            return
+        for name, value in values.items():
+            ids = self._index[name][value]
+            ids.discard(id)
+            if not ids:
+                del self._index[name][value]
+                self._sorted.pop(name, None)
+
+    def ids(self):
+        return set(self._values)
+
+    def exact(self, name, value):
+        """
+        @retval set of ids whose attribute equals value
+        """
+        try:
+            return set(self._index.get(name, {}).get(value, ()))
+        except TypeError:
+            # Unhashable value, nothing indexed can equal it
+            return set()
+
+    def prefix(self, name, prefix):
+        """
+        @retval set of ids whose string attribute starts with prefix
+        """
+        keys = self._sorted.get(name)
+        if keys is None:
+            keys = [v for v in self._index.get(name, {}) if isinstance(v, basestring)]
+            keys.sort()
+            self._sorted[name] = keys
+
+        result = set()
+        by_value = self._index.get(name, {})
+        for i in xrange(bisect.bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix):
+                break
+            result.update(by_value[keys[i]])
+        return result
+
+    def scan(self, name, pattern, candidates):
+        """
+        @retval the candidates whose attribute equals pattern, or is a string
+        it matches, as DataObject.compared_to does with regex=True
+        """
+        try:
+            regex = re.compile(pattern)
+        except (re.error, TypeError):
+            regex = None
+        result = set()
+        for id in candidates:
+            values = self._values.get(id)
+            if values is None or name not in values:
+                continue
+            value = values[name]
+            if value == pattern:
+                result.add(id)
+            elif regex is not None and isinstance(value, basestring) \
+                    and regex.search(value):
+                result.add(id)
+        return result
+
+    def candidates(self, description, atts, regex):
+        """
+        @brief Ids of the resources which may match description on atts. Exact
+        and prefix predicates are looked up first, other regex predicates
+        filter what they leave. Attributes whose values are not indexed do
+        not narrow the set.
+        @retval set of ids, a superset of the matches
+        """
+        lookups = []
+        scans = []
+        for name in atts:
+            value = getattr(description, name)
+            if not isinstance(value, INDEXED_TYPES):
+                continue
+            if not regex or not isinstance(value, basestring):
+                lookups.append((0, name, value, None))
+                continue
+            prefix = literal_prefix(value)
+            if prefix is not None:
+                lookups.append((1, name, value, prefix))
+            else:
+                scans.append((name, value))
+
+        result = None
+        # Exact lookups first, they are usually the most selective
+        lookups.sort(key=lambda lookup: lookup[0])
+        for kind, name, value, prefix in lookups:
+            if kind == 0:
+                found = self.exact(name, value)
+            else:
+                found = self.prefix(name, prefix) | self.exact(name, value)
+            result = found if result is None else result & found
+            if not result:
+                return result
+
+        if result is None:
+            result = self.ids()
+        for name, value in scans:
+            result = self.scan(name, value, result)
+            if not result:
+                break
+        return result
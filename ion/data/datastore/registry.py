@@ -11,11 +11,15 @@
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
 
+import time
+
 from twisted.internet import defer
+from twisted.python import failure
 
 from ion.data import store
 from ion.data import dataobject
 from ion.data.datastore import objstore
+from ion.data.datastore.attribute_index import AttributeIndex
 
 from ion.core import ioninit
 from ion.core.process.process import ProcessFactory
@@ -25,6 +29,11 @@ import ion.util.procutils as pu
 
 CONF = ioninit.config(__name__)
 
+# Seconds after which find_resource rebuilds the attribute index from the
+# store, 0 to keep it until invalidated. Set it when other registries write
+# to the same backend.
+CF_index_max_age = CONF.getValue('index_max_age', 0)
+
 class LCStateMixin(object):
     """
     @brief This mixin class is used to add life cycle state convenience methods
@@ -91,14 +100,35 @@ class RegistryBackend(objstore.ObjectChassis):
 class Registry(objstore.ObjectStore, IRegistry, LCStateMixin):
     """
     @brief Registry is the backend implementation used by all registry services
+    @note find_resource uses an AttributeIndex of the resources, built from
+    the store on first use and kept up to date by register_resource (and so
+    set_resource_lcstate). Changes made to the store by another Registry
+    instance are not seen by this one's index until it is rebuilt: after
+    invalidate_index, or once it is older than index_max_age seconds.
     """
 
     objectChassis = RegistryBackend
 
+    _index = None
+    _index_built = 0
+    _index_generation = 0
+    # While the index is built: id -> resource registered meanwhile, and the
+    # Deferreds of other callers waiting for the index
+    _index_pending = None
+    _index_waiters = None
+
     def clear_registry(self):
         log.info(self.__class__.__name__ + '################################################################# clear_registry called ')
+        self.invalidate_index()
         return self.backend.clear_store()
 
+    def invalidate_index(self):
+        """
+        @brief Drop the attribute index, find_resource rebuilds it from the store
+        """
+        self._index = None
+        self._index_generation += 1
+
 
 
     @defer.inlineCallbacks
@@ -130,6 +160,11 @@ class Registry(objstore.ObjectStore, IRegistry, LCStateMixin):
             log.info("Committing resource")
             resource.RegistryCommit = yield res_client.commit()
             log.info("Committed resource")
+            if self._index is not None:
+                self._index.add(id, resource)
+            elif self._index_pending is not None:
+                # Added to the index being built once it is done
+                self._index_pending[id] = resource
         else:
             resource = None
 
@@ -204,6 +239,58 @@ class Registry(objstore.ObjectStore, IRegistry, LCStateMixin):
         defer.returnValue([(yield self.get_resource(ref)) for ref in refs])
 
 
+    @defer.inlineCallbacks
+    def _get_index(self):
+        """
+        @brief The attribute index, built from every resource on first use.
+        Resources registered while it is built are added when it is done, and
+        callers which come meanwhile wait for the same build.
+        """
+        if self._index is not None and CF_index_max_age and \
+                time.time() - self._index_built > CF_index_max_age:
+            self.invalidate_index()
+        if self._index is not None:
+            defer.returnValue(self._index)
+
+        if self._index_waiters is not None:
+            d = defer.Deferred()
+            self._index_waiters.append(d)
+            index = yield d
+            defer.returnValue(index)
+
+        self._index_waiters = []
+        try:
+            while True:
+                generation = self._index_generation
+                self._index_pending = {}
+                index = AttributeIndex()
+                refs = yield self._list()
+                for ref in refs:
+                    res = yield self.get_resource(ref)
+                    if res:
+                        index.add(ref.RegistryIdentity, res)
+                for id, res in self._index_pending.items():
+                    index.add(id, res)
+                # Cleared or invalidated while building - start over
+                if generation == self._index_generation:
+                    break
+            log.info(self.__class__.__name__ + ': indexed ' + str(len(index)) + ' resources')
+            self._index = index
+            self._index_built = time.time()
+        except Exception:
+            reason = failure.Failure()
+            waiters = self._index_waiters
+            self._index_pending = self._index_waiters = None
+            for d in waiters:
+                d.errback(reason)
+            reason.raiseException()
+
+        waiters = self._index_waiters
+        self._index_pending = self._index_waiters = None
+        for d in waiters:
+            d.callback(index)
+        defer.returnValue(index)
+
     @defer.inlineCallbacks
     def find_resource(self,description,regex=True,ignore_defaults=True,attnames=[]):
         """
@@ -213,6 +300,8 @@ class Registry(objstore.ObjectStore, IRegistry, LCStateMixin):
         @param regex Whether a regex is used or not
         @param ignore_defaults ignore registry defaults
         @param attnames attribute names associated with the resource
+        @note Only the candidates the attribute index leaves are read from the
+        store, and checked with DataObject.compared_to
         """
 
         # container for the return arguments
@@ -220,16 +309,18 @@ class Registry(objstore.ObjectStore, IRegistry, LCStateMixin):
         log.info("description class %s" % description.__class__)
         results=[]
         if isinstance(description,dataobject.DataObject):
-            refs = yield self._list()
             log.debug(description)
+            index = yield self._get_index()
 
-            # Get the list of descriptions in this registry
+            atts = attnames or description.attributes
+            if ignore_defaults:
+                atts = description.non_default_atts(atts)
+            ids = index.candidates(description, atts, regex)
+            log.info(self.__class__.__name__ + ': find_resource has ' + str(len(ids)) + ' candidates of ' + str(len(index)) + ' items in registry')
 
-            reslist = yield self._list_descriptions()
-            log.info(self.__class__.__name__ + ': find_resource found ' + str(len(reslist)) + ' items in registry')
             num_match = 1
-            for ref in refs:
-                log.info("ref: %s" % ref)
+            for id in sorted(ids):
+                ref = dataobject.ResourceReference(RegistryIdentity=id)
                 res = yield self.get_resource(ref)
                 log.debug("Found #"+str(num_match)+":"+str(res))
                 num_match += 1
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+@file ion/data/datastore/test/test_attribute_index.py
+@test ion.data.datastore.attribute_index and its use by Registry.find_resource
+"""
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from ion.data import store
+from ion.data import dataobject
+from ion.data.datastore import registry
+from ion.data.datastore.attribute_index import AttributeIndex, literal_prefix
+
+
+class AttributeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = AttributeIndex()
+        for id, name in (('1', 'foo'), ('2', 'food'), ('3', 'moo')):
+            res = dataobject.Resource()
+            res.name = name
+            self.index.add(id, res)
+
+    def test_literal_prefix(self):
+        self.assertEqual(literal_prefix('^foo'), 'foo')
+        self.assertEqual(literal_prefix('^foo.*'), 'foo')
+        self.assertEqual(literal_prefix('foo'), None)
+        self.assertEqual(literal_prefix('^fo+'), None)
+
+    def test_lookups(self):
+        self.assertEqual(self.index.exact('name', 'foo'), set(['1']))
+        self.assertEqual(self.index.prefix('name', 'foo'), set(['1', '2']))
+        self.assertEqual(self.index.scan('name', 'oo$', set(['1', '3'])), set(['1', '3']))
+        self.assertEqual(self.index.exact('missing', 'foo'), set())
+
+        # Re-adding replaces the old values
+        res = dataobject.Resource()
+        res.name = 'bar'
+        self.index.add('1', res)
+        self.assertEqual(self.index.exact('name', 'foo'), set())
+        self.assertEqual(self.index.prefix('name', 'foo'), set(['2']))
+
+    def test_candidates(self):
+        desc = dataobject.Resource()
+        desc.name = 'foo'
+        atts = ['name']
+        self.assertEqual(self.index.candidates(desc, atts, False), set(['1']))
+        self.assertEqual(self.index.candidates(desc, atts, True), set(['1', '2']))
+        desc.name = '^fo'
+        self.assertEqual(self.index.candidates(desc, atts, True), set(['1', '2']))
+        self.assertEqual(self.index.candidates(desc, [], True), set(['1', '2', '3']))
+
+
+class IndexedFindTest(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        s = yield store.Store.create_store()
+        self.reg = registry.Registry(s)
+        self.resources = []
+        for name in ('foo', 'food', 'moo', 'bar'):
+            res = dataobject.Resource.create_new_resource()
+            res.name = name
+            res = yield self.reg.register_resource(res)
+            self.resources.append(res)
+
+        # Count the resources read from the store
+        self.reads = 0
+        get_resource = self.reg.get_resource
+        def counting_get_resource(ref):
+            self.reads += 1
+            return get_resource(ref)
+        self.reg.get_resource = counting_get_resource
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.reg.clear_registry()
+
+    @defer.inlineCallbacks
+    def test_find_reads_candidates_only(self):
+        desc = dataobject.Resource()
+        desc.name = 'moo'
+        results = yield self.reg.find_resource(desc, regex=False, attnames=['name'])
+        self.assertEqual([r.name for r in results], ['moo'])
+        # All four read once to build the index, then the one candidate
+        self.assertEqual(self.reads, 5)
+
+        desc.name = '^foo'
+        results = yield self.reg.find_resource(desc, regex=True, attnames=['name'])
+        self.assertEqual(sorted([r.name for r in results]), ['foo', 'food'])
+        self.assertEqual(self.reads, 7)
+
+    @defer.inlineCallbacks
+    def test_index_follows_lcstate(self):
+        ref = yield self.reg.set_resource_lcstate_active(self.resources[3].reference())
+        desc = dataobject.Resource()
+        desc.lifecycle = dataobject.LCStates.active
+        results = yield self.reg.find_resource(desc, regex=False, attnames=['lifecycle'])
+        self.assertEqual([r.name for r in results], ['bar'])
+
+        yield self.reg.set_resource_lcstate_retired(ref)
+        results = yield self.reg.find_resource(desc, regex=False, attnames=['lifecycle'])
+        self.assertEqual(results, [])
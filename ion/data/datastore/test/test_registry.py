@@ -168,6 +168,49 @@ class RegistryTest(unittest.TestCase):
         self.assertNotIn(res1, results)
         self.assertIn(res2, results)
 
+    @defer.inlineCallbacks
+    def test_registry_find_index(self):
+        # Only meaningful for the Registry itself, not the service client
+        if not isinstance(self.reg, registry.Registry):
+            return
+
+        res1 = dataobject.Resource.create_new_resource()
+        res1.name = 'foo'
+        res1 = yield self.reg.register_resource(res1)
+
+        # Registered while the index is built from a listing of the store
+        # taken before
+        gate = defer.Deferred()
+        def slow_list():
+            refs = []
+            registry.Registry._list(self.reg).addCallback(refs.extend)
+            return gate.addCallback(lambda _: refs)
+        self.reg._list = slow_list
+        blank = dataobject.Resource()
+        blank.name = 'moo'
+        d = self.reg.find_resource(blank, regex=False)
+        res2 = dataobject.Resource.create_new_resource()
+        res2.name = 'moo'
+        res2 = yield self.reg.register_resource(res2)
+        del self.reg._list
+        gate.callback(None)
+        yield d
+
+        results = yield self.reg.find_resource(blank, regex=False)
+        self.assertIn(res2, results)
+
+        # Written by another registry on the same backend
+        other = registry.Registry(self.reg.backend)
+        res3 = dataobject.Resource.create_new_resource()
+        res3.name = 'moo'
+        res3 = yield other.register_resource(res3)
+        results = yield self.reg.find_resource(blank, regex=False)
+        self.assertNotIn(res3, results)
+        self.reg.invalidate_index()
+        results = yield self.reg.find_resource(blank, regex=False)
+        self.assertIn(res2, results)
+        self.assertIn(res3, results)
+
 
         
 class RegistryServiceTest(IonTestCase, RegistryTest):
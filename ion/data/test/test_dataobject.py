@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 
+import time
+import msgpack
+
 from twisted.trial import unittest
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
 
+from ion.core import ioninit
+from ion.util.itv_decorator import itv
+CONF = ioninit.config(__name__)
+
 from twisted.python import reflect
 
 
@@ -318,6 +325,12 @@ class TestSimpleObject(unittest.TestCase):
         self.assertEqual(self.obj,dec,'Original: %s \n Decoded: %s' % (str(self.obj), str(dec)))
         self.assertEqual(type(self.obj).__name__,type(dec).__name__)
 
+    def testNative(self):
+        data = msgpack.unpackb(msgpack.packb(self.obj.encode_native()))
+        dec = dataobject.DataObject.decode_native(data)
+        self.assertEqual(self.obj,dec,'Original: %s \n Decoded: %s' % (str(self.obj), str(dec)))
+        self.assertEqual(type(self.obj),type(dec))
+
 
 class PrimaryTypesObject(SimpleObject):
     """
@@ -762,3 +775,108 @@ class TestResource(unittest.TestCase):
 class TestDEncoder(unittest.TestCase):
     """
     """
+
+
+class TestCompiledCodec(unittest.TestCase):
+
+    def _round_trip(self, obj):
+        data = msgpack.unpackb(msgpack.packb(obj.encode_native()))
+        return dataobject.DataObject.decode_native(data)
+
+    def test_encoding(self):
+        obj = DataContainer()
+        obj.name = 'container'
+        obj.dt = DataType1()
+        obj.dt.s = 'one'
+        # A subclass of the declared type is tagged, the declared type is not
+        self.assertEqual(obj.encode_native(),
+            [dataobject.TAG_OBJECT, 'DataContainer',
+             {'name':'container',
+              'dt':[dataobject.TAG_OBJECT, 'DataType1', {'f':0.0, 's':'one'}]}])
+
+        nested = NestedObject()
+        enc = nested.encode_native()[2]
+        self.assertEqual(enc['primary']['integer'], 5)
+        self.assertEqual(enc['rset']['rset'], [])
+
+    def test_resource(self):
+        res = dataobject.Resource.create_new_resource()
+        res.name = 'res'
+        res.set_lifecyclestate(dataobject.LCStates.active)
+        self.assertEqual(res.encode_native()[2]['lifecycle'], 'active')
+
+        dec = self._round_trip(res)
+        self.assertEqual(res, dec)
+        self.assertEqual(dec.lifecycle, dataobject.LCStates.active)
+
+    def test_mixed_values(self):
+        obj = ListObject()
+        obj.rlist = [1, 'a', (2, 3), set([4]), [SimpleObject()], {'k':[dataobject.LCStates.retired]}]
+        dec = self._round_trip(obj)
+        self.assertEqual(obj, dec)
+        self.assertEqual(type(dec.rlist[2]), tuple)
+
+        class Unknown(object):
+            pass
+        obj.rlist = [Unknown()]
+        self.assertRaises(TypeError, obj.encode_native)
+
+    def test_defaults_not_shared(self):
+        # Attributes missing from the data get fresh defaults
+        data = [dataobject.TAG_OBJECT, 'ListObject', {'name':'x'}]
+        dec1 = dataobject.DataObject.decode_native(data)
+        dec2 = dataobject.DataObject.decode_native(data)
+        dec1.rlist.append(1)
+        self.assertEqual(dec2.rlist, [])
+        self.assertEqual(dec1.name, 'x')
+
+        self.assertRaises(ValueError, dataobject.DataObject.decode_native,
+                          [dataobject.TAG_OBJECT, 'NoSuchClass', {}])
+
+    def test_serializer(self):
+        obj = SimpleObject()
+        obj.name = 'serialized'
+        content_type, _, data = dataobject.serializer.encode(obj, serializer='compiled')
+        self.assertEqual(content_type, 'application/ion-dataobject-native')
+        self.assertEqual(dataobject.serializer.decode(data, content_type), obj)
+
+        # The original wire format is still available, and decode takes both
+        content_type, _, data = dataobject.serializer.encode(obj, serializer='alpha')
+        self.assertEqual(dataobject.serializer.decode(data, content_type), obj)
+        self.assertEqual(dataobject.DataObject.decode(obj.encode_native()), obj)
+
+    @itv(CONF)
+    def test_codec_performance(self):
+        count = 2000
+
+        obj = ListObject()
+        obj.name = 'benchmark'
+        obj.rlist = [PrimaryTypesObject() for i in range(10)]
+
+        tzero = time.time()
+        for i in xrange(count):
+            data = msgpack.packb(obj.encode())
+        alpha_enc = time.time() - tzero
+        tzero = time.time()
+        for i in xrange(count):
+            dataobject.DataObject.decode(msgpack.unpackb(data))
+        alpha_dec = time.time() - tzero
+
+        tzero = time.time()
+        for i in xrange(count):
+            data = msgpack.packb(obj.encode_native())
+        native_enc = time.time() - tzero
+        native_size = len(data)
+        tzero = time.time()
+        for i in xrange(count):
+            dataobject.DataObject.decode_native(msgpack.unpackb(data))
+        native_dec = time.time() - tzero
+
+        self.assertEqual(dataobject.DataObject.decode_native(msgpack.unpackb(data)), obj)
+
+        print('Encode, %d objects: alpha %f s, compiled %f s, speedup %.1fx' % \
+            (count, alpha_enc, native_enc, alpha_enc / max(native_enc, 1e-6)))
+        print('Decode, %d objects: alpha %f s, compiled %f s, speedup %.1fx' % \
+            (count, alpha_dec, native_dec, alpha_dec / max(native_dec, 1e-6)))
+        print('Packed size: alpha %d bytes, compiled %d bytes' % \
+            (len(msgpack.packb(obj.encode())), native_size))
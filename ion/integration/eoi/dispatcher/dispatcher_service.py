@@ -8,12 +8,13 @@ Created on Nov 9, 2010
 """
 
 import ion.util.ionlog
-import subprocess
 
 from twisted.internet import defer
 from ion.core.process.process import ProcessFactory
 from ion.core.process.service_process import ServiceProcess, ServiceClient
 from ion.core.messaging.ion_reply_codes import ResponseCodes as RC
+from ion.integration.eoi.dispatcher.workflow_executor import WorkflowExecutor, \
+    CF_max_running, CF_timeout
 
 
 log = ion.util.ionlog.getLogger(__name__)
@@ -23,6 +24,10 @@ log = ion.util.ionlog.getLogger(__name__)
 class DispatcherService(ServiceProcess):
     """
     Dispatching service for starting remote workflow (scripts)
+
+    Workflows run through a WorkflowExecutor, so the service keeps handling
+    messages while they run; each notify is replied to when its workflow ends.
+    Spawn args 'max_running' and 'timeout' override the executor's config.
     """
 
     
@@ -44,7 +49,9 @@ class DispatcherService(ServiceProcess):
 #        kwargs['spawnargs']['proc-name'] = __name__ + ".DispatcherService"
         ServiceProcess.__init__(self, *args, **kwargs)
         # Step 2: Add class attributes
-        # NONE
+        self.executor = WorkflowExecutor(
+            max_running=self.spawn_args.get('max_running', CF_max_running),
+            timeout=self.spawn_args.get('timeout', CF_timeout))
         
     def slc_init(self):
         """
@@ -52,6 +59,12 @@ class DispatcherService(ServiceProcess):
         (Yields ALLOWED)
         """
         pass
+
+    def slc_terminate(self):
+        """
+        Stops any running workflows
+        """
+        return self.executor.terminate()
     
     @defer.inlineCallbacks
     def op_notify(self, content, headers, msg):
@@ -67,22 +80,31 @@ class DispatcherService(ServiceProcess):
             reply = "Invalid notify content: %s" % (str(ex))
             yield self.reply_uncaught_err(msg, content = reply, response_code = reply)
             defer.returnValue(None)
-        # Step 2: Build the subprocess arguments to start the workflow
+        # Step 2: Build the process arguments to start the workflow
         args = self._prepare_workflow(datasetId, datasetName, workflow)
-        # Step 3: Start the workflow with the subprocess module
-        try:
-#            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            proc = subprocess.Popen(args)
-        except Exception as ex:
-            reply = "Could not start workflow: %s" % (str(ex))
-            (content, headers, msg) = yield self.reply_uncaught_err(msg, content = reply, response_code = reply)
-            defer.returnValue(content)
-        returncode = proc.wait()
-        if returncode == 0:
-            yield self.reply(msg, content="Workflow completed with SUCCESS")
-        else:
-            msgout = proc.communicate()[0]
-            yield self.reply(msg, content="Error on notify.  Retrieved return code: '%s'.  Retrieved message: %s" % (str(returncode), str(msgout)))
+        # Step 3: Queue the workflow, the reply is sent when it ends.  Not
+        # yielded on, so other notifications are handled in the meantime
+        d = self.executor.submit(datasetId, args)
+        d.addCallbacks(self._reply_result, self._reply_start_error,
+                       callbackArgs=(msg,), errbackArgs=(msg,))
+
+    def _reply_result(self, result, msg):
+        """
+        Replies to a notify with the outcome of its workflow
+        """
+        if result['exitcode'] == 0:
+            return self.reply(msg, content="Workflow completed with SUCCESS")
+        msgout = ''.join(result['outlines'] + result['errlines'])
+        if result['timed_out']:
+            return self.reply(msg, content="Error on notify.  Workflow timed out.  Retrieved message: %s" % (msgout))
+        return self.reply(msg, content="Error on notify.  Retrieved return code: '%s'.  Retrieved message: %s" % (str(result['exitcode']), msgout))
+
+    def _reply_start_error(self, reason, msg):
+        """
+        Replies to a notify whose workflow could not be started
+        """
+        reply = "Could not start workflow: %s" % (reason.getErrorMessage())
+        return self.reply_uncaught_err(msg, content = reply, response_code = reply)
     
     def _unpack_notification(self, content):
         """
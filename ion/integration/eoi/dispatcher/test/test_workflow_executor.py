@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+@file:   ion/integration/eoi/dispatcher/test/test_workflow_executor.py
+@test:   ion.integration.eoi.dispatcher.workflow_executor Concurrency limit,
+         coalescing and timeouts, with shell commands as workflows
+"""
+
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer
+
+from ion.test.iontest import IonTestCase
+from ion.integration.eoi.dispatcher.workflow_executor import WorkflowExecutor
+
+
+class WorkflowExecutorTest(IonTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.executor = WorkflowExecutor(max_running=2, timeout=10, kill_timeout=1)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.executor.terminate()
+        shutil.rmtree(self.dir)
+
+    def _workflow(self, script):
+        return ['/bin/sh', '-c', script]
+
+    @defer.inlineCallbacks
+    def test_output_and_exit_code(self):
+        result = yield self.executor.submit('ds1', self._workflow('echo out; echo err >&2'))
+        self.assertEqual(result['exitcode'], 0)
+        self.assertEqual(''.join(result['outlines']), 'out\n')
+        self.assertEqual(''.join(result['errlines']), 'err\n')
+        self.assertFalse(result['timed_out'])
+
+        result = yield self.executor.submit('ds1', self._workflow('echo failed; exit 3'))
+        self.assertEqual(result['exitcode'], 3)
+        self.assertEqual(''.join(result['outlines']), 'failed\n')
+
+    @defer.inlineCallbacks
+    def test_concurrency_limit(self):
+        # Each workflow records how many were running when it started
+        log = os.path.join(self.dir, 'log')
+        script = 'echo start >> %s; sleep 0.3; echo end >> %s' % (log, log)
+        runs = [self.executor.submit('ds%d' % i, self._workflow(script)) for i in range(4)]
+        self.assertEqual(self.executor.stats()['running'], 2)
+        self.assertEqual(self.executor.stats()['queued'], 2)
+        yield defer.gatherResults(runs)
+
+        running = max_running = 0
+        for line in open(log).read().split():
+            running += line == 'start' and 1 or -1
+            max_running = max(max_running, running)
+        self.assertEqual(max_running, 2)
+
+    @defer.inlineCallbacks
+    def test_coalesce(self):
+        count = os.path.join(self.dir, 'count')
+        script = 'sleep 0.2; echo run >> %s' % count
+        first = self.executor.submit('ds1', self._workflow(script))
+        # Arriving while ds1 is processed: one follow-up run for all three
+        later = [self.executor.submit('ds1', self._workflow(script)) for i in range(3)]
+        self.assertEqual(self.executor.stats()['coalesced'], 2)
+
+        result = yield first
+        self.assertEqual(result['notifications'], 1)
+        results = yield defer.gatherResults(later)
+        self.assertEqual([r['notifications'] for r in results], [3] * 3)
+        self.assertEqual(open(count).read().split(), ['run', 'run'])
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        self.executor.timeout = 0.2
+        result = yield self.executor.submit('ds1', self._workflow('echo begun; sleep 30'))
+        self.assertTrue(result['timed_out'])
+        self.assertNotEqual(result['exitcode'], 0)
+        self.assertEqual(''.join(result['outlines']), 'begun\n')
+
+    @defer.inlineCallbacks
+    def test_terminate_fails_waiting_runs(self):
+        self.executor.max_running = 1
+        running = self.executor.submit('ds1', self._workflow('sleep 30'))
+        # ds2 waits for the slot ds1 holds
+        waiting = self.executor.submit('ds2', self._workflow('echo never'))
+        self.assertEqual(self.executor.stats()['queued'], 1)
+
+        yield self.executor.terminate()
+        result = yield running
+        self.assertNotEqual(result['exitcode'], 0)
+        try:
+            yield waiting
+            self.fail('The waiting run should fail')
+        except RuntimeError:
+            pass
+        self.assertEqual(self.executor.stats()['queued'], 0)
+
+        # A later notification for ds2 does not join the dead run
+        result = yield self.executor.submit('ds2', self._workflow('echo again'))
+        self.assertEqual(''.join(result['outlines']), 'again\n')
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+@file:   ion/integration/eoi/dispatcher/workflow_executor.py
+@brief:  Runs dispatcher workflows as external processes without blocking the
+         reactor: a bounded number at once, one at a time per dataset, with
+         duplicate notifications coalesced and a timeout on each run.
+"""
+
+from twisted.internet import defer, reactor
+
+import ion.util.ionlog
+log = ion.util.ionlog.getLogger(__name__)
+
+from ion.util.os_process import OSProcess
+
+from ion.core import ioninit
+CONF = ioninit.config(__name__)
+
+# Workflows running at once, over all datasets
+CF_max_running = CONF.getValue('max_running', 4)
+# Seconds a workflow may run before it is terminated, None for no limit
+CF_timeout = CONF.getValue('timeout', 3600)
+# Seconds a terminated workflow has to exit before it is killed
+CF_kill_timeout = CONF.getValue('kill_timeout', 5)
+
+
+class WorkflowRun(object):
+    """
+    One queued or running workflow, and the notifications waiting on it
+    """
+    def __init__(self, dataset_id, args):
+        self.dataset_id = dataset_id
+        self.args = list(args)
+        self.waiters = []
+        self.notifications = 0
+        self.process = None
+        self.timeout_call = None
+        self.timed_out = False
+
+    def add_waiter(self):
+        self.notifications += 1
+        d = defer.Deferred()
+        self.waiters.append(d)
+        return d
+
+
+class WorkflowExecutor(object):
+    """
+    Each dataset has a queue of workflow runs, which run in order. A
+    notification for a run that is already queued (same workflow and
+    arguments) joins it instead of adding another, so any number of
+    notifications arriving while a dataset is being processed cause a single
+    follow-up run. At most max_running datasets are processed at once; the
+    others wait their turn in the order they became ready.
+
+    Results are dicts with the keys of ion.util.os_process.OSProcess results
+    (exitcode, outlines, errlines) plus timed_out and notifications, the
+    number of notifications the run answered.
+    """
+    def __init__(self, max_running=CF_max_running, timeout=CF_timeout,
+                 kill_timeout=CF_kill_timeout):
+        self.max_running = max_running
+        self.timeout = timeout
+        self.kill_timeout = kill_timeout
+
+        # dataset id -> list of WorkflowRun, the first may be running
+        self._queues = {}
+        # dataset id -> running WorkflowRun
+        self._running = {}
+        # dataset ids with a run waiting for a free slot, in order
+        self._ready = []
+
+        self.started = 0
+        self.coalesced = 0
+
+    def submit(self, dataset_id, args):
+        """
+        Queues a workflow run for a dataset
+        @param args binary and arguments of the workflow process
+        @retval Deferred which fires with the result dict once the run is done,
+        or fails if the workflow could not be started
+        """
+        queue = self._queues.setdefault(dataset_id, [])
+        for run in queue:
+            if run.process is None and run.args == list(args):
+                self.coalesced += 1
+                log.debug('Workflow for dataset %s already queued' % dataset_id)
+                return run.add_waiter()
+
+        run = WorkflowRun(dataset_id, args)
+        d = run.add_waiter()
+        queue.append(run)
+        if len(queue) == 1:
+            self._ready.append(dataset_id)
+            self._start_ready()
+        return d
+
+    def stats(self):
+        return {'running':len(self._running),
+                'queued':sum([len(q) for q in self._queues.values()]) - len(self._running),
+                'started':self.started,
+                'coalesced':self.coalesced}
+
+    def terminate(self):
+        """
+        Stops the running workflows and fails all queued ones
+        @retval Deferred which fires once the running processes have exited
+        """
+        failed = []
+        for dataset_id, queue in self._queues.items():
+            if queue[0].process is None:
+                # Waiting for a free slot - it will never get one
+                failed.extend(queue)
+                del self._queues[dataset_id]
+            else:
+                failed.extend(queue[1:])
+                del queue[1:]
+        self._ready = []
+        for run in failed:
+            for d in run.waiters:
+                d.errback(RuntimeError('Workflow executor terminated'))
+
+        closing = []
+        for run in self._running.values():
+            d = defer.Deferred()
+            run.waiters.append(d)
+            closing.append(d)
+            run.process.close(timeout=self.kill_timeout)
+        return defer.DeferredList(closing, consumeErrors=True)
+
+    def _start_ready(self):
+        while self._ready and len(self._running) < self.max_running:
+            dataset_id = self._ready.pop(0)
+            self._start(self._queues[dataset_id][0])
+
+    def _start(self, run):
+        log.info('Starting workflow for dataset %s: %s' % (run.dataset_id, run.args))
+        run.process = OSProcess(binary=run.args[0], spawnargs=run.args[1:])
+        self._running[run.dataset_id] = run
+        self.started += 1
+        try:
+            d = run.process.spawn()
+        except Exception, ex:
+            log.error('Could not start workflow %s: %s' % (run.args, str(ex)))
+            self._finished(run, error=ex)
+            return
+
+        if self.timeout:
+            run.timeout_call = reactor.callLater(self.timeout, self._timed_out, run)
+        d.addCallbacks(self._exited, self._failed, callbackArgs=(run,),
+                       errbackArgs=(run,))
+
+    def _timed_out(self, run):
+        run.timeout_call = None
+        run.timed_out = True
+        log.warn('Workflow for dataset %s timed out after %s seconds' %
+                 (run.dataset_id, self.timeout))
+        run.process.close(timeout=self.kill_timeout)
+
+    def _exited(self, result, run):
+        self._finished(run, result=result)
+
+    def _failed(self, reason, run):
+        # OSProcess fails with the result dict for a non zero exit code
+        result = reason.value.args and reason.value.args[0]
+        if isinstance(result, dict):
+            self._finished(run, result=result)
+        else:
+            self._finished(run, error=reason)
+
+    def _finished(self, run, result=None, error=None):
+        if run.timeout_call is not None:
+            if run.timeout_call.active():
+                run.timeout_call.cancel()
+            run.timeout_call = None
+
+        del self._running[run.dataset_id]
+        queue = self._queues[run.dataset_id]
+        queue.pop(0)
+        if queue:
+            self._ready.append(run.dataset_id)
+        else:
+            del self._queues[run.dataset_id]
+
+        if error is None:
+            result = dict(result)
+            result['timed_out'] = run.timed_out
+            result['notifications'] = run.notifications
+            log.info('Workflow for dataset %s ended with exit code %s' %
+                     (run.dataset_id, result['exitcode']))
+        for d in run.waiters:
+            if error is None:
+                d.callback(result)
+            else:
+                d.errback(error)
+
+        self._start_ready()
@@ -506,10 +506,10 @@ class NpreservingEngine(Engine):
         # provisioner has not queried IaaS and sent state update notifications
         # back to the controller in less time than it takes for this method
         # to complete.
-        all_instance_lists = state.get_all("instance-state")
+        all_latest = state.get_all_latest("instance-state")
         
         # How many instances are not terminated/ing or corrupted?
-        valid_count = self._valid_count(all_instance_lists)
+        valid_count = self._valid_count(state, all_latest)
         log.debug("valid count: %d" % valid_count)
         
         # First task is always to make sure that any unique instances that
@@ -535,7 +535,7 @@ class NpreservingEngine(Engine):
             if iaas_id:
                 # If there is already an IaaS ID for this unique instance ID,
                 # make sure it is active or starting already.
-                iaas_state = self._state_of_iaas_id(iaas_id, all_instance_lists)
+                iaas_state = self._state_of_iaas_id(iaas_id, all_latest)
                 if iaas_state in BAD_STATES:
                     log.warn("The VM '%s' for unique instance '%s' is in a state that needs compensation: %s" % (iaas_id, uniq_id, iaas_state))
                     thiskv = self.unique_instances[uniq_id]
@@ -572,24 +572,15 @@ class NpreservingEngine(Engine):
         elif valid_count > target:
             log.info("Taking generic instance count from %d to %d (and there are %d unique-instances)" % (valid_count, target, uniqnum))
             while valid_count > target:
-                die_id = self._something_to_kill(all_instance_lists)
+                die_id = self._something_to_kill(state, all_latest)
                 if not die_id:
                     # Should be impossible in this situation
                     raise Exception("Cannot find any valid instances to terminate?")
                 self._destroy_one(control, die_id)
                 valid_count -= 1
                 
-    def _valid_count(self, all_instance_lists):
-        valid_count = 0
-        for instance_list in all_instance_lists:
-            ok = True
-            for state_item in instance_list:
-                if state_item.value in BAD_STATES:
-                    ok = False
-                    break
-            if ok:
-                valid_count += 1
-        return valid_count
+    def _valid_count(self, state, all_latest):
+        return len(self._filter_bad_instances(state, all_latest))
             
     def _launch_one(self, control, uniquekv=None):
         """Return instance_id"""
@@ -607,9 +598,9 @@ class NpreservingEngine(Engine):
             
         return str(launch_item.instance_ids[0])
     
-    def _something_to_kill(self, all_instance_lists):
+    def _something_to_kill(self, state, all_latest):
         """Pick one instance to die.  Filters instances that are not uniques"""
-        candidates = self._filter_bad_instances(all_instance_lists)
+        candidates = self._filter_bad_instances(state, all_latest)
         candidates = self._filter_unique_instances(candidates)
         if len(candidates) == 0:
             return None
@@ -629,14 +620,14 @@ class NpreservingEngine(Engine):
                 newcandidates.append(candidate)
         return newcandidates
     
-    def _filter_bad_instances(self, all_instance_lists):
-        """Filter out instances that are in terminating state or 'worse'"""
+    def _filter_bad_instances(self, state, all_latest):
+        """Filter out instances that have been in terminating state or 'worse'"""
         
         candidates = []
-        for instance_list in all_instance_lists:
+        for state_item in all_latest:
             ok = True
-            for state_item in instance_list:
-                if state_item.value in BAD_STATES:
+            for bad_state in BAD_STATES:
+                if state.has_seen("instance-state", state_item.key, bad_state):
                     ok = False
                     break
             if ok:
@@ -646,10 +637,8 @@ class NpreservingEngine(Engine):
         
         return candidates
         
-    def _state_of_iaas_id(self, iaas_id, all_instance_lists):
-        for instance_list in all_instance_lists:
-            # Important to get last item, most recent state
-            one_state_item = instance_list[-1]
+    def _state_of_iaas_id(self, iaas_id, all_latest):
+        for one_state_item in all_latest:
             if one_state_item.key == iaas_id:
                 return one_state_item.value
     
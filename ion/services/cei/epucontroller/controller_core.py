@@ -3,7 +3,6 @@ log = ion.util.ionlog.getLogger(__name__)
 
 import time
 import uuid
-from collections import defaultdict
 from ion.services.cei.decisionengine import EngineLoader
 import ion.services.cei.states as InstanceStates
 from ion.services.cei import cei_events
@@ -13,19 +12,32 @@ from twisted.internet import defer
 from forengine import Control
 from forengine import State
 from forengine import StateItem
+from forengine import window_stats
 
 PROVISIONER_VARS_KEY = 'provisioner_vars'
+STATE_MAX_LENGTH_KEY = 'state_max_length'
+STATE_MAX_AGE_KEY = 'state_max_age'
+
+# Defaults for how much sensor data is kept per key, age is in seconds
+DEFAULT_STATE_MAX_LENGTH = 100
+DEFAULT_STATE_MAX_AGE = None
 
 class ControllerCore(object):
     """Controller functionality that is not specific to the messaging layer.
     """
 
     def __init__(self, provisioner_client, engineclass, conf=None):
-        self.state = ControllerCoreState()
         prov_vars = None
+        max_length = DEFAULT_STATE_MAX_LENGTH
+        max_age = DEFAULT_STATE_MAX_AGE
         if conf:
             if conf.has_key(PROVISIONER_VARS_KEY):
                 prov_vars = conf[PROVISIONER_VARS_KEY]
+            if conf.has_key(STATE_MAX_LENGTH_KEY):
+                max_length = int(conf[STATE_MAX_LENGTH_KEY])
+            if conf.has_key(STATE_MAX_AGE_KEY):
+                max_age = float(conf[STATE_MAX_AGE_KEY])
+        self.state = ControllerCoreState(max_length, max_age)
                 
         # There can only ever be one 'reconfigure' or 'decide' engine call run
         # at ANY time.  The 'decide' call is triggered via timed looping call
@@ -65,33 +77,104 @@ class ControllerCore(object):
     def run_reconfigure(self, conf):
         yield self.busy.run(self.engine.reconfigure, self.control, conf)
 
+class StateHistory(object):
+    """Bounded history of the StateItems for one key, oldest first.
+
+    Holds at most max_length items and drops items older than max_age
+    seconds, but always keeps the most recent one. If track_values is set,
+    every distinct value ever added is remembered so has_seen works after
+    the items themselves are gone.
+    """
+
+    def __init__(self, max_length=None, max_age=None, track_values=False):
+        self.max_length = max_length
+        self.max_age = max_age
+        self.items = []
+        self.seen = None
+        if track_values:
+            self.seen = set()
+
+    def append(self, item):
+        items = self.items
+        items.append(item)
+        if self.seen is not None:
+            self.seen.add(item.value)
+
+        drop = 0
+        if self.max_length and len(items) > self.max_length:
+            drop = len(items) - self.max_length
+        if self.max_age is not None:
+            oldest = item.time - self.max_age
+            while drop < len(items) - 1 and items[drop].time < oldest:
+                drop += 1
+        if drop:
+            del items[:drop]
+
+    def latest(self):
+        if self.items:
+            return self.items[-1]
+        return None
+
+    def has_seen(self, value):
+        if self.seen is not None:
+            return value in self.seen
+        for item in self.items:
+            if item.value == value:
+                return True
+        return False
+
+
 class ControllerCoreState(State):
     """Keeps data, also what is passed to decision engine.
 
     In the future the decision engine will be passed more of a "view"
+
+    Only a bounded history is kept for each key, see StateHistory.
     """
 
-    def __init__(self):
+    def __init__(self, max_length=DEFAULT_STATE_MAX_LENGTH,
+            max_age=DEFAULT_STATE_MAX_AGE):
         super(ControllerCoreState, self).__init__()
         self.instance_state_parser = InstanceStateParser()
         self.queuelen_parser = QueueLengthParser()
-        self.instance_states = defaultdict(list)
-        self.queue_lengths = defaultdict(list)
+        self.max_length = max_length
+        self.max_age = max_age
+        self.instance_states = {}
+        self.queue_lengths = {}
+
+    def _add(self, data, item):
+        history = data.get(item.key)
+        if history is None:
+            # instance states are few and engines care about the whole
+            # lifecycle, queue lengths are many and only recent ones matter
+            track_values = data is self.instance_states
+            history = StateHistory(self.max_length, self.max_age,
+                    track_values=track_values)
+            data[item.key] = history
+        history.append(item)
 
     def new_instancestate(self, content):
         state_item = self.instance_state_parser.state_item(content)
         if state_item:
-            self.instance_states[state_item.key].append(state_item)
+            self._add(self.instance_states, state_item)
 
     def new_launch(self, new_instance_id):
         state = InstanceStates.REQUESTING
         item = StateItem("instance-state", new_instance_id, time.time(), state)
-        self.instance_states[item.key].append(item)
+        self._add(self.instance_states, item)
 
     def new_queuelen(self, content):
         state_item = self.queuelen_parser.state_item(content)
         if state_item:
-            self.queue_lengths[state_item.key].append(state_item)
+            self._add(self.queue_lengths, state_item)
+
+    def _data(self, typename):
+        if typename == "instance-state":
+            return self.instance_states
+        elif typename == "queue-length":
+            return self.queue_lengths
+        else:
+            raise KeyError("Unknown typename: '%s'" % typename)
 
     def get_all(self, typename):
         """
@@ -103,14 +186,8 @@ class ControllerCoreState(State):
         or an empty list if nothing matches.
         @exception KeyError if typename is unknown
         """
-        if typename == "instance-state":
-            data = self.instance_states
-        elif typename == "queue-length":
-            data = self.queue_lengths
-        else:
-            raise KeyError("Unknown typename: '%s'" % typename)
-
-        return data.values()
+        data = self._data(typename)
+        return [history.items for history in data.itervalues()]
 
     def get(self, typename, key):
         """Get all data about a particular key of a particular type.
@@ -121,18 +198,42 @@ class ControllerCoreState(State):
         or an empty list if nothing matches.
         @exception KeyError if typename is unknown
         """
-        if typename == "instance-state":
-            data = self.instance_states
-        elif typename == "queue-length":
-            data = self.queue_lengths
-        else:
-            raise KeyError("Unknown typename: '%s'" % typename)
-
+        data = self._data(typename)
         if data.has_key(key):
-            return data[key]
+            return data[key].items
         else:
             return []
 
+    def latest(self, typename, key):
+        """State API method, see State.latest
+        """
+        history = self._data(typename).get(key)
+        if history:
+            return history.latest()
+        return None
+
+    def get_all_latest(self, typename):
+        """State API method, see State.get_all_latest
+        """
+        data = self._data(typename)
+        return [history.latest() for history in data.itervalues()]
+
+    def has_seen(self, typename, key, value):
+        """State API method, see State.has_seen
+        """
+        history = self._data(typename).get(key)
+        if history:
+            return history.has_seen(value)
+        return False
+
+    def window_stats(self, typename, key, seconds=None):
+        """State API method, see State.window_stats
+        """
+        history = self._data(typename).get(key)
+        if history:
+            return window_stats(history.items, seconds)
+        return None
+
 
 class InstanceStateParser(object):
     """Converts instance state message into a StateItem
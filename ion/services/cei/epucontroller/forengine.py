@@ -1,3 +1,5 @@
+import time
+
 class Control(object):
     """
     This is the superclass for any implementation of the control object that
@@ -137,6 +139,66 @@ class State(object):
         """
         raise NotImplementedError
 
+    def latest(self, typename, key):
+        """
+        Get the most recent data point about a particular key of a
+        particular type.
+        
+        Implementations should override this with something cheaper than
+        the default, which searches get_all.
+        
+        @retval StateItem most recent StateItem for the key or None
+        @exception KeyError if typename is unknown
+        
+        """
+        for item_list in self.get_all(typename):
+            if item_list and item_list[-1].key == key:
+                return item_list[-1]
+        return None
+    
+    def get_all_latest(self, typename):
+        """
+        Get the most recent data point for every key of a particular type.
+        
+        @retval list(StateItem) one StateItem per key, or an empty list
+        @exception KeyError if typename is unknown
+        
+        """
+        return [item_list[-1] for item_list in self.get_all(typename)
+                if item_list]
+    
+    def has_seen(self, typename, key, value):
+        """
+        Find out if a particular key of a particular type has ever had
+        a value, even if that data point is no longer kept.
+        
+        @retval bool True if the value was seen
+        @exception KeyError if typename is unknown
+        
+        """
+        for item_list in self.get_all(typename):
+            if item_list and item_list[-1].key == key:
+                for item in item_list:
+                    if item.value == value:
+                        return True
+        return False
+    
+    def window_stats(self, typename, key, seconds=None):
+        """
+        Get the minimum, maximum and mean of the numeric values of a
+        particular key of a particular type.
+        
+        @param seconds only consider data obtained this many seconds ago
+        or later, default is every data point that is kept
+        @retval tuple (min, max, mean) or None if there is no data
+        @exception KeyError if typename is unknown
+        
+        """
+        for item_list in self.get_all(typename):
+            if item_list and item_list[-1].key == key:
+                return window_stats(item_list, seconds)
+        return None
+
 
 class StateItem(object):
     """
@@ -159,3 +221,17 @@ class StateItem(object):
         self.key = str(key)
         self.time = int(time)
         self.value = value
+
+
+def window_stats(items, seconds=None):
+    """Returns (min, max, mean) of the values of StateItems in a window,
+    or None if the window is empty.
+    """
+    if seconds is not None:
+        oldest = time.time() - seconds
+        values = [item.value for item in items if item.time >= oldest]
+    else:
+        values = [item.value for item in items]
+    if not values:
+        return None
+    return (min(values), max(values), float(sum(values)) / len(values))
@@ -20,7 +20,10 @@ class ProvisionerService(ServiceProcess):
 
     def slc_init(self):
         cei_events.event("provisioner", "init_begin", log)
-        self.store = ProvisionerStore()
+        max_history = self.spawn_args.get('store_history')
+        if max_history:
+            max_history = int(max_history)
+        self.store = ProvisionerStore(max_history=max_history)
         notifier = self.spawn_args.get('notifier')
         self.notifier = notifier or ProvisionerNotifier(self)
         self.dtrs = DeployableTypeRegistryClient(self)
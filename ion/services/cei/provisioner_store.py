@@ -8,25 +8,49 @@
 
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
+import bisect
+import copy
 import uuid
 import time
 from itertools import groupby
 from twisted.internet import defer
 
-try:
-    import json
-except ImportError:
-    import simplejson as json
-
 class ProvisionerStore(object):
     """Abstraction for data storage routines by provisioner
+
+    Records are kept decoded, in a history per launch/node pair that is
+    ordered by key (state, then timestamp). Secondary indexes by launch,
+    node and site and a latest-state view of launches are maintained on
+    each put, so queries do not scan the whole history.
+
+    If max_history is set, only the last max_history records of each
+    launch/node pair are kept. Returned records are deep copies of the
+    stored ones, so callers may change them freely.
     """
 
     # Using a simple in-memory dict for now, until it is clear how
     # to use CEI datastore
-    def __init__(self):
+    def __init__(self, max_history=None):
+        self.max_history = max_history
+
+        # key -> record
         self.data = {}
 
+        # (launch_id, node_id) -> ascending list of keys
+        self._history = {}
+
+        # launch_id -> set of node_ids (including '' for the launch record)
+        self._launch_nodes = {}
+
+        # node_id -> launch_id
+        self._node_launch = {}
+
+        # site -> set of (launch_id, node_id)
+        self._site_nodes = {}
+
+        # launch state -> set of launch_ids, from the latest launch records
+        self._launch_states = {}
+
     def put_record(self, record, newstate=None, timestamp=None):
         """Stores a record, optionally first updating state.
         """
@@ -45,7 +69,10 @@ class ProvisionerStore(object):
 
         record['state_timestamp'] = ts
         key = '|'.join([launch_id, node_id, state, ts, newid])
-        self.data[key] = json.dumps(record)
+
+        # store a snapshot, the caller keeps its own record
+        self.data[key] = copy.deepcopy(record)
+        self._index(key, launch_id, node_id, record.get('site'))
         log.debug('Added provisioner state: "%s"', key)
         return defer.succeed(key)
 
@@ -56,88 +83,112 @@ class ProvisionerStore(object):
         return [self.put_record(r, newstate=newstate, timestamp=ts)
                 for r in records]
 
-    @defer.inlineCallbacks
+    def _index(self, key, launch_id, node_id, site):
+        pair = (launch_id, node_id)
+        history = self._history.get(pair)
+        if history is None:
+            history = self._history[pair] = []
+            self._launch_nodes.setdefault(launch_id, set()).add(node_id)
+            if node_id:
+                self._node_launch[node_id] = launch_id
+
+        if node_id and site is not None:
+            self._site_nodes.setdefault(site, set()).add(pair)
+
+        if not node_id and history:
+            old_state = self.data[history[-1]]['state']
+            self._launch_states[old_state].discard(launch_id)
+
+        bisect.insort(history, key)
+
+        if not node_id:
+            state = self.data[history[-1]]['state']
+            self._launch_states.setdefault(state, set()).add(launch_id)
+
+        if self.max_history and len(history) > self.max_history:
+            for old_key in history[:-self.max_history]:
+                del self.data[old_key]
+            del history[:-self.max_history]
+
+    def _latest(self, launch_id, node_id):
+        history = self._history.get((launch_id, node_id))
+        if history:
+            return copy.deepcopy(self.data[history[-1]])
+        return None
+
     def get_site_nodes(self, site, before_state=None):
         """Retrieves the latest node record for all nodes at a site.
         """
-        #for performance, we would probably want to store these
-        # records denormalized in the store, by site id
-        all = yield self.get_all()
-        groups = group_records(all, 'node_id')
         site_nodes = []
-        for node_id, records in groups.iteritems():
-            if node_id and records[0]['site'] == site:
-                site_nodes.append(records[0])
-        defer.returnValue(site_nodes)
+        for launch_id, node_id in self._site_nodes.get(site, ()):
+            record = self._latest(launch_id, node_id)
+            if record.get('site') == site:
+                site_nodes.append(record)
+        return defer.succeed(site_nodes)
 
-    @defer.inlineCallbacks
     def get_launches(self, state=None):
         """Retrieves all launches in the given state, or the latest state
         of all launches if state is unspecified.
         """
-        records = yield self.get_all(node='')
-        groups = group_records(records, 'launch_id')
-        launches = []
-        for launch_id, records in groups.iteritems():
-            latest = records[0]
-            if state:
-                if latest['state'] == state:
-                    launches.append(latest)
-            else:
-                launches.append(latest)
-        defer.returnValue(launches)
+        if state:
+            launch_ids = self._launch_states.get(state, ())
+        else:
+            launch_ids = [launch_id
+                    for launch_id, node_ids in self._launch_nodes.iteritems()
+                    if '' in node_ids]
+        launches = [self._latest(launch_id, '') for launch_id in launch_ids]
+        return defer.succeed(launches)
 
-    @defer.inlineCallbacks
     def get_launch(self, launch):
         """Retrieves the latest launch record, from the launch_id.
+
+        As before the records were indexed, a launch without a launch record
+        gives its node record with the greatest key.
         """
-        records = yield self.get_all(launch, '')
-        defer.returnValue(records[0])
+        record = self._latest(launch, '')
+        if record is None:
+            keys = [self._history[(launch, node_id)][-1]
+                    for node_id in self._launch_nodes.get(launch, ())]
+            if keys:
+                record = copy.deepcopy(self.data[max(keys)])
+        return defer.succeed(record)
 
-    @defer.inlineCallbacks
     def get_launch_nodes(self, launch):
         """Retrieves the latest node records, from the launch_id.
         """
-        records = yield self.get_all(launch)
-        groups = group_records(records, 'node_id')
-        nodes = []
-        for node_id, records in groups.iteritems():
-            if node_id:
-                nodes.append(records[0])
-        defer.returnValue(nodes)
+        nodes = [self._latest(launch, node_id)
+                for node_id in self._launch_nodes.get(launch, ())
+                if node_id]
+        return defer.succeed(nodes)
 
-    @defer.inlineCallbacks
     def get_nodes_by_id(self, node_ids):
         """Retrieves the latest node records, from a list of node_ids
         """
-        records = yield self.get_all()
-        groups = group_records(records, 'node_id')
         nodes = []
         for node_id in node_ids:
-            records = groups.get(node_id)
-            if records:
-                nodes.append(records[0])
-            else:
+            launch_id = self._node_launch.get(node_id)
+            if launch_id is None:
                 nodes.append(None)
-        defer.returnValue(nodes)
+            else:
+                nodes.append(self._latest(launch_id, node_id))
+        return defer.succeed(nodes)
 
     def get_all(self, launch=None, node=None):
         """Retrieves the states about an instance or launch.
 
         States are returned in order.
         """
-        prefix = ''
         if launch:
-            prefix = '%s|' % launch
             if node:
-                prefix += '%s|' % node
-        #TODO uhhh. regex..? don't know what matching functionality we
-        # actually need here yet.
-
-        matches = [(s[0], json.loads(s[1])) for s in self.data.iteritems()
-                if s[0].startswith(prefix)]
-        matches.sort(reverse=True)
-        records = [r[1] for r in matches]
+                keys = list(self._history.get((launch, node), ()))
+            else:
+                keys = []
+                for node_id in self._launch_nodes.get(launch, ()):
+                    keys.extend(self._history[(launch, node_id)])
+        else:
+            keys = self.data.keys()
+        keys.sort(reverse=True)
+        records = [copy.deepcopy(self.data[key]) for key in keys]
         return defer.succeed(records)
 
 def group_records(records, *args):
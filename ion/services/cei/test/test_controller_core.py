@@ -0,0 +1,54 @@
+from twisted.trial import unittest
+
+import ion.services.cei.states as InstanceStates
+from ion.services.cei.epucontroller import StateItem
+from ion.services.cei.epucontroller.controller_core import ControllerCoreState
+from ion.services.cei.epucontroller.controller_core import StateHistory
+
+class ControllerCoreStateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.state = ControllerCoreState(max_length=3)
+
+    def test_bounded_history(self):
+        for qlen in range(10):
+            self.state.new_queuelen({'queue_id' : 'q', 'queuelen' : qlen})
+
+        qlens = self.state.get("queue-length", "q")
+        self.assertEqual([item.value for item in qlens], [7, 8, 9])
+        self.assertEqual(self.state.latest("queue-length", "q").value, 9)
+        self.assertEqual(self.state.window_stats("queue-length", "q"),
+                (7, 9, 8.0))
+        self.assertEqual(self.state.latest("queue-length", "other"), None)
+        self.assertEqual(self.state.window_stats("queue-length", "other"),
+                None)
+        self.assertRaises(KeyError, self.state.latest, "unknown", "q")
+
+    def test_instance_states_seen(self):
+        self.state.new_launch("i-1")
+        for state in (InstanceStates.PENDING, InstanceStates.STARTED,
+                InstanceStates.RUNNING, InstanceStates.TERMINATING,
+                InstanceStates.TERMINATED):
+            self.state.new_instancestate({'node_id' : 'i-1', 'state' : state})
+
+        self.assertEqual(len(self.state.get("instance-state", "i-1")), 3)
+        latest = self.state.get_all_latest("instance-state")
+        self.assertEqual([item.value for item in latest],
+                [InstanceStates.TERMINATED])
+        self.assertTrue(self.state.has_seen("instance-state", "i-1",
+                InstanceStates.REQUESTING))
+        self.assertFalse(self.state.has_seen("instance-state", "i-1",
+                InstanceStates.FAILED))
+
+    def test_max_age(self):
+        history = StateHistory(max_age=60)
+        for t in (0, 30, 100, 130):
+            history.append(StateItem("queue-length", "q", t, t))
+        self.assertEqual([item.time for item in history.items], [100, 130])
+
+        # the most recent item is always kept
+        history = StateHistory(max_age=60)
+        history.append(StateItem("queue-length", "q", 0, 0))
+        history.append(StateItem("queue-length", "q", 500, 1))
+        self.assertEqual(history.latest().value, 1)
+        self.assertEqual(len(history.items), 1)
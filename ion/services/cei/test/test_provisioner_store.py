@@ -49,6 +49,79 @@ class ProvisionerStoreTests(IonTestCase):
         self.assertEqual(result[0]['state'], states.PENDING)
         self.assertEqual(result[1]['state'], states.REQUESTED)
 
+    @defer.inlineCallbacks
+    def test_latest_views(self):
+        launch_id = new_id()
+        yield self.store.put_record({'launch_id' : launch_id,
+            'state' : states.REQUESTED})
+        nodes = [{'launch_id' : launch_id, 'node_id' : new_id(),
+            'state' : states.REQUESTED, 'site' : 'chicago'} for i in range(3)]
+        yield self.store.put_records(nodes)
+
+        other = {'launch_id' : new_id(), 'node_id' : new_id(),
+                'state' : states.REQUESTED, 'site' : 'knoxville'}
+        yield self.store.put_record(other)
+
+        yield self.store.put_record(nodes[0], states.PENDING)
+        nodes[0]['state'] = states.FAILED
+        yield self.store.put_record({'launch_id' : launch_id,
+            'state' : states.PENDING})
+
+        site_nodes = yield self.store.get_site_nodes('chicago')
+        self.assertEqual(len(site_nodes), 3)
+        by_id = dict((n['node_id'], n) for n in site_nodes)
+        self.assertEqual(by_id[nodes[0]['node_id']]['state'], states.PENDING)
+        self.assertEqual(by_id[nodes[1]['node_id']]['state'], states.REQUESTED)
+
+        launch_nodes = yield self.store.get_launch_nodes(launch_id)
+        self.assertEqual(len(launch_nodes), 3)
+
+        found = yield self.store.get_nodes_by_id([nodes[0]['node_id'],
+            new_id(), other['node_id']])
+        self.assertEqual(found[0]['state'], states.PENDING)
+        self.assertEqual(found[1], None)
+        self.assertEqual(found[2]['site'], 'knoxville')
+
+        launch = yield self.store.get_launch(launch_id)
+        self.assertEqual(launch['state'], states.PENDING)
+        launches = yield self.store.get_launches(state=states.PENDING)
+        self.assertEqual([l['launch_id'] for l in launches], [launch_id])
+        launches = yield self.store.get_launches(state=states.REQUESTED)
+        self.assertEqual(launches, [])
+        launches = yield self.store.get_launches()
+        self.assertEqual(len(launches), 1)
+
+    @defer.inlineCallbacks
+    def test_returned_copies(self):
+        launch_id = new_id()
+        yield self.store.put_record({'launch_id' : launch_id,
+            'state' : states.REQUESTED, 'deployable_type' : {'nodes' : ['a']}})
+
+        # Changing a returned record, nested values too, leaves the store alone
+        launch = yield self.store.get_launch(launch_id)
+        launch['deployable_type']['nodes'].append('b')
+        launch = yield self.store.get_launch(launch_id)
+        self.assertEqual(launch['deployable_type']['nodes'], ['a'])
+        records = yield self.store.get_all(launch_id)
+        records[0]['deployable_type']['nodes'].append('c')
+        launch = yield self.store.get_launch(launch_id)
+        self.assertEqual(launch['deployable_type']['nodes'], ['a'])
+
+    @defer.inlineCallbacks
+    def test_history_compaction(self):
+        self.store = ProvisionerStore(max_history=2)
+        launch_id = new_id()
+        record = {'launch_id' : launch_id, 'node_id' : new_id(),
+                'state' : states.REQUESTED}
+        yield self.store.put_record(record)
+        yield self.store.put_record(record, states.PENDING)
+        yield self.store.put_record(record, states.STARTED)
+
+        result = yield self.store.get_all(launch_id, record['node_id'])
+        self.assertEqual([r['state'] for r in result],
+                [states.STARTED, states.PENDING])
+        self.assertEqual(len(self.store.data), 2)
+
     def test_group_records(self):
         records = [
                 {'site' : 'chicago', 'allocation' : 'big', 'name' : 'sandwich'},
@@ -92,6 +92,10 @@ class DataStoreService(ServiceProcess):
         self.m_store = None
         self.c_store = None
         self.b_store = None
+        
+        # The key of the stored mutable head and the keys of the stored commits
+        # for each repository which is loaded in the work bench
+        self._repository_state = {}
             
 
         log.info('DataStoreService.__init__()')
@@ -122,6 +126,64 @@ class DataStoreService(ServiceProcess):
         
 
     
+    @defer.inlineCallbacks
+    def _load_repository(self, repo_key):
+        """
+        Make sure the work bench holds the stored state of a repository. The
+        commit index is only queried the first time a repository is used, or
+        when the stored head is not the one loaded last time - otherwise the
+        cached commits in the work bench are used.
+        Returns the set of stored commit keys or None if the repository is not
+        in the store.
+        """
+        blob = yield self.m_store.get(repo_key)
+        if not blob:
+            defer.returnValue(None)
+            
+        store_head = gpb_wrapper.StructureElement.parse_structure_element(blob)
+        
+        state = self._repository_state.get(repo_key)
+        if state is not None and state['head'] == store_head.key and \
+                self.workbench.get_repository(repo_key) is not None:
+            defer.returnValue(state['commits'])
+        
+        self.workbench._hashed_elements[store_head.key]=store_head
+        
+        # Get the commits using the query interface
+        store_commits = {}
+        blobs = yield self.c_store.query({self.CommitIndexName:repo_key})
+            
+        for key, blob in blobs.items():
+            #print 'BLOB key: "%s"; value: "%s"' % (binascii.b2a_hex(key), binascii.b2a_hex(blob))
+            wse = gpb_wrapper.StructureElement.parse_structure_element(blob)
+            assert key == wse.key, 'Calculated key does not match the stored key!'
+            store_commits[wse.key] = wse
+            
+        # Load these commits into the workbench
+        self.workbench._hashed_elements.update(store_commits)
+            
+        repo = self.workbench._load_repo_from_mutable(store_head)
+            
+        # Check to make sure the mutable is upto date with the commits...
+        for commit_key in store_commits.keys():
+            if not commit_key in repo._commit_index:
+                raise DataStoreError('Can not handle divergence yet...')
+        
+        state = {'head':store_head.key, 'commits':set(store_commits.keys())}
+        self._repository_state[repo_key] = state
+        defer.returnValue(state['commits'])
+    
+    @defer.inlineCallbacks
+    def op_get_heads(self, content, headers, msg):
+        """
+        Reply with the head commits of the stored repositories so that a push
+        only sends the commits which are not stored already.
+        """
+        for repo_key in content:
+            yield self._load_repository(str(repo_key))
+            
+        yield self.workbench.op_get_heads(content, headers, msg)
+    
     @defer.inlineCallbacks
     def op_push(self, heads, headers, msg):
         
@@ -130,46 +192,24 @@ class DataStoreService(ServiceProcess):
         for head in heads:
             
             # Extract the repository key from the mutable
-            raw_mutable = object_utils.get_gpb_class_from_type_id(mutable_type)()
-            raw_mutable.ParseFromString(head.value)
-            repo_key = str(raw_mutable.repositorykey)
+            repo_key = self.workbench._mutable_repository_key(head)
             
-            # Get the mutable
-            store_head = None
-            store_commits = {}
-
-            pushed_repos[repo_key] = store_commits
-
-            blob = yield self.m_store.get(repo_key)
-            # if the store has a version of the repo - then load it
-            if blob:
-                store_head = gpb_wrapper.StructureElement.parse_structure_element(blob)
-                self.workbench._hashed_elements[store_head.key]=store_head
+            # Get the keys of the commits which are already stored
+            store_commits = yield self._load_repository(repo_key)
+            if store_commits is None:
+                store_commits = set()
                 
-                # Get the commits using the query interface
-                blobs = yield self.c_store.query({self.CommitIndexName:repo_key})
-                    
-                for key, blob in blobs.items():
-                    #print 'BLOB key: "%s"; value: "%s"' % (binascii.b2a_hex(key), binascii.b2a_hex(blob))
-                    wse = gpb_wrapper.StructureElement.parse_structure_element(blob)
-                    assert key == wse.key, 'Calculated key does not match the stored key!'
-                    store_commits[wse.key] = wse
-                    
-                    
-                # Load these commits into the workbench
-                self.workbench._hashed_elements.update(store_commits)
-                    
-                repo = self.workbench._load_repo_from_mutable(store_head)
-                    
-                # Check to make sure the mutable is upto date with the commits...
-                for commit_key in store_commits.keys():
-                    if not commit_key in repo._commit_index:
-                        raise DataStoreError('Can not handle divergence yet...')
+            pushed_repos[repo_key] = store_commits
             
             
-        yield self.workbench.op_push(heads, headers, msg)
-        
-        def_list = []
+        complete = yield self.workbench.op_push(heads, headers, msg)
+        if not complete:
+            # The objects which did arrive are stored already - the pusher
+            # pushes again and the transfer resumes
+            return
+        
+        commit_items = {}
+        commit_attributes = {}
         # First put the updated commits
         for repo_key, store_commits in pushed_repos.items():
             # Get the updated repository
@@ -203,13 +243,11 @@ class DataStoreService(ServiceProcess):
                     elif  cref.objectroot.ObjectType == terminology_type:
                         attributes['word'] = cref.objectroot.word
                     
-                    # Should replace this with one put slice command
-                    defd = self.c_store.put(key = key,
-                                           value = wse.serialize(),
-                                           index_attributes = attributes)
-                    def_list.append(defd)
+                    commit_items[key] = wse.serialize()
+                    commit_attributes[key] = attributes
+                    store_commits.add(key)
             
-        yield defer.DeferredList(def_list)
+        yield self.c_store.batch_put(commit_items, commit_attributes)
             
         # Pretty useless to try and debug by reading, but its a start...   
         #print 'KVS: \n', self.c_store.kvs, '\n\n'
@@ -217,16 +255,17 @@ class DataStoreService(ServiceProcess):
         #print 'Index: \n', self.c_store.indices, '\n\n'
             
             
-        def_list = []
+        mutable_items = {}
         # Now put the mutable heads
-        for repo_key in pushed_repos.keys():
+        for repo_key, store_commits in pushed_repos.items():
             repo = self.workbench.get_repository(repo_key)
             wse = self.workbench.serialize_mutable(repo._dotgit)
-            defd = self.m_store.put(repo_key, wse.serialize())
+            mutable_items[repo_key] = wse.serialize()
             
-            def_list.append(defd)
+            # The work bench now holds the stored state of the repository
+            self._repository_state[repo_key] = {'head':wse.key, 'commits':store_commits}
             
-        yield defer.DeferredList(def_list)
+        yield self.m_store.batch_put(mutable_items)
         
             
                 
@@ -235,36 +274,12 @@ class DataStoreService(ServiceProcess):
     def op_pull(self, content, headers, msg):
         """
         Content is a string - the name of a mutable head for a repository
+        The work bench only sends the commits newer than the heads the
+        requester already has.
         """
         repo_key = str(content)
         
-        store_commits ={}
-        
-        blob = yield self.m_store.get(repo_key)
-        # if the store has a version of the repo - then load it
-        if blob:
-            store_head = gpb_wrapper.StructureElement.parse_structure_element(blob)
-            self.workbench._hashed_elements[store_head.key]=store_head
-                
-            # Get the commits using the query interface
-            blobs = yield self.c_store.query({self.CommitIndexName:repo_key})
-                
-            for key, blob in blobs.items():
-                #print 'BLOB key: "%s"; value: "%s"' % (binascii.b2a_hex(key), binascii.b2a_hex(blob))
-                wse = gpb_wrapper.StructureElement.parse_structure_element(blob)
-                assert key == wse.key, 'Calculated key does not match the stored key!'
-                store_commits[wse.key] = wse
-                    
-                    
-                # Load these commits into the workbench
-                self.workbench._hashed_elements.update(store_commits)
-                    
-                repo = self.workbench._load_repo_from_mutable(store_head)
-                    
-                # Check to make sure the mutable is upto date with the commits...
-                for commit_key in store_commits.keys():
-                    if not commit_key in repo._commit_index:
-                        raise DataStoreError('Can not handle divergence yet...')
+        yield self._load_repository(repo_key)
         
         yield self.workbench.op_pull(content, headers, msg)
         
@@ -273,31 +288,57 @@ class DataStoreService(ServiceProcess):
         """
         The data store is getting objects for another process...
         """
-        def_list=[]
+        links = []
         # Elements is a dictionary of wrapped structure elements
         for se in elements.values():
             
             assert se.type == link_type, 'This is not a link element!'
             link = object_utils.get_gpb_class_from_type_id(link_type)()
             link.ParseFromString(se.value)
+            links.append(link)
+            
+        keys = [link.key for link in links if link.type != commit_type]
+        commit_keys = [link.key for link in links if link.type == commit_type]
+        
+        # Can get commits for a service in a fetch
+        yield self._load_store_elements(commit_keys, self.c_store)
+        
+        wses = yield self._load_store_elements(keys, self.b_store)
+        
+        if headers.get(self.workbench.FETCH_CLOSURE, False) == 'True':
+            # Load everything below the requested objects so the workbench can
+            # send the whole structure in one reply
+            while len(wses) > 0:
+                child_keys = set()
+                for wse in wses:
+                    if not wse.isleaf:
+                        child_keys.update(self.workbench._get_child_keys(wse))
                 
-            # if it is already in memory, don't worry about it...
-            if not link.key in self.workbench._hashed_elements:            
-                if link.type == commit_type:
-                    # Can get commits for a service in a fetch
-                    def_list.append(self.c_store.get(link.key))
-                else:
-                    def_list.append(self.b_store.get(link.key))
+                wses = yield self._load_store_elements(child_keys, self.b_store)
             
-        obj_list = yield defer.DeferredList(def_list)
-        #print 'OBJECT LIST:', obj_list
+        yield self.workbench.op_fetch_linked_objects(elements, headers, message)
+        
+    @defer.inlineCallbacks
+    def _load_store_elements(self, keys, backend):
+        """
+        Load the elements for keys which are not already in memory from the
+        backend into the workbench. Returns the list of elements loaded.
+        """
+        # if it is already in memory, don't worry about it...
+        keys = [key for key in keys if not key in self.workbench._hashed_elements]
+        if not keys:
+            defer.returnValue([])
             
+        blobs = yield backend.multi_get(keys)
+        
         # Load this list of objects from the store into memory for use in the datastores workbench
-        for result, blob in obj_list:
+        wses = []
+        for blob in blobs.values():
             wse = gpb_wrapper.StructureElement.parse_structure_element(blob)
-            self._hashed_elements[wse.key]=wse
+            self.workbench._hashed_elements[wse.key]=wse
+            wses.append(wse)
             
-        yield self.workbench.op_fetch_linked_objects(elements, headers, message)
+        defer.returnValue(wses)
         
     @defer.inlineCallbacks
     def push(self, *args):
@@ -318,52 +359,50 @@ class DataStoreService(ServiceProcess):
         defer.returnValue(ret)
         
     @defer.inlineCallbacks
-    def fetch_linked_objects(self, address, links):
+    def fetch_linked_objects(self, address, links, closure=False, max_bytes=None):
         """
         The datastore is getting any objects it does not already have... 
+        Objects which do not fit in max_bytes are left out of the reply.
         """
         
         #Check and make sure it is not in the datastore
-        def_list = []
-        for link in links:
-            if not link.key in self.workbench._hashed_elements:            
-                # Can request to get commits in a fetch...
-                if link.type == commit_type:
-                    def_list.append(self.c_store.get(link.key))
-                else:
-                    def_list.append(self.b_store.get(link.key))
+        # Can request to get commits in a fetch...
+        links = [link for link in links if not link.key in self.workbench._hashed_elements]
         
-        #for defd in def_list:
-        #    print 'Defd type: %s; value: %s' % (type(defd), defd)
-        
-        # The list of requested objects that are in the store
-        obj_list = yield defer.DeferredList(def_list)
-        
-        #for obj in obj_list:
-        #    print 'obj type: %s; value: %s' % (type(obj), obj)
+        commit_keys = [link.key for link in links if link.type == commit_type]
+        blob_keys = [link.key for link in links if link.type != commit_type]
         
+        # The requested objects that are in the store - one request per store
+        blobs = {}
+        if commit_keys:
+            found = yield self.c_store.multi_get(commit_keys)
+            blobs.update(found)
+        if blob_keys:
+            found = yield self.b_store.multi_get(blob_keys)
+            blobs.update(found)
         
         # If we have the object, put it in the work space, if not request it.
         need_list = []
         obj_dict = {}
         
-        # For some reason the obj_list is a tuple not just the value of the result
-        for link, (result, blob)  in zip(links, obj_list):
+        for link in links:
+            blob = blobs.get(link.key, None)
             if blob is None:
                 need_list.append(link)
                 obj_dict[link.key] = None
             else:
                 #print 'BLOB type: %s; value: %s' % (type(blob), blob)
                 wse = gpb_wrapper.StructureElement.parse_structure_element(blob)
-                self._hashed_elements[wse.key]=wse
+                self.workbench._hashed_elements[wse.key]=wse
                 obj_dict[link.key] = wse
 
 
         # Get these from the other service
+        got_objs = {}
         if need_list:
-            got_objs = yield self.workbench.fetch_linked_objects(address, need_list)
+            got_objs = yield self.workbench.fetch_linked_objects(address, need_list, closure=closure, max_bytes=max_bytes)
         
-        def_list = []
+        blob_items = {}
         for key, wse in got_objs.items():
             #if wse.type == commit_type:
             #    raise DataStoreError('Can not get commits in a fetch!')
@@ -373,13 +412,13 @@ class DataStoreService(ServiceProcess):
             
             # Don't ever put commits out of context. This is done by push!
             if wse.type != commit_type:
-                def_list.append(self.b_store.put(key, wse.serialize()))
+                blob_items[key] = wse.serialize()
                 
             # Add it to the dictionary of objects 
         
         obj_dict.update(got_objs)
         
-        yield defer.DeferredList(def_list)
+        yield self.b_store.batch_put(blob_items)
         
         defer.returnValue(obj_dict.values())
         
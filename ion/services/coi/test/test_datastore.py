@@ -18,6 +18,8 @@ from ion.test.iontest import IonTestCase
 from net.ooici.play import addressbook_pb2
 from ion.util import procutils as pu
 from ion.core.object import object_utils
+from ion.core.object import workbench
+from ion.core.exception import ReceivedError
 
 person_type = object_utils.create_type_identifier(object_id=20001, version=1)
 addresslink_type = object_utils.create_type_identifier(object_id=20003, version=1)
@@ -119,11 +121,60 @@ class DataStoreTest(IonTestCase):
         
         
         # Test to make sure pushing a non existent workbench fails
-        
+
         # How do I test raises in a deferred call?
         #self.assertRaises(KeyError,proc_ds1.push, 'ps2','NonExistentRepositoryName')
-        
-        
+
+    @defer.inlineCallbacks
+    def test_incremental_push(self):
+
+        child_ds1 = yield self.sup.get_child_id('ds1')
+        proc_ds1 = self._get_procinstance(child_ds1)
+
+        child_ds2 = yield self.sup.get_child_id('ds2')
+        proc_ds2 = self._get_procinstance(child_ds2)
+
+        # Count the queries and the commits stored by the receiving data store
+        queries = []
+        query = proc_ds2.c_store.query
+        def counting_query(*args, **kwargs):
+            queries.append(args)
+            return query(*args, **kwargs)
+        proc_ds2.c_store.query = counting_query
+
+        puts = []
+        batch_put = proc_ds2.c_store.batch_put
+        def counting_batch_put(items, *args, **kwargs):
+            puts.extend(items.keys())
+            return batch_put(items, *args, **kwargs)
+        proc_ds2.c_store.batch_put = counting_batch_put
+
+        repo, ab = proc_ds1.workbench.init_repository(addressbook_type,'addressbook')
+        ab.title = 'First'
+        repo.commit('First')
+
+        response, ex = yield proc_ds1.push('ps2','addressbook')
+        self.assertEqual(response, proc_ds1.ION_SUCCESS)
+        self.assertEqual(len(puts), 1)
+
+        for title in ['Second', 'Third']:
+            ab.title = title
+            repo.commit(title)
+
+            response, ex = yield proc_ds1.push('ps2','addressbook')
+            self.assertEqual(response, proc_ds1.ION_SUCCESS)
+
+        # Each push only stored its own commit and the history was never queried
+        self.assertEqual(len(puts), 3)
+        self.assertEqual(len(queries), 0)
+
+        repo_ds2 = proc_ds2.workbench.get_repository(repo.repository_key)
+        self.assertEqual(repo_ds2._dotgit, repo._dotgit)
+
+        ab_2 = yield repo_ds2.checkout('master')
+        self.assertEqual(ab_2.title, 'Third')
+
+
     @defer.inlineCallbacks
     def test_merge_push(self):
             
@@ -360,6 +411,153 @@ class DataStoreTest(IonTestCase):
                 
         
 
+    @defer.inlineCallbacks
+    def _get_datastores(self):
+        child_ds1 = yield self.sup.get_child_id('ds1')
+        proc_ds1 = self._get_procinstance(child_ds1)
+        
+        child_ds2 = yield self.sup.get_child_id('ds2')
+        proc_ds2 = self._get_procinstance(child_ds2)
+        
+        defer.returnValue((proc_ds1, proc_ds2))
+        
+    def _make_addressbook(self, proc):
+        repo, ab = proc.workbench.init_repository(addresslink_type,'addressbook')
+        
+        for name, id in (('David', 5), ('John', 222)):
+            p = repo.create_object(person_type)
+            p.name = name
+            p.id = id
+            ab.person.add()
+            ab.person[len(ab.person)-1] = p
+            
+        repo.commit()
+        return repo, ab
+        
+    def _count_pushes(self, proc):
+        sent = []
+        send_push = proc.workbench._send_push
+        def counting_send_push(*args):
+            sent.append(args)
+            return send_push(*args)
+        proc.workbench._send_push = counting_send_push
+        return sent
+        
+    @defer.inlineCallbacks
+    def test_push_progress(self):
+        """
+        A push which takes longer than push_timeout does not time out while
+        the receiver keeps reporting progress
+        """
+        proc_ds1, proc_ds2 = yield self._get_datastores()
+        repo, ab = self._make_addressbook(proc_ds1)
+        
+        saved = (workbench.CF_push_timeout, workbench.CF_transfer_batch_bytes,
+                 workbench.CF_transfer_progress_interval)
+        workbench.CF_push_timeout = 0.5
+        workbench.CF_transfer_batch_bytes = 1
+        workbench.CF_transfer_progress_interval = 0
+        
+        # Each fetch is quick but all of them take longer than the timeout
+        fetch = proc_ds2.fetch_linked_objects
+        @defer.inlineCallbacks
+        def slow_fetch(*args, **kwargs):
+            yield pu.asleep(0.3)
+            result = yield fetch(*args, **kwargs)
+            defer.returnValue(result)
+        proc_ds2.fetch_linked_objects = slow_fetch
+        
+        sent = self._count_pushes(proc_ds1)
+        reports = []
+        try:
+            response, ex = yield proc_ds1.push('ps2','addressbook', reports.append)
+        finally:
+            (workbench.CF_push_timeout, workbench.CF_transfer_batch_bytes,
+             workbench.CF_transfer_progress_interval) = saved
+            
+        self.assertEqual(response, proc_ds1.ION_SUCCESS)
+        self.assertEqual(len(sent), 1)
+        
+        self.assert_(len(reports) > 1)
+        self.assertEqual(reports[-1]['repository'], repo.repository_key)
+        self.assertEqual(reports[-1]['pending'], 0)
+        
+        repo_ds2 = proc_ds2.workbench.get_repository(repo.repository_key)
+        ab_2 = yield repo_ds2.checkout('master')
+        self.assertEqual(ab_2, ab)
+        
+    @defer.inlineCallbacks
+    def test_push_resume(self):
+        """
+        A push whose transfer failed is sent again, and the receiver fetches
+        only what it did not get the first time
+        """
+        proc_ds1, proc_ds2 = yield self._get_datastores()
+        repo, ab = self._make_addressbook(proc_ds1)
+        
+        saved = (workbench.CF_transfer_retries, workbench.CF_transfer_batch_bytes)
+        workbench.CF_transfer_retries = 0
+        workbench.CF_transfer_batch_bytes = 1
+        
+        # The second fetch times out
+        fetch = proc_ds2.fetch_linked_objects
+        calls = []
+        fetched = []
+        @defer.inlineCallbacks
+        def failing_fetch(address, links, *args, **kwargs):
+            keys = [link.key for link in links]
+            calls.append(keys)
+            if len(calls) == 2:
+                raise defer.TimeoutError('Fetch timed out')
+            result = yield fetch(address, links, *args, **kwargs)
+            fetched.extend([se.key for se in result if se is not None])
+            defer.returnValue(result)
+        proc_ds2.fetch_linked_objects = failing_fetch
+        
+        sent = self._count_pushes(proc_ds1)
+        try:
+            response, ex = yield proc_ds1.push('ps2','addressbook')
+        finally:
+            workbench.CF_transfer_retries, workbench.CF_transfer_batch_bytes = saved
+            
+        self.assertEqual(response, proc_ds1.ION_SUCCESS)
+        self.assertEqual(len(sent), 2)
+        
+        # The links of the failed fetch were asked for again, nothing else twice
+        later = set()
+        for keys in calls[2:]:
+            later.update(keys)
+        self.assert_(set(calls[1]) <= later)
+        self.assertEqual(len(fetched), len(set(fetched)))
+        
+        repo_ds2 = proc_ds2.workbench.get_repository(repo.repository_key)
+        ab_2 = yield repo_ds2.checkout('master')
+        self.assertEqual(ab_2, ab)
+        
+    @defer.inlineCallbacks
+    def test_push_rejected(self):
+        """
+        A push the receiver rejects is not sent again
+        """
+        proc_ds1, proc_ds2 = yield self._get_datastores()
+        self._make_addressbook(proc_ds1)
+        
+        received = []
+        def reject_push(heads, headers, msg):
+            received.append(heads)
+            return proc_ds2.reply_err(msg, {'errmsg':'Push rejected'})
+        proc_ds2.workbench.op_push = reject_push
+        
+        sent = self._count_pushes(proc_ds1)
+        try:
+            yield proc_ds1.push('ps2','addressbook')
+            self.fail('The rejected push should raise ReceivedError')
+        except ReceivedError, ex:
+            pass
+            
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(len(received), 1)
+        
     @itv(CONF)
     @defer.inlineCallbacks
     def test_load_data(self):
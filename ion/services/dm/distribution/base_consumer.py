@@ -11,8 +11,10 @@ import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
 
 import time
+from collections import deque
 
 from twisted.internet import defer
+from twisted.python import failure
 from twisted.internet.task import LoopingCall
 from twisted.internet import reactor
 
@@ -27,6 +29,10 @@ from ion.data import dataobject
 from ion.resources.dm_resource_descriptions import PubSubTopicResource, \
     DataMessageObject, StringMessageObject, DictionaryMessageObject
 
+# Defaults for the delivery pipeline, can be set in the spawn args
+DEFAULT_DELIVERY_CONCURRENCY = 4 # Sends in flight at once, one per queue
+DEFAULT_DELIVERY_BATCH = 1 # Results per 'data_batch' message, 1 sends 'data'
+DEFAULT_DELIVERY_BACKLOG = 1000 # Unsent results before ondata must wait
 
 class BaseConsumer(Process):
     '''
@@ -58,6 +64,15 @@ class BaseConsumer(Process):
         #    self.loop = LoopingCall(self.digest)
         self.loop_running = False
 
+        # Delivery pipeline - results are sent in order per queue, queues in parallel
+        self.delivery_concurrency = self.spawn_args.get('delivery concurrency', DEFAULT_DELIVERY_CONCURRENCY)
+        self.delivery_batch = self.spawn_args.get('delivery batch', DEFAULT_DELIVERY_BATCH)
+        self.delivery_backlog = self.spawn_args.get('delivery backlog', DEFAULT_DELIVERY_BACKLOG)
+        self._delivery_sem = defer.DeferredSemaphore(self.delivery_concurrency)
+        self._outbox = {}
+        self._outbox_size = 0
+        self._draining = {}
+
 
         self.receive_cnt = {}
         #self.received_msg = []
@@ -215,35 +230,55 @@ class BaseConsumer(Process):
 
         yield self.reply_ok(msg,{'received':self.receive_cnt,'sent':self.send_cnt})
 
-    @defer.inlineCallbacks
     def op_data(self, content, headers, msg):
 
         log.debug(self.__class__.__name__ +', MSG Received: ' + str(headers))
 
+        return self._receive_data([content], headers)
+
+    def op_data_batch(self, content, headers, msg):
+        '''
+        Message interface to receive several data messages at once, as sent
+        by a consumer with a 'delivery batch' greater than one
+        '''
+        log.debug(self.__class__.__name__ +', Batch of %d Received: %s' % (len(content), headers))
+
+        return self._receive_data(content, headers)
+
+    @defer.inlineCallbacks
+    def _receive_data(self, contents, headers):
+
         log.info(self.__class__.__name__ + '; Calling data process!')
 
-        # Keep a record of messages received
-        #@note this could get big! What todo?
+        for content in contents:
 
-        self.receive_cnt[headers.get('receiver')] += 1
-        #self.received_msg.append(content) # Do not keep the messages!
+            # Keep a record of messages received
+            #@note this could get big! What todo?
 
-        # Unpack the message and turn it into data
-        datamessage = dataobject.DataObject.decode(content)
-        if isinstance(datamessage, (StringMessageObject, DictionaryMessageObject)):
-            data = datamessage.data
-        else:
-            data = None
+            self.receive_cnt[headers.get('receiver')] += 1
+            #self.received_msg.append(content) # Do not keep the messages!
 
-        notification = datamessage.notification
-        timestamp = datamessage.timestamp
+            # Unpack the message and turn it into data
+            datamessage = dataobject.DataObject.decode(content)
+            if isinstance(datamessage, (StringMessageObject, DictionaryMessageObject)):
+                data = datamessage.data
+            else:
+                data = None
 
-        # Build the keyword args for ondata
-        args = dict(self.params)
-        args.update(self.deliver)
+            notification = datamessage.notification
+            timestamp = datamessage.timestamp
 
-        log.debug('**ARGS to ondata:'+str(args))
-        yield defer.maybeDeferred(self.ondata, data, notification, timestamp, **args)
+            # Build the keyword args for ondata
+            args = dict(self.params)
+            args.update(self.deliver)
+
+            # Back pressure - do not make more results while too many are unsent
+            if self._outbox_size >= self.delivery_backlog:
+                log.debug('Delivery backlog of %d results, waiting to process data' % self._outbox_size)
+                yield self._wait_delivered()
+
+            log.debug('**ARGS to ondata:'+str(args))
+            yield defer.maybeDeferred(self.ondata, data, notification, timestamp, **args)
 
         log.info(self.__class__.__name__ +"; op_data: Finished data processing")
 
@@ -257,9 +292,9 @@ class BaseConsumer(Process):
         else: # Do the digets thing...
 
             if self.interval_cnt.has_key(headers.get('receiver')):
-                self.interval_cnt[headers.get('receiver')] += 1
+                self.interval_cnt[headers.get('receiver')] += len(contents)
             else:
-                self.interval_cnt[headers.get('receiver')] = 1
+                self.interval_cnt[headers.get('receiver')] = len(contents)
 
 
             log.debug(self.__class__.__name__ +"; op_data: digest state: \n" + \
@@ -344,17 +379,87 @@ class BaseConsumer(Process):
 
         self.msgs_to_send.append((queue, msg.encode()))
 
-    @defer.inlineCallbacks
     def deliver_messages(self):
+        '''
+        Hand the queued results to the delivery pipeline. The returned deferred
+        fires when they, and any results already in the pipeline, are sent.
+        '''
         # Send data only when the process is complete!
-        if self.msgs_to_send:
-            while len(self.msgs_to_send) > 0:
-                queue, msg = self.msgs_to_send.pop(0)
-                yield self.send(queue, 'data', msg)
-                if self.send_cnt.has_key(queue):
-                    self.send_cnt[queue] += 1
-                else:
-                    self.send_cnt[queue] = 1
+        msgs, self.msgs_to_send = self.msgs_to_send, []
+        for queue, msg in msgs:
+            pending = self._outbox.get(queue)
+            if pending is None:
+                pending = self._outbox[queue] = deque()
+            pending.append(msg)
+        self._outbox_size += len(msgs)
+
+        return self._wait_delivered()
+
+    def _wait_delivered(self):
+        '''
+        Returns a deferred which fires when every result in the pipeline is sent
+        and fails with the first send error.
+        '''
+        waiting = []
+        for queue in self._outbox.keys():
+            d = defer.Deferred()
+            waiters = self._draining.get(queue)
+            if waiters is None:
+                self._draining[queue] = [d]
+                self._drain(queue)
+            else:
+                waiters.append(d)
+            waiting.append(d)
+
+        if not waiting:
+            return defer.succeed(None)
+
+        d = defer.DeferredList(waiting, consumeErrors=True)
+        def check(results):
+            for success, result in results:
+                if not success:
+                    return result
+        return d.addCallback(check)
+
+    @defer.inlineCallbacks
+    def _drain(self, queue):
+        '''
+        Sends the results for one queue, in order, until there are none left.
+        '''
+        pending = self._outbox[queue]
+        error = None
+        while pending:
+            if self.delivery_batch > 1:
+                count = min(len(pending), self.delivery_batch)
+                operation = 'data_batch'
+                content = [pending.popleft() for i in range(count)]
+            else:
+                count = 1
+                operation = 'data'
+                content = pending.popleft()
+
+            try:
+                yield self._delivery_sem.run(self.send, queue, operation, content)
+            except Exception:
+                error = failure.Failure()
+            self._outbox_size -= count
+            if error:
+                break
+
+            if self.send_cnt.has_key(queue):
+                self.send_cnt[queue] += count
+            else:
+                self.send_cnt[queue] = count
+
+        # Results left after an error stay queued for the next delivery
+        if not pending:
+            del self._outbox[queue]
+        waiters = self._draining.pop(queue)
+        for d in waiters:
+            if error:
+                d.errback(error)
+            else:
+                d.callback(None)
 
 class ConsumerDesc(ProcessDesc):
     '''
@@ -377,3 +377,97 @@ class BaseConsumerTest(IonTestCase):
         sent = msg_cnt.get('sent',{})
         self.assertEqual(sent.get(self.queue2),1)
         self.assertEqual(received.get(self.queue1),4)
+
+
+class DeliveryPipelineTest(IonTestCase):
+    '''
+    Test cases for the delivery pipeline of the base consumer. Sends are
+    recorded and completed by the test instead of going to the broker.
+    '''
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield self._setup_consumer({'delivery concurrency':2})
+
+    @defer.inlineCallbacks
+    def _setup_consumer(self, spawnargs):
+        from ion.services.dm.distribution.consumers import forwarding_consumer
+        self.consumer = forwarding_consumer.ForwardingConsumer(spawnargs=spawnargs)
+        yield self.consumer.plc_init()
+        self.sent = []
+        def send(queue, operation, content):
+            d = defer.Deferred()
+            self.sent.append((queue, operation, content, d))
+            return d
+        self.consumer.send = send
+
+    def _queue(self, queues, count):
+        for i in range(count):
+            self.consumer.ondata(str(i), 'note', 0.0, queues=queues)
+
+    def _finish_sends(self):
+        sent, self.sent = self.sent, []
+        for queue, operation, content, d in sent:
+            d.callback(None)
+        return sent
+
+    def test_grouped_concurrent_delivery(self):
+        self._queue(['q1', 'q2', 'q3'], 3)
+        done = []
+        self.consumer.deliver_messages().addCallback(done.append)
+
+        # One send per queue, at most 'delivery concurrency' at once
+        self.assertEqual(len(self.sent), 2)
+        self.assertNotEqual(self.sent[0][0], self.sent[1][0])
+        self.assertEqual(self.consumer.msgs_to_send, [])
+
+        sends = []
+        while self.sent:
+            sends.extend(self._finish_sends())
+        self.assertEqual(len(done), 1)
+        self.assertEqual(len(sends), 9)
+        self.assertEqual(self.consumer.send_cnt, {'q1':3, 'q2':3, 'q3':3})
+
+        # Results go out in order for each queue
+        for queue in ('q1', 'q2', 'q3'):
+            data = [dataobject.DataObject.decode(s[2]).data
+                    for s in sends if s[0] == queue]
+            self.assertEqual(data, ['0', '1', '2'])
+
+    @defer.inlineCallbacks
+    def test_batch_delivery(self):
+        yield self._setup_consumer({'delivery batch':2})
+        self._queue(['q1'], 5)
+        self.consumer.deliver_messages()
+
+        sends = []
+        while self.sent:
+            sends.extend(self._finish_sends())
+        self.assertEqual([(s[1], len(s[2])) for s in sends],
+                [('data_batch', 2), ('data_batch', 2), ('data_batch', 1)])
+        self.assertEqual(self.consumer.send_cnt, {'q1':5})
+
+    @defer.inlineCallbacks
+    def test_back_pressure(self):
+        yield self._setup_consumer({'delivery backlog':2})
+        self.consumer.receive_cnt['in'] = 0
+        self._queue(['q1'], 2)
+        self.consumer.deliver_messages()
+
+        dmsg = StringMessageObject()
+        dmsg.data = 'more'
+        dmsg.notification = 'note'
+        dmsg.timestamp = 0.0
+        done = []
+        self.consumer.deliver = {'queues':['q1']}
+        self.consumer.op_data(dmsg.encode(), {'receiver':'in'}, None).addCallback(done.append)
+
+        # ondata waits until the backlog is sent
+        self.assertEqual(self.consumer.receive_cnt['in'], 1)
+        self.assertEqual(self.consumer.msgs_to_send, [])
+        self.assertEqual(done, [])
+
+        while self.sent:
+            self._finish_sends()
+        self.assertEqual(len(done), 1)
+        self.assertEqual(self.consumer.send_cnt, {'q1':3})
@@ -10,12 +10,33 @@
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
 from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
 import re
 from uuid import uuid4
 
 from ion.core.process.process import ProcessFactory
 from ion.core.process.service_process import ServiceProcess, ServiceClient
 from ion.services.coi.attributestore import AttributeStoreClient
+from ion.services.dm.scheduler.timer_wheel import TimerWheel, \
+    CATCH_UP_SKIP, CATCH_UP_BURST
+
+from ion.core import ioninit
+CONF = ioninit.config(__name__)
+
+# Seconds between writes of changed tasks to the attribute store
+CF_flush_interval = CONF.getValue('flush_interval', 1.0)
+# Defaults for tasks which do not set them: random delay added to each
+# firing as a fraction of the interval, and what to do about firings missed
+# while the scheduler was stalled or down ('skip' or 'burst')
+CF_jitter = CONF.getValue('jitter', 0.0)
+CF_catch_up = CONF.getValue('catch_up', CATCH_UP_SKIP)
+# Seconds between attempts to read the stored tasks while the attribute store
+# does not answer
+CF_recover_retry = CONF.getValue('recover_retry', 1.0)
+
+# Task IDs are uuid4 strings, which tells them apart from other keys in the
+# attribute store when recovering
+TASK_ID_REGEX = '^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
 
 
 class SchedulerService(ServiceProcess):
@@ -23,26 +44,69 @@ class SchedulerService(ServiceProcess):
     First pass at a message-based cron service, where you register a send-to address,
     interval and payload, and the scheduler will message you when the timer expires.
     @note this will be subsumed into CEI at some point; consider this a prototype.
+
+    Tasks are held in memory on a TimerWheel. The attribute store is written
+    behind, every flush_interval seconds, and only read to recover the tasks
+    when the service starts. Recovery runs in the background, retrying until
+    the store answers, and tasks can be added and removed meanwhile. Tasks may
+    set 'jitter' and 'catch_up' next to 'interval'; the config gives the
+    defaults.
     """
     # Declaration of service
     declare = ServiceProcess.service_declare(name='scheduler',
-                                          version='0.1.1',
+                                          version='0.2.0',
                                           dependencies=['attributestore'])
 
     def slc_init(self):
         # @note Might want to start another AS instance with a different target name
         self.store = AttributeStoreClient(targetname='attributestore')
 
+        # task id -> task definition, as stored
+        self.tasks = {}
+        # task id -> definition to write, or None to remove, on the next flush
+        self._dirty = {}
+        self._flushing = False
+
+        self.wheel = TimerWheel(self._fire_batch)
+        self._flush_loop = LoopingCall(self._flush)
+
+        self._recovered = False
+        self._recovering = False
+        # Task ids removed while recovering - their stored definition may
+        # still be read after the flush dropped the removal from _dirty
+        self._removed = set()
+        # (DelayedCall, Deferred) of the wait before the next recovery attempt
+        self._recover_wait = None
+
+    def slc_activate(self):
+        if not self.wheel.running:
+            self.wheel.start()
+        if not self._flush_loop.running:
+            self._flush_loop.start(self.spawn_args.get('flush_interval', CF_flush_interval),
+                                   now=False)
+        # Do not wait for the store here - it may not be up yet
+        if not self._recovered and not self._recovering:
+            self._recovering = True
+            self._recover()
+
     def slc_stop(self):
         log.debug('SLC stop of Scheduler')
 
+    @defer.inlineCallbacks
     def slc_deactivate(self):
         """
-        Called before terminate, this is a good place to tear down the AS and jobs.
-        @todo iterate over the list
-        foreach task in op_query:
-          rm_task(task)
+        Called before terminate: stop the timers and write out pending changes.
+        Tasks stay in the store, to be recovered on the next start.
         """
+        self.wheel.stop()
+        if self._flush_loop.running:
+            self._flush_loop.stop()
+        self._recovering = False
+        if self._recover_wait is not None:
+            call, d = self._recover_wait
+            call.cancel()
+            d.callback(None)
+        yield self._flush()
 
     def slc_shutdown(self):
         log.debug('SLC shutdown of Scheduler')
@@ -59,30 +123,33 @@ class SchedulerService(ServiceProcess):
         try:
             task_id = str(uuid4())
             msg_interval = float(content['interval'])
-        except KeyError, ke:
-            log.exception('Required keys in payload not found!')
+            if 'target' not in content:
+                raise KeyError('target')
+            catch_up = content.get('catch_up', CF_catch_up)
+            if catch_up not in (CATCH_UP_SKIP, CATCH_UP_BURST):
+                raise ValueError('Unknown catch_up policy "%s"' % catch_up)
+        except (KeyError, ValueError, TypeError), ke:
+            log.exception('Invalid task definition!')
             yield self.reply_err(msg, {'value': str(ke)})
             return
 
         log.debug('ok, gotta task to save')
 
-        # Just drop the entire message payload in
-        rc = yield self.store.put(task_id, content)
-        if re.search('rror', rc):
-            yield self.reply_err(msg, 'Error "%s" adding task to registry!' % rc)
-            return
+        # Just drop the entire message payload in, with the time of the first
+        # run so the phase survives a restart
+        tdef = dict(content)
+        tdef['start'] = reactor.seconds() + msg_interval
+        self._schedule(task_id, tdef)
+        self._dirty[task_id] = tdef
 
-        # Now that task is stored into registry, add to messaging callback
-        log.debug('Adding task to scheduler')
-        reactor.callLater(msg_interval, self._send_and_reschedule, task_id)
         log.debug('Add completed OK')
         yield self.reply_ok(msg, {'value':task_id})
 
     @defer.inlineCallbacks
     def op_rm_task(self, content, headers, msg):
         """
-        Remove a task from the list/store. Will be dropped from the reactor
-        when the timer fires and _send_and_reschedule checks the registry.
+        Remove a task from the timers right away, and from the store on the
+        next flush.
         """
         task_id = content
 
@@ -92,8 +159,14 @@ class SchedulerService(ServiceProcess):
             self.reply_err(msg, {'value': err})
             return
 
-        log.debug('Removing task_id %s from store...' % task_id)
-        yield self.store.remove(task_id)
+        task_id = str(task_id)
+        log.debug('Removing task_id %s' % task_id)
+        self.wheel.cancel(task_id)
+        if self.tasks.pop(task_id, None) is not None or self._recovering:
+            # A task not recovered yet is skipped by the recovery
+            self._dirty[task_id] = None
+        if self._recovering:
+            self._removed.add(task_id)
         log.debug('Removal completed')
         yield self.reply_ok(msg, {'value': 'OK'})
 
@@ -103,47 +176,109 @@ class SchedulerService(ServiceProcess):
         Query tasks registered, returns a maybe-empty list
         """
         log.debug('Looking for matching tasks')
-        tlist = yield self.store.query(content)
+        regex = re.compile(content)
+        tlist = [task_id for task_id in self.tasks if regex.search(task_id)]
 
         log.debug(tlist)
 
-        self.reply_ok(msg,  {'value': tlist})
+        yield self.reply_ok(msg,  {'value': tlist})
 
     ##################################################
     # Internal methods
 
-    @defer.inlineCallbacks
-    def _send_and_reschedule(self, task_id):
+    def _schedule(self, task_id, tdef):
+        self.tasks[task_id] = tdef
+        self.wheel.schedule(task_id, tdef['start'],
+                            interval=float(tdef['interval']),
+                            jitter=float(tdef.get('jitter', CF_jitter)),
+                            catch_up=tdef.get('catch_up', CF_catch_up))
+
+    def _fire_batch(self, timers):
         """
-        Check to see if we're still in the store - if not, we've been removed
-        and should abort the run.
+        Send the messages of all tasks due in one tick
         """
-        log.debug('Worker activated for task %s' % task_id)
-        tdef = yield self.store.get(task_id)
-        if tdef == None:
-            log.info('Task ID missing in store, assuming removal and aborting')
-            return
+        sends = []
+        for timer in timers:
+            tdef = self.tasks.get(timer.key)
+            if tdef is None:
+                continue
+            log.debug('Time to send "%s" to "%s", id "%s"' %
+                      (tdef['payload'], tdef['target'], timer.key))
+            d = self.send(tdef['target'], 'scheduler', tdef['payload'])
+            d.addErrback(self._send_failed, timer.key)
+            sends.append(d)
+        return defer.DeferredList(sends)
 
-        payload = tdef['payload']
-        target_id = tdef['target']
-        interval = tdef['interval']
+    def _send_failed(self, reason, task_id):
+        log.error('Send for task %s failed: %s' % (task_id, reason.getErrorMessage()))
 
-        log.debug('Time to send "%s" to "%s", id "%s"' % (payload, target_id, task_id))
-        yield self.send(target_id, 'scheduler', payload)
-        log.debug('Send completed, rescheduling %s' % task_id)
+    @defer.inlineCallbacks
+    def _recover(self):
+        """
+        Load the tasks written by an earlier run, trying again every
+        recover_retry seconds until the store answers or the service is
+        deactivated. Tasks added or removed meanwhile are left alone. Firings
+        missed while down are handled by each task's catch-up policy.
+        """
+        count = 0
+        while self._recovering:
+            try:
+                keys = yield self.store.query(TASK_ID_REGEX)
+                for task_id in keys:
+                    if not self._recovering:
+                        return
+                    if task_id in self.tasks or task_id in self._dirty \
+                            or task_id in self._removed:
+                        continue
+                    tdef = yield self.store.get(task_id)
+                    if not isinstance(tdef, dict) or 'interval' not in tdef \
+                            or 'target' not in tdef:
+                        continue
+                    # Added, removed or recovered while it was read
+                    if task_id in self.tasks or task_id in self._dirty \
+                            or task_id in self._removed or not self._recovering:
+                        continue
+                    if 'start' not in tdef:
+                        tdef['start'] = reactor.seconds() + float(tdef['interval'])
+                    self._schedule(task_id, tdef)
+                    count += 1
+            except Exception, ex:
+                retry = self.spawn_args.get('recover_retry', CF_recover_retry)
+                log.warn('Could not read tasks from the store, retrying in %s s: %s' %
+                         (retry, str(ex)))
+                d = defer.Deferred()
+                self._recover_wait = (reactor.callLater(retry, d.callback, None), d)
+                yield d
+                self._recover_wait = None
+                continue
 
-        reactor.callLater(interval, self._send_and_reschedule, task_id)
+            self._recovering = False
+            self._recovered = True
+            self._removed.clear()
+            log.info('Recovered %d scheduled tasks' % count)
 
+    @defer.inlineCallbacks
+    def _flush(self):
         """
-        Update last-invoked timestamp in registry
-        @bug This code is commented out as it causes a run-time race condition with op_rm_task -
-        splitting the read and this write fails quite often.
-
-#        log.debug('Updating last-run time')
-#        tdef['last_run'] = time.time()
-#        self.store.put(task_id, tdef)
+        Write tasks added or removed since the last flush to the store
         """
-        log.debug('Task %s rescheduled for %f seconds OK' % (task_id, interval))
+        if self._flushing or not self._dirty:
+            return
+        self._flushing = True
+        dirty, self._dirty = self._dirty, {}
+        try:
+            for task_id, tdef in dirty.items():
+                try:
+                    if tdef is None:
+                        yield self.store.remove(task_id)
+                    else:
+                        yield self.store.put(task_id, tdef)
+                except Exception, ex:
+                    log.error('Could not write task %s: %s' % (task_id, str(ex)))
+                    # Retry on the next flush, unless changed again since
+                    self._dirty.setdefault(task_id, tdef)
+        finally:
+            self._flushing = False
 
 class SchedulerServiceClient(ServiceClient):
     """
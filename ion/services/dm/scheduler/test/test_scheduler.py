@@ -18,14 +18,16 @@ from ion.util.procutils import asleep
 
 log = ion.util.ionlog.getLogger(__name__)
 
+SCHEDULER = {'name': 'scheduler', 'module': 'ion.services.dm.scheduler.scheduler_service',
+             'class': 'SchedulerService'}
 
 class SchedulerTest(IonTestCase):
     @defer.inlineCallbacks
     def setUp(self):
         self.timeout = 10
+        # The scheduler starts before the attribute store it recovers from
         services = [
-            {'name': 'scheduler', 'module': 'ion.services.dm.scheduler.scheduler_service',
-             'class': 'SchedulerService'},
+            SCHEDULER,
             {'name' : 'attributestore', 'module' : 'ion.services.coi.attributestore',
              'class' : 'AttributeStoreService'},
             {'name' : 'scheduled_task', 'module' : 'ion.services.dm.scheduler.test.receiver',
@@ -102,4 +104,65 @@ class SchedulerTest(IonTestCase):
         
         log.debug(rl)
         self.failUnlessEqual(len(rl['value']), 0)
-        yield asleep(0.5)
\ No newline at end of file
+        yield asleep(0.5)
+
+    @defer.inlineCallbacks
+    def test_restart_recovers_tasks(self):
+        sc = SchedulerServiceClient(proc=self.sup)
+        reply = yield sc.add_task(self.dest, 10.0, 'pingtest recovered')
+        task_id = reply['value']
+
+        # Terminating writes the task to the store
+        yield self.sup.get_child_def('scheduler').shutdown()
+        yield self._spawn_processes([SCHEDULER], sup=self.sup)
+
+        # Recovery runs after the new scheduler is up
+        for i in range(20):
+            rl = yield sc.query_tasks(task_id)
+            if rl['value']:
+                break
+            yield asleep(0.1)
+        self.failUnlessEqual(rl['value'], [task_id])
+
+        rc = yield sc.rm_task(task_id)
+        self.failUnlessEqual(rc['value'], 'OK')
+
+    @defer.inlineCallbacks
+    def test_rm_during_recovery(self):
+        sc = SchedulerServiceClient(proc=self.sup)
+        reply = yield sc.add_task(self.dest, 10.0, 'pingtest removed')
+        task_id = reply['value']
+
+        sid = yield self._get_procid('scheduler')
+        proc = self._get_procinstance(sid)
+        yield proc._flush()
+
+        # Recover again as if the task had not been read yet, with the read
+        # of its definition held back
+        proc.wheel.cancel(task_id)
+        del proc.tasks[task_id]
+        gate = defer.Deferred()
+        reading = defer.Deferred()
+        get = proc.store.get
+        @defer.inlineCallbacks
+        def slow_get(key):
+            tdef = yield get(key)
+            if key == task_id:
+                reading.callback(None)
+                yield gate
+            defer.returnValue(tdef)
+        proc.store.get = slow_get
+        proc._recovered = False
+        proc._recovering = True
+        recovery = proc._recover()
+        yield reading
+
+        # Removed and flushed while its stale definition is being read
+        yield sc.rm_task(task_id)
+        yield proc._flush()
+        gate.callback(None)
+        yield recovery
+
+        self.assertNotIn(task_id, proc.tasks)
+        rl = yield sc.query_tasks(task_id)
+        self.failUnlessEqual(rl['value'], [])
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+@file ion/services/dm/scheduler/test/test_timer_wheel.py
+@test ion.services.dm.scheduler.timer_wheel Timer wheel on a fake clock
+"""
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from ion.services.dm.scheduler.timer_wheel import TimerWheel, CATCH_UP_BURST
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.batches = []
+        # Small wheels, so timers cascade and park in short tests
+        self.wheel = TimerWheel(self._fire, resolution=0.1, slots=(8, 4, 4),
+                                max_burst=3, clock=self.clock)
+        self.wheel.start()
+
+    def tearDown(self):
+        self.wheel.stop()
+
+    def _fire(self, timers):
+        self.batches.append([(t.key, self.clock.seconds()) for t in timers])
+
+    def _fired(self, key):
+        return [when for batch in self.batches for k, when in batch if k == key]
+
+    def test_one_shot(self):
+        self.wheel.schedule('a', 1000.25)
+        self.clock.advance(0.2)
+        self.assertEqual(self.batches, [])
+        self.clock.advance(0.1)
+        self.assertEqual(len(self._fired('a')), 1)
+        self.assertTrue(self._fired('a')[0] >= 1000.25)
+        self.assertEqual(len(self.wheel), 0)
+        # Only one DelayedCall, and none once the wheel is empty
+        self.assertEqual(len(self.clock.getDelayedCalls()), 0)
+
+    def test_batch_and_cancel(self):
+        for i in range(100):
+            self.wheel.schedule(i, 1000.5)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        for i in range(0, 100, 2):
+            self.assertNotEqual(self.wheel.cancel(i), None)
+        self.assertEqual(self.wheel.cancel('missing'), None)
+
+        self.clock.advance(1)
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(sorted([k for k, when in self.batches[0]]), range(1, 100, 2))
+
+    def test_cascade_and_park(self):
+        # Spans are 8, 32 and 128 ticks: one timer per wheel, and one beyond
+        for key, delay in (('near', 0.5), ('mid', 2.5), ('far', 10.0), ('beyond', 40.0)):
+            self.wheel.schedule(key, 1000 + delay)
+        for i in range(450):
+            self.clock.advance(0.1)
+        for key, delay in (('near', 0.5), ('mid', 2.5), ('far', 10.0), ('beyond', 40.0)):
+            fired = self._fired(key)
+            self.assertEqual(len(fired), 1)
+            # Within a tick, allowing for rounding in the fake clock
+            self.assertTrue(1000 + delay - 1e-6 <= fired[0] < 1000 + delay + 0.11)
+
+    def test_periodic_without_drift(self):
+        self.wheel.schedule('p', 1000.3, interval=0.3)
+        for i in range(100):
+            self.clock.advance(0.1)
+        fired = self._fired('p')
+        self.assertEqual(len(fired), 33)
+        for n, when in enumerate(fired):
+            self.assertAlmostEqual(when, 1000.3 + 0.3 * n, 5)
+
+    def test_catch_up(self):
+        skip = self.wheel.schedule('skip', 1000.5, interval=1.0)
+        self.wheel.schedule('burst', 1000.5, interval=1.0, catch_up=CATCH_UP_BURST)
+        # A stall: the clock jumps 10 seconds at once
+        self.clock.advance(10)
+        self.assertEqual(len(self._fired('skip')), 1)
+        self.assertEqual(skip.missed, 9)
+        self.assertEqual(skip.deadline, 1010.5)
+        self.assertEqual(len(self._fired('burst')), 1)
+
+        # Burst makes up max_burst firings, one per tick, then skips the rest
+        for i in range(10):
+            self.clock.advance(0.1)
+        self.assertEqual(len(self._fired('skip')), 2)
+        burst = self._fired('burst')
+        self.assertEqual(len(burst), 5)
+        self.assertTrue(burst[3] - burst[1] < 0.25)
+        self.assertEqual(self.wheel.get('burst').deadline, 1011.5)
+
+    def test_jitter(self):
+        self.wheel.schedule('j', 1001, interval=1.0, jitter=0.5)
+        for i in range(100):
+            self.clock.advance(0.1)
+        fired = self._fired('j')
+        self.assertEqual(len(fired), 9)
+        for n, when in enumerate(fired):
+            self.assertTrue(1001 + n <= when <= 1001 + n + 0.6)
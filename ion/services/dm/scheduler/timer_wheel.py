@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+
+"""
+@file ion/services/dm/scheduler/timer_wheel.py
+@package ion.services.dm.scheduler.timer_wheel Hierarchical timer wheel
+@brief In-process timers for the scheduler. Timers live in the slots of a
+hierarchy of wheels and move down a level as their time approaches, so adding
+and cancelling are O(1) and the reactor holds a single DelayedCall. Timers due
+in the same tick fire together as one batch.
+@see Varghese and Lauck, Hashed and Hierarchical Timing Wheels (1987)
+"""
+
+import math
+import random
+
+import ion.util.ionlog
+log = ion.util.ionlog.getLogger(__name__)
+
+from ion.core import ioninit
+CONF = ioninit.config(__name__)
+
+# Seconds per tick of the innermost wheel
+CF_resolution = CONF.getValue('resolution', 0.1)
+# Slots in each wheel, innermost first
+CF_wheel_slots = CONF.getValue('wheel_slots', (256, 64, 64, 64))
+# Missed firings made up for in a row by a 'burst' timer, before it skips
+CF_max_burst = CONF.getValue('max_burst', 10)
+
+CATCH_UP_SKIP = 'skip'
+CATCH_UP_BURST = 'burst'
+
+
+class Timer(object):
+    """
+    A one shot or periodic timer. deadline is the nominal time of the next
+    firing; fire_time adds the jitter. Periodic deadlines stay on the grid of
+    the first one, so they do not drift.
+    """
+    def __init__(self, key, deadline, interval=None, jitter=0.0,
+                 catch_up=CATCH_UP_SKIP, data=None):
+        self.key = key
+        self.deadline = deadline
+        self.interval = interval
+        self.jitter = jitter
+        self.catch_up = catch_up
+        self.data = data
+        self.fire_time = deadline
+        self.fired = 0
+        self.missed = 0
+        self._burst = 0
+        self._tick = None
+        self._level = None
+        self._slot = None
+
+    def set_deadline(self, deadline):
+        self.deadline = deadline
+        self.fire_time = deadline
+        if self.jitter and self.interval:
+            self.fire_time += random.uniform(0, self.jitter * self.interval)
+
+    def next_deadline(self, now, max_burst):
+        """
+        Advances the deadline after a firing, applying the catch-up policy if
+        firings were missed
+        @retval False for a one shot timer
+        """
+        if not self.interval:
+            return False
+        deadline = self.deadline + self.interval
+        if deadline <= now:
+            if self.catch_up == CATCH_UP_BURST and self._burst < max_burst:
+                # Fire again on the next tick
+                self._burst += 1
+            else:
+                behind = int((now - deadline) / self.interval) + 1
+                self.missed += behind
+                deadline += behind * self.interval
+                self._burst = 0
+        else:
+            self._burst = 0
+        self.set_deadline(deadline)
+        return True
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timer wheel. Wheel i covers ticks up to the product of the
+    sizes of wheels 0..i ahead of the current tick; a timer goes in the
+    innermost wheel whose span covers it, and is moved inward when the outer
+    slot it is in comes round. Timers further out than the outermost span
+    wait in its last slot and are placed again when that comes round.
+
+    fire is called with a list of the Timers due, in order of fire time. A
+    periodic timer is rescheduled before fire is called and can be cancelled
+    from it.
+    """
+    def __init__(self, fire, resolution=CF_resolution, slots=CF_wheel_slots,
+                 max_burst=CF_max_burst, clock=None):
+        """
+        @param clock provider of seconds() and callLater(), the reactor by
+        default; a twisted.internet.task.Clock in tests
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.fire = fire
+        self.resolution = float(resolution)
+        self.sizes = list(slots)
+        self.max_burst = max_burst
+        self.clock = clock
+
+        # spans[i] is the number of ticks covered by wheels 0..i
+        self.spans = []
+        span = 1
+        for size in self.sizes:
+            span *= size
+            self.spans.append(span)
+
+        # wheels[level][slot] is a dict of key -> Timer
+        self.wheels = [[{} for i in range(size)] for size in self.sizes]
+        self._counts = [0] * len(self.sizes)
+        self._timers = {}
+
+        self.origin = clock.seconds()
+        self.current = 0
+        self._wake_call = None
+        self._wake_tick = None
+        self.running = False
+
+        self.batches = 0
+        self.fired = 0
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def get(self, key):
+        return self._timers.get(key)
+
+    def keys(self):
+        return self._timers.keys()
+
+    def start(self):
+        self.running = True
+        self._schedule_wake()
+
+    def stop(self):
+        self.running = False
+        if self._wake_call is not None and self._wake_call.active():
+            self._wake_call.cancel()
+        self._wake_call = None
+        self._wake_tick = None
+
+    def schedule(self, key, deadline, interval=None, jitter=0.0,
+                 catch_up=CATCH_UP_SKIP, data=None):
+        """
+        Adds a timer, replacing any with the same key
+        @param deadline time of the first firing, as clock.seconds()
+        @param interval seconds between firings, None for a one shot timer
+        @param jitter random delay added to each firing, as a fraction of the
+        interval
+        @param catch_up CATCH_UP_SKIP to drop firings missed in a stall, or
+        CATCH_UP_BURST to make them up
+        @retval Timer
+        """
+        self.cancel(key)
+        timer = Timer(key, deadline, interval, jitter, catch_up, data)
+        timer.set_deadline(deadline)
+        self._timers[key] = timer
+        self._insert(timer, self.current + 1)
+        if self.running and (self._wake_tick is None or timer._tick < self._wake_tick):
+            self._schedule_wake()
+        return timer
+
+    def cancel(self, key):
+        """
+        Removes a timer, O(1)
+        @retval the Timer, or None if there was none for key
+        """
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            self._unlink(timer)
+        return timer
+
+    def _tick_of(self, t):
+        # Ticks completed at time t, allowing for rounding of the wake time
+        return int((t - self.origin) / self.resolution + 1e-6)
+
+    def _insert(self, timer, min_tick):
+        # First tick at or after the fire time, so timers never fire early
+        tick = int(math.ceil((timer.fire_time - self.origin) / self.resolution - 1e-6))
+        tick = max(tick, min_tick)
+        timer._tick = tick
+        delta = tick - self.current
+        top = len(self.sizes) - 1
+        for level in range(len(self.sizes)):
+            if delta < self.spans[level] or level == top:
+                break
+        if delta >= self.spans[top]:
+            # Beyond the outermost wheel: park in its furthest slot
+            tick = self.current + self.spans[top] - 1
+        if level == 0:
+            slot = tick % self.sizes[0]
+        else:
+            slot = (tick // self.spans[level - 1]) % self.sizes[level]
+        timer._level = level
+        timer._slot = self.wheels[level][slot]
+        timer._slot[timer.key] = timer
+        self._counts[level] += 1
+
+    def _unlink(self, timer):
+        if timer._slot is not None:
+            del timer._slot[timer.key]
+            self._counts[timer._level] -= 1
+            timer._slot = None
+
+    def _cascade(self):
+        # Outer wheels first, their timers may land in inner slots due now
+        for level in range(len(self.sizes) - 1, 0, -1):
+            span = self.spans[level - 1]
+            if self.current % span:
+                continue
+            slot = self.wheels[level][(self.current // span) % self.sizes[level]]
+            if not slot:
+                continue
+            timers = slot.values()
+            slot.clear()
+            self._counts[level] -= len(timers)
+            for timer in timers:
+                timer._slot = None
+                self._insert(timer, self.current)
+
+    def advance(self):
+        """
+        Moves the wheel up to the clock's current time and fires what is due
+        @retval number of timers fired
+        """
+        now = self.clock.seconds()
+        target = self._tick_of(now)
+        due = []
+        while self.current < target:
+            if not self._timers:
+                self.current = target
+                break
+            self.current += 1
+            self._cascade()
+            slot = self.wheels[0][self.current % self.sizes[0]]
+            if slot:
+                due.extend(slot.values())
+                self._counts[0] -= len(slot)
+                for timer in slot.values():
+                    timer._slot = None
+                slot.clear()
+
+        if not due:
+            return 0
+        due.sort(key=lambda timer: timer.fire_time)
+        for timer in due:
+            timer.fired += 1
+            if timer.next_deadline(now, self.max_burst):
+                self._insert(timer, self.current + 1)
+            else:
+                del self._timers[timer.key]
+
+        self.batches += 1
+        self.fired += len(due)
+        try:
+            self.fire(due)
+        except Exception:
+            log.exception('Error firing %d timers' % len(due))
+        return len(due)
+
+    def _next_tick(self):
+        """
+        @retval the next tick with timers due or to move inward, None if empty
+        """
+        if not self._timers:
+            return None
+        size = self.sizes[0]
+        next_tick = None
+        if self._counts[0]:
+            for tick in range(self.current + 1, self.current + size + 1):
+                if self.wheels[0][tick % size]:
+                    next_tick = tick
+                    break
+        if len(self._counts) > 1 and sum(self._counts[1:]):
+            boundary = (self.current // size + 1) * size
+            if next_tick is None or boundary < next_tick:
+                next_tick = boundary
+        return next_tick
+
+    def _schedule_wake(self):
+        if self._wake_call is not None and self._wake_call.active():
+            self._wake_call.cancel()
+        self._wake_call = None
+        self._wake_tick = self._next_tick()
+        if self._wake_tick is None or not self.running:
+            return
+        delay = self.origin + self._wake_tick * self.resolution - self.clock.seconds()
+        self._wake_call = self.clock.callLater(max(delay, 0), self._wake)
+
+    def _wake(self):
+        self._wake_call = None
+        self.advance()
+        if self.running:
+            self._schedule_wake()
@@ -12,7 +12,8 @@ log = ion.util.ionlog.getLogger(__name__)
 
 from twisted.trial import unittest
 
-from ion.services.dm.util.url_manipulation import base_dap_url, generate_filename, rewrite_url
+from ion.services.dm.util.url_manipulation import base_dap_url, generate_filename, rewrite_url, \
+    normalize_url
 from ion.core import ioninit
 
 class BaseUrlTester(unittest.TestCase):
@@ -29,6 +30,15 @@ class BaseUrlTester(unittest.TestCase):
         cname = cfg.getValue('cache_hostname', None)
         self.failUnless(len(cname) > 0)
 
+    def test_normalize_url(self):
+        self.assertEqual(normalize_url('HTTP://Amoeba.UCSD.edu:80/glacier.nc.dds#top'),
+                         'http://amoeba.ucsd.edu/glacier.nc.dds')
+        self.assertEqual(normalize_url('http://amoeba.ucsd.edu:8001'),
+                         'http://amoeba.ucsd.edu:8001/')
+        # Constraint expressions are kept in order
+        self.assertEqual(normalize_url('http://amoeba.ucsd.edu/g.nc.ascii?b,a'),
+                         'http://amoeba.ucsd.edu/g.nc.ascii?b,a')
+
     def test_pydap_urls(self):
         # Variable access, generated by pydap web interface
         b = base_dap_url('http://amoeba.ucsd.edu:8001/glacier.nc.ascii?var232%5B0:1:0%5D%5B0:1:0%5D%5B0:1:601%5D%5B0:1:401%5D&')
@@ -100,3 +100,27 @@ def base_dap_url(src_url):
     except IndexError, ie:
         log.exception('DAP URL does not match expected pattern!')
         raise ie
+
+def normalize_url(src_url):
+    """
+    @brief Canonical form of a URL, used as the key of cached responses.
+    Lower cases the scheme and hostname, drops a default port and any
+    fragment, and makes an empty path '/'. The query is kept as is, since DAP
+    constraint expressions are order sensitive.
+    @param src_url Source URL
+    @retval Normalized URL
+    """
+    ml = urlparse.urlsplit(src_url)
+    scheme = ml.scheme.lower()
+    netloc = ml.hostname or ''
+    if ml.username:
+        userinfo = ml.username
+        if ml.password:
+            userinfo = userinfo + ':' + ml.password
+        netloc = userinfo + '@' + netloc
+    port = ml.port
+    if port and not (scheme == 'http' and port == 80) and \
+            not (scheme == 'https' and port == 443):
+        netloc = '%s:%d' % (netloc, port)
+    path = ml.path or '/'
+    return urlparse.urlunsplit((scheme, netloc, path, ml.query, ''))
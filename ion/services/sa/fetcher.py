@@ -17,15 +17,61 @@ log = ion.util.ionlog.getLogger(__name__)
 import base64
 
 from twisted.internet import defer
-import httplib as http
-from socket import gaierror
-import urlparse
+from twisted.internet.error import ConnectError, DNSLookupError
 import simplejson as json
 
 from ion.core.process.process import ProcessFactory
 from ion.core.exception import ReceivedError
 from ion.core.process.service_process import ServiceProcess, ServiceClient
 from ion.services.dm.util.url_manipulation import base_dap_url
+from ion.services.sa.http_cache import get_response_cache
+from ion.util.http_client import HTTPClientError
+
+# Everything a fetch can fail with: bad URL or HTTP status, protocol error,
+# or failure to connect
+FETCH_ERRORS = (ValueError, HTTPClientError, ConnectError, DNSLookupError)
+
+class UpstreamError(ValueError):
+    """
+    The upstream server answered with an error status. page is the status
+    line and headers, as sent by FetcherService._http_op.
+    """
+    def __init__(self, msg, page):
+        ValueError.__init__(self, msg)
+        self.page = page
+
+def _fetch_error(re):
+    """
+    @retval UpstreamError for an error reply carrying the upstream status,
+    ValueError for any other error reply of the fetcher
+    """
+    page = len(re.args) > 1 and re.args[1] or None
+    if isinstance(page, basestring) and page.startswith('HTTP/'):
+        return UpstreamError('Error on URL: ' + page.split('\r\n', 1)[0], page)
+    return ValueError('Error on URL: ' + re[0]['exception'])
+
+class Base64Encoder(object):
+    """
+    Base64-encodes a body chunk by chunk as it is received, so a large page is
+    never held both raw and encoded. Bytes past a multiple of three are carried
+    over to the next chunk.
+    """
+    def __init__(self):
+        self._parts = []
+        self._rest = ''
+
+    def write(self, data):
+        data = self._rest + data
+        cut = len(data) - len(data) % 3
+        self._rest = data[cut:]
+        if cut:
+            self._parts.append(base64.b64encode(data[:cut]))
+
+    def getvalue(self):
+        if self._rest:
+            self._parts.append(base64.b64encode(self._rest))
+            self._rest = ''
+        return ''.join(self._parts)
 
 class FetcherService(ServiceProcess):
     """
@@ -35,6 +81,8 @@ class FetcherService(ServiceProcess):
     @todo Dependencies - perhaps pub-sub?
     @todo refactor to use dap_tools
     @note These are not class methods!
+    @note Fetches are non-blocking and share the keep-alive connections of
+    ion.util.http_client, through the response cache of ion.services.sa.http_cache
     """
     #log.info('Declaring fetcher...')
     declare = ServiceProcess.service_declare(name='fetcher',
@@ -57,6 +105,14 @@ class FetcherService(ServiceProcess):
 
         return hstr
 
+    def _fetch(self, operation, src_url, consumer=None):
+        """
+        @brief Issue a request through the shared response cache
+        @param consumer Optional callable given the body in chunks
+        @retval Deferred HTTPResponse
+        """
+        return get_response_cache().request(operation, src_url, consumer=consumer)
+
     @defer.inlineCallbacks
     def _http_op(self, operation, src_url, msg):
         """
@@ -72,22 +128,19 @@ class FetcherService(ServiceProcess):
 
         log.debug('Fetcher: %s %s' % (operation, src_url))
 
-        src = urlparse.urlsplit(src_url)
         try:
-            conn = http.HTTPConnection(src.netloc)
-            # @bug Need to merge path with query, no canned fn in urlparse lib
-            conn.request(operation, src.path)
-            res = conn.getresponse()
-        except gaierror, ge:
-            log.exception()
-            yield self.reply_err(msg, content=str(ge))
+            res = yield self._fetch(operation, src_url)
+        except FETCH_ERRORS, ex:
+            log.exception('Error on %s %s' % (operation, src_url))
+            yield self.reply_err(msg, content=str(ex))
+            return
 
         hstr = self._reassemble_headers(res)
 
         # Did it succeed?
         if res.status == 200:
-            # @note read on HEAD returns no data
-            hstr = hstr + '\n' + res.read()
+            # @note HEAD returns no data
+            hstr = hstr + '\n' + (res.body or '')
             # Uncomment this to see the completed result
             # log.debug(hstr)
             # @note base64-encoded page returned!
@@ -98,32 +151,33 @@ class FetcherService(ServiceProcess):
             yield self.reply_err(msg, content=hstr)
 
         log.debug('fetch completed %s' % res.status)
-    def get_page(self, url, get_headers=False):
+
+    @defer.inlineCallbacks
+    def get_page(self, url, get_headers=False, consumer=None):
         """
         Inner routine to grab a page, with or without http headers.
-        May raise gaierror or ValueError
+        Deferred, may fail with any of FETCH_ERRORS.
+        @param consumer Optional callable given the body in chunks, the page
+        is then returned without its body
         @todo Merge this and _http_op
         @todo Better propagation of HTTP result codes back to callers (eg 404)
         @note See ion.services.sa.test.test_fetcher.GetPageTester
         @note Does not transmit, and therefore does not call base64
         """
-        src = urlparse.urlsplit(url)
         try:
-            conn = http.HTTPConnection(src.netloc)
-            # @bug Need to merge path with query, no canned fn in urlparse lib
-            conn.request('GET', src.path)
-            res = conn.getresponse()
-        except gaierror, ge:
+            res = yield self._fetch('GET', url, consumer)
+        except FETCH_ERRORS, ex:
             log.error('Socket error fetching page')
-            raise ge
+            raise ex
 
         if res.status == 200:
+            body = res.body or ''
             if get_headers:
                 hstr = self._reassemble_headers(res)
-                hstr = hstr + '\r\n' + res.read()
-                return hstr
+                hstr = hstr + '\r\n' + body
+                defer.returnValue(hstr)
             else:
-                return(res.read())
+                defer.returnValue(body)
         else:
             raise ValueError('Error fetching "%s"' % url)
 
@@ -132,22 +186,22 @@ class FetcherService(ServiceProcess):
         """
         A lot of DAP clients break the spec and use the HEAD http verb.
         Sigh.
-
-        Much easier to implement in httplib than twisted.
         """
         yield self._http_op('HEAD', content, msg)
 
     @defer.inlineCallbacks
     def op_get_url(self, content, headers, msg):
         """
-        Refactored page puller using httplib instead of client.getPage
+        Refactored page puller using the non-blocking client instead of client.getPage
         """
         yield self._http_op('GET', content, msg)
 
+    @defer.inlineCallbacks
     def _get_dataset_no_xmit(self, source_url):
         """
         The core of the fetcher: function to grab an entire DAP dataset and
-        return it as a dictionary.
+        return it as a dictionary. The das, dds and dods are fetched in
+        parallel, the dods is base64-encoded as it streams in.
         @note dods is base64-encoded!
         """
         base_url = base_dap_url(source_url)
@@ -156,16 +210,19 @@ class FetcherService(ServiceProcess):
         dods_url = base_url + '.dods'
 
         log.debug('Starting fetch of "%s"' % base_url)
+        dods = Base64Encoder()
+        fetches = [self.get_page(das_url),
+                   self.get_page(dds_url),
+                   self.get_page(dods_url, consumer=dods.write)]
         try:
-            das = self.get_page(das_url)
-            dds = self.get_page(dds_url)
-            dods = self.get_page(dods_url)
-        except ValueError, ve:
-            log.exception('Error on fetch of ' + base_url)
-            raise ve
-        except gaierror, ge:
-            log.exception('Error on fetch of ' + base_url)
-            raise ge
+            results = yield defer.DeferredList(fetches, fireOnOneErrback=True,
+                                               consumeErrors=True)
+        except defer.FirstError, fe:
+            log.error('Error on fetch of %s: %s' % (base_url, fe.subFailure.getErrorMessage()))
+            fe.subFailure.raiseException()
+
+        das = results[0][1]
+        dds = results[1][1]
 
         log.debug('Fetches completed OK, composing and returning message')
 
@@ -175,12 +232,9 @@ class FetcherService(ServiceProcess):
         dset_msg['source_url'] = base_url
         dset_msg['das'] = json.dumps(das)
         dset_msg['dds'] = json.dumps(dds)
-        dset_msg['dods'] = base64.b64encode(dods)
-#        from IPython.Shell import IPShellEmbed
-#        ipshell = IPShellEmbed('')
-#        ipshell()
+        dset_msg['dods'] = dods.getvalue()
 
-        return(dset_msg)
+        defer.returnValue(dset_msg)
 
     @defer.inlineCallbacks
     def op_get_dap_dataset(self, content, headers, msg):
@@ -191,14 +245,10 @@ class FetcherService(ServiceProcess):
         """
         try:
             # Do the fetches, carefully
-            dmesg = self._get_dataset_no_xmit(content)
-        except ValueError, ve:
-            yield self.reply_err(msg, 'reply',
-                                 {'value':'Error on fetch: %s' % str(ve)}, {})
-            defer.returnValue(None)
-        except gaierror, ge:
+            dmesg = yield self._get_dataset_no_xmit(content)
+        except FETCH_ERRORS, ex:
             yield self.reply_err(msg, 'reply',
-                                 {'value':'Error on fetch: %s' % str(ge)}, {})
+                                 {'value':'Error on fetch: %s' % str(ex)}, {})
             defer.returnValue(None)
 
         log.info('Returning dataset via reply_ok...')
@@ -226,7 +276,7 @@ class FetcherClient(ServiceClient):
         try:
             (content, headers, msg) = yield self.rpc_send('get_head', requested_url)
         except ReceivedError, re:
-            raise ValueError('Error on URL: ' + re[0]['exception'])
+            raise _fetch_error(re)
         defer.returnValue(content)
 
 
@@ -243,7 +293,7 @@ class FetcherClient(ServiceClient):
         try:
             (content, headers, msg) = yield self.rpc_send('get_url', requested_url)
         except ReceivedError, re:
-            raise ValueError('Error on URL: ' + re[0]['exception'])
+            raise _fetch_error(re)
         defer.returnValue(content)
 
     @defer.inlineCallbacks
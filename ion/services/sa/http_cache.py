@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+
+"""
+@file ion/services/sa/http_cache.py
+@brief HTTP response cache shared by the DAP proxy and the fetcher. Entries are
+keyed by normalized URL, revalidated with ETag/Last-Modified once stale, and
+evicted least recently used within a byte budget. Evicted bodies can spill to
+a local directory instead of being dropped. Concurrent identical GETs are
+collapsed into one upstream fetch.
+@see http://www.w3.org/Protocols/rfc2616/rfc2616-sec13.html
+"""
+
+import email.utils
+import hashlib
+import os
+import time
+
+from twisted.internet import defer
+from twisted.python import failure
+
+import ion.util.ionlog
+log = ion.util.ionlog.getLogger(__name__)
+
+from ion.services.dm.util.url_manipulation import normalize_url
+from ion.util.http_client import get_connection_pool, HTTPResponse
+
+from ion.core import ioninit
+CONF = ioninit.config(__name__)
+
+# Bytes of response bodies held in memory
+CF_max_bytes = CONF.getValue('max_bytes', 64 * 1024 * 1024)
+# Larger responses are passed through without being cached
+CF_max_entry_bytes = CONF.getValue('max_entry_bytes', 16 * 1024 * 1024)
+# Directory bodies evicted from memory are written to, None to drop them
+CF_spill_dir = CONF.getValue('spill_dir', None)
+# Bytes of spilled bodies kept on disk
+CF_spill_max_bytes = CONF.getValue('spill_max_bytes', 512 * 1024 * 1024)
+# Seconds a response without Cache-Control or Expires is fresh for
+CF_default_ttl = CONF.getValue('default_ttl', 0)
+
+
+class CachedResponse(object):
+    """
+    Status, headers and body of a cached response, with the time it stops
+    being fresh. The body is held in memory or in a spill file.
+    """
+    def __init__(self, status, reason, headers, body, expires):
+        self.status = status
+        self.reason = reason
+        self.headers = list(headers)
+        self.size = len(body)
+        self.expires = expires
+        self.path = None
+        self._body = body
+
+    def _get_header(self, name):
+        for key, value in self.headers:
+            if key == name:
+                return value
+        return None
+
+    etag = property(lambda self: self._get_header('etag'))
+    last_modified = property(lambda self: self._get_header('last-modified'))
+
+    def in_memory(self):
+        return self._body is not None
+
+    def is_fresh(self, now=None):
+        return self.expires > (now or time.time())
+
+    def get_body(self):
+        if self._body is not None:
+            return self._body
+        f = open(self.path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def spill(self, path):
+        """
+        Moves the body to a file
+        """
+        f = open(path, 'wb')
+        try:
+            f.write(self._body)
+        finally:
+            f.close()
+        self.path = path
+        self._body = None
+
+    def discard(self):
+        """
+        Removes the spill file, if any
+        """
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+    def update(self, headers, expires):
+        """
+        Takes the new validators and freshness of a 304 Not Modified response
+        """
+        names = set([key for key, value in headers])
+        self.headers = [(k, v) for k, v in self.headers if k not in names] + list(headers)
+        self.expires = expires
+
+    def to_response(self, with_body=True):
+        """
+        @retval new HTTPResponse for this entry
+        """
+        res = HTTPResponse('HTTP/1.1', self.status, self.reason)
+        res.headers = list(self.headers)
+        if with_body:
+            res.body = self.get_body()
+        else:
+            res.body = ''
+        return res
+
+
+def _cache_control(headers):
+    """
+    @retval dict of Cache-Control directives, values are None for flags
+    """
+    directives = {}
+    for key, value in headers:
+        if key != 'cache-control':
+            continue
+        for part in value.split(','):
+            name, sep, arg = part.strip().partition('=')
+            if name:
+                directives[name.lower()] = sep and arg.strip('" ') or None
+    return directives
+
+def _is_storable(response):
+    """
+    True if a response may be kept by a shared cache
+    """
+    if response.status != 200 or response.body is None:
+        return False
+    cc = _cache_control(response.headers)
+    return 'no-store' not in cc and 'private' not in cc
+
+def _expires(headers, default_ttl, now):
+    """
+    @retval time until which a response with these headers is fresh
+    """
+    cc = _cache_control(headers)
+    if 'no-cache' in cc:
+        return 0
+    for name in ('s-maxage', 'max-age'):
+        if cc.get(name):
+            try:
+                return now + int(cc[name])
+            except ValueError:
+                return 0
+    for key, value in headers:
+        if key == 'expires':
+            parsed = email.utils.parsedate_tz(value)
+            if parsed is None:
+                return 0
+            return email.utils.mktime_tz(parsed)
+    return now + default_ttl
+
+
+class HTTPResponseCache(object):
+    """
+    Caches GET responses of an upstream with the request() signature of
+    ion.util.http_client.HTTPConnectionPool, and can be used in its place.
+    Stale entries are revalidated with a conditional GET, fresh entries also
+    answer HEAD requests. Entries without a validator or freshness lifetime
+    are not kept, there is no way to reuse them.
+    """
+    def __init__(self, fetch=None, max_bytes=CF_max_bytes,
+                 max_entry_bytes=CF_max_entry_bytes, spill_dir=CF_spill_dir,
+                 spill_max_bytes=CF_spill_max_bytes, default_ttl=CF_default_ttl):
+        """
+        @param fetch upstream request(method, url, headers, consumer) callable,
+        by default the container wide connection pool
+        """
+        self.fetch = fetch
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.default_ttl = default_ttl
+
+        if spill_dir and not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+
+        # normalized url -> CachedResponse
+        self._entries = {}
+        # normalized url -> tick of last use, for LRU eviction
+        self._last_used = {}
+        self._tick = 0
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+
+        # normalized url -> list of (Deferred, consumer) waiting on a fetch
+        self._pending = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.collapsed = 0
+        self.evictions = 0
+        self.spills = 0
+
+    def _upstream(self, method, url, headers, consumer):
+        fetch = self.fetch or get_connection_pool().request
+        return fetch(method, url, headers=headers, consumer=consumer)
+
+    def request(self, method, url, headers=None, consumer=None):
+        """
+        Answers a request from the cache, or from upstream.
+        @param consumer optional callable given the body, in which case the
+        response is returned without it
+        @retval Deferred which fires with an HTTPResponse
+        """
+        key = normalize_url(url)
+        entry = self._entries.get(key)
+
+        if method == 'HEAD':
+            if entry is not None and entry.is_fresh():
+                self.hits += 1
+                self._touch(key)
+                return defer.succeed(entry.to_response(with_body=False))
+            return self._upstream(method, url, headers, consumer)
+
+        if method != 'GET' or headers:
+            # Requests with their own conditions or ranges go straight through
+            return self._upstream(method, url, headers, consumer)
+
+        if entry is not None and entry.is_fresh():
+            self.hits += 1
+            self._touch(key)
+            return defer.succeed(self._deliver(entry.to_response(), consumer))
+
+        if key in self._pending:
+            self.collapsed += 1
+            d = defer.Deferred()
+            self._pending[key].append((d, consumer))
+            return d
+
+        self._pending[key] = []
+        d = self._get(key, url, entry, consumer)
+        d.addBoth(self._release_waiters, key, url)
+        return d
+
+    @defer.inlineCallbacks
+    def _get(self, key, url, entry, consumer):
+        """
+        Fetches or revalidates url for the first of a set of collapsed requests
+        @retval Deferred (HTTPResponse, body), body is None if it was streamed
+        and too large to keep
+        """
+        headers = None
+        if entry is not None:
+            headers = {}
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+            headers = headers or None
+
+        collector = _Collector(consumer, self.max_entry_bytes)
+        res = yield self._upstream('GET', url, headers, collector.write)
+
+        if res.status == 304 and entry is not None and self._entries.get(key) is not entry:
+            # Evicted while it was revalidated - fetch the whole response again
+            log.debug('Entry for %s went while revalidating it, refetching' % key)
+            entry = None
+            collector = _Collector(consumer, self.max_entry_bytes)
+            res = yield self._upstream('GET', url, None, collector.write)
+
+        if res.status == 304 and entry is not None:
+            self.revalidated += 1
+            entry.update(res.headers, _expires(res.headers, self.default_ttl, time.time()))
+            self._touch(key)
+            res = entry.to_response()
+            body = res.body
+            defer.returnValue((self._deliver(res, consumer), body))
+
+        self.misses += 1
+        body = None
+        if collector.parts is not None:
+            body = res.body = ''.join(collector.parts)
+            self.store(url, res)
+        if consumer is not None:
+            res.body = None
+        defer.returnValue((res, body))
+
+    def _release_waiters(self, result, key, url):
+        """
+        Answers the requests collapsed into this one
+        @retval the first request's HTTPResponse
+        """
+        waiters = self._pending.pop(key, [])
+
+        if isinstance(result, failure.Failure):
+            for d, consumer in waiters:
+                d.errback(result)
+            return result
+
+        res, body = result
+        for d, consumer in waiters:
+            if body is None:
+                # Too large to have kept a copy, fetch it separately
+                self._upstream('GET', url, None, consumer).chainDeferred(d)
+                continue
+            copy = HTTPResponse(res.version, res.status, res.reason)
+            copy.headers = list(res.headers)
+            copy.body = body
+            d.callback(self._deliver(copy, consumer))
+        return res
+
+    def _deliver(self, res, consumer):
+        if consumer is not None:
+            if res.body:
+                consumer(res.body)
+            res.body = None
+        return res
+
+    def lookup(self, url):
+        """
+        @retval HTTPResponse of a fresh entry for url, or None
+        """
+        key = normalize_url(url)
+        entry = self._entries.get(key)
+        if entry is None or not entry.is_fresh():
+            return None
+        self.hits += 1
+        self._touch(key)
+        return entry.to_response()
+
+    def store(self, url, response):
+        """
+        Keeps a complete response, if it can be reused
+        @retval True if it was stored
+        """
+        if not _is_storable(response) or len(response.body) > self.max_entry_bytes:
+            return False
+        expires = _expires(response.headers, self.default_ttl, time.time())
+        entry = CachedResponse(response.status, response.reason,
+                               response.headers, response.body, expires)
+        if not (entry.is_fresh() or entry.etag or entry.last_modified):
+            return False
+
+        key = normalize_url(url)
+        self._remove(key)
+        self._entries[key] = entry
+        self.memory_bytes += entry.size
+        self._touch(key)
+        self._evict()
+        return True
+
+    def invalidate(self, url):
+        """
+        Drops the entry for url, if any
+        """
+        self._remove(normalize_url(url))
+
+    def clear(self):
+        for key in self._entries.keys():
+            self._remove(key)
+
+    def stats(self):
+        return {'entries':len(self._entries),
+                'memory_bytes':self.memory_bytes,
+                'spilled_bytes':self.spilled_bytes,
+                'hits':self.hits,
+                'misses':self.misses,
+                'revalidated':self.revalidated,
+                'collapsed':self.collapsed,
+                'evictions':self.evictions,
+                'spills':self.spills}
+
+    def _touch(self, key):
+        self._tick += 1
+        self._last_used[key] = self._tick
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        self._last_used.pop(key, None)
+        if entry is None:
+            return
+        if entry.in_memory():
+            self.memory_bytes -= entry.size
+        else:
+            self.spilled_bytes -= entry.size
+            entry.discard()
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(key).hexdigest())
+
+    def _evict(self):
+        if self.memory_bytes > self.max_bytes:
+            in_memory = [(self._last_used[k], k) for k, e in self._entries.items()
+                         if e.in_memory()]
+            in_memory.sort()
+            for tick, key in in_memory:
+                if self.memory_bytes <= self.max_bytes:
+                    break
+                entry = self._entries[key]
+                if self.spill_dir and entry.size <= self.spill_max_bytes:
+                    try:
+                        entry.spill(self._spill_path(key))
+                    except (IOError, OSError), ex:
+                        log.warn('Could not spill %s: %s' % (key, str(ex)))
+                        self._remove(key)
+                        self.evictions += 1
+                        continue
+                    self.memory_bytes -= entry.size
+                    self.spilled_bytes += entry.size
+                    self.spills += 1
+                else:
+                    self._remove(key)
+                    self.evictions += 1
+
+        if self.spilled_bytes > self.spill_max_bytes:
+            spilled = [(self._last_used[k], k) for k, e in self._entries.items()
+                       if not e.in_memory()]
+            spilled.sort()
+            for tick, key in spilled:
+                if self.spilled_bytes <= self.spill_max_bytes:
+                    break
+                self._remove(key)
+                self.evictions += 1
+
+
+class _Collector(object):
+    """
+    Passes body chunks on to a consumer while keeping a copy for the cache.
+    With a consumer, the copy is dropped (parts is None) once it is too large
+    to cache; without one, the whole body is kept for the caller.
+    """
+    def __init__(self, consumer, limit):
+        self.consumer = consumer
+        self.limit = limit
+        self.size = 0
+        self.parts = []
+
+    def write(self, data):
+        if self.consumer is not None:
+            self.consumer(data)
+        if self.parts is not None:
+            self.size += len(data)
+            if self.consumer is not None and self.size > self.limit:
+                self.parts = None
+            else:
+                self.parts.append(data)
+
+
+_cache = None
+
+def get_response_cache():
+    """
+    @retval the container wide HTTPResponseCache
+    """
+    global _cache
+    if _cache is None:
+        _cache = HTTPResponseCache()
+    return _cache
@@ -11,7 +11,9 @@ import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
 
 from ion.core.process.process import ProcessFactory
-#from ion.services.dm.util.eoi_data_stream_producer import CoordinatorClient
+from ion.services.sa.fetcher import FetcherClient, UpstreamError
+from ion.services.sa.http_cache import get_response_cache
+from ion.util.http_client import HTTPResponse
 
 from ion.core.process.service_process import ServiceProcess
 from twisted.internet import defer, protocol, reactor
@@ -24,54 +26,133 @@ from ion.core import ioninit
 config = ioninit.config(__name__)
 PROXY_PORT = int(config.getValue('proxy_port', '8100'))
 
+# Headers which apply to a single connection, and are not passed on
+HOP_BY_HOP = ['connection', 'keep-alive', 'proxy-authenticate',
+              'proxy-authorization', 'te', 'trailer', 'transfer-encoding',
+              'upgrade', 'content-length']
+
+def parse_fetcher_page(page):
+    """
+    @brief Split a page returned by the fetcher (status line, headers, a blank
+    line and the body) into an HTTPResponse
+    @param page Decoded page, as built by FetcherService._http_op
+    @retval HTTPResponse
+    """
+    head, sep, body = page.partition('\r\n\n')
+    if not sep:
+        head, sep, body = page.partition('\r\n\r\n')
+    lines = head.split('\r\n')
+    parts = lines[0].split(' ', 2)
+    try:
+        res = HTTPResponse(parts[0], int(parts[1]), len(parts) > 2 and parts[2] or '')
+    except (IndexError, ValueError):
+        raise ValueError('Bad status line from fetcher "%s"' % lines[0])
+    for line in lines[1:]:
+        name, colon, value = line.partition(':')
+        if colon:
+            res.headers.append((name.strip().lower(), value.strip()))
+    res.body = body
+    return res
+
 class DAPProxyProtocol(LineReceiver):
     """
     Super, super simple HTTP proxy. Goal: Take requests from DAP clients such
-    as matlab and netcdf, convert them into OOI messages to the preservation
-    service coordinator, and return whatever it gets from same as http.
+    as matlab and netcdf, convert them into OOI messages to the fetcher,
+    and return whatever it gets from same as http.
 
     Initially written using the twisted proxy classes, but in the end what we
     need here is quite different from what the provide, so its much simpler
     to just implement it as a most-basic protocol.
 
+    Responses are answered from the shared response cache when fresh. HTTP/1.1
+    connections stay open for further requests unless the client sends
+    'Connection: close'; HTTP/1.0 ones only with 'Connection: keep-alive'.
+
     @see http://en.wikipedia.org/wiki/Hypertext_Transfer_Protocol
     @see The DAP protocol spec at http://www.opendap.org/pdf/ESE-RFC-004v1.1.pdf
     """
     def reset(self):
         self.buf = []
-        self.http_connected = False
-        self.hostname = None
 
     def connectionMade(self):
         log.debug('connected!')
+        self.http_connected = False
+        self.hostname = None
         self.reset()
 
     def lineReceived(self, line):
         log.debug('got a line: %s' % line)
+        if not line and not self.buf:
+            # Stray blank line between requests
+            return
         self.buf.append(line)
         if len(line) == 0:
             log.info('Ready to send request off!')
+            # Hold further requests on this connection until this one is done
+            self.pauseProducing()
             self.send_receive()
 
+    def _request_headers(self):
+        headers = {}
+        for line in self.buf[1:]:
+            name, colon, value = line.partition(':')
+            if colon:
+                headers[name.strip().lower()] = value.strip()
+        return headers
+
+    def write_response(self, res, keep_alive, with_body=True):
+        """
+        Writes an HTTPResponse to the client, with a Content-Length so the
+        connection can be kept open
+        """
+        body = res.body or ''
+        lines = ['HTTP/1.1 %d %s' % (res.status, res.reason)]
+        for name, value in res.getheaders():
+            if name not in HOP_BY_HOP:
+                lines.append('%s: %s' % (name, value))
+        length = res.getheader('content-length')
+        if with_body or length is None:
+            length = str(len(body))
+        lines.append('Content-Length: %s' % length)
+        lines.append('Connection: %s' % (keep_alive and 'keep-alive' or 'close'))
+        lines.extend(['', ''])
+        self.transport.write('\r\n'.join(lines))
+        if with_body:
+            self.transport.write(body)
+
+    def write_error(self, status, reason, message, keep_alive=False):
+        res = HTTPResponse('HTTP/1.1', status, reason)
+        res.headers.append(('content-type', 'text/plain; charset=UTF-8'))
+        res.body = message + '\r\n'
+        self.write_response(res, keep_alive)
+
+    def _done(self, keep_alive):
+        self.reset()
+        if keep_alive:
+            self.resumeProducing()
+        else:
+            self.transport.loseConnection()
+
     @defer.inlineCallbacks
     def send_receive(self):
         """
-        Ready to send an http command off to the coordinator for dispatch.
+        Ready to send an http command off to the fetcher.
         """
-        generic_err = '500 Server error, no comprende.\r\n'
-        cc = CoordinatorClient()
         # First entry in buffer should be 'GET url http/1.0' or similar
         try:
-            cmd, url, method = self.buf[0].split(' ')
+            cmd, url, version = self.buf[0].split(' ')
         except ValueError:
             log.warn('Unable to parse command "%s"' % self.buf[0])
-            self.transport.write('400 Command not understood\r\n')
-            self.transport.loseConnection()
-            self.reset()
+            self.write_error(400, 'Bad Request', 'Command not understood')
+            self._done(False)
             return
 
-        if 'Connection: close' in self.buf:
-            # @todo Handle 1.1 persisten connections correctly
+        connection = self._request_headers().get('connection', '').lower()
+        if version.upper() == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+        if not keep_alive:
             log.debug('disconnect request found')
 
         if self.http_connected:
@@ -79,7 +160,6 @@ class DAPProxyProtocol(LineReceiver):
             url = 'http://%s%s' % (self.hostname, url)
             log.debug('new ' + url)
 
-
         if cmd == 'CONNECT':
             self.http_connected = True
             self.hostname = url
@@ -89,47 +169,82 @@ class DAPProxyProtocol(LineReceiver):
             self.transport.write('HTTP/1.1 200 Did get connection\r\n')
             self.transport.write('Content-Type: text/plain; charset=UTF-8\r\n')
             self.transport.write('\r\n')
-            self.buf = []
-            defer.returnValue(None)
+            self._done(True)
+            return
 
         if cmd not in ['GET', 'HEAD']:
             log.error('Unknown command "%s"' % self.buf[0])
-            yield self.transport.write(generic_err)
-            yield self.transport.loseConnection()
-            self.reset()
+            self.write_error(501, 'Not Implemented', 'Unsupported method %s' % cmd)
+            self._done(False)
             return
 
-        # Either get or head commands
-        if cmd == 'HEAD':
-            resp = yield cc.get_head(url)
-        elif cmd == 'GET':
-            log.debug('pulling url...')
-            resp = yield cc.get_url(url)
-
-        # Did the command succeed?
-        if resp['status'] != 'OK':
-            log.warn('Bad result on %s %s' % (cmd, url))
-            rs = resp['value']
-            log.warn(rs)
-            yield self.transport.write(rs)
-            yield self.transport.loseConnection()
-            self.reset()
-            log.debug('done with error handler')
+        try:
+            res = yield self.factory.get_response(cmd, url)
+        except UpstreamError, ex:
+            # Pass the status of the upstream server on, e.g. 404
+            log.info('Upstream error on %s %s: %s' % (cmd, url, str(ex)))
+            try:
+                res = parse_fetcher_page(ex.page)
+            except ValueError:
+                self.write_error(502, 'Bad Gateway', str(ex), keep_alive)
+                self._done(keep_alive)
+                return
+        except defer.TimeoutError, ex:
+            log.warn('Timeout on %s %s' % (cmd, url))
+            self.write_error(504, 'Gateway Timeout', 'Timeout fetching %s' % url, keep_alive)
+            self._done(keep_alive)
+            return
+        except Exception, ex:
+            # Whatever went wrong, the client gets an answer
+            log.warn('Bad result on %s %s: %s' % (cmd, url, str(ex)))
+            self.write_error(502, 'Bad Gateway', str(ex), keep_alive)
+            self._done(keep_alive)
             return
 
-        log.debug('cmd %s returned OK' % cmd)
-
-        # OK, response OK, decode page and return it
-        self.transport.write(base64.b64decode(resp['value']))
-
-        yield self.transport.loseConnection()
-        self.reset()
+        log.debug('cmd %s returned %d' % (cmd, res.status))
+        self.write_response(res, keep_alive, with_body=(cmd == 'GET'))
+        self._done(keep_alive)
         log.debug('send_receive completed')
 
 
 class DAPProxyFactory(protocol.ServerFactory):
+    """
+    Creates a DAPProxyProtocol per client connection, all sharing one fetcher
+    client and the container wide response cache.
+    """
     protocol = DAPProxyProtocol
 
+    def __init__(self, fetcher=None, cache=None):
+        self.fetcher = fetcher
+        self.cache = cache or get_response_cache()
+
+    @defer.inlineCallbacks
+    def get_response(self, cmd, url):
+        """
+        @brief Answer a GET or HEAD from the cache, or from the fetcher
+        @note Requests are not collapsed here: the fetcher does that, and it
+        may be in this container, waiting on the same cache.
+        @retval Deferred HTTPResponse, fails with UpstreamError when the
+        upstream server answers with an error status
+        """
+        res = self.cache.lookup(url)
+        if res is not None:
+            log.debug('cache hit on %s' % url)
+            defer.returnValue(res)
+
+        if self.fetcher is None:
+            self.fetcher = FetcherClient()
+        if cmd == 'HEAD':
+            resp = yield self.fetcher.get_head(url)
+        else:
+            log.debug('pulling url...')
+            resp = yield self.fetcher.get_url(url)
+
+        res = parse_fetcher_page(base64.b64decode(resp['value']))
+        if cmd == 'GET':
+            self.cache.store(url, res)
+        defer.returnValue(res)
+
 class ProxyService(ServiceProcess):
     """
     Proxy service. Stub, really, since the proxy listens on a plain tcp port.
@@ -145,7 +260,8 @@ class ProxyService(ServiceProcess):
         Use this hook to bind to listener TCP port.
         """
         log.info('starting proxy on port %d' % PROXY_PORT)
-        self.proxy_port = yield reactor.listenTCP(PROXY_PORT, DAPProxyFactory())
+        factory = DAPProxyFactory(FetcherClient(proc=self))
+        self.proxy_port = yield reactor.listenTCP(PROXY_PORT, factory)
         log.info('Proxy listener running.')
 
     @defer.inlineCallbacks
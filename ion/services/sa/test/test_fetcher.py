@@ -7,13 +7,16 @@
 """
 
 import base64
+import simplejson as json
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
 from twisted.internet import defer
-from socket import gaierror
 
-from ion.services.sa.fetcher import FetcherClient, FetcherService
+from ion.services.sa.fetcher import FetcherClient, FetcherService, \
+    Base64Encoder, FETCH_ERRORS
 from ion.test.iontest import IonTestCase
+from ion.util.http_client import get_connection_pool
+from ion.util.test.test_http_client import start_test_server
 
 from ion.core import ioninit
 CONF = ioninit.config(__name__)
@@ -34,32 +37,92 @@ class FetcherServiceTester(IonTestCase):
     def tearDown(self):
         yield self._stop_container()
 
+    @defer.inlineCallbacks
     def test_single_page_with_headers(self):
-        page = self.mf.get_page('http://amoeba.ucsd.edu/tmp/test1.txt',
+        page = yield self.mf.get_page('http://amoeba.ucsd.edu/tmp/test1.txt',
                                 get_headers=True)
         self.failUnlessSubstring('content-length', page)
         self.failUnlessSubstring('is the time for all', page)
 
+    @defer.inlineCallbacks
     def test_no_headers(self):
-        page = self.mf.get_page('http://amoeba.ucsd.edu/tmp/test1.txt')
+        page = yield self.mf.get_page('http://amoeba.ucsd.edu/tmp/test1.txt')
         self.failIfSubstring('content-length', page)
         self.failUnlessSubstring('is the time for all', page)
 
+    @defer.inlineCallbacks
     def test_bad_host(self):
         try:
-            self.mf.get_page('http://foo.bar.baz/')
-        except gaierror, ge:
-            log.debug('got err as expected! %s' % str(ge))
-            pass
-        except ValueError, ve:
-            log.debug('got err as expected: %s' % str(ve))
+            yield self.mf.get_page('http://foo.bar.baz/')
+        except FETCH_ERRORS, ex:
+            log.debug('got err as expected! %s' % str(ex))
             pass
         #else:
         #    self.fail('Should have raised an exception!')
 
     def test_404(self):
-        self.failUnlessRaises(ValueError, self.mf.get_page,
-                              'http://amoeba.ucsd.edu/tmp/bad-filename')
+        return self.assertFailure(
+            self.mf.get_page('http://amoeba.ucsd.edu/tmp/bad-filename'),
+            ValueError)
+
+class LocalFetcherTest(IonTestCase):
+    """
+    Exercise the fetches against a local server, no container needed.
+    """
+    def setUp(self):
+        self.dods = ''.join([chr(i % 256) for i in range(100000)])
+        self.pages = {'/data/test.das':'Attributes {}',
+                      '/data/test.dds':'Dataset {} test;',
+                      '/data/test.dods':self.dods,
+                      '/page':'Now is the time for all good men'}
+        self.port, self.site, self.res = start_test_server(self.pages, delay=0.1)
+        self.base = 'http://127.0.0.1:%d' % self.port.getHost().port
+        self.mf = FetcherService()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        get_connection_pool().close()
+        yield self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_get_page(self):
+        page = yield self.mf.get_page(self.base + '/page', get_headers=True)
+        self.failUnlessSubstring('content-length', page)
+        self.failUnlessSubstring('is the time for all', page)
+
+        yield self.assertFailure(self.mf.get_page(self.base + '/missing'),
+                                 ValueError)
+
+    @defer.inlineCallbacks
+    def test_dap_dataset_parallel(self):
+        dset = yield self.mf._get_dataset_no_xmit(self.base + '/data/test.dods')
+        self.assertEqual(json.loads(dset['das']), self.pages['/data/test.das'])
+        self.assertEqual(json.loads(dset['dds']), self.pages['/data/test.dds'])
+        self.assertEqual(base64.b64decode(dset['dods']), self.dods)
+
+        # All three components were in flight at once
+        self.assertEqual(self.res.max_active, 3)
+
+    @defer.inlineCallbacks
+    def test_concurrent_fetches(self):
+        pages = yield defer.gatherResults(
+            [self.mf.get_page(self.base + '/page?n=%d' % i) for i in range(4)])
+        self.assertEqual(pages, [self.pages['/page']] * 4)
+        # The fetches did not wait for each other
+        self.assertEqual(self.res.max_active, 4)
+
+    @defer.inlineCallbacks
+    def test_identical_fetches_collapse(self):
+        pages = yield defer.gatherResults(
+            [self.mf.get_page(self.base + '/page') for i in range(4)])
+        self.assertEqual(pages, [self.pages['/page']] * 4)
+        self.assertEqual(self.res.requests, 1)
+
+    def test_base64_encoder(self):
+        encoder = Base64Encoder()
+        for i in range(0, len(self.dods), 1001):
+            encoder.write(self.dods[i:i+1001])
+        self.assertEqual(encoder.getvalue(), base64.b64encode(self.dods))
 
 class FetcherTest(IonTestCase):
     @itv(CONF)
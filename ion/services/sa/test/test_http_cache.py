@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+"""
+@file ion/services/sa/test/test_http_cache.py
+@test ion.services.sa.http_cache Response cache, and the proxy in front of it,
+against a scripted upstream
+"""
+
+import base64
+import os
+import shutil
+import tempfile
+
+import ion.util.ionlog
+log = ion.util.ionlog.getLogger(__name__)
+
+from twisted.internet import defer
+from twisted.test import proto_helpers
+
+from ion.test.iontest import IonTestCase
+from ion.core.exception import ReceivedError
+from ion.services.sa.fetcher import _fetch_error
+from ion.services.sa.http_cache import HTTPResponseCache
+from ion.services.sa.proxy import DAPProxyFactory, parse_fetcher_page
+from ion.util.http_client import HTTPResponse
+
+
+class ScriptedUpstream(object):
+    """
+    Stands in for the connection pool. Each request waits until the test
+    answers it with respond().
+    """
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, headers=None, consumer=None):
+        d = defer.Deferred()
+        self.requests.append((method, url, headers, consumer, d))
+        return d
+
+    def respond(self, status, body='', headers=None, index=-1):
+        method, url, req_headers, consumer, d = self.requests[index]
+        res = HTTPResponse('HTTP/1.1', status, status == 200 and 'OK' or 'Other')
+        res.headers = list(headers or [])
+        if consumer is None:
+            res.body = body
+        else:
+            for i in range(0, len(body), 10):
+                consumer(body[i:i+10])
+        d.callback(res)
+
+
+class HTTPResponseCacheTest(IonTestCase):
+
+    def setUp(self):
+        self.upstream = ScriptedUpstream()
+        self.cache = HTTPResponseCache(fetch=self.upstream.request,
+                                       max_bytes=100, max_entry_bytes=60,
+                                       spill_dir=None, default_ttl=0)
+
+    @defer.inlineCallbacks
+    def test_fresh_hit_and_normalized_key(self):
+        d = self.cache.request('GET', 'http://Example.com:80/data.dds')
+        self.upstream.respond(200, 'Dataset {}', [('cache-control', 'max-age=60')])
+        res = yield d
+        self.assertEqual(res.body, 'Dataset {}')
+
+        res = yield self.cache.request('GET', 'http://example.com/data.dds#x')
+        self.assertEqual(res.body, 'Dataset {}')
+        res = yield self.cache.request('HEAD', 'http://example.com/data.dds')
+        self.assertEqual(res.body, '')
+        self.assertEqual(len(self.upstream.requests), 1)
+        self.assertEqual(self.cache.stats()['hits'], 2)
+
+    @defer.inlineCallbacks
+    def test_revalidation(self):
+        url = 'http://example.com/data.das'
+        d = self.cache.request('GET', url)
+        self.upstream.respond(200, 'Attributes {}', [('etag', '"v1"')])
+        yield d
+
+        # Not fresh, so the second request is a conditional GET
+        chunks = []
+        d = self.cache.request('GET', url, consumer=chunks.append)
+        self.assertEqual(self.upstream.requests[-1][2], {'If-None-Match':'"v1"'})
+        self.upstream.respond(304, headers=[('etag', '"v1"')])
+        res = yield d
+        self.assertEqual(res.body, None)
+        self.assertEqual(''.join(chunks), 'Attributes {}')
+        self.assertEqual(self.cache.stats()['revalidated'], 1)
+
+        # Changed upstream, the new version replaces the entry
+        d = self.cache.request('GET', url)
+        self.upstream.respond(200, 'Attributes {a}', [('etag', '"v2"')])
+        res = yield d
+        self.assertEqual(res.body, 'Attributes {a}')
+        self.assertEqual(self.cache._entries[url].etag, '"v2"')
+
+    @defer.inlineCallbacks
+    def test_evicted_while_revalidating(self):
+        url = 'http://example.com/data.das'
+        d = self.cache.request('GET', url)
+        self.upstream.respond(200, 'Attributes {}', [('etag', '"v1"')])
+        yield d
+
+        d = self.cache.request('GET', url)
+        self.cache.invalidate(url)
+        self.upstream.respond(304, headers=[('etag', '"v1"')])
+        # Nothing left to answer from, so it is fetched in full
+        self.assertEqual(self.upstream.requests[-1][2], None)
+        self.upstream.respond(200, 'Attributes {}', [('etag', '"v1"')])
+        res = yield d
+        self.assertEqual(res.body, 'Attributes {}')
+        self.assertEqual(self.cache.stats()['revalidated'], 0)
+        self.assertEqual(self.cache._last_used.keys(), [url])
+
+    @defer.inlineCallbacks
+    def test_not_stored(self):
+        url = 'http://example.com/page'
+        for headers in ([], [('cache-control', 'no-store'), ('etag', '"a"')]):
+            d = self.cache.request('GET', url)
+            self.upstream.respond(200, 'page', headers)
+            yield d
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+        # Too large for an entry, still streamed to the consumer
+        chunks = []
+        d = self.cache.request('GET', url, consumer=chunks.append)
+        self.upstream.respond(200, 'x' * 70, [('etag', '"b"')])
+        yield d
+        self.assertEqual(''.join(chunks), 'x' * 70)
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    @defer.inlineCallbacks
+    def test_collapse(self):
+        url = 'http://example.com/data.dods'
+        chunks = []
+        fetches = [self.cache.request('GET', url),
+                   self.cache.request('GET', url, consumer=chunks.append),
+                   self.cache.request('GET', url)]
+        self.assertEqual(len(self.upstream.requests), 1)
+        # Collapsed even though the response will not be kept
+        self.upstream.respond(200, 'dods data')
+        results = yield defer.gatherResults(fetches)
+        self.assertEqual([r.body for r in results], ['dods data', None, 'dods data'])
+        self.assertEqual(''.join(chunks), 'dods data')
+        self.assertEqual(self.cache.stats()['collapsed'], 2)
+
+    @defer.inlineCallbacks
+    def test_collapse_failure(self):
+        url = 'http://example.com/data.dods'
+        fetches = [self.cache.request('GET', url) for i in range(2)]
+        self.upstream.requests[0][4].errback(ValueError('no route'))
+        for d in fetches:
+            yield self.assertFailure(d, ValueError)
+        self.assertEqual(self.cache._pending, {})
+
+    def test_lru_eviction(self):
+        for name in ('a', 'b', 'c'):
+            res = HTTPResponse('HTTP/1.1', 200, 'OK')
+            res.headers = [('cache-control', 'max-age=60')]
+            res.body = name * 40
+            self.cache.store('http://example.com/' + name, res)
+            if name == 'b':
+                self.cache.lookup('http://example.com/a')
+
+        # 'b' was least recently used
+        self.assertEqual(self.cache.lookup('http://example.com/b'), None)
+        self.assertEqual(self.cache.lookup('http://example.com/a').body, 'a' * 40)
+        self.assertEqual(self.cache.memory_bytes, 80)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+
+class SpillTest(IonTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = HTTPResponseCache(fetch=ScriptedUpstream().request,
+                                       max_bytes=100, max_entry_bytes=60,
+                                       spill_dir=self.dir, spill_max_bytes=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _store(self, name):
+        res = HTTPResponse('HTTP/1.1', 200, 'OK')
+        res.headers = [('etag', '"%s"' % name), ('cache-control', 'max-age=60')]
+        res.body = name * 40
+        self.cache.store('http://example.com/' + name, res)
+
+    def test_spill_and_delete(self):
+        for name in ('a', 'b', 'c'):
+            self._store(name)
+        self.assertEqual(len(os.listdir(self.dir)), 1)
+        self.assertEqual(self.cache.spilled_bytes, 40)
+        # Spilled bodies are read back from disk
+        self.assertEqual(self.cache.lookup('http://example.com/a').body, 'a' * 40)
+
+        for name in ('d', 'e'):
+            self._store(name)
+        # Least recently used spilled entry deleted to keep the directory
+        # within budget
+        self.assertEqual(len(os.listdir(self.dir)), 2)
+        self.assertEqual(self.cache.lookup('http://example.com/b'), None)
+        self.assertEqual(self.cache.lookup('http://example.com/a').body, 'a' * 40)
+
+        self.cache.clear()
+        self.assertEqual(os.listdir(self.dir), [])
+        self.assertEqual(self.cache.memory_bytes, 0)
+        self.assertEqual(self.cache.spilled_bytes, 0)
+
+
+class StubFetcherClient(object):
+    """
+    Answers get_url like FetcherClient, with a page built the same way as
+    FetcherService._http_op
+    """
+    def __init__(self, headers):
+        self.headers = headers
+        self.requests = []
+
+    def get_url(self, url):
+        self.requests.append(url)
+        hstr = 'HTTP/1.0 200 OK\r\n'
+        for name, value in self.headers:
+            hstr = hstr + '%s: %s\r\n' % (name, value)
+        hstr = hstr + '\n' + 'page of ' + url
+        return defer.succeed({'value':base64.b64encode(hstr)})
+
+    def get_head(self, url):
+        if url.endswith('/missing'):
+            # As FetcherClient reports an error status of the upstream server
+            raise _fetch_error(ReceivedError({'exception':'None'},
+                                             'HTTP/1.0 404 Not Found\r\nA: b\r\n'))
+        if url.endswith('/slow'):
+            raise defer.TimeoutError()
+        if url.endswith('/broken'):
+            raise IOError('disk full')
+        raise ValueError('Error on URL: no HEAD here')
+
+
+class ProxyTest(IonTestCase):
+
+    def setUp(self):
+        self.fetcher = StubFetcherClient([('content-type', 'text/plain'),
+                                          ('cache-control', 'max-age=60')])
+        self.cache = HTTPResponseCache(fetch=ScriptedUpstream().request)
+        self.factory = DAPProxyFactory(self.fetcher, self.cache)
+        self.proto = self.factory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.transport)
+
+    def test_parse_fetcher_page(self):
+        res = parse_fetcher_page('HTTP/1.0 404 Not Found\r\nA: b\r\n\nbody\r\n\n')
+        self.assertEqual((res.status, res.reason), (404, 'Not Found'))
+        self.assertEqual(res.headers, [('a', 'b')])
+        self.assertEqual(res.body, 'body\r\n\n')
+
+    def test_persistent_and_cached(self):
+        url = 'http://example.com/data.dds'
+        self.proto.dataReceived('GET %s HTTP/1.1\r\nHost: example.com\r\n\r\n' % url +
+                                'GET %s HTTP/1.1\r\n\r\n' % url)
+        out = self.transport.value()
+        self.assertEqual(out.count('HTTP/1.1 200 OK'), 2)
+        self.assertEqual(out.count('Content-Length: %d' % len('page of ' + url)), 2)
+        self.assertTrue('Connection: keep-alive' in out)
+        self.assertFalse(self.transport.disconnecting)
+        # Second answered from the cache
+        self.assertEqual(self.fetcher.requests, [url])
+
+        self.transport.clear()
+        self.proto.dataReceived('GET %s HTTP/1.1\r\nConnection: close\r\n\r\n' % url)
+        self.assertTrue('Connection: close' in self.transport.value())
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_http10_and_errors(self):
+        self.proto.dataReceived('HEAD http://example.com/x HTTP/1.0\r\n\r\n')
+        out = self.transport.value()
+        self.assertTrue(out.startswith('HTTP/1.1 502 Bad Gateway'))
+        self.assertTrue(self.transport.disconnecting)
+
+        self.transport = proto_helpers.StringTransport()
+        proto = self.factory.buildProtocol(None)
+        proto.makeConnection(self.transport)
+        proto.dataReceived('POST http://example.com/x HTTP/1.1\r\n\r\n')
+        self.assertTrue(self.transport.value().startswith('HTTP/1.1 501'))
+
+    def test_upstream_errors(self):
+        for path, status in (('/missing', '404 Not Found'),
+                             ('/slow', '504 Gateway Timeout'),
+                             ('/broken', '502 Bad Gateway')):
+            self.transport.clear()
+            self.proto.dataReceived('HEAD http://example.com%s HTTP/1.1\r\n\r\n' % path)
+            # Every request is answered and the connection stays usable
+            self.assertTrue(self.transport.value().startswith('HTTP/1.1 ' + status))
+            self.assertFalse(self.transport.disconnecting)
@@ -3,56 +3,282 @@
 """
 @file ion/util/cache.py
 @author Adam R. Smith
-@brief Simple caching utilities.
+@brief Simple caching utilities: a least recently used cache bounded by entry
+count and bytes, with per entry time to live, and a memoize decorator built on
+it which also shares the Deferred of a call in progress.
 """
 
+import sys
 from time import time
 
+from twisted.internet import defer
+
+from ion.core import ioninit
+CONF = ioninit.config(__name__)
+
+# Default bounds of each memoized function's cache, None for no bound
+CF_max_entries = CONF.getValue('max_entries', 10000)
+CF_max_bytes = CONF.getValue('max_bytes', None)
+
+# Indexes into a cache entry: [prev, next, key, value, size, expires]
+_PREV, _NEXT, _KEY, _VALUE, _SIZE, _EXPIRES = range(6)
+
+def sizeof(value):
+    """
+    @retval approximate size of a value in bytes; the length of a string, the
+    shallow size of other objects
+    """
+    if isinstance(value, basestring):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+class LRUCache(object):
+    """
+    Least recently used cache, bounded by number of entries and by the total
+    size of the values. Entries may expire after a time to live; an expired
+    entry is dropped when it is next looked up, or by collect(). Entries are
+    kept in a doubly linked list, least recently used first, so lookups and
+    evictions take constant time.
+    """
+    def __init__(self, max_entries=None, max_bytes=None, ttl=0, sizeof=sizeof, clock=time):
+        """
+        @param ttl seconds an entry lives for, 0 for ever
+        @param sizeof callable giving the size of a value, used with max_bytes
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.clock = clock
+        self._map = {}
+        self._root = root = []
+        root[:] = [root, root, None, None, 0, 0]
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejections = 0
+        # Misses answered by a value already being computed, see memoize
+        self.shared = 0
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        entry = self._map.get(key)
+        return entry is not None and not self._expired(entry)
+
+    def _expired(self, entry):
+        expires = entry[_EXPIRES]
+        return expires and expires <= self.clock()
+
+    def _unlink(self, entry):
+        prev, next = entry[_PREV], entry[_NEXT]
+        prev[_NEXT] = next
+        next[_PREV] = prev
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._map[entry[_KEY]]
+        self.bytes -= entry[_SIZE]
+
+    def get(self, key, default=None):
+        """
+        @retval the value of key, made the most recently used, or default if
+        not cached or expired
+        """
+        entry = self._map.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry[_EXPIRES] and entry[_EXPIRES] <= self.clock():
+            self._remove(entry)
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._unlink(entry)
+        root = self._root
+        last = root[_PREV]
+        entry[_PREV], entry[_NEXT] = last, root
+        last[_NEXT] = root[_PREV] = entry
+        self.hits += 1
+        return entry[_VALUE]
+
+    def put(self, key, value, ttl=None):
+        """
+        Caches a value as the most recently used, evicting the least recently
+        used entries beyond the bounds. A value larger than max_bytes on its
+        own is not cached.
+        @param ttl seconds this entry lives for, by default the cache's ttl
+        """
+        old = self._map.get(key)
+        if old is not None:
+            self._remove(old)
+
+        size = 0
+        if self.max_bytes is not None:
+            size = self.sizeof(value)
+            if size > self.max_bytes:
+                self.rejections += 1
+                return
+        if ttl is None:
+            ttl = self.ttl
+        expires = ttl and self.clock() + ttl or 0
+
+        root = self._root
+        last = root[_PREV]
+        entry = [last, root, key, value, size, expires]
+        last[_NEXT] = root[_PREV] = entry
+        self._map[key] = entry
+        self.bytes += size
+
+        max_entries = self.max_entries
+        max_bytes = self.max_bytes
+        while (max_entries is not None and len(self._map) > max_entries) or \
+                (max_bytes is not None and self.bytes > max_bytes):
+            self._remove(root[_NEXT])
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        entry = self._map.get(key)
+        if entry is None:
+            return default
+        self._remove(entry)
+        return entry[_VALUE]
+
+    def keys(self):
+        """
+        @retval list of keys, least recently used first, including expired
+        entries not yet collected
+        """
+        keys = []
+        entry = self._root[_NEXT]
+        while entry is not self._root:
+            keys.append(entry[_KEY])
+            entry = entry[_NEXT]
+        return keys
+
+    def collect(self):
+        """
+        Drops all expired entries
+        """
+        now = self.clock()
+        for entry in self._map.values():
+            if entry[_EXPIRES] and entry[_EXPIRES] <= now:
+                self._remove(entry)
+                self.expirations += 1
+
+    def clear(self):
+        root = self._root
+        root[:] = [root, root, None, None, 0, 0]
+        self._map.clear()
+        self.bytes = 0
+
+    def stats(self):
+        """
+        @retval dict of counters and current entries and bytes
+        """
+        return {'hits':self.hits, 'misses':self.misses,
+                'evictions':self.evictions, 'expirations':self.expirations,
+                'rejections':self.rejections, 'shared':self.shared,
+                'entries':len(self._map), 'bytes':self.bytes}
+
+
 class memoize(object):
     """
-    Memoize with timeout.
-    This has been optimized repeatedly to squeeze out extra performance.
-    
+    Memoize with timeout, bounded by an LRUCache per function.
+    Keyword arguments are part of the key; calls with unhashable arguments
+    are not cached. When the function returns a Deferred, callers while it
+    is in progress share its result, and its result is cached once it
+    succeeds; later calls get a fired Deferred. Failures are not cached.
+
+    The cache of a decorated function is its 'cache' attribute.
+
     http://code.activestate.com/recipes/325905/ (r5)
     Modified by Adam R. Smith
     """
-    
+
     _caches = {}
-    _timeouts = {}
 
-    def __init__(self, timeout=0):
+    def __init__(self, timeout=0, max_entries=CF_max_entries,
+                 max_bytes=CF_max_bytes, sizeof=sizeof):
         self.timeout = timeout
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
 
-    def collect(self):
+    @classmethod
+    def collect(cls):
         """Clear cache of results which have timed out"""
-        for func in self._caches:
-            cache = {}
-            for key in self._caches[func]:
-                if (self._timeouts[func] <= 0) or ((time() - self._caches[func][key][1]) < self._timeouts[func]):
-                    cache[key] = self._caches[func][key]
-            self._caches[func] = cache
+        for cache in cls._caches.values():
+            cache.collect()
+
+    @classmethod
+    def stats(cls):
+        """
+        @retval dict of qualified function name -> stats of its cache
+        """
+        return dict(('%s.%s' % (f.__module__, f.__name__), cache.stats())
+                    for f, cache in cls._caches.items())
 
     def __call__(self, f):
-        cache = self.cache = self._caches[f] = {}
-        timeout = self._timeouts[f] = self.timeout
+        # Values are (result, whether it came from a Deferred)
+        sizeof = self.sizeof
+        cache = self.cache = self._caches[f] = LRUCache(
+            max_entries=self.max_entries, max_bytes=self.max_bytes,
+            ttl=self.timeout, sizeof=lambda v: sizeof(v[0]))
+        # key -> Deferreds of callers waiting on a call in progress
+        pending = {}
+        missing = object()
 
         def func(*args, **kwargs):
-            key = tuple(args)
-            if len(kwargs):
+            key = args
+            if kwargs:
                 kw = kwargs.items()
                 kw.sort()
                 key += tuple(kw)
-                
-            cached = (key in cache)
-            if cached:
-                v = cache[key]
-                if (timeout > 0) and ((time() - v[1]) > timeout):
-                    cached = False
-            if not cached:
-                ts = time() if timeout else 0
-                v = cache[key] = (f(*args, **kwargs), ts)
-            return v[0]
-        #func.func_name = f.func_name
+
+            try:
+                v = cache.get(key, missing)
+            except TypeError:
+                # Unhashable argument
+                return f(*args, **kwargs)
+            if v is not missing:
+                if v[1]:
+                    return defer.succeed(v[0])
+                return v[0]
+
+            waiters = pending.get(key)
+            if waiters is not None:
+                cache.shared += 1
+                d = defer.Deferred()
+                waiters.append(d)
+                return d
+
+            res = f(*args, **kwargs)
+            if not isinstance(res, defer.Deferred):
+                cache.put(key, (res, False))
+                return res
+
+            waiters = pending[key] = []
+            def _done(value):
+                del pending[key]
+                cache.put(key, (value, True))
+                for d in waiters:
+                    d.callback(value)
+                return value
+            def _failed(fail):
+                del pending[key]
+                for d in waiters:
+                    d.errback(fail)
+                return fail
+            res.addCallbacks(_done, _failed)
+            return res
+        func.__name__ = f.__name__
         func.__doc__ = f.__doc__
+        func.cache = cache
 
         return func
@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+
+"""
+@file ion/util/http_client.py
+@brief Non-blocking HTTP/1.1 client with keep-alive connection pools per host.
+Replaces blocking httplib use inside the reactor; bodies can be streamed to a
+consumer in chunks instead of being held in memory.
+@see http://www.w3.org/Protocols/rfc2616/rfc2616.html
+"""
+
+import urlparse
+
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols.basic import LineReceiver
+
+import ion.util.ionlog
+log = ion.util.ionlog.getLogger(__name__)
+
+from ion.core import ioninit
+CONF = ioninit.config(__name__)
+
+# Connections kept open (busy or idle) to one host and port
+CF_max_per_host = CONF.getValue('max_per_host', 4)
+# Seconds an idle connection is kept open for reuse
+CF_idle_timeout = CONF.getValue('idle_timeout', 30)
+# Seconds to wait for a new connection
+CF_connect_timeout = CONF.getValue('connect_timeout', 30)
+
+
+class HTTPClientError(Exception):
+    """
+    Malformed response, or connection lost before the response was complete
+    """
+
+class StaleConnectionError(HTTPClientError):
+    """
+    A reused connection was closed by the server before it sent a response;
+    the request can safely be sent again on a new connection.
+    """
+
+
+class HTTPResponse(object):
+    """
+    Status and headers of an HTTP response, with the accessors of
+    httplib.HTTPResponse. Header names are lower case. The body is in 'body'
+    unless it was streamed to a consumer.
+    """
+    def __init__(self, version, status, reason):
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.headers = []
+        self.body = None
+
+    def getheaders(self):
+        return list(self.headers)
+
+    def getheader(self, name, default=None):
+        name = name.lower()
+        for key, value in self.headers:
+            if key == name:
+                return value
+        return default
+
+
+class HTTPClientProtocol(LineReceiver):
+    """
+    HTTP/1.1 client which keeps its connection open between requests. It
+    handles one request at a time, HTTPConnectionPool shares them out.
+    """
+    MAX_LENGTH = 65536
+
+    def __init__(self):
+        self.pool = None
+        self.pool_key = None
+        self.idle_call = None
+        self.persistent = True
+        self.requests = 0
+        self._finished = None
+        self._reset()
+
+    def _reset(self):
+        self._state = 'IDLE'
+        self._method = None
+        self._response = None
+        self._consumer = None
+        self._body = None
+        self._remaining = None
+        self._keep_alive = True
+
+    def request(self, method, path, host, headers=None, consumer=None):
+        """
+        Sends a request on this connection.
+        @param consumer optional callable given each chunk of the body as it
+        arrives, instead of collecting the body in the response
+        @retval Deferred which fires with an HTTPResponse once it is complete
+        """
+        assert self._finished is None, 'Request already in progress'
+        self._finished = defer.Deferred()
+        self._method = method
+        self._consumer = consumer
+        self._body = []
+        self._state = 'STATUS'
+        self.requests += 1
+
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % host]
+        if headers:
+            for name, value in headers.items():
+                lines.append('%s: %s' % (name, value))
+        lines.extend(['', ''])
+        self.transport.write('\r\n'.join(lines))
+        return self._finished
+
+    def lineReceived(self, line):
+        if self._state == 'STATUS':
+            parts = line.split(' ', 2)
+            try:
+                version = parts[0]
+                status = int(parts[1])
+            except (IndexError, ValueError):
+                self._fail('Bad status line "%s"' % line)
+                return
+            reason = len(parts) > 2 and parts[2] or ''
+            self._response = HTTPResponse(version, status, reason)
+            self._keep_alive = version == 'HTTP/1.1'
+            self._state = 'HEADERS'
+
+        elif self._state == 'HEADERS':
+            if line:
+                name, sep, value = line.partition(':')
+                self._response.headers.append((name.strip().lower(), value.strip()))
+            else:
+                self._headers_complete()
+
+        elif self._state == 'CHUNK_SIZE':
+            try:
+                size = int(line.split(';', 1)[0], 16)
+            except ValueError:
+                self._fail('Bad chunk size "%s"' % line)
+                return
+            if size == 0:
+                self._state = 'TRAILER'
+            else:
+                self._remaining = size
+                self._state = 'CHUNK'
+                self.setRawMode()
+
+        elif self._state == 'CHUNK_END':
+            self._state = 'CHUNK_SIZE'
+
+        elif self._state == 'TRAILER':
+            if not line:
+                self._finish()
+
+        else:
+            log.warn('Unexpected data from %s: "%s"' % (self.pool_key, line))
+            self.persistent = False
+            self.transport.loseConnection()
+
+    def _headers_complete(self):
+        response = self._response
+
+        # Interim response (100 Continue), the real one follows
+        if 100 <= response.status < 200:
+            self._state = 'STATUS'
+            return
+
+        connection = (response.getheader('connection') or '').lower()
+        if connection == 'close':
+            self._keep_alive = False
+        elif connection == 'keep-alive':
+            self._keep_alive = True
+
+        if self._method == 'HEAD' or response.status in (204, 304):
+            self._finish()
+            return
+
+        encoding = (response.getheader('transfer-encoding') or '').lower()
+        length = response.getheader('content-length')
+        if encoding == 'chunked':
+            self._state = 'CHUNK_SIZE'
+        elif length is not None:
+            try:
+                self._remaining = int(length)
+            except ValueError:
+                self._fail('Bad content-length "%s"' % length)
+                return
+            if self._remaining == 0:
+                self._finish()
+            else:
+                self._state = 'BODY'
+                self.setRawMode()
+        else:
+            # Body ends when the server closes the connection
+            self._keep_alive = False
+            self._remaining = None
+            self._state = 'BODY'
+            self.setRawMode()
+
+    def rawDataReceived(self, data):
+        if self._state == 'BODY':
+            if self._remaining is None:
+                self._deliver(data)
+                return
+            part, rest = data[:self._remaining], data[self._remaining:]
+            self._remaining -= len(part)
+            self._deliver(part)
+            if self._remaining == 0:
+                self._finish(rest)
+
+        elif self._state == 'CHUNK':
+            part, rest = data[:self._remaining], data[self._remaining:]
+            self._remaining -= len(part)
+            self._deliver(part)
+            if self._remaining == 0:
+                self._state = 'CHUNK_END'
+                self.setLineMode(rest)
+
+        elif data:
+            log.warn('Unexpected data from %s' % str(self.pool_key))
+            self.persistent = False
+            self.transport.loseConnection()
+
+    def _deliver(self, data):
+        if not data:
+            return
+        if self._consumer is not None:
+            self._consumer(data)
+        else:
+            self._body.append(data)
+
+    def _finish(self, rest=''):
+        response = self._response
+        if self._consumer is None:
+            response.body = ''.join(self._body)
+
+        if rest or not self._keep_alive:
+            self.persistent = False
+            self.transport.loseConnection()
+
+        d, self._finished = self._finished, None
+        self._reset()
+        self.setLineMode()
+        d.callback(response)
+
+    def _fail(self, reason, error_class=HTTPClientError):
+        self.persistent = False
+        d, self._finished = self._finished, None
+        self._reset()
+        self.transport.loseConnection()
+        if d is not None:
+            d.errback(error_class(reason))
+
+    def connectionLost(self, reason):
+        self.persistent = False
+        if self._finished is not None:
+            if self._state == 'BODY' and self._remaining is None:
+                self._finish()
+            elif self._state == 'STATUS' and self.requests > 1:
+                self._fail('Connection closed: %s' % reason.getErrorMessage(),
+                           StaleConnectionError)
+            else:
+                self._fail('Connection lost: %s' % reason.getErrorMessage())
+        if self.pool is not None:
+            self.pool._connection_lost(self)
+
+
+class HTTPConnectionPool(object):
+    """
+    Keep-alive HTTP connections, at most max_per_host to each host and port.
+    Requests beyond that wait for a connection to come free. Idle connections
+    are closed after idle_timeout seconds.
+    """
+    def __init__(self, max_per_host=CF_max_per_host, idle_timeout=CF_idle_timeout,
+                 connect_timeout=CF_connect_timeout):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+
+        # (host, port) -> list of idle protocols
+        self._idle = {}
+        # (host, port) -> number of connections, open or opening
+        self._count = {}
+        # (host, port) -> list of Deferreds waiting for a connection
+        self._waiting = {}
+
+    def request(self, method, url, headers=None, consumer=None):
+        """
+        Sends a request for an http URL on a pooled connection.
+        @param consumer optional callable given each chunk of the body
+        @retval Deferred which fires with an HTTPResponse
+        """
+        src = urlparse.urlsplit(url)
+        if src.scheme != 'http' or not src.hostname:
+            return defer.fail(ValueError('Unsupported URL "%s"' % url))
+
+        key = (src.hostname, src.port or 80)
+        path = src.path or '/'
+        if src.query:
+            path = path + '?' + src.query
+        return self._request(key, src.netloc, method, path, headers, consumer)
+
+    @defer.inlineCallbacks
+    def _request(self, key, host, method, path, headers, consumer):
+        for attempt in (1, 2):
+            proto = yield self._acquire(key)
+            try:
+                response = yield proto.request(method, path, host, headers, consumer)
+            except StaleConnectionError:
+                self._release(proto)
+                if attempt == 2:
+                    raise
+                log.debug('Connection to %s:%d was closed, retrying' % key)
+                continue
+            except:
+                self._release(proto)
+                raise
+            self._release(proto)
+            defer.returnValue(response)
+
+    def stats(self, host, port=80):
+        """
+        @retval dict of connection counts for a host
+        """
+        key = (host, port)
+        return {'connections':self._count.get(key, 0),
+                'idle':len(self._idle.get(key, [])),
+                'waiting':len(self._waiting.get(key, []))}
+
+    def close(self):
+        """
+        Closes all idle connections; busy ones close when their request is done.
+        """
+        for idle in self._idle.values():
+            for proto in list(idle):
+                proto.persistent = False
+                proto.transport.loseConnection()
+
+    def _acquire(self, key):
+        idle = self._idle.get(key)
+        while idle:
+            proto = idle.pop()
+            self._cancel_idle(proto)
+            if proto.persistent:
+                return defer.succeed(proto)
+
+        if self._count.get(key, 0) < self.max_per_host:
+            return self._open(key)
+
+        d = defer.Deferred()
+        self._waiting.setdefault(key, []).append(d)
+        return d
+
+    def _open(self, key):
+        self._count[key] = self._count.get(key, 0) + 1
+        creator = protocol.ClientCreator(reactor, HTTPClientProtocol)
+        d = creator.connectTCP(key[0], key[1], self.connect_timeout)
+        def connected(proto):
+            proto.pool = self
+            proto.pool_key = key
+            return proto
+        def failed(reason):
+            self._count[key] -= 1
+            self._next_waiter(key)
+            return reason
+        return d.addCallbacks(connected, failed)
+
+    def _release(self, proto):
+        key = proto.pool_key
+        if not proto.persistent:
+            # The slot is freed when the connection is lost
+            return
+
+        waiting = self._waiting.get(key)
+        if waiting:
+            waiting.pop(0).callback(proto)
+            return
+
+        proto.idle_call = reactor.callLater(self.idle_timeout, self._expire, proto)
+        self._idle.setdefault(key, []).append(proto)
+
+    def _expire(self, proto):
+        proto.idle_call = None
+        proto.persistent = False
+        proto.transport.loseConnection()
+
+    def _cancel_idle(self, proto):
+        if proto.idle_call is not None:
+            if proto.idle_call.active():
+                proto.idle_call.cancel()
+            proto.idle_call = None
+
+    def _connection_lost(self, proto):
+        key = proto.pool_key
+        self._cancel_idle(proto)
+        idle = self._idle.get(key)
+        if idle and proto in idle:
+            idle.remove(proto)
+        self._count[key] -= 1
+        self._next_waiter(key)
+
+    def _next_waiter(self, key):
+        waiting = self._waiting.get(key)
+        if waiting and self._count.get(key, 0) < self.max_per_host:
+            self._open(key).chainDeferred(waiting.pop(0))
+
+
+_pool = None
+
+def get_connection_pool():
+    """
+    @retval the container wide HTTPConnectionPool
+    """
+    global _pool
+    if _pool is None:
+        _pool = HTTPConnectionPool()
+    return _pool
@@ -7,6 +7,7 @@
 """
 
 from twisted.internet import defer, protocol, reactor
+from twisted.internet.error import ProcessExitedAlready
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
 
@@ -144,12 +145,16 @@ class OSProcess(protocol.ProcessProtocol):
         """
         Default implementation of close. Override this in your derived class.
         """
-        if force:
-            self.transport.loseConnection()
-            self.transport.signalProcess("KILL")
-        else:
-            self.transport.closeStdin()
-            self.transport.signalProcess("TERM")
+        # The process may have exited with its pipes still held open by a child
+        try:
+            if force:
+                self.transport.loseConnection()
+                self.transport.signalProcess("KILL")
+            else:
+                self.transport.closeStdin()
+                self.transport.signalProcess("TERM")
+        except ProcessExitedAlready:
+            pass
 
     def connectionMade(self):
         """
@@ -181,7 +186,8 @@ class OSProcess(protocol.ProcessProtocol):
         the exit code, the lines produced on stdout, and the lines on stderr.
         If the exit code is non zero, the errback is raised.
         """
-        log.debug("OSProcess: process ended (exitcode: %d)" % reason.value.exitCode)
+        # exitCode is None if the process was ended by a signal
+        log.debug("OSProcess: process ended (exitcode: %s)" % str(reason.value.exitCode))
 
         # if this was called as a result of a close() call, we need to cancel the timeout so
         # it won't try to kill again
@@ -8,7 +8,6 @@
 
 import sys
 import traceback
-import re
 import time
 import uuid
 
@@ -19,6 +18,7 @@ log = ion.util.ionlog.getLogger(__name__)
 
 from ion.core import ioninit
 from ion.core.id import Id
+from ion.core.messaging import message_trace
 from ion.data.store import Store
 
 def log_attributes(obj):
@@ -32,42 +32,11 @@ def log_attributes(obj):
 
 def log_message(msg):
     """
-    Log an inbound message with all headers unless quiet attribute set.
+    Log an inbound message with all headers unless quiet attribute set. The
+    message is only formatted if a handler emits the record.
     @param msg  carrot BaseMessage instance
     """
-    body = msg.payload
-    lstr = ""
-    procname = str(body.get('receiver',None))
-    lstr += "===Message=== receiver=%s op=%s===" % (procname, body.get('op', None))
-    if body.get('quiet', False):
-        lstr += " (Q)"
-    else:
-        amqpm = str(msg._amqp_message)
-        # Cut out the redundant or encrypted AMQP body to make log shorter
-        amqpm = re.sub("body='(\\\\'|[^'])*'","*BODY*", amqpm)
-        lstr += '\n---AMQP--- ' + amqpm + "; "
-        for attr in sorted(msg.__dict__.keys()):
-            value = msg.__dict__.get(attr)
-            if attr == '_amqp_message' or attr == 'body' or \
-                    attr == '_decoded_cache' or attr == 'backend':
-                pass
-            else:
-                lstr += "%s=%r, " % (attr, value)
-        lstr += "\n---ION HEADERS--- "
-        mbody = dict(body)
-        content = mbody.pop('content')
-        for attr in sorted(mbody.keys()):
-            value = mbody.get(attr)
-            lstr += "%s=%r, " % (attr, value)
-        lstr += "\n---CONTENT---\n"
-        if type(content) is dict:
-            for attr in sorted(content.keys()):
-                value = content.get(attr)
-                lstr += "%s=%r, " % (attr, value)
-        else:
-            lstr += repr(content)
-        lstr += "\n============="
-    log.debug(lstr)
+    message_trace.log_message(msg, log)
 
 id_seqs = {}
 def create_unique_id(ns):
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+@file ion/util/test/test_cache.py
+@test ion.util.cache LRU bounds, expiry and memoize
+"""
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from ion.util.cache import LRUCache, memoize
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_max_entries(self):
+        cache = LRUCache(max_entries=3)
+        for key in 'abc':
+            cache.put(key, key.upper())
+        self.assertEqual(cache.get('a'), 'A')
+        cache.put('d', 'D')
+        # b was least recently used
+        self.assertEqual(cache.keys(), ['c', 'a', 'd'])
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.evictions, 1)
+
+        cache.put('c', 'C2')
+        self.assertEqual(cache.keys(), ['a', 'd', 'c'])
+        self.assertEqual(cache.pop('a'), 'A')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_max_bytes(self):
+        cache = LRUCache(max_bytes=10)
+        cache.put('a', 'xxxx')
+        cache.put('b', 'xxxx')
+        self.assertEqual(cache.bytes, 8)
+        cache.put('c', 'xxxx')
+        self.assertEqual(cache.keys(), ['b', 'c'])
+        self.assertEqual(cache.bytes, 8)
+        # Too large on its own, not cached and nothing evicted
+        cache.put('d', 'x' * 11)
+        self.assertEqual(cache.keys(), ['b', 'c'])
+        self.assertEqual(cache.rejections, 1)
+        cache.put('b', 'x')
+        self.assertEqual(cache.bytes, 5)
+
+    def test_ttl(self):
+        clock = Clock()
+        cache = LRUCache(ttl=10, clock=clock)
+        cache.put('a', 1)
+        cache.put('b', 2, ttl=0)
+        cache.put('c', 3, ttl=100)
+        clock.now += 20
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.expirations, 1)
+        self.assertEqual(cache.get('b'), 2)
+        clock.now += 100
+        cache.collect()
+        self.assertEqual(cache.keys(), ['b'])
+        self.assertEqual(cache.expirations, 2)
+
+
+class MemoizeTest(unittest.TestCase):
+
+    def test_memoize(self):
+        calls = []
+        @memoize(0, max_entries=2)
+        def square(x, offset=0):
+            calls.append(x)
+            return x * x + offset
+
+        self.assertEqual(square(2), 4)
+        self.assertEqual(square(2), 4)
+        self.assertEqual(square(2, offset=1), 5)
+        self.assertEqual(calls, [2, 2])
+        square(3)
+        square(4)
+        self.assertEqual(len(square.cache), 2)
+        self.assertEqual(square.cache.evictions, 2)
+
+        self.assertEqual(square.__name__, 'square')
+
+        @memoize(max_bytes=10)
+        def text(n):
+            return 'x' * n
+        text(4)
+        text(5)
+        self.assertEqual(text.cache.bytes, 9)
+
+        # Unhashable arguments are passed through
+        @memoize()
+        def length(value):
+            return len(value)
+        self.assertEqual(length([1, 2]), 2)
+        self.assertEqual(len(length.cache), 0)
+
+    def test_memoize_timeout(self):
+        calls = []
+        @memoize(10)
+        def value(x):
+            calls.append(x)
+            return x
+        clock = Clock()
+        value.cache.clock = clock
+        value(1)
+        value(1)
+        clock.now += 20
+        value(1)
+        self.assertEqual(calls, [1, 1])
+
+    @defer.inlineCallbacks
+    def test_memoize_deferred(self):
+        pending = []
+        @memoize()
+        def fetch(key):
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+
+        d1 = fetch('a')
+        d2 = fetch('a')
+        self.assertEqual(len(pending), 1)
+        pending[0].callback('A')
+        self.assertEqual((yield d1), 'A')
+        self.assertEqual((yield d2), 'A')
+        self.assertEqual((yield fetch('a')), 'A')
+        self.assertEqual(len(pending), 1)
+        stats = fetch.cache.stats()
+        self.assertEqual(stats['shared'], 1)
+        self.assertEqual(stats['hits'], 1)
+
+        # Failures are shared too, but not cached
+        d1 = fetch('b')
+        d2 = fetch('b')
+        pending[1].errback(ValueError('b'))
+        yield self.assertFailure(d1, ValueError)
+        yield self.assertFailure(d2, ValueError)
+        fetch('b')
+        self.assertEqual(len(pending), 3)
+        pending[2].callback('B')
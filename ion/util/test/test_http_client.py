@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+@file ion/util/test/test_http_client.py
+@test ion.util.http_client Keep-alive client and connection pool, against a
+local twisted.web server
+"""
+
+import ion.util.ionlog
+log = ion.util.ionlog.getLogger(__name__)
+
+from twisted.internet import defer, protocol, reactor
+from twisted.web import resource, server
+
+from ion.test.iontest import IonTestCase
+from ion.util.http_client import HTTPConnectionPool, HTTPClientError
+
+
+class PageResource(resource.Resource):
+    """
+    Serves fixed pages after a delay, and keeps count of the requests in
+    progress at once. Pages ending in '.chunked' are sent chunked.
+    """
+    isLeaf = True
+
+    def __init__(self, pages, delay=0.05):
+        resource.Resource.__init__(self)
+        self.pages = pages
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+        self.requests = 0
+
+    def render_GET(self, request):
+        page = self.pages.get(request.path)
+        if page is None:
+            request.setResponseCode(404)
+            return 'Not found'
+        self.requests += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+
+        def finish():
+            self.active -= 1
+            if not request.path.endswith('.chunked'):
+                request.setHeader('content-length', str(len(page)))
+            # Several writes, so the client sees the body in pieces
+            for i in range(0, len(page), 1000):
+                request.write(page[i:i+1000])
+            request.finish()
+        reactor.callLater(self.delay, finish)
+        return server.NOT_DONE_YET
+
+    def render_HEAD(self, request):
+        request.setHeader('content-length', '0')
+        return ''
+
+
+class BadStatusProtocol(protocol.Protocol):
+    """
+    Answers any request with something which is not HTTP
+    """
+    def dataReceived(self, data):
+        self.transport.write('Not HTTP at all\r\n\r\n')
+
+
+class CountingSite(server.Site):
+    """
+    Site which counts the client connections made to it
+    """
+    connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return server.Site.buildProtocol(self, addr)
+
+
+def start_test_server(pages, delay=0.05):
+    """
+    @retval (port, site, resource) of a local HTTP server on a free port
+    """
+    res = PageResource(pages, delay)
+    site = CountingSite(res)
+    port = reactor.listenTCP(0, site, interface='127.0.0.1')
+    return port, site, res
+
+
+class HTTPConnectionPoolTest(IonTestCase):
+
+    def setUp(self):
+        self.pages = {'/small':'Now is the time for all good men',
+                      '/big.chunked':'x' * 50000 + 'end'}
+        self.port, self.site, self.res = start_test_server(self.pages)
+        self.base = 'http://127.0.0.1:%d' % self.port.getHost().port
+        self.pool = HTTPConnectionPool(max_per_host=2)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        self.pool.close()
+        yield self.port.stopListening()
+        # Let the closed connections finish
+        d = defer.Deferred()
+        reactor.callLater(0.05, d.callback, None)
+        yield d
+
+    @defer.inlineCallbacks
+    def test_keep_alive(self):
+        for i in range(3):
+            res = yield self.pool.request('GET', self.base + '/small')
+            self.assertEqual(res.status, 200)
+            self.assertEqual(res.body, self.pages['/small'])
+            self.assertEqual(res.getheader('Content-Length'), str(len(res.body)))
+        self.assertEqual(self.site.connections, 1)
+        self.assertEqual(self.pool.stats('127.0.0.1', self.port.getHost().port)['idle'], 1)
+
+    @defer.inlineCallbacks
+    def test_chunked_stream(self):
+        chunks = []
+        res = yield self.pool.request('GET', self.base + '/big.chunked',
+                                      consumer=chunks.append)
+        self.assertEqual(res.body, None)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(''.join(chunks), self.pages['/big.chunked'])
+
+        # The connection is still good after a chunked body
+        res = yield self.pool.request('GET', self.base + '/small')
+        self.assertEqual(res.body, self.pages['/small'])
+        self.assertEqual(self.site.connections, 1)
+
+    @defer.inlineCallbacks
+    def test_limit_per_host(self):
+        fetches = [self.pool.request('GET', self.base + '/small') for i in range(5)]
+        results = yield defer.gatherResults(fetches)
+        self.assertEqual([r.status for r in results], [200] * 5)
+        self.assertEqual(self.res.max_active, 2)
+        self.assertEqual(self.site.connections, 2)
+
+    @defer.inlineCallbacks
+    def test_404_and_head(self):
+        res = yield self.pool.request('GET', self.base + '/missing')
+        self.assertEqual(res.status, 404)
+        res = yield self.pool.request('HEAD', self.base + '/small')
+        self.assertEqual(res.status, 200)
+        self.assertEqual(res.body, '')
+
+    @defer.inlineCallbacks
+    def test_server_closed_connection(self):
+        yield self.pool.request('GET', self.base + '/small')
+        # Server side drops the idle connection, the pool reconnects
+        for proto in self.pool._idle.values()[0]:
+            proto.transport.loseConnection()
+        d = defer.Deferred()
+        reactor.callLater(0.05, d.callback, None)
+        yield d
+        res = yield self.pool.request('GET', self.base + '/small')
+        self.assertEqual(res.body, self.pages['/small'])
+
+    def test_bad_url(self):
+        return self.assertFailure(self.pool.request('GET', 'ftp://example.com/'),
+                                  ValueError)
+
+    @defer.inlineCallbacks
+    def test_bad_response(self):
+        factory = protocol.ServerFactory()
+        factory.protocol = BadStatusProtocol
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        try:
+            url = 'http://127.0.0.1:%d/small' % port.getHost().port
+            yield self.assertFailure(self.pool.request('GET', url), HTTPClientError)
+        finally:
+            yield port.stopListening()